@@ -0,0 +1,147 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Measure the forward latency of a model and fit the latency model of the
+simulated model agent.
+
+Usage:
+    python benchmark/profile_latency_model.py internlm/internlm2_5-7b-chat \
+        --output latency.json
+    lmdeploy serve api_server internlm/internlm2_5-7b-chat --backend pytorch \
+        --device cpu --simulated-model deterministic \
+        --simulated-latency-model latency.json
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+import torch
+
+from lmdeploy.cli.utils import ArgumentHelper, DefaultsAndTypesHelpFormatter
+from lmdeploy.messages import PytorchEngineConfig
+from lmdeploy.pytorch.devices import DeviceContext, get_device_manager
+from lmdeploy.pytorch.engine.cache_engine import CacheEngine
+from lmdeploy.pytorch.engine.engine import _build_backend_config, _build_cache_config
+from lmdeploy.pytorch.engine.model_agent import build_model_agent
+from lmdeploy.pytorch.engine.simulated_agent import LatencyModel
+from lmdeploy.pytorch.model_inputs import ModelInputs
+from lmdeploy.utils import get_logger
+
+get_logger('lmdeploy').setLevel('ERROR')
+
+
+def make_inputs(batch_size: int, q_len: int, history_len: int, block_size: int, num_blocks: int, vocab_size: int,
+                is_decoding: bool):
+    """inputs of sequences of the same length, the blocks are shared by the
+    sequences since only the latency matters."""
+    num_seq_blocks = (history_len + q_len + block_size - 1) // block_size
+    assert num_seq_blocks <= num_blocks, 'no enough cache blocks for the sequence'
+    block_offsets = torch.arange(num_seq_blocks)[None].expand(batch_size, -1)
+    return ModelInputs(input_ids=torch.randint(1, vocab_size, (1, batch_size * q_len)),
+                       seq_length=torch.full((batch_size, ), q_len),
+                       history_lengths=torch.full((batch_size, ), history_len),
+                       block_offsets=block_offsets.contiguous(),
+                       is_decoding=is_decoding,
+                       num_ignored_history=torch.zeros(batch_size, dtype=torch.long))
+
+
+async def measure(agent, device_context: DeviceContext, inputs: ModelInputs, repeat: int):
+    """measure the mean latency of the forward and the logits of the last
+    tokens."""
+    num_tokens, attention = LatencyModel.get_features(inputs)
+    inputs = inputs.to_device(device_context.device)
+    last_token_loc = inputs.seq_length.cumsum(0) - 1
+    latencies = []
+    for _ in range(repeat + 1):
+        device_context.synchronize()
+        start = time.perf_counter()
+        output = await agent.async_forward(inputs, swap_in_map=dict(), swap_out_map=dict())
+        agent.get_logits(output['hidden_states'][:, last_token_loc])
+        device_context.synchronize()
+        latencies.append(time.perf_counter() - start)
+    # the first forward is warmup
+    return dict(is_decoding=inputs.is_decoding,
+                batch_size=inputs.seq_length.size(0),
+                history_len=int(inputs.history_lengths[0]),
+                num_tokens=num_tokens,
+                attention=attention,
+                latency=float(np.mean(latencies[1:])))
+
+
+async def profile(args):
+    engine_config = PytorchEngineConfig(dtype=args.dtype,
+                                        block_size=args.cache_block_seq_len,
+                                        cache_max_entry_count=args.cache_max_entry_count,
+                                        max_prefill_token_num=max(args.prefill_lens),
+                                        device_type=args.device,
+                                        eager_mode=args.eager_mode)
+    device_context = DeviceContext(device_type=engine_config.device_type)
+    with get_device_manager().context(device_context):
+        agent = build_model_agent(args.model_path,
+                                  cache_config=_build_cache_config(engine_config),
+                                  backend_config=_build_backend_config(engine_config),
+                                  trust_remote_code=True,
+                                  dtype=engine_config.dtype)
+        cache_config = agent.cache_config
+        block_size = cache_config.block_size
+        num_blocks = cache_config.num_gpu_blocks
+        vocab_size = agent.model_config.vocab_size
+
+        samples = []
+        for q_len in args.prefill_lens:
+            inputs = make_inputs(1, q_len, 0, block_size, num_blocks, vocab_size, is_decoding=False)
+            samples.append(await measure(agent, device_context, inputs, args.repeat))
+        for batch_size in args.decode_batches:
+            for history_len in args.context_lens:
+                inputs = make_inputs(batch_size, 1, history_len, block_size, num_blocks, vocab_size, is_decoding=True)
+                samples.append(await measure(agent, device_context, inputs, args.repeat))
+
+    # the free memory to size the same number of cache blocks
+    cache_block_size = CacheEngine.get_cache_block_size(block_size, agent.model_config, 1, cache_config.quant_policy)
+    free_memory = num_blocks * cache_block_size / cache_config.cache_max_entry_count
+    return samples, LatencyModel.fit(samples, free_memory=free_memory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fit the latency model of the simulated model agent',
+                                     formatter_class=DefaultsAndTypesHelpFormatter)
+    parser.add_argument('model_path', type=str, help='the path of the model')
+    parser.add_argument('--output', type=str, default='latency_model.json', help='the json file of the latency model')
+    parser.add_argument('--prefill-lens',
+                        type=int,
+                        nargs='+',
+                        default=[128, 512, 1024, 2048, 4096],
+                        help='prompt lengths of the prefill steps')
+    parser.add_argument('--decode-batches',
+                        type=int,
+                        nargs='+',
+                        default=[1, 8, 32, 64, 128],
+                        help='batch sizes of the decoding steps')
+    parser.add_argument('--context-lens',
+                        type=int,
+                        nargs='+',
+                        default=[128, 1024, 2048],
+                        help='context lengths of the decoding steps')
+    parser.add_argument('--repeat', type=int, default=5, help='number of the measured forwards of each shape')
+    ArgumentHelper.device(parser)
+    ArgumentHelper.eager_mode(parser)
+    ArgumentHelper.dtype(parser)
+    ArgumentHelper.cache_block_seq_len(parser)
+    ArgumentHelper.cache_max_entry_count(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    samples, latency_model = asyncio.run(profile(args))
+    print(f'{"stage":<8}{"batch":>8}{"history":>10}{"tokens":>10}{"latency":>12}{"fitted":>12}')
+    for sample in samples:
+        stage = 'decode' if sample['is_decoding'] else 'prefill'
+        fitted = latency_model.predict(sample['is_decoding'], sample['num_tokens'], sample['attention'])
+        print(f'{stage:<8}{sample["batch_size"]:>8}{sample["history_len"]:>10}{sample["num_tokens"]:>10}'
+              f'{sample["latency"]:>12.5f}{fitted:>12.5f}')
+    latency_model.to_json(args.output)
+    print(f'latency model is saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Profile the throughput of multi-tenant lora traffic as a function of the
+number of adapters and the skew of their popularity.
+
+Each request picks an adapter from a zipf distribution, the i-th adapter is
+picked with probability proportional to `1 / i ** skew`, skew 0 is uniform.
+The requests are sent by `--concurrency` clients in a closed loop.
+
+The adapters are copies of `--adapter-path` under different names. With
+`--simulated-model` no weights are loaded and each distinct adapter in a
+forward costs `--lora-per-adapter` seconds.
+
+Usage:
+    # compare the scheduling policies with the simulated model
+    python benchmark/profile_lora_batching.py /path/to/model --device cpu \
+        --simulated-model deterministic --lora-per-adapter 0.0005 \
+        --num-adapters 1 8 32 128 --skews 0 1 2 --prefill-policy fcfs
+    python benchmark/profile_lora_batching.py /path/to/model --device cpu \
+        --simulated-model deterministic --lora-per-adapter 0.0005 \
+        --num-adapters 1 8 32 128 --skews 0 1 2 --prefill-policy adapter_aware --max-active-adapters 8
+    # a real adapter
+    python benchmark/profile_lora_batching.py /path/to/model --adapter-path /path/to/adapter \
+        --num-adapters 1 8 32 --skews 0 1 --max-lora-slots 16
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+from transformers import AutoTokenizer
+
+from lmdeploy import GenerationConfig, PytorchEngineConfig, pipeline
+from lmdeploy.cli.utils import ArgumentHelper, DefaultsAndTypesHelpFormatter
+from lmdeploy.profiler import Profiler, Session
+
+
+def get_adapter_names(num_adapters: int):
+    """names of the copied adapters."""
+    return [f'adapter{idx}' for idx in range(num_adapters)]
+
+
+def sample_adapters(num_adapters: int, skew: float, num_requests: int, seed: int = 0) -> List[str]:
+    """sample the adapter of each request from a zipf distribution."""
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, num_adapters + 1)**skew
+    indices = rng.choice(num_adapters, size=num_requests, p=weights / weights.sum())
+    names = get_adapter_names(num_adapters)
+    return [names[idx] for idx in indices]
+
+
+class PromptBuilder:
+    """prompts of random tokens, the prefix caches are never hit."""
+
+    def __init__(self, tokenizer, seed: int = 0):
+        self.tokenizer = tokenizer
+        self.rng = random.Random(seed)
+        special_ids = set(tokenizer.all_special_ids)
+        self.token_ids = [i for i in range(len(tokenizer)) if i not in special_ids]
+
+    def build(self, length: int):
+        """text of random tokens."""
+        return self.tokenizer.decode(self.rng.choices(self.token_ids, k=length))
+
+
+async def run_requests(pipe, prompts: List[str], adapters: List[str], output_len: int, concurrency: int,
+                       profiler: Profiler):
+    """send the requests by `concurrency` clients."""
+    gen_config = GenerationConfig(max_new_tokens=output_len, ignore_eos=True, do_sample=False)
+    queue = asyncio.Queue()
+    for prompt, adapter_name in zip(prompts, adapters):
+        queue.put_nowait((prompt, adapter_name))
+
+    async def _client():
+        while not queue.empty():
+            prompt, adapter_name = queue.get_nowait()
+            sess = profiler.new_session(0, output_len)
+            sess.tick(0)
+            finish_reason = None
+            async for out in pipe.generate(prompt,
+                                           next(pipe._session_id),
+                                           gen_config=gen_config,
+                                           adapter_name=adapter_name,
+                                           stream_response=True,
+                                           sequence_start=True,
+                                           sequence_end=True,
+                                           do_preprocess=False):
+                sess.input_len = out.input_token_len
+                sess.tick(out.generate_token_len)
+                finish_reason = out.finish_reason
+            sess.finish(Session.SUCCESS if finish_reason == 'length' else Session.FAIL)
+
+    profiler.start()
+    await asyncio.gather(*[_client() for _ in range(concurrency)])
+    profiler.finish()
+
+
+def save_results(results: List[Dict], csv_file: str = None, json_file: str = None, config: Dict = None):
+    """save a row of each setting to csv and the config with the results to
+    json."""
+    if csv_file:
+        with open(csv_file, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            for res in results:
+                writer.writerow({k: f'{v:.6g}' if isinstance(v, float) else v for k, v in res.items()})
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(dict(config=config, results=results), f, indent=4)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Profile the throughput of multi-tenant lora traffic',
+                                     formatter_class=DefaultsAndTypesHelpFormatter)
+    parser.add_argument('model_path',
+                        type=str,
+                        help='the path of the model in localhost or '
+                        'the repo_id of the model in huggingface.co')
+    parser.add_argument('--adapter-path',
+                        type=str,
+                        default=None,
+                        help='the lora adapter copied under different names, '
+                        'only optional with the simulated model')
+    parser.add_argument('--num-adapters', type=int, nargs='+', default=[1, 8, 32], help='the adapter counts to sweep')
+    parser.add_argument('--skews', type=float, nargs='+', default=[0, 1], help='the zipf skews to sweep')
+    parser.add_argument('-n', '--num-requests', type=int, default=512, help='number of the requests of a setting')
+    parser.add_argument('-c', '--concurrency', type=int, default=64, help='number of the concurrent clients')
+    parser.add_argument('--input-len', type=int, default=128, help='number of the input tokens')
+    parser.add_argument('--output-len', type=int, default=128, help='number of the output tokens')
+    parser.add_argument('--percentiles', type=int, nargs='+', default=[50, 99], help='the latency percentiles')
+    parser.add_argument('--csv', type=str, default='./profile_lora_batching.csv', help='where to save the csv')
+    parser.add_argument('--json', type=str, default=None, help='where to save the json')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the prompts and the adapters')
+
+    pt_group = parser.add_argument_group('PyTorch engine arguments')
+    ArgumentHelper.eager_mode(pt_group)
+    ArgumentHelper.device(pt_group)
+    ArgumentHelper.simulated_model(pt_group)
+    ArgumentHelper.tp(pt_group)
+    ArgumentHelper.session_len(pt_group, default=4096)
+    ArgumentHelper.cache_max_entry_count(pt_group)
+    ArgumentHelper.max_batch_size(pt_group)
+    ArgumentHelper.dtype(pt_group)
+    pt_group.add_argument('--max-lora-slots',
+                          type=int,
+                          default=None,
+                          help='number of the adapters resident on device, default to all adapters')
+    pt_group.add_argument('--max-active-adapters',
+                          type=int,
+                          default=64,
+                          help='max number of distinct adapters in a step')
+    pt_group.add_argument('--prefill-policy',
+                          type=str,
+                          default='fcfs',
+                          choices=['fcfs', 'cache_aware', 'adapter_aware'],
+                          help='the order to prefill the waiting requests')
+    pt_group.add_argument('--lora-per-adapter',
+                          type=float,
+                          default=None,
+                          help='latency of each distinct adapter in a forward of the simulated model in seconds, '
+                          'overrides the latency model')
+    return parser.parse_args()
+
+
+def build_pipeline(args, tmp_dir: str):
+    """launch the engine with the copies of the adapter."""
+    adapter_path = args.adapter_path
+    latency_model_path = args.simulated_latency_model
+    if args.simulated_model is not None:
+        from lmdeploy.pytorch.engine.simulated_agent import LatencyModel
+        # the simulated model loads no weights of the adapters
+        adapter_path = adapter_path or tmp_dir
+        if args.lora_per_adapter is not None:
+            latency_model = LatencyModel()
+            if latency_model_path is not None:
+                latency_model = LatencyModel.from_json(latency_model_path)
+            latency_model.lora_per_adapter = args.lora_per_adapter
+            latency_model_path = os.path.join(tmp_dir, 'latency.json')
+            latency_model.to_json(latency_model_path)
+    assert adapter_path is not None, '--adapter-path is required without the simulated model'
+
+    adapters = dict((name, adapter_path) for name in get_adapter_names(max(args.num_adapters)))
+    engine_config = PytorchEngineConfig(session_len=args.session_len,
+                                        max_batch_size=args.max_batch_size,
+                                        tp=args.tp,
+                                        cache_max_entry_count=args.cache_max_entry_count,
+                                        eager_mode=args.eager_mode,
+                                        dtype=args.dtype,
+                                        device_type=args.device,
+                                        adapters=adapters,
+                                        max_lora_slots=args.max_lora_slots,
+                                        max_active_adapters=args.max_active_adapters,
+                                        prefill_policy=args.prefill_policy,
+                                        simulated_model=args.simulated_model,
+                                        simulated_latency_model=latency_model_path)
+    return pipeline(args.model_path, backend_config=engine_config, log_level='ERROR')
+
+
+def main():
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pipe = build_pipeline(args, tmp_dir)
+
+        q = args.percentiles[-1]
+        results = []
+        for num_adapters in args.num_adapters:
+            for skew in args.skews:
+                seed = args.seed + len(results)
+                prompt_builder = PromptBuilder(tokenizer, seed=seed)
+                prompts = [prompt_builder.build(args.input_len) for _ in range(args.num_requests)]
+                adapters = sample_adapters(num_adapters, skew, args.num_requests, seed=seed)
+                profiler = Profiler(True, args.percentiles)
+                pipe._run(
+                    coro=run_requests(pipe, prompts, adapters, args.output_len, args.concurrency, profiler)).result()
+                profiler.compute_metrics()
+                results.append(dict(num_adapters=num_adapters, skew=skew, **profiler.to_dict()))
+                res = results[-1]
+                print(f'adapters: {num_adapters:>5}, skew: {skew:>5.2f}, req/s: {res["request_throughput"]:.3f}, '
+                      f'output tok/s: {res["output_throughput"]:.1f}, ttft_p{q}: {res[f"ttft_p{q}"]:.3f}, '
+                      f'tpot_p{q}: {res[f"tpot_p{q}"]:.4f}')
+        pipe.close()
+
+    print(f'\nprefill policy: {args.prefill_policy}, max active adapters: {args.max_active_adapters}')
+    print(f'{"adapters":>10}{"skew":>8}{"req/s":>10}{"tok/s":>12}{f"ttft_p{q}":>12}{f"tpot_p{q}":>12}')
+    for res in results:
+        print(f'{res["num_adapters"]:>10}{res["skew"]:>8.2f}{res["request_throughput"]:>10.3f}'
+              f'{res["output_throughput"]:>12.1f}{res[f"ttft_p{q}"]:>12.3f}{res[f"tpot_p{q}"]:>12.4f}')
+
+    config = dict(vars(args))
+    save_results(results, csv_file=args.csv, json_file=args.json, config=config)
+
+
+if __name__ == '__main__':
+    main()
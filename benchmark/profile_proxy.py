@@ -0,0 +1,178 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Profile the overhead of the proxy server with a stub api_server.
+
+The stub api_server streams tokens without a model, so the difference between
+requesting the stub directly and through the proxy is the overhead of the
+proxy.
+
+Usage:
+python3 benchmark/profile_proxy.py --concurrency 256 --num-requests 1024 --output-len 256
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import time
+
+import aiohttp
+import numpy as np
+import requests
+
+MODEL_NAME = 'stub'
+
+
+def run_stub_server(port: int, token_interval: float):
+    """an api_server that streams fixed tokens."""
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+
+    @app.get('/health')
+    async def health():
+        return JSONResponse(dict())
+
+    @app.get('/v1/models')
+    async def models():
+        return dict(object='list', data=[dict(id=MODEL_NAME, object='model')])
+
+    @app.post('/v1/completions')
+    async def completions(raw_request: Request):
+        request = await raw_request.json()
+        max_tokens = request.get('max_tokens') or 16
+
+        def _chunk(idx: int):
+            finish_reason = 'length' if idx == max_tokens - 1 else None
+            return dict(id='0',
+                        object='text_completion',
+                        model=MODEL_NAME,
+                        choices=[dict(index=0, text=' tok', finish_reason=finish_reason)])
+
+        if not request.get('stream'):
+            return JSONResponse(dict(id='0', model=MODEL_NAME, choices=[dict(index=0, text=' tok' * max_tokens)]))
+
+        async def _stream():
+            for idx in range(max_tokens):
+                if token_interval > 0:
+                    await asyncio.sleep(token_interval)
+                yield f'data: {json.dumps(_chunk(idx))}\n\n'
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(_stream(), media_type='text/event-stream')
+
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='error')
+
+
+def run_proxy_server(port: int, max_connections_per_node: int):
+    """the proxy server."""
+    from lmdeploy.serve.proxy.proxy import proxy
+    proxy(server_name='127.0.0.1',
+          server_port=port,
+          log_level='ERROR',
+          max_connections_per_node=max_connections_per_node)
+
+
+def wait_server(url: str, timeout: float = 60):
+    """wait until the server is ready."""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            if requests.get(f'{url}/v1/models').status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'server {url} is not ready')
+
+
+async def stream_request(session: aiohttp.ClientSession, url: str, output_len: int):
+    """request a stream and return the number of chunks, first token latency
+    and latency."""
+    payload = dict(model=MODEL_NAME, prompt='hi', max_tokens=output_len, stream=True)
+    start = time.perf_counter()
+    ttft = None
+    num_chunks = 0
+    async with session.post(f'{url}/v1/completions', json=payload) as response:
+        async for line in response.content:
+            line = line.strip()
+            if not line or line == b'data: [DONE]':
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            num_chunks += 1
+    return num_chunks, ttft, time.perf_counter() - start
+
+
+async def benchmark(url: str, concurrency: int, num_requests: int, output_len: int):
+    """send the requests with the concurrency."""
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=6 * 60 * 60)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def _limited():
+            async with sem:
+                return await stream_request(session, url, output_len)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[_limited() for _ in range(num_requests)])
+        elapsed = time.perf_counter() - start
+    num_chunks = np.array([res[0] for res in results])
+    ttfts = np.array([res[1] for res in results])
+    latencies = np.array([res[2] for res in results])
+    assert (num_chunks == output_len).all(), 'incomplete streams'
+    return dict(elapsed=elapsed,
+                tokens_per_sec=num_chunks.sum() / elapsed,
+                mean_ttft=ttfts.mean(),
+                mean_token_latency=(latencies / num_chunks).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile the overhead of the proxy server.')
+    parser.add_argument('--concurrency', type=int, default=256, help='number of concurrent streams')
+    parser.add_argument('--num-requests', type=int, default=1024, help='number of requests')
+    parser.add_argument('--output-len', type=int, default=256, help='number of tokens of each stream')
+    parser.add_argument('--token-interval', type=float, default=0.0, help='seconds between tokens of the stub')
+    parser.add_argument('--stub-port', type=int, default=23334, help='port of the stub api_server')
+    parser.add_argument('--proxy-port', type=int, default=8001, help='port of the proxy server')
+    parser.add_argument('--max-connections-per-node',
+                        type=int,
+                        default=512,
+                        help='max number of the connections from the proxy to a node')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    stub = ctx.Process(target=run_stub_server, args=(args.stub_port, args.token_interval), daemon=True)
+    proxy = ctx.Process(target=run_proxy_server, args=(args.proxy_port, args.max_connections_per_node), daemon=True)
+    stub.start()
+    proxy.start()
+    stub_url = f'http://127.0.0.1:{args.stub_port}'
+    proxy_url = f'http://127.0.0.1:{args.proxy_port}'
+    try:
+        wait_server(stub_url)
+        wait_server(proxy_url)
+        requests.post(f'{proxy_url}/nodes/add', json=dict(url=stub_url, status=dict(models=[MODEL_NAME])))
+
+        results = dict()
+        for name, url in [('direct', stub_url), ('proxy', proxy_url)]:
+            # warmup
+            asyncio.run(benchmark(url, args.concurrency, args.concurrency, 4))
+            results[name] = asyncio.run(benchmark(url, args.concurrency, args.num_requests, args.output_len))
+
+        print(f'concurrency={args.concurrency} num_requests={args.num_requests} output_len={args.output_len}')
+        print(f'{"":<8}{"elapsed(s)":>12}{"tokens/s":>12}{"ttft(ms)":>12}{"token(ms)":>12}')
+        for name, res in results.items():
+            print(f'{name:<8}{res["elapsed"]:>12.2f}{res["tokens_per_sec"]:>12.0f}'
+                  f'{res["mean_ttft"] * 1000:>12.2f}{res["mean_token_latency"] * 1000:>12.3f}')
+        overhead = results['proxy']['mean_token_latency'] - results['direct']['mean_token_latency']
+        print(f'proxy overhead per token: {overhead * 1e6:.1f} us')
+    finally:
+        requests.post(f'{proxy_url}/nodes/remove', params=dict(node_url=stub_url))
+        proxy.terminate()
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
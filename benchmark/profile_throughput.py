@@ -199,6 +199,8 @@ def parse_args():
     # pytorch engine args
     pt_group = parser.add_argument_group('PyTorch engine arguments')
     ArgumentHelper.eager_mode(pt_group)
+    ArgumentHelper.device(pt_group)
+    ArgumentHelper.simulated_model(pt_group)
 
     tp_act = ArgumentHelper.tp(pt_group)
     session_len_act = ArgumentHelper.session_len(pt_group, default=4096)
@@ -254,6 +256,9 @@ def main():
             enable_prefix_caching=args.enable_prefix_caching,
             quant_policy=args.quant_policy,
             dtype=args.dtype,
+            device_type=args.device,
+            simulated_model=args.simulated_model,
+            simulated_latency_model=args.simulated_latency_model,
         )
 
     if args.use_uvloop:
@@ -0,0 +1,491 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Replay a request trace against lmdeploy and report the goodput under
+service level objectives.
+
+The trace is a jsonl file, each line is a request:
+    {"timestamp": 0.53, "session_id": "s0", "prefix_group": "sys0", "prefix_len": 512,
+     "input_len": 128, "output_len": 256}
+
+- timestamp (float): arrival time in seconds from the start of the trace.
+- session_id (optional): the turns of a session are sent in order, a turn is
+    sent after the response of the previous turn and carries the prompts and
+    the responses of the previous turns as history.
+- prefix_group, prefix_len (optional): the sessions of a prefix group share a
+    prompt prefix of `prefix_len` tokens, like a system prompt.
+- prompt (optional): the text of the turn, `input_len` random tokens are used
+    otherwise.
+- output_len (int): number of the generated tokens, eos is ignored.
+
+Usage:
+    # synthesize a trace of multi-turn sessions sharing system prompts
+    python benchmark/profile_trace_replay.py trace.jsonl /path/to/model --synthesize \
+        --num-sessions 200 --max-turns 4 --num-prefix-groups 8
+    # sweep the request rate with the in-process AsyncEngine
+    python benchmark/profile_trace_replay.py trace.jsonl /path/to/model \
+        --request-rates 1 2 4 8 --arrival poisson --slo-ttft 1 --slo-tpot 0.05
+    # replay the trace timestamps against an api_server
+    python benchmark/profile_trace_replay.py trace.jsonl /path/to/model \
+        --api-url http://0.0.0.0:23333 --slo-ttft 1
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+from transformers import AutoTokenizer
+
+from lmdeploy import GenerationConfig, PytorchEngineConfig, TurbomindEngineConfig, pipeline
+from lmdeploy.cli.utils import ArgumentHelper, DefaultsAndTypesHelpFormatter
+from lmdeploy.profiler import SLO, Profiler, Session
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+
+@dataclass
+class TraceRequest:
+    """a request of the trace."""
+    timestamp: float
+    input_len: int
+    output_len: int
+    session_id: Optional[str] = None
+    prefix_group: Optional[str] = None
+    prefix_len: int = 0
+    prompt: Optional[str] = None
+
+
+def load_trace(file_path: str, num_requests: int = None) -> List[TraceRequest]:
+    """load the requests of a jsonl trace sorted by the timestamps."""
+    trace = []
+    with open(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                trace.append(TraceRequest(**json.loads(line)))
+    trace.sort(key=lambda req: req.timestamp)
+    return trace[:num_requests] if num_requests else trace
+
+
+def save_trace(trace: List[TraceRequest], file_path: str):
+    """save the requests to a jsonl trace."""
+    with open(file_path, 'w') as f:
+        for req in trace:
+            f.write(json.dumps({k: v for k, v in asdict(req).items() if v is not None}) + '\n')
+
+
+def synthesize_trace(num_sessions: int,
+                     max_turns: int,
+                     num_prefix_groups: int,
+                     prefix_len: int,
+                     input_len: int,
+                     output_len: int,
+                     range_ratio: float,
+                     session_rate: float,
+                     think_time: float,
+                     seed: int = 0) -> List[TraceRequest]:
+    """sessions arrive as a poisson process, the turns of a session are
+    separated by exponential think time."""
+    rng = random.Random(seed)
+
+    def _sample_len(length: int):
+        return max(1, int(length * rng.uniform(1 - range_ratio, 1 + range_ratio)))
+
+    trace = []
+    start = 0.0
+    for sess_id in range(num_sessions):
+        start += rng.expovariate(session_rate)
+        prefix_group = f'group{rng.randrange(num_prefix_groups)}' if num_prefix_groups > 0 else None
+        timestamp = start
+        for _ in range(rng.randint(1, max_turns)):
+            trace.append(
+                TraceRequest(timestamp=round(timestamp, 6),
+                             input_len=_sample_len(input_len),
+                             output_len=_sample_len(output_len),
+                             session_id=f'session{sess_id}',
+                             prefix_group=prefix_group,
+                             prefix_len=prefix_len if prefix_group else 0))
+            timestamp += rng.expovariate(1 / think_time) if think_time > 0 else 0
+    trace.sort(key=lambda req: req.timestamp)
+    return trace
+
+
+def get_arrivals(trace: List[TraceRequest],
+                 arrival: str,
+                 request_rate: float = None,
+                 burstiness: float = 1.0,
+                 seed: int = 0) -> np.ndarray:
+    """arrival times of the requests in seconds.
+
+    Args:
+        trace (List[TraceRequest]): The requests sorted by the timestamps.
+        arrival (str): `trace` rescales the timestamps of the trace to the
+            request rate, `poisson` and `gamma` sample the intervals.
+        request_rate (float): Mean number of requests per second, None keeps
+            the timestamps of the trace.
+        burstiness (float): The shape of the gamma intervals, smaller is
+            burstier, 1 is a poisson process.
+    """
+    num_requests = len(trace)
+    if arrival == 'trace':
+        timestamps = np.array([req.timestamp for req in trace], dtype=np.float64)
+        timestamps -= timestamps[0]
+        if request_rate is None or num_requests < 2 or timestamps[-1] == 0:
+            return timestamps
+        trace_rate = (num_requests - 1) / timestamps[-1]
+        return timestamps * trace_rate / request_rate
+    assert request_rate is not None, f'request rate is required by {arrival} arrival'
+    if arrival == 'poisson':
+        burstiness = 1.0
+    rng = np.random.default_rng(seed)
+    intervals = rng.gamma(burstiness, 1 / (burstiness * request_rate), num_requests)
+    intervals[0] = 0
+    return np.cumsum(intervals)
+
+
+class PromptBuilder:
+    """build the prompts of the requests, the text of random tokens is
+    generated once for each prefix group and each turn."""
+
+    def __init__(self, tokenizer, seed: int = 0):
+        self.tokenizer = tokenizer
+        self.rng = random.Random(seed)
+        special_ids = set(tokenizer.all_special_ids)
+        self.token_ids = [i for i in range(len(tokenizer)) if i not in special_ids]
+        self.prefixes: Dict[str, str] = dict()
+        self.histories: Dict[str, str] = dict()
+
+    def random_text(self, length: int):
+        """text of random tokens."""
+        return self.tokenizer.decode(self.rng.choices(self.token_ids, k=length))
+
+    def build(self, req: TraceRequest):
+        """the prompt of a request, the prefix and the history come first."""
+        text = req.prompt if req.prompt is not None else self.random_text(req.input_len)
+        prefix = ''
+        if req.prefix_group is not None:
+            if req.prefix_group not in self.prefixes:
+                self.prefixes[req.prefix_group] = self.random_text(req.prefix_len)
+            prefix = self.prefixes[req.prefix_group]
+        history = self.histories.get(req.session_id, '') if req.session_id is not None else ''
+        return prefix + history, text
+
+    def update(self, req: TraceRequest, text: str, response: str):
+        """append a finished turn to the history of the session."""
+        if req.session_id is not None:
+            self.histories[req.session_id] = self.histories.get(req.session_id, '') + text + response
+
+
+def _to_status(finish_reason: str):
+    return Session.SUCCESS if finish_reason == 'length' else Session.FAIL
+
+
+class PipelineClient:
+    """send the requests to an in-process AsyncEngine."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def run(self, coro):
+        """run a coroutine on the event loop of the engine."""
+        return self.pipe._run(coro=coro).result()
+
+    async def request(self, prompt: str, output_len: int, sess: Session):
+        gen_config = GenerationConfig(max_new_tokens=output_len, ignore_eos=True, do_sample=False)
+        session_id = next(self.pipe._session_id)
+        response = ''
+        finish_reason = None
+        async for out in self.pipe.generate(prompt,
+                                            session_id,
+                                            gen_config=gen_config,
+                                            stream_response=True,
+                                            sequence_start=True,
+                                            sequence_end=True,
+                                            do_preprocess=False):
+            sess.input_len = out.input_token_len
+            sess.tick(out.generate_token_len)
+            response += out.response
+            finish_reason = out.finish_reason
+        sess.finish(_to_status(finish_reason))
+        return response
+
+
+class OpenAIClient:
+    """send the requests to the completions endpoint of an api_server."""
+
+    def __init__(self, api_url: str, model_name: str = None, max_connections: int = 1024):
+        self.api_url = api_url.rstrip('/')
+        self.model_name = model_name
+        self.max_connections = max_connections
+        self.http = None
+
+    def run(self, coro):
+        """run a coroutine with a connection pool."""
+
+        async def _run():
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            timeout = aiohttp.ClientTimeout(total=6 * 60 * 60)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+                self.http = http
+                if self.model_name is None:
+                    async with http.get(f'{self.api_url}/v1/models') as response:
+                        self.model_name = (await response.json())['data'][0]['id']
+                return await coro
+
+        return asyncio.run(_run())
+
+    async def request(self, prompt: str, output_len: int, sess: Session):
+        payload = dict(model=self.model_name,
+                       prompt=prompt,
+                       max_tokens=output_len,
+                       ignore_eos=True,
+                       temperature=0,
+                       stream=True,
+                       stream_options=dict(include_usage=True))
+        response = ''
+        finish_reason = None
+        try:
+            async with self.http.post(f'{self.api_url}/v1/completions', json=payload) as resp:
+                if resp.status != 200:
+                    logger.error(f'request failed with status {resp.status}: {await resp.text()}')
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line.startswith(b'data: ') or line == b'data: [DONE]':
+                        continue
+                    chunk = json.loads(line[len(b'data: '):])
+                    usage = chunk.get('usage') or dict()
+                    sess.input_len = usage.get('prompt_tokens', sess.input_len)
+                    sess.tick(usage.get('completion_tokens', sess.ns[-1] + 1))
+                    for choice in chunk['choices']:
+                        response += choice['text']
+                        finish_reason = choice.get('finish_reason') or finish_reason
+        except aiohttp.ClientError as e:
+            logger.error(f'request failed: {e}')
+        sess.finish(_to_status(finish_reason))
+        return response
+
+
+async def replay(client, trace: List[TraceRequest], arrivals: np.ndarray, prompts: PromptBuilder, profiler: Profiler):
+    """send the requests at the arrival times, the turns of a session wait for
+    the previous turns.
+
+    The latencies are measured from the time a request is sent, the delay of
+    the turns waiting for the previous ones is logged.
+    """
+    last_turns: Dict[str, asyncio.Task] = dict()
+    delays = []
+
+    async def _send(req: TraceRequest, arrival: float, prev_turn: asyncio.Task):
+        await asyncio.sleep(max(0, start + arrival - time.perf_counter()))
+        if prev_turn is not None:
+            await prev_turn
+        delays.append(time.perf_counter() - start - arrival)
+        history, text = prompts.build(req)
+        sess = profiler.new_session(0, req.output_len)
+        sess.tick(0)
+        response = await client.request(history + text, req.output_len, sess)
+        prompts.update(req, text, response)
+
+    profiler.start()
+    start = time.perf_counter()
+    tasks = []
+    for req, arrival in zip(trace, arrivals):
+        prev_turn = last_turns.get(req.session_id) if req.session_id is not None else None
+        task = asyncio.create_task(_send(req, arrival, prev_turn))
+        if req.session_id is not None:
+            last_turns[req.session_id] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    profiler.finish()
+    return float(np.mean(delays))
+
+
+def save_results(results: List[Dict], csv_file: str = None, json_file: str = None, config: Dict = None):
+    """save a row of each request rate to csv and the config with the results
+    to json."""
+    if csv_file:
+        keys = list(results[0].keys())
+        with open(csv_file, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            for res in results:
+                writer.writerow({k: f'{v:.6g}' if isinstance(v, float) else v for k, v in res.items()})
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(dict(config=config, results=results), f, indent=4)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay a request trace and report the goodput under SLOs',
+                                     formatter_class=DefaultsAndTypesHelpFormatter)
+    parser.add_argument('trace', type=str, help='the path of the jsonl trace')
+    parser.add_argument('model_path',
+                        type=str,
+                        help='the path of the model in localhost or '
+                        'the repo_id of the model in huggingface.co')
+    parser.add_argument('--api-url',
+                        type=str,
+                        default=None,
+                        help='the url of an api_server, the engine is launched in-process if not set')
+    parser.add_argument('--model-name', type=str, default=None, help='the served model name of the api_server')
+    parser.add_argument('-n', '--num-requests', type=int, default=None, help='replay the first n requests')
+    parser.add_argument('--request-rates',
+                        type=float,
+                        nargs='+',
+                        default=None,
+                        help='the request rates to sweep, the trace timestamps are replayed if not set')
+    parser.add_argument('--arrival',
+                        type=str,
+                        default='trace',
+                        choices=['trace', 'poisson', 'gamma'],
+                        help='`trace` rescales the trace timestamps to the request rate, '
+                        '`poisson` and `gamma` sample the arrival intervals')
+    parser.add_argument('--burstiness',
+                        type=float,
+                        default=1.0,
+                        help='the shape of the gamma intervals, smaller is burstier')
+    parser.add_argument('--slo-ttft', type=float, default=None, help='SLO of the time to the first token in seconds')
+    parser.add_argument('--slo-tpot', type=float, default=None, help='SLO of the time per output token in seconds')
+    parser.add_argument('--slo-e2e', type=float, default=None, help='SLO of the end-to-end latency in seconds')
+    parser.add_argument('--slo-attainment',
+                        type=float,
+                        default=0.99,
+                        help='the ratio of requests meeting the SLOs to sustain a request rate')
+    parser.add_argument('--percentiles', type=int, nargs='+', default=[50, 90, 99], help='the latency percentiles')
+    parser.add_argument('--csv', type=str, default='./profile_trace_replay.csv', help='where to save the csv')
+    parser.add_argument('--json', type=str, default=None, help='where to save the json')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the random prompts and arrivals')
+
+    # synthetic trace args
+    syn_group = parser.add_argument_group('Synthetic trace arguments')
+    syn_group.add_argument('--synthesize',
+                           action='store_true',
+                           help='synthesize a trace and save it to the trace path before replaying')
+    syn_group.add_argument('--num-sessions', type=int, default=200, help='number of the sessions')
+    syn_group.add_argument('--max-turns', type=int, default=4, help='max number of the turns of a session')
+    syn_group.add_argument('--num-prefix-groups', type=int, default=8, help='number of the shared prefixes')
+    syn_group.add_argument('--prefix-len', type=int, default=512, help='number of the tokens of a shared prefix')
+    syn_group.add_argument('--input-len', type=int, default=256, help='mean number of the input tokens of a turn')
+    syn_group.add_argument('--output-len', type=int, default=256, help='mean number of the output tokens of a turn')
+    syn_group.add_argument('--range-ratio', type=float, default=0.5, help='the range of the sampled lengths')
+    syn_group.add_argument('--session-rate', type=float, default=1.0, help='number of new sessions per second')
+    syn_group.add_argument('--think-time', type=float, default=5.0, help='mean seconds between the turns')
+
+    ArgumentHelper.backend(parser)
+    # pytorch engine args
+    pt_group = parser.add_argument_group('PyTorch engine arguments')
+    ArgumentHelper.eager_mode(pt_group)
+    ArgumentHelper.device(pt_group)
+    ArgumentHelper.simulated_model(pt_group)
+
+    tp_act = ArgumentHelper.tp(pt_group)
+    session_len_act = ArgumentHelper.session_len(pt_group, default=8192)
+    cache_count_act = ArgumentHelper.cache_max_entry_count(pt_group)
+    cache_block_seq_len_act = ArgumentHelper.cache_block_seq_len(pt_group)
+    prefix_caching_act = ArgumentHelper.enable_prefix_caching(pt_group)
+    max_batch_size_act = ArgumentHelper.max_batch_size(pt_group)
+    dtype_act = ArgumentHelper.dtype(pt_group)
+
+    # turbomind engine args
+    tb_group = parser.add_argument_group('TurboMind engine argument')
+    tb_group._group_actions.append(tp_act)
+    tb_group._group_actions.append(session_len_act)
+    tb_group._group_actions.append(cache_count_act)
+    tb_group._group_actions.append(cache_block_seq_len_act)
+    tb_group._group_actions.append(prefix_caching_act)
+    tb_group._group_actions.append(max_batch_size_act)
+    tb_group._group_actions.append(dtype_act)
+    ArgumentHelper.model_format(tb_group, default='hf')
+
+    args = parser.parse_args()
+    return args
+
+
+def build_client(args):
+    if args.api_url is not None:
+        return OpenAIClient(args.api_url, args.model_name)
+    if args.backend == 'turbomind':
+        engine_config = TurbomindEngineConfig(session_len=args.session_len,
+                                              max_batch_size=args.max_batch_size,
+                                              tp=args.tp,
+                                              cache_max_entry_count=args.cache_max_entry_count,
+                                              cache_block_seq_len=args.cache_block_seq_len,
+                                              model_format=args.model_format,
+                                              enable_prefix_caching=args.enable_prefix_caching,
+                                              dtype=args.dtype)
+    else:
+        engine_config = PytorchEngineConfig(session_len=args.session_len,
+                                            max_batch_size=args.max_batch_size,
+                                            tp=args.tp,
+                                            cache_max_entry_count=args.cache_max_entry_count,
+                                            block_size=args.cache_block_seq_len,
+                                            eager_mode=args.eager_mode,
+                                            enable_prefix_caching=args.enable_prefix_caching,
+                                            dtype=args.dtype,
+                                            device_type=args.device,
+                                            simulated_model=args.simulated_model,
+                                            simulated_latency_model=args.simulated_latency_model)
+    return PipelineClient(pipeline(args.model_path, backend_config=engine_config, log_level='ERROR'))
+
+
+def main():
+    args = parse_args()
+    if args.synthesize:
+        trace = synthesize_trace(args.num_sessions,
+                                 args.max_turns,
+                                 args.num_prefix_groups,
+                                 args.prefix_len,
+                                 args.input_len,
+                                 args.output_len,
+                                 args.range_ratio,
+                                 args.session_rate,
+                                 args.think_time,
+                                 seed=args.seed)
+        save_trace(trace, args.trace)
+        print(f'synthetic trace of {len(trace)} requests is saved to {args.trace}')
+    trace = load_trace(args.trace, args.num_requests)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    client = build_client(args)
+    slo = SLO(ttft=args.slo_ttft, tpot=args.slo_tpot, e2e=args.slo_e2e)
+
+    results = []
+    request_rates = args.request_rates or [None]
+    for idx, request_rate in enumerate(request_rates):
+        arrivals = get_arrivals(trace, args.arrival, request_rate, args.burstiness, seed=args.seed + idx)
+        # new random prompts for each run, the prefix cache of the previous run is not hit
+        prompts = PromptBuilder(tokenizer, seed=args.seed + idx)
+        profiler = Profiler(True, args.percentiles)
+        mean_delay = client.run(replay(client, trace, arrivals, prompts, profiler))
+        profiler.compute_metrics()
+        profiler.compute_goodput(slo)
+        rate_name = 'trace' if request_rate is None else request_rate
+        profiler.summarize(title=f'Trace Replay (request rate: {rate_name})',
+                           hyperparams=[('Mean session turn delay (s)', mean_delay)])
+        results.append(dict(request_rate=rate_name, mean_turn_delay=mean_delay, **profiler.to_dict()))
+
+    print(f'\nSLO: {slo}, attainment >= {args.slo_attainment}')
+    print(f'{"rate":>10}{"req/s":>10}{"goodput":>10}{"attain":>10}'
+          f'{f"ttft_p{args.percentiles[-1]}":>12}{f"tpot_p{args.percentiles[-1]}":>12}')
+    q = args.percentiles[-1]
+    sustained = None
+    for res in results:
+        rate = res['request_rate']
+        print(f'{rate:>10}{res["request_throughput"]:>10.3f}{res["goodput"]:>10.3f}{res["slo_attainment"]:>10.3f}'
+              f'{res[f"ttft_p{q}"]:>12.3f}{res[f"tpot_p{q}"]:>12.4f}')
+        if res['slo_attainment'] >= args.slo_attainment and rate != 'trace':
+            sustained = rate if sustained is None else max(sustained, rate)
+    if args.request_rates:
+        print(f'max request rate meeting the SLO: {sustained}')
+
+    config = dict(vars(args), trace=os.path.abspath(args.trace), num_requests=len(trace), slo=asdict(slo))
+    save_results(results, csv_file=args.csv, json_file=args.json, config=config)
+
+
+if __name__ == '__main__':
+    main()
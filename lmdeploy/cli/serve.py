@@ -124,6 +124,11 @@ class SubCliServe:
                             'engine’s tasks once the maximum number of concurrent requests is '
                             'reached, regardless of any additional requests sent by clients '
                             'concurrently during that time. Default to None.')
+        parser.add_argument('--num-tokenizer-workers',
+                            type=int,
+                            default=4,
+                            help='The number of threads that render chat templates and tokenize '
+                            'prompts off the event loop')
         # common args
         ArgumentHelper.backend(parser)
         ArgumentHelper.log_level(parser)
@@ -144,8 +149,10 @@ class SubCliServe:
         pt_group = parser.add_argument_group('PyTorch engine arguments')
 
         ArgumentHelper.adapters(pt_group)
+        ArgumentHelper.lora_slots(pt_group)
         ArgumentHelper.device(pt_group)
         ArgumentHelper.eager_mode(pt_group)
+        ArgumentHelper.simulated_model(pt_group)
 
         # common engine args
         dtype_act = ArgumentHelper.dtype(pt_group)
@@ -206,9 +213,23 @@ class SubCliServe:
         parser.add_argument('--server-port', type=int, default=8000, help='Server port of the proxy')
         parser.add_argument('--strategy',
                             type=str,
-                            choices=['random', 'min_expected_latency', 'min_observed_latency'],
+                            choices=['random', 'min_expected_latency', 'min_observed_latency', 'prefix_affinity'],
                             default='min_expected_latency',
                             help='the strategy to dispatch requests to nodes')
+        parser.add_argument('--max-connections-per-node',
+                            type=int,
+                            default=512,
+                            help='the max number of the connections to a node, requests '
+                            'exceeding the limit wait for a free connection')
+        parser.add_argument('--max-queue-depth',
+                            type=int,
+                            default=None,
+                            help='requests are rejected with 429 when the waiting requests '
+                            'of every node exceed it. Default to no limit')
+        parser.add_argument('--health-check-interval',
+                            type=float,
+                            default=5,
+                            help='seconds between the health probes of the nodes')
         ArgumentHelper.api_keys(parser)
         ArgumentHelper.ssl(parser)
         ArgumentHelper.log_level(parser)
@@ -283,11 +304,16 @@ class SubCliServe:
                                                  block_size=args.cache_block_seq_len,
                                                  session_len=args.session_len,
                                                  adapters=adapters,
+                                                 max_lora_slots=args.max_lora_slots,
+                                                 max_lora_rank=args.max_lora_rank,
+                                                 lora_target_modules=args.lora_target_modules,
                                                  enable_prefix_caching=args.enable_prefix_caching,
                                                  device_type=args.device,
                                                  quant_policy=args.quant_policy,
                                                  eager_mode=args.eager_mode,
-                                                 max_prefill_token_num=args.max_prefill_token_num)
+                                                 max_prefill_token_num=args.max_prefill_token_num,
+                                                 simulated_model=args.simulated_model,
+                                                 simulated_latency_model=args.simulated_latency_model)
         else:
             from lmdeploy.messages import TurbomindEngineConfig
             backend_config = TurbomindEngineConfig(dtype=args.dtype,
@@ -323,7 +349,8 @@ class SubCliServe:
                        proxy_url=args.proxy_url,
                        max_log_len=args.max_log_len,
                        disable_fastapi_docs=args.disable_fastapi_docs,
-                       max_concurrent_requests=args.max_concurrent_requests)
+                       max_concurrent_requests=args.max_concurrent_requests,
+                       num_tokenizer_workers=args.num_tokenizer_workers)
 
     @staticmethod
     def api_client(args):
@@ -100,12 +100,13 @@ class ArgumentHelper:
         return parser.add_argument('--dtype',
                                    type=str,
                                    default=default,
-                                   choices=['auto', 'float16', 'bfloat16'],
+                                   choices=['auto', 'float16', 'bfloat16', 'float32'],
                                    help='data type for model weights and activations. '
                                    'The "auto" option will use FP16 precision '
                                    'for FP32 and FP16 models, and BF16 precision '
-                                   'for BF16 models. This option will be ignored if '
-                                   'the model is a quantized model')
+                                   'for BF16 models. "float32" is only supported by '
+                                   'the pytorch engine and recommended on cpu. This '
+                                   'option will be ignored if the model is a quantized model')
 
     @staticmethod
     def quant_dtype(parser, default: str = 'int8'):
@@ -185,6 +186,22 @@ class ArgumentHelper:
                                    choices=[0, 4, 8],
                                    help='Quantize kv or not. 0: no quant; 4: 4bit kv; 8: 8bit kv')
 
+    @staticmethod
+    def simulated_model(parser):
+        """Add argument simulated_model and simulated_latency_model to
+        parser."""
+
+        parser.add_argument('--simulated-model',
+                            type=str,
+                            default=None,
+                            choices=['deterministic', 'sampled'],
+                            help='Replace the model with a simulated model to benchmark the engine '
+                            'without loading weights. Only the config of the model is required')
+        return parser.add_argument('--simulated-latency-model',
+                                   type=str,
+                                   default=None,
+                                   help='Json file of the forward latency model of the simulated model')
+
     @staticmethod
     def rope_scaling_factor(parser):
         """Add argument rope_scaling_factor to parser."""
@@ -336,7 +353,7 @@ class ArgumentHelper:
         )
 
     @staticmethod
-    def device(parser, default: str = 'cuda', choices: List[str] = ['cuda', 'ascend', 'maca', 'camb']):
+    def device(parser, default: str = 'cuda', choices: List[str] = ['cuda', 'ascend', 'maca', 'camb', 'cpu']):
         """Add argument device to parser."""
 
         return parser.add_argument('--device',
@@ -381,6 +398,28 @@ class ArgumentHelper:
                                    'adapters. If only have one adapter, one can only input '
                                    'the path of the adapter.')
 
+    @staticmethod
+    def lora_slots(parser):
+        """Add argument max_lora_slots, max_lora_rank and lora_target_modules
+        to parser."""
+
+        parser.add_argument('--max-lora-slots',
+                            type=int,
+                            default=None,
+                            help='Number of lora adapters resident on device. Adapters loaded at '
+                            'runtime are paged into the slots in LRU order. Default to the number '
+                            'of the adapters')
+        parser.add_argument('--max-lora-rank',
+                            type=int,
+                            default=None,
+                            help='Max rank of the lora adapters. Default to the max rank of the adapters')
+        return parser.add_argument('--lora-target-modules',
+                                   type=str,
+                                   nargs='+',
+                                   default=None,
+                                   help='Modules that the lora adapters can target. Default to the '
+                                   'targets of the adapters')
+
     @staticmethod
     def work_dir(parser):
         """Add argument work_dir to parser."""
@@ -1,8 +1,9 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # modify from https://github.com/vllm-project/vllm/blob/main/vllm/entrypoints/logger.py  # noqa
+import json
 from typing import List, Optional
 
-from .messages import GenerationConfig
+from .messages import GenerationConfig, RequestTimeline
 from .utils import get_logger
 
 logger = get_logger('lmdeploy')
@@ -48,3 +49,9 @@ class RequestLogger:
                     f'gen_config={gen_config}, '
                     f'prompt={prompt!r}, '
                     f'prompt_token_id={prompt_token_ids}')
+
+    def log_timeline(self, session_id: int, timeline: RequestTimeline) -> None:
+        """log the timeline of a finished request in json, which is parsed by
+        `lmdeploy.serve.timeline`."""
+        logger.info(f'session={session_id}, '
+                    f'timeline={json.dumps(timeline.to_dict())}')
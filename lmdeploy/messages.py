@@ -1,7 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import enum
-from dataclasses import dataclass, field
-from typing import Callable, Dict, List, Literal, Optional
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Literal, Optional
 
 import torch
 from pydantic.dataclasses import dataclass as pydantic_dataclass
@@ -51,6 +51,11 @@ class GenerationConfig:
             the stop tokens.
         bad_token_ids (List[str]): List of tokens that the engine will never
             generate.
+        stop_token_sequences (List[List[int]]): Token sequences that stop
+            the generation when they are generated. Stop words that can not
+            be matched by a single token are converted to sequences. Only
+            supported by the pytorch engine, the sequences are kept in the
+            returned output.
         min_new_tokens (int): The minimum numbers of tokens to generate,
             ignoring the number of tokens in the prompt.
         skip_special_tokens (bool): Whether or not to remove special tokens
@@ -98,6 +103,7 @@ class GenerationConfig:
     bad_words: List[str] = None
     stop_token_ids: List[int] = None
     bad_token_ids: List[int] = None
+    stop_token_sequences: List[List[int]] = None
     min_new_tokens: int = None
     skip_special_tokens: bool = True
     spaces_between_special_tokens: bool = True
@@ -122,12 +128,26 @@ class GenerationConfig:
                 return indexes
             return None
 
+        def stop_word_sequences(words):
+            """stop words split into multiple tokens."""
+            sequences = []
+            for word in words or []:
+                encoded = tokenizer.encode(word, add_bos=False)
+                if len(encoded) > 1:
+                    sequences.append(encoded)
+            return sequences
+
         stop_token_ids = special_word_token_ids(self.stop_words) or []
         bad_token_ids = special_word_token_ids(self.bad_words) or []
         stop_token_ids.extend(self.stop_token_ids or [])
         bad_token_ids.extend(self.bad_token_ids or [])
+        stop_token_sequences = list(self.stop_token_sequences or [])
+        for seq in stop_word_sequences(self.stop_words):
+            if seq not in stop_token_sequences:
+                stop_token_sequences.append(seq)
         self.stop_token_ids = list(set(stop_token_ids)) or None
         self.bad_token_ids = list(set(bad_token_ids)) or None
+        self.stop_token_sequences = stop_token_sequences or None
 
     def __post_init__(self):
         """Check input validation."""
@@ -231,9 +251,10 @@ class PytorchEngineConfig:
 
     Args:
         dtype (str): data type for model weights and activations. It can be
-            one of the following values, ['auto', 'float16', 'bfloat16']
-            The `auto` option will use FP16 precision for FP32 and FP16
-            models, and BF16 precision for BF16 models.
+            one of the following values, ['auto', 'float16', 'bfloat16',
+            'float32']. The `auto` option will use FP16 precision for FP32
+            and FP16 models, and BF16 precision for BF16 models. `float32`
+            is meant for the cpu device.
         tp (int): Tensor Parallelism. default 1.
         session_len (int): Max session length. Default None.
         max_batch_size (int): Max batch size. If it is not specified,
@@ -250,10 +271,25 @@ class PytorchEngineConfig:
         num_gpu_blocks (int): Num gpu blocks. If num is 0, cache
             would be allocate according to current environment.
         adapters (dict): The path configs to lora adapters.
+        max_lora_slots (int): Number of lora adapters resident on device.
+            Adapters loaded to host memory are paged into the slots in LRU
+            order, default to the number of `adapters`.
+        max_lora_rank (int): Max rank of the lora adapters, default to the
+            max rank of `adapters`.
+        lora_target_modules (List[str]): Modules that lora adapters can
+            target, default to the targets of `adapters`. Adapters loaded at
+            runtime can not target other modules.
+        max_active_adapters (int): Max number of distinct lora adapters in
+            a step. Requests of other adapters wait until the running
+            requests finish, since each adapter in a batch adds to the cost
+            of the lora kernels.
         max_prefill_token_num (int): tokens per iteration.
         thread_safe (bool): thread safe engine instance.
         enable_prefix_caching (bool): Enable token match and sharing caches.
-        device_type (str): The inference device type, options ['cuda']
+        enable_host_prefix_caching (bool): Move prefix caches evicted from
+            device to host memory instead of dropping them. Requires
+            `enable_prefix_caching`.
+        device_type (str): The inference device type, options ['cuda', 'cpu']
         eager_mode (bool): Enable "eager" mode or not
         custom_module_map (Dict): nn module map customized by users. Once
             provided, the original nn modules of the model will be
@@ -265,6 +301,49 @@ class PytorchEngineConfig:
             If unspecified, will use the default version.
         quant_policy (int): default to 0. When k/v is quantized into 4 or 8
             bit, set it to 4 or 8, respectively
+        eviction_type (str): How to evict the caches of preempted sequences,
+            options ['recompute', 'swap']. `swap` would move the caches to
+            host memory when it is cheaper than recomputing them.
+        prefill_policy (str): The order to prefill waiting requests, options
+            ['fcfs', 'cache_aware', 'adapter_aware']. `cache_aware` prefers
+            requests sharing cached prefixes and only charges uncached tokens
+            to `max_prefill_token_num`. `adapter_aware` prefers requests of
+            the lora adapters in the batch, then the adapters with the oldest
+            requests. Requests waiting longer than
+            `prefill_starvation_time` seconds are always scheduled first.
+        prefill_starvation_time (float): Max waiting time in seconds before
+            a request is prefilled in arrival order.
+        enable_chunked_prefill (bool): Split long prompts into chunks and
+            prefill them together with running decodes, so decoding is not
+            stalled by long prefills. Each step computes at most
+            `max_prefill_token_num` tokens.
+        enable_pipelined_schedule (bool): Schedule and prepare the inputs of
+            the next decoding step while the current step is running. The
+            sampled tokens are patched into the prepared inputs on device.
+        disk_cache_dir (str): Directory to persist prefix caches. Caches
+            dropped from memory are written to it and can be reused across
+            restarts. Requires `enable_prefix_caching`.
+        disk_cache_max_blocks (int): Max number of blocks kept in
+            `disk_cache_dir`, 0 means unlimited.
+        disk_cache_prewarm_blocks (int): Number of the hottest blocks on
+            disk to be loaded on start.
+        speculative_method (str): Speculative decoding method, options
+            [None, 'ngram', 'draft_model']. `ngram` proposes tokens by
+            looking up the prompt and generated tokens, `draft_model`
+            proposes tokens with `speculative_draft_model`.
+        num_speculative_tokens (int): Max number of tokens proposed and
+            verified in each decoding step.
+        speculative_draft_model (str): Path of the draft model, which should
+            share the tokenizer with the target model.
+        ngram_prompt_lookup_min (int): Min ngram size to match.
+        ngram_prompt_lookup_max (int): Max ngram size to match.
+        simulated_model (str): Replace the model with a simulated model
+            agent to benchmark the engine and the serving stack without
+            loading weights, options [None, 'deterministic', 'sampled'].
+            Only the config of the model is required.
+        simulated_latency_model (str): Json file of the forward latency
+            model of the simulated model, which can be fitted by
+            `benchmark/profile_latency_model.py`.
     """
     dtype: str = 'auto'
     tp: int = 1
@@ -276,19 +355,39 @@ class PytorchEngineConfig:
     num_cpu_blocks: int = 0
     num_gpu_blocks: int = 0
     adapters: Dict[str, str] = None
+    max_lora_slots: int = None
+    max_lora_rank: int = None
+    lora_target_modules: List[str] = None
+    max_active_adapters: int = 64
     max_prefill_token_num: int = 4096
     thread_safe: bool = False
     enable_prefix_caching: bool = False
+    enable_host_prefix_caching: bool = False
     device_type: str = 'cuda'
     eager_mode: bool = False
     custom_module_map: Dict[str, str] = None
     download_dir: str = None
     revision: str = None
     quant_policy: Literal[0, 4, 8] = 0
+    eviction_type: Literal['recompute', 'swap'] = 'recompute'
+    prefill_policy: Literal['fcfs', 'cache_aware', 'adapter_aware'] = 'fcfs'
+    prefill_starvation_time: float = 5.0
+    enable_chunked_prefill: bool = False
+    enable_pipelined_schedule: bool = False
+    disk_cache_dir: str = None
+    disk_cache_max_blocks: int = 0
+    disk_cache_prewarm_blocks: int = 0
+    speculative_method: Literal[None, 'ngram', 'draft_model'] = None
+    num_speculative_tokens: int = 4
+    speculative_draft_model: str = None
+    ngram_prompt_lookup_min: int = 1
+    ngram_prompt_lookup_max: int = 4
+    simulated_model: Literal[None, 'deterministic', 'sampled'] = None
+    simulated_latency_model: str = None
 
     def __post_init__(self):
         """Check input validation."""
-        assert self.dtype in ['auto', 'float16', 'bfloat16']
+        assert self.dtype in ['auto', 'float16', 'bfloat16', 'float32']
         assert self.tp >= 1, 'invalid tp'
         assert 0 < self.cache_max_entry_count < 1, \
             'invalid cache_max_entry_count'
@@ -297,7 +396,31 @@ class PytorchEngineConfig:
             'invalid max_prefill_token_num'
         assert self.num_gpu_blocks >= 0, 'invalid num_gpu_blocks'
         assert self.quant_policy in (0, 4, 8), 'invalid quant_policy'
-        assert self.device_type in ['cuda', 'ascend', 'maca', 'camb'], (f'invalid device_type: {self.device_type}')
+        assert self.eviction_type in ['recompute', 'swap'], \
+            f'invalid eviction_type: {self.eviction_type}'
+        assert self.prefill_policy in ['fcfs', 'cache_aware', 'adapter_aware'], \
+            f'invalid prefill_policy: {self.prefill_policy}'
+        assert self.prefill_starvation_time >= 0, \
+            'invalid prefill_starvation_time'
+        assert self.disk_cache_max_blocks >= 0, 'invalid disk_cache_max_blocks'
+        assert self.disk_cache_prewarm_blocks >= 0, \
+            'invalid disk_cache_prewarm_blocks'
+        assert self.speculative_method in [None, 'ngram', 'draft_model'], \
+            f'invalid speculative_method: {self.speculative_method}'
+        assert self.num_speculative_tokens > 0, \
+            'invalid num_speculative_tokens'
+        assert 0 < self.ngram_prompt_lookup_min <= \
+            self.ngram_prompt_lookup_max, 'invalid ngram_prompt_lookup size'
+        if self.speculative_method == 'draft_model':
+            assert self.speculative_draft_model is not None, \
+                'speculative_draft_model is required by draft_model method'
+        assert self.simulated_model in [None, 'deterministic', 'sampled'], \
+            f'invalid simulated_model: {self.simulated_model}'
+        assert self.max_lora_slots is None or self.max_lora_slots >= 0, \
+            'invalid max_lora_slots'
+        assert self.max_active_adapters > 0, 'invalid max_active_adapters'
+        assert self.device_type in ['cuda', 'ascend', 'maca', 'camb', 'cpu'], \
+            f'invalid device_type: {self.device_type}'
         if self.quant_policy > 0 and self.device_type not in ['cuda', 'ascend']:
             assert False, \
                    'kv cache quantization only works for CUDA and ASCEND.'
@@ -318,6 +441,7 @@ class ResponseType(enum.Enum):
     HANDLER_NOT_EXIST = enum.auto()
     INPUT_LENGTH_ERROR = enum.auto()
     INTERNAL_ENGINE_ERROR = enum.auto()
+    ADAPTER_NOT_EXIST = enum.auto()
 
 
 @dataclass
@@ -364,6 +488,10 @@ class EngineOutput:
             may not equal to the length of token_ids
         logprobs (List[Dict[int, float]]): the top logprobs for each output
             position.
+        index (int): the index of the choice when `n > 1`.
+        timeline (Dict[str, Any]): the engine side fields of
+            `RequestTimeline`, only reported with the last output of the
+            pytorch engine.
     """
     status: ResponseType
     token_ids: List[int]
@@ -371,6 +499,72 @@ class EngineOutput:
     logprobs: List[Dict[int, float]] = None
     logits: torch.Tensor = None
     last_hidden_state: torch.Tensor = None
+    index: int = 0
+    timeline: Dict[str, Any] = None
+
+
+@dataclass
+class RequestTimeline:
+    """Timeline of a request, all the times are unix timestamps in seconds.
+
+    Args:
+        request_time (float): the request is received by the server.
+        tokenized_time (float): the prompt is rendered and tokenized.
+        instance_time (float): a free engine instance is acquired.
+        arrive_time (float): the request is added to the engine.
+        scheduled_time (float): the request is scheduled for the first
+            prefill.
+        first_token_time (float): the first token is generated.
+        finish_time (float): the last token is generated.
+        end_time (float): the last response is detokenized.
+        detokenize_time (float): total seconds of detokenization.
+        scheduled_step (int): index of the engine forward of the first
+            prefill.
+        first_token_step (int): index of the engine forward generating the
+            first token.
+        finish_step (int): index of the engine forward generating the last
+            token.
+
+    The engine side fields are only reported by the pytorch engine.
+    """
+    request_time: float = None
+    tokenized_time: float = None
+    instance_time: float = None
+    arrive_time: float = None
+    scheduled_time: float = None
+    first_token_time: float = None
+    finish_time: float = None
+    end_time: float = None
+    detokenize_time: float = 0.0
+    scheduled_step: int = None
+    first_token_step: int = None
+    finish_step: int = None
+
+    def update(self, **kwargs):
+        """update the fields, such as the ones reported by the engine."""
+        for key, value in kwargs.items():
+            if hasattr(self, key):
+                setattr(self, key, value)
+
+    def durations(self) -> Dict[str, float]:
+        """seconds spent in each stage, unknown stages are skipped."""
+        stages = dict(tokenize=('request_time', 'tokenized_time'),
+                      instance_queue=('tokenized_time', 'instance_time'),
+                      scheduler_queue=('arrive_time', 'scheduled_time'),
+                      prefill=('scheduled_time', 'first_token_time'),
+                      decode=('first_token_time', 'finish_time'),
+                      total=('request_time', 'end_time'))
+        durations = dict()
+        for name, (start, end) in stages.items():
+            start, end = getattr(self, start), getattr(self, end)
+            if start is not None and end is not None:
+                durations[name] = end - start
+        durations['detokenize'] = self.detokenize_time
+        return durations
+
+    def to_dict(self) -> Dict[str, Any]:
+        """the fields and the durations."""
+        return dict(**asdict(self), durations=self.durations())
 
 
 @dataclass
@@ -1,7 +1,8 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import csv
 import time
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, List, Optional
 
 import numpy as np
 
@@ -26,6 +27,51 @@ class Session:
     def finish(self, status):
         self.status = status
 
+    def is_success(self):
+        """the request finished with all the requested tokens."""
+        return self.status == Session.SUCCESS and self.ns[-1] >= self.req_output_len
+
+    @property
+    def ttft(self):
+        return self.ts[1] - self.ts[0]
+
+    @property
+    def tpot(self):
+        ns, ts = self.ns, self.ts
+        if ns[-1] > ns[1]:
+            return (ts[-1] - ts[1]) / (ns[-1] - ns[1])
+        # no-stream-output
+        return (ts[-1] - ts[0]) / (ns[-1] - ns[0])
+
+    @property
+    def e2e(self):
+        return self.ts[-1] - self.ts[0]
+
+
+@dataclass
+class SLO:
+    """Service level objectives of a request in seconds, None means no
+    limit.
+
+    Args:
+        ttft (float): Max time to the first token.
+        tpot (float): Max time per output token after the first one.
+        e2e (float): Max end-to-end latency.
+    """
+    ttft: Optional[float] = None
+    tpot: Optional[float] = None
+    e2e: Optional[float] = None
+
+    def meet(self, sess: Session):
+        """whether a successful request meets the objectives."""
+        if not sess.is_success():
+            return False
+        for name in ['ttft', 'tpot', 'e2e']:
+            limit = getattr(self, name)
+            if limit is not None and getattr(sess, name) > limit:
+                return False
+        return True
+
 
 class Profiler:
 
@@ -56,21 +102,16 @@ class Profiler:
         self.success = 0
 
         for sess in self.sessions:
-            if sess.status != Session.SUCCESS:
+            if not sess.is_success():
                 continue
             ns = sess.ns
             ts = sess.ts
-            if ns[-1] < sess.req_output_len:
-                continue
             self.success += 1
             self.total_output += ns[-1]
             self.total_input += sess.input_len
-            self.e2es.append(ts[-1] - ts[0])
-            self.ttfts.append(ts[1] - ts[0])
-            if ns[-1] > ns[1]:
-                self.tpots.append((ts[-1] - ts[1]) / (ns[-1] - ns[1]))
-            else:  # no-stream-output
-                self.tpots.append((ts[-1] - ts[0]) / (ns[-1] - ns[0]))
+            self.e2es.append(sess.e2e)
+            self.ttfts.append(sess.ttft)
+            self.tpots.append(sess.tpot)
             t_dif = np.subtract(ts[1:], ts[:-1])
             n_dif = np.subtract(ns[1:], ns[:-1])
             self.itls.extend(t_dif[1:])
@@ -102,6 +143,35 @@ class Profiler:
 
         self.rps = self.success / self.elapsed_time
 
+    def compute_goodput(self, slo: SLO):
+        """compute the rate of the requests meeting the slo."""
+        good = [sess for sess in self.sessions if slo.meet(sess)]
+        self.slo = slo
+        self.goodput = len(good) / self.elapsed_time
+        self.goodput_tokens = sum(sess.ns[-1] for sess in good) / self.elapsed_time
+        self.slo_attainment = len(good) / max(len(self.sessions), 1)
+
+    def to_dict(self) -> Dict[str, float]:
+        """flat metrics, the percentiles are suffixed with `_p{q}`."""
+        metrics = dict(duration=self.elapsed_time,
+                       total_requests=len(self.sessions),
+                       successful_requests=self.success,
+                       total_input_tokens=self.total_input,
+                       total_output_tokens=self.total_output,
+                       input_throughput=self.input_throughput,
+                       output_throughput=self.output_throughput,
+                       request_throughput=self.rps)
+        if hasattr(self, 'goodput'):
+            metrics.update(goodput=self.goodput, goodput_tokens=self.goodput_tokens, slo_attainment=self.slo_attainment)
+        stats = [('e2e', self.e2e_mean, self.e2e_stat), ('tpot', self.tpot_mean, self.tpot_stat)]
+        if self.stream_output:
+            stats += [('ttft', self.ttft_mean, self.ttft_stat), ('itl', self.itls_mean, self.itls_stat)]
+        for name, mean, stat in stats:
+            metrics[f'{name}_mean'] = float(mean)
+            for q, value in zip(self.percentages, stat):
+                metrics[f'{name}_p{q}'] = float(value)
+        return metrics
+
     def summarize(self, title: str, hyperparams: List = None, header=40, digits=10):
 
         width = header + digits * (1 + len(self.percentages))
@@ -125,6 +195,10 @@ class Profiler:
         tab_row('Input throughput (tok/s)', self.input_throughput)
         tab_row('Output throughput (tok/s)', self.output_throughput)
         tab_row('Request throughput (req/s)', self.rps)
+        if hasattr(self, 'goodput'):
+            tab_row('Goodput (req/s)', self.goodput)
+            tab_row('Goodput (tok/s)', self.goodput_tokens)
+            tab_row('SLO attainment', self.slo_attainment)
         print('-' * width)
         tab_row('', 'mean', *(f'P{q}' for q in self.percentages))
         tab_row('End-to-end Latency', self.e2e_mean, *self.e2e_stat)
@@ -1,26 +1,39 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 
 import re
-from typing import Dict, Iterable, List, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Set, Tuple
 
 import torch
 from torch import nn
 
 
-def get_ranks_and_scalings(target_name: str, cfgs: Iterable, device: torch.device = None):
-    """get ranks and scalings."""
-    ranks = []
-    scalings = []
-    for cfg in cfgs:
-        if target_name not in cfg.target_modules:
-            ranks.append(0)
-            scalings.append(1)
-            continue
-        ranks.append(cfg.r)
-        scalings.append(float(cfg.lora_alpha / cfg.r))
-    ranks = torch.tensor(ranks, device=device)
-    scalings = torch.tensor(scalings, device=device)
-    return ranks, scalings
+def get_rank_and_scaling(target_name: str, cfg: Any):
+    """get rank and scaling of an adapter on the target."""
+    target_names = [name.split('.')[-1] for name in cfg.target_modules]
+    if target_name not in target_names:
+        return 0, 1.0
+    return cfg.r, float(cfg.lora_alpha / cfg.r)
+
+
+def get_lora_modules(model: nn.Module):
+    """get lora modules with their target names."""
+    from lmdeploy.pytorch.nn.linear import LoRA
+    return [(name.split('.')[-1], mod) for name, mod in model.named_modules() if isinstance(mod, LoRA)]
+
+
+def load_adapter_slots(model: nn.Module, adapter_slot_map: Dict[int, int]):
+    """copy adapters from host memory to the device slots.
+
+    Args:
+        model (nn.Module): The model or the graph runner.
+        adapter_slot_map (Dict[int, int]): slot -> adapter id.
+    """
+    if hasattr(model, 'get_model'):
+        model = model.get_model()
+    for _, mod in get_lora_modules(model):
+        for slot, adapter_id in adapter_slot_map.items():
+            mod.load_slot(slot, adapter_id)
 
 
 def find_all_target(model: torch.nn.Module, target_name: str):
@@ -109,21 +122,124 @@ def load_lora_weights(model: nn.Module, weights: Iterable[Tuple[str, torch.Tenso
 
 
 class AdapterManager:
-    """adapter manager."""
+    """Adapters in host memory and LRU paging of the device slots.
 
-    def __init__(self, adapters: Dict[str, str]):
-        if adapters is None:
-            adapters = dict()
+    Adapter ids index the host memory weights and slot ids index the device
+    weights of the lora layers, id 0 of both is no adapter. Adapters loaded at
+    start up take ids of the sorted names from 1 and are resident in the slots
+    of the same ids, see `add_adapters`.
 
-        adapter_names = list(adapters.keys())
-        adapter_names = sorted(adapter_names)
-        adapter_names = [None] + adapter_names
+    Args:
+        adapters (Dict[str, str]): adapter name -> path loaded at start up.
+        num_slots (int): Number of the device slots, defaults to the number of
+            the adapters.
+    """
 
-        adapter_id_map = dict(zip(adapter_names, range(len(adapter_names))))
-        self.adapter_id_map = adapter_id_map
+    def __init__(self, adapters: Dict[str, str] = None, num_slots: int = None):
+        if adapters is None:
+            adapters = dict()
+        if num_slots is None:
+            num_slots = len(adapters)
+        self.num_slots = num_slots
+
+        self.adapter_id_map: Dict[str, int] = {None: 0}
+        self.adapter_paths: Dict[str, str] = dict()
+        # paths of the removed adapters, a name can not be reused by other
+        # weights since the prefix caches are keyed by the name.
+        self._history_paths: Dict[str, str] = dict()
+        self._next_adapter_id = 1
+
+        # resident adapter name -> slot, least recently used first
+        self.slot_map: Dict[str, int] = OrderedDict()
+        self._free_slots = list(range(1, num_slots + 1))
+        # slot -> adapter id, copied to the device before next forward
+        self._slot_loads: Dict[int, int] = dict()
+
+        for name in sorted(adapters):
+            adapter_id = self.add_adapter(name, adapters[name])
+            if adapter_id <= num_slots:
+                self._free_slots.remove(adapter_id)
+                self.slot_map[name] = adapter_id
+
+    def add_adapter(self, name: str, path: str):
+        """add an adapter in host memory, return the adapter id."""
+        if name in self.adapter_id_map:
+            raise ValueError(f'Adapter <{name}> has been loaded.')
+        old_path = self._history_paths.get(name, path)
+        if old_path != path:
+            raise ValueError(f'Adapter <{name}> has been loaded from <{old_path}>, '
+                             'weights of a name can not be changed.')
+        adapter_id = self._next_adapter_id
+        self._next_adapter_id += 1
+        self.adapter_id_map[name] = adapter_id
+        self.adapter_paths[name] = path
+        return adapter_id
+
+    def remove_adapter(self, name: str, reserve_name: bool = True):
+        """remove an adapter and free its slot, return the adapter id.
+
+        Args:
+            name (str): The adapter name.
+            reserve_name (bool): The name can only be reused by the same path.
+                Set False if the adapter has never been used.
+        """
+        if name is None or name not in self.adapter_id_map:
+            raise ValueError(f'Adapter <{name}> does not exist.')
+        adapter_id = self.adapter_id_map.pop(name)
+        path = self.adapter_paths.pop(name)
+        if reserve_name:
+            self._history_paths[name] = path
+        slot = self.slot_map.pop(name, None)
+        if slot is not None:
+            self._slot_loads.pop(slot, None)
+            self._free_slots.append(slot)
+        return adapter_id
+
+    def has_adapter(self, name: str):
+        """adapter exists."""
+        return name in self.adapter_id_map
+
+    def is_resident(self, name: str):
+        """adapter is in a device slot."""
+        return name is None or name in self.slot_map
+
+    def acquire(self, name: str, pinned: Set[str] = None):
+        """page the adapter into a slot, evict the least recently used
+        adapter if no slot is free.
+
+        Args:
+            name (str): The adapter name.
+            pinned (Set[str]): Adapters that can not be evicted.
+
+        Returns:
+            bool: False if all slots are pinned.
+        """
+        if name is None:
+            return True
+        if name in self.slot_map:
+            self.slot_map.move_to_end(name)
+            return True
+        if len(self._free_slots) > 0:
+            slot = self._free_slots.pop(0)
+        else:
+            pinned = pinned or set()
+            victim = next((other for other in self.slot_map if other not in pinned), None)
+            if victim is None:
+                return False
+            slot = self.slot_map.pop(victim)
+        self.slot_map[name] = slot
+        self._slot_loads[slot] = self.adapter_id_map[name]
+        return True
+
+    def pop_slot_loads(self):
+        """pop the adapters to copy to the slots, slot -> adapter id."""
+        slot_loads = self._slot_loads
+        self._slot_loads = dict()
+        return slot_loads
 
     def get_adapter_ids(self, names: List[str]):
-        return [self.adapter_id_map[name] for name in names]
+        """get slots of the resident adapters."""
+        return [self.slot_map[name] if name is not None else 0 for name in names]
 
     def num_adapters(self):
         return len(self.adapter_id_map)
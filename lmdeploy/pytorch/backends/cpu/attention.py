@@ -0,0 +1,174 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from dataclasses import dataclass
+from typing import Literal
+
+import torch
+
+from ..attention import AttentionBuilder, AttentionImpl, AttentionMetadata
+
+
+@dataclass
+class CpuAttentionMetadata(AttentionMetadata):
+    """cpu attention metadata."""
+    is_decoding: bool
+    block_offsets: torch.Tensor
+    q_start_loc: torch.Tensor = None
+    q_seqlens: torch.Tensor = None
+    kv_start_loc: torch.Tensor = None
+    kv_seqlens: torch.Tensor = None
+    fill_seqlens: torch.Tensor = None
+    quant_policy: Literal[0, 4, 8] = 0
+    kv_flatten_size: int = None
+
+
+class CpuAttentionImpl(AttentionImpl[CpuAttentionMetadata]):
+    """cpu attention implementation in pure torch."""
+
+    def __init__(
+        self,
+        num_heads: int,
+        head_size: int,
+        scale: float = None,
+        num_kv_heads: int = None,
+        v_head_size: int = None,
+        alibi: bool = False,
+        sliding_window: int = None,
+        logit_softcapping: float = None,
+        causal: bool = True,
+        **kwargs,
+    ):
+        super().__init__(
+            num_heads=num_heads,
+            head_size=head_size,
+            scale=scale,
+            num_kv_heads=num_kv_heads,
+            v_head_size=v_head_size,
+            alibi=alibi,
+            sliding_window=sliding_window,
+            logit_softcapping=logit_softcapping,
+            causal=causal,
+            **kwargs,
+        )
+        if alibi:
+            raise RuntimeError('alibi attention is not supported on cpu.')
+
+        from lmdeploy.pytorch.kernels.cpu import (fill_kv_cache, flash_attention_fwd, flatten_kv_cache,
+                                                  paged_attention_fwd)
+        self.fill_kv_cache = fill_kv_cache
+        self.paged_attention_fwd = paged_attention_fwd
+        self.flatten_kv_cache = flatten_kv_cache
+        self.flash_attention_fwd = flash_attention_fwd
+
+    def forward(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        k_cache: torch.Tensor,
+        v_cache: torch.Tensor,
+        attn_metadata: CpuAttentionMetadata,
+        k_scales_zeros: torch.Tensor = None,
+        v_scales_zeros: torch.Tensor = None,
+        inplace: bool = True,
+    ) -> torch.Tensor:
+        """forward."""
+        block_offsets = attn_metadata.block_offsets
+        q_start_loc = attn_metadata.q_start_loc
+        q_seqlens = attn_metadata.q_seqlens
+        kv_seqlens = attn_metadata.kv_seqlens
+        quant_policy = attn_metadata.quant_policy
+        fill_q_start_loc = q_start_loc
+        fill_seqlens = q_seqlens
+        if attn_metadata.fill_seqlens is not None:
+            fill_seqlens = attn_metadata.fill_seqlens
+            fill_q_start_loc = fill_seqlens.cumsum(0) - fill_seqlens
+
+        # fill kv cache
+        if key is not None and value is not None:
+            self.fill_kv_cache(
+                key,
+                value,
+                k_cache,
+                v_cache,
+                fill_q_start_loc,
+                fill_seqlens,
+                kv_seq_length=kv_seqlens,
+                max_q_seq_length=None,
+                block_offsets=block_offsets,
+                quant_policy=quant_policy,
+            )
+
+        q_shape = query.shape
+        o_shape = q_shape[:-1] + (self.v_head_size, )
+        attn_output = query.new_empty(o_shape)
+
+        if attn_metadata.is_decoding:
+            self.paged_attention_fwd(
+                query,
+                k_cache,
+                v_cache,
+                attn_output,
+                block_offsets,
+                kv_seqlens=kv_seqlens,
+                quant_policy=quant_policy,
+                window_size=self.sliding_window,
+                sm_scale=self.scale,
+                logit_softcapping=self.logit_softcapping,
+            )
+        else:
+            kv_start_loc = attn_metadata.kv_start_loc
+            flatten_k, flatten_v = self.flatten_kv_cache(
+                k_cache,
+                v_cache,
+                kv_seqlens,
+                block_offsets,
+                start_loc=kv_start_loc,
+                out_size=attn_metadata.kv_flatten_size,
+                out_dtype=query.dtype,
+                quant_policy=quant_policy,
+            )
+            self.flash_attention_fwd(
+                query,
+                flatten_k,
+                flatten_v,
+                attn_output,
+                q_start_loc=q_start_loc,
+                q_seqlens=q_seqlens,
+                kv_start_loc=kv_start_loc,
+                kv_seqlens=kv_seqlens,
+                window_size=self.sliding_window,
+                sm_scale=self.scale,
+                logit_softcapping=self.logit_softcapping,
+                causal=self.causal,
+            )
+
+        return attn_output
+
+
+class CpuAttentionBuilder(AttentionBuilder[CpuAttentionMetadata]):
+    """cpu attention builder."""
+
+    @staticmethod
+    def build(
+        num_heads: int,
+        head_size: int,
+        scale: float = None,
+        num_kv_heads: int = None,
+        v_head_size: int = None,
+        alibi: bool = False,
+        sliding_window: int = None,
+        logical_softcapping: float = None,
+        causal: bool = True,
+        **kwargs,
+    ) -> CpuAttentionImpl:
+        """build."""
+        return CpuAttentionImpl(num_heads,
+                                head_size,
+                                scale=scale,
+                                num_kv_heads=num_kv_heads,
+                                v_head_size=v_head_size,
+                                alibi=alibi,
+                                sliding_window=sliding_window,
+                                logical_softcapping=logical_softcapping,
+                                causal=causal,
+                                **kwargs)
@@ -0,0 +1,51 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+
+from lmdeploy.pytorch.model_inputs import StepContextManager
+
+from ..lora import AdapterInfo, LoRABuilder, LoRAImpl
+
+
+class CpuLoRAImpl(LoRAImpl):
+    """cpu lora implementation, tokens of the same adapter are computed
+    together."""
+
+    def forward(self,
+                x: torch.Tensor,
+                lora_A: torch.Tensor,
+                lora_B: torch.Tensor,
+                base_output: torch.Tensor,
+                adapter_info: AdapterInfo,
+                ctx_mgr: StepContextManager,
+                colwise: bool,
+                is_tp: bool = True):
+        """forward."""
+        context = ctx_mgr.current_context()
+        x = x.flatten(0, -2)
+        token_adapter_ids = context.local_adapter_ids.repeat_interleave(context.q_seqlens, output_size=x.size(0))
+
+        sliced_base = base_output[..., adapter_info.base_slice]
+        lora_out = x.new_zeros(x.size(0), sliced_base.size(-1))
+        ranks = adapter_info.ranks.tolist()
+        scalings = adapter_info.scalings.tolist()
+        for adapter_id in token_adapter_ids.unique().tolist():
+            rank = ranks[adapter_id]
+            if rank == 0:
+                continue
+            r_start = adapter_info.get_rank_offset(adapter_id)
+            mask = token_adapter_ids == adapter_id
+            lora_a = lora_A[r_start:r_start + rank]
+            lora_b = lora_B[r_start:r_start + rank]
+            lora_out[mask] = (x[mask] @ lora_a.t()) @ lora_b * scalings[adapter_id]
+
+        sliced_base.add_(lora_out.reshape(sliced_base.shape))
+        return base_output
+
+
+class CpuLoRABuilder(LoRABuilder):
+    """cpu lora layer builder."""
+
+    @staticmethod
+    def build():
+        """build."""
+        return CpuLoRAImpl()
@@ -0,0 +1,30 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+
+from ..multinomial_sampling import MultinomialSamplingBuilder, MultinomialSamplingImpl
+
+
+class CpuMultinomialSamplingImpl(MultinomialSamplingImpl):
+    """cpu multinomial sampling implementation, reproducible with the
+    seeds."""
+
+    def __init__(self):
+        from lmdeploy.pytorch.kernels.cpu import multinomial_sampling
+        self.multinomial_sampling = multinomial_sampling
+
+    def forward(self,
+                scores: torch.Tensor,
+                seeds: torch.LongTensor,
+                offsets: torch.LongTensor,
+                indices: torch.Tensor = None):
+        """forward."""
+        return self.multinomial_sampling(scores, seeds, offsets, indices)
+
+
+class CpuMultinomialSamplingBuilder(MultinomialSamplingBuilder):
+    """cpu multinomial sampling implementation builder."""
+
+    @staticmethod
+    def build():
+        """build."""
+        return CpuMultinomialSamplingImpl()
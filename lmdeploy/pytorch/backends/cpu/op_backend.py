@@ -0,0 +1,96 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from lmdeploy.utils import get_logger
+
+from ..base import OpType
+from ..default import DefaultOpsBackend
+
+logger = get_logger('lmdeploy')
+
+
+class CpuOpsBackend(DefaultOpsBackend):
+    """cpu layer backend.
+
+    Attention, sampling and lora are implemented in pure torch, the other
+    layers fallback to the default implementation.
+    """
+
+    @staticmethod
+    def get_name() -> str:
+        """backend name."""
+        return 'cpu'
+
+    @classmethod
+    def get_layer_impl_builder(cls, layer_type: OpType):
+        """get cpu layer builder."""
+        if layer_type == OpType.PagedAttention:
+            from .attention import CpuAttentionBuilder
+            return CpuAttentionBuilder
+        elif layer_type == OpType.FlashAttention:
+            from .flash_attention import CpuFlashAttentionBuilder
+            return CpuFlashAttentionBuilder
+        elif layer_type == OpType.MultinomialSampling:
+            from .multinomial_sampling import CpuMultinomialSamplingBuilder
+            return CpuMultinomialSamplingBuilder
+        elif layer_type == OpType.LoRA:
+            from .lora import CpuLoRABuilder
+            return CpuLoRABuilder
+        else:
+            logger.debug(f'Op {layer_type} fallback to default implementation.')
+            return super().get_layer_impl_builder(layer_type)
+
+    @staticmethod
+    def get_attention_metadata_cls():
+        """get attention metadata class."""
+        from .attention import CpuAttentionMetadata
+        return CpuAttentionMetadata
+
+    @classmethod
+    def update_step_context(cls, step_context):
+        """update step context."""
+        attn_meta_cls = cls.get_attention_metadata_cls()
+        q_seqlens = step_context.q_seqlens
+        q_start_loc = q_seqlens.cumsum(0) - q_seqlens
+        kv_seqlens = step_context.kv_seqlens
+        kv_start_loc = None
+        kv_flatten_size = None
+        if not step_context.is_decoding:
+            kv_start_loc = kv_seqlens.cumsum(0) - kv_seqlens
+            kv_flatten_size = kv_seqlens.sum().item()
+        attn_metadata = attn_meta_cls(
+            step_context.is_decoding,
+            step_context.block_offsets,
+            q_start_loc=q_start_loc,
+            q_seqlens=q_seqlens,
+            kv_start_loc=kv_start_loc,
+            kv_seqlens=kv_seqlens,
+            kv_flatten_size=kv_flatten_size,
+            quant_policy=step_context.kv_quant_policy,
+        )
+
+        cross_seqlens = step_context.cross_seqlens
+        cross_kv_seqlens = step_context.cross_kv_seqlens
+        cross_attn_metadata = None
+        if cross_seqlens is not None:
+            fill_seqlens = cross_seqlens
+            if fill_seqlens.sum().item() == 0:
+                fill_seqlens = None
+            cross_kv_start_loc = None
+            cross_kv_flatten_size = None
+            if not step_context.is_decoding and cross_kv_seqlens is not None:
+                cross_kv_start_loc = cross_kv_seqlens.cumsum(0) - cross_kv_seqlens
+                cross_kv_flatten_size = cross_kv_seqlens.sum().item()
+            cross_attn_metadata = attn_meta_cls(
+                step_context.is_decoding,
+                step_context.block_offsets,
+                q_start_loc=q_start_loc,
+                q_seqlens=q_seqlens,
+                kv_start_loc=cross_kv_start_loc,
+                kv_seqlens=cross_kv_seqlens,
+                kv_flatten_size=cross_kv_flatten_size,
+                fill_seqlens=fill_seqlens,
+                quant_policy=step_context.kv_quant_policy,
+            )
+
+        step_context.attn_metadata = attn_metadata
+        step_context.cross_attn_metadata = cross_attn_metadata
+        return step_context
@@ -116,6 +116,7 @@ class CUDAGraphRunner(GraphRunner):
 
         self.graph_pool_handle = torch.cuda.graph_pool_handle()
         self._runner_map: Dict[Any, CUDASingleGraphRunner] = dict()
+        self._graph_stats = dict(num_graph_hits=0, num_graph_misses=0, num_eager_forwards=0)
 
     def check_enable_graph(self):
         """check enable graph."""
@@ -138,6 +139,7 @@ class CUDAGraphRunner(GraphRunner):
         enable_graph = self.enable_graph(**kwargs)
 
         if not enable_graph:
+            self._graph_stats['num_eager_forwards'] += 1
             return self.model(**kwargs)
 
         graph_key = self.get_graph_key(**kwargs)
@@ -154,11 +156,18 @@ class CUDAGraphRunner(GraphRunner):
                                            device=self.device)
             runner.capture(**kwargs)
             self._runner_map[graph_key] = runner
+            self._graph_stats['num_graph_misses'] += 1
         else:
             runner = self._runner_map[graph_key]
+            self._graph_stats['num_graph_hits'] += 1
         output = runner.forward(**kwargs)
         return output
 
+    def get_graph_stats(self) -> Dict[str, int]:
+        """get the numbers of the forwards replaying a captured graph, the
+        forwards capturing a new graph and the eager forwards."""
+        return dict(self._graph_stats)
+
     def prepare_inputs_for_generation(
         self,
         past_key_values: List[List[torch.Tensor]],
@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List
+from typing import Dict, List
 
 import torch
 
@@ -27,6 +27,11 @@ class GraphRunner:
         """get model."""
         return self.model
 
+    def get_graph_stats(self) -> Dict[str, int]:
+        """get the numbers of the forwards replaying a captured graph, the
+        forwards capturing a new graph and the eager forwards."""
+        return dict()
+
     def get_logits(self, hidden_states: torch.Tensor):
         """get logits of model output."""
         if not hasattr(self.model, 'get_logits'):
@@ -9,22 +9,28 @@ from lmdeploy.pytorch.model_inputs import StepContextManager
 
 @dataclass
 class AdapterInfo:
-    """Adapter information."""
+    """Adapter information.
+
+    The lora weights are split into slots of `max_rank` rows, slot 0 is
+    reserved for no adapter and takes no rows. `ranks` and `scalings` of the
+    slots are updated inplace when adapters are paged in.
+    """
     in_features: int
     out_features: int
     ranks: torch.Tensor
     scalings: torch.Tensor
     base_slice: slice
+    max_rank: int
     rank_offsets: torch.Tensor = field(init=False)
-    max_rank: int = field(init=False)
 
     def __post_init__(self):
         """post init."""
-        ranks = self.ranks
-        rank_offsets = ranks.cumsum(0) - ranks
-        max_rank = ranks.max().item()
-        self.rank_offsets = rank_offsets
-        self.max_rank = max_rank
+        slot_ids = torch.arange(self.ranks.size(0), device=self.ranks.device)
+        self.rank_offsets = (slot_ids - 1).clamp_min(0) * self.max_rank
+
+    def get_rank_offset(self, slot: int):
+        """first row of the slot in the lora weights."""
+        return max(slot - 1, 0) * self.max_rank
 
 
 class LoRAImpl(ABC):
@@ -21,5 +21,8 @@ def get_backend():
     if device_type == 'camb':
         from .dlinfer import CambOpsBackend
         return CambOpsBackend
+    if device_type == 'cpu':
+        from .cpu import CpuOpsBackend
+        return CpuOpsBackend
     else:
         raise RuntimeError(f'Unsupported device type: {device_type}')
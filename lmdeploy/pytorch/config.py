@@ -62,7 +62,12 @@ class SchedulerConfig:
     max_request_output_len: int = 512
     eviction_type: str = 'recompute'
     prefill_interval: int = 16
+    swap_block_cost: float = 16.0
     max_active_adapters: int = 64
+    prefill_policy: str = 'fcfs'
+    prefill_starvation_time: float = 5.0
+    enable_chunked_prefill: bool = False
+    enable_pipelined_schedule: bool = False
 
 
 @dataclass
@@ -77,8 +82,16 @@ class CacheConfig:
     cache_max_entry_count: float = 0.8
     max_prefill_token_num: int = 4096
     enable_prefix_caching: bool = False
+    enable_host_prefix_caching: bool = False
+    disk_cache_dir: str = None
+    disk_cache_max_blocks: int = 0
+    disk_cache_prewarm_blocks: int = 0
     quant_policy: Literal[0, 4, 8] = 0
     device_type: str = 'cuda'
+    # device slots of lora adapters, defaults to the adapters at start up
+    max_lora_slots: int = None
+    max_lora_rank: int = None
+    lora_target_modules: List[str] = None
 
     def __post_init__(self):
         """post init."""
@@ -87,6 +100,23 @@ class CacheConfig:
         if self.window_size > 1 and self.enable_prefix_caching:
             logger.warning('Prefix caching is not available for window attention.')
             self.enable_prefix_caching = False
+        if self.enable_host_prefix_caching and not self.enable_prefix_caching:
+            logger.warning('Host prefix caching requires prefix caching.')
+            self.enable_host_prefix_caching = False
+        if self.disk_cache_dir is not None and not self.enable_prefix_caching:
+            logger.warning('Disk prefix caching requires prefix caching.')
+            self.disk_cache_dir = None
+
+
+@dataclass
+class SpecDecodeConfig:
+    """Config of speculative decoding."""
+
+    method: Literal['ngram', 'draft_model']
+    num_spec_tokens: int = 4
+    draft_model: str = None
+    ngram_min: int = 1
+    ngram_max: int = 4
 
 
 @dataclass
@@ -1,14 +1,82 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import threading
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass
-from typing import Callable
+from typing import Callable, Tuple
+
+import torch
+
+
+class _HostEvent:
+    """event of the host, kernels on cpu are finished when they return."""
+
+    def record(self, stream=None):
+        pass
+
+    def wait(self, stream=None):
+        pass
+
+    def query(self) -> bool:
+        return True
+
+    def synchronize(self):
+        pass
 
 
 @dataclass
 class DeviceContext:
+    """device of the engine.
+
+    Streams and events are created through the context. The other devices
+    expose their streams through the cuda api of torch, cpu has no stream and
+    its events are always finished.
+    """
     device_type: str = 'cuda'
 
+    @property
+    def is_cpu(self) -> bool:
+        """the engine runs on cpu."""
+        return self.device_type == 'cpu'
+
+    @property
+    def device(self) -> str:
+        """torch device of the tensors."""
+        return 'cpu' if self.is_cpu else 'cuda'
+
+    def new_stream(self):
+        """create a stream."""
+        return None if self.is_cpu else torch.cuda.Stream()
+
+    def current_stream(self):
+        """current stream."""
+        return None if self.is_cpu else torch.cuda.current_stream()
+
+    def stream(self, stream):
+        """context of launching kernels on the stream."""
+        return nullcontext() if self.is_cpu else torch.cuda.stream(stream)
+
+    def new_event(self):
+        """create an event."""
+        return _HostEvent() if self.is_cpu else torch.cuda.Event()
+
+    def synchronize(self):
+        """wait for all the kernels."""
+        if not self.is_cpu:
+            torch.cuda.synchronize()
+
+    def empty_cache(self):
+        """release the cached memory."""
+        if not self.is_cpu:
+            torch.cuda.empty_cache()
+
+    def mem_get_info(self, device_id: int = 0) -> Tuple[int, int]:
+        """free and total memory of the device in bytes."""
+        if self.is_cpu:
+            import psutil
+            mem = psutil.virtual_memory()
+            return mem.available, mem.total
+        return torch.cuda.mem_get_info(device_id)
+
 
 DefaultContext = DeviceContext()
 
@@ -0,0 +1,237 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import atexit
+import glob
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+
+def root_digest(adapter_name: str) -> str:
+    """digest of the trie root of given adapter."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f'adapter:{adapter_name}'.encode())
+    return hasher.hexdigest()
+
+
+def block_digest(parent: str, tokens: np.ndarray) -> str:
+    """chained digest of a token block.
+
+    Unlike builtin `hash`, the digest is stable across processes.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(parent.encode())
+    hasher.update(np.ascontiguousarray(tokens, dtype='<i8').tobytes())
+    return hasher.hexdigest()
+
+
+def model_digest(model_path: str) -> str:
+    """digest of the model identity.
+
+    The resolved model path, the config and the weight index are hashed, so
+    models sharing a directory name do not share a digest.
+    """
+    hasher = hashlib.blake2b(digest_size=8)
+    if not os.path.isdir(model_path):
+        # repo id of the model hub
+        hasher.update(model_path.encode())
+        return hasher.hexdigest()
+    hasher.update(os.path.realpath(model_path).encode())
+    for name in ['config.json', 'model.safetensors.index.json', 'pytorch_model.bin.index.json']:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                hasher.update(name.encode())
+                hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def get_disk_cache_dir(root: str, model_path: str, dtype: torch.dtype, block_size: int, quant_policy: int,
+                       world_size: int):
+    """get the cache directory of the model.
+
+    Caches can only be shared between engines with the same model, dtype,
+    block size, kv quant policy and tensor parallel size.
+    """
+    model_name = os.path.basename(os.path.normpath(model_path))
+    dtype = str(dtype).split('.')[-1]
+    namespace = f'{model_name}-{model_digest(model_path)}-{dtype}-b{block_size}-q{quant_policy}-tp{world_size}'
+    return os.path.join(root, namespace)
+
+
+def _get_block_path(root: str, key: str, rank: int):
+    """get block path."""
+    return os.path.join(root, key[:2], f'{key}.rank{rank}.bin')
+
+
+def _get_block_paths(root: str, key: str):
+    """get block paths of all ranks."""
+    return glob.glob(os.path.join(root, key[:2], f'{key}.rank*.bin'))
+
+
+class LocalDiskBlockStore:
+    """Store cache blocks as files in a local directory.
+
+    Blocks are written by a background thread and loaded with memory mapping.
+
+    Args:
+        root (str): The cache directory.
+        rank (int): Distribution rank, each rank keeps its own shard.
+    """
+
+    def __init__(self, root: str, rank: int = 0):
+        self.root = root
+        self.rank = rank
+        os.makedirs(root, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='DiskCacheWriter')
+        self._pending: Dict[str, Future] = dict()
+
+    def get_path(self, key: str):
+        """get block path."""
+        return _get_block_path(self.root, key, self.rank)
+
+    def _write(self, key: str, data: torch.Tensor):
+        """write block."""
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        data.numpy().tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+    def save(self, key: str, data: torch.Tensor):
+        """save block data(uint8 tensor on host) asynchronously."""
+        self._pending = dict((k, f) for k, f in self._pending.items() if not f.done())
+        self._pending[key] = self._executor.submit(self._write, key, data)
+
+    def load(self, key: str, nbytes: int) -> torch.Tensor:
+        """load block data as a memory mapped uint8 tensor."""
+        future = self._pending.pop(key, None)
+        if future is not None:
+            future.result()
+        return torch.from_file(self.get_path(key), shared=False, size=nbytes, dtype=torch.uint8)
+
+
+class DiskCacheIndex:
+    """Index of blocks stored on disk.
+
+    Entries are kept in LRU order and persisted in a jsonl file, so the
+    hottest prefixes can be reloaded after restart.
+
+    Args:
+        root (str): The cache directory.
+        max_blocks (int): Max number of blocks on disk, 0 means unlimited.
+    """
+    INDEX_NAME = 'index.jsonl'
+    FLUSH_INTERVAL = 64
+
+    def __init__(self, root: str, max_blocks: int = 0):
+        self.root = root
+        self.max_blocks = max_blocks
+        self.entries: Dict[str, Dict] = OrderedDict()
+        self._num_dirty = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+        atexit.register(self.flush)
+
+    @property
+    def index_path(self):
+        """index path."""
+        return os.path.join(self.root, self.INDEX_NAME)
+
+    def _load(self):
+        """load index."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'Skip broken line in {self.index_path}.')
+                    continue
+                key = entry['key']
+                if not os.path.exists(_get_block_path(self.root, key, 0)):
+                    continue
+                self.entries[key] = entry
+        logger.info(f'Load {len(self.entries)} blocks from disk cache {self.root}.')
+
+    def flush(self):
+        """write index to disk."""
+        if self._num_dirty == 0:
+            return
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.index_path)
+        self._num_dirty = 0
+
+    def _mark_dirty(self):
+        """mark index dirty."""
+        self._num_dirty += 1
+        if self._num_dirty >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str):
+        """get entry."""
+        return self.entries.get(key)
+
+    def _remove(self, key: str):
+        """remove entry and block files."""
+        self.entries.pop(key)
+        for path in _get_block_paths(self.root, key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def add(self, key: str, parent: str, adapter_name: str, tokens: np.ndarray):
+        """add block entry, the block file should be written by the cache
+        engine."""
+        self.entries[key] = dict(key=key, parent=parent, adapter=adapter_name, tokens=tokens.tolist(), hits=0)
+        while self.max_blocks > 0 and len(self.entries) > self.max_blocks:
+            self._remove(next(iter(self.entries)))
+        self._mark_dirty()
+
+    def touch(self, key: str):
+        """record a hit of the block."""
+        entry = self.entries[key]
+        entry['hits'] += 1
+        self.entries.move_to_end(key)
+        self._mark_dirty()
+
+    def get_chain(self, key: str) -> List[Dict]:
+        """get entries from the root to the block, empty if any ancestor is
+        missing."""
+        chain = []
+        entry = self.entries.get(key)
+        while entry is not None:
+            chain.append(entry)
+            parent = entry['parent']
+            if parent == root_digest(entry['adapter']):
+                return chain[::-1]
+            entry = self.entries.get(parent)
+        return []
+
+    def hottest(self, num: int) -> List[str]:
+        """keys of the hottest blocks."""
+        entries = sorted(self.entries.values(), key=lambda entry: entry['hits'], reverse=True)
+        return [entry['key'] for entry in entries[:num]]
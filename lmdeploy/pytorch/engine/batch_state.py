@@ -0,0 +1,114 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from collections import OrderedDict
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from ..messages import SchedulerSequence
+
+SeqList = List[SchedulerSequence]
+
+
+class BatchState:
+    """Persistent device states of the running sequences.
+
+    Each sequence owns a slot holding the set of tokens it has seen, which is
+    used by repetition penalty. The tokens of the sequences are synced
+    incrementally when they are scheduled, and the sampled tokens are
+    appended on device, so penalties cost O(vocab) per step instead of
+    gathering the whole context.
+
+    Args:
+        capacity (int): Number of slots, no less than the max batch size.
+        vocab_size (int): Vocabulary size.
+        device (str): Device of the states.
+    """
+
+    def __init__(self, capacity: int, vocab_size: int, device: str = 'cuda'):
+        self.capacity = capacity
+        self.vocab_size = vocab_size
+        self.device = device
+        self.seen_tokens: torch.BoolTensor = None
+        # seq_id -> slot, in LRU order
+        self.slots: Dict[int, int] = OrderedDict()
+        # number of host tokens of each slot that have been synced
+        self.num_synced = np.zeros(capacity, dtype=np.int64)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def _alloc_slot(self, used_seq_ids: set):
+        """alloc a slot, the least recently used slot not in `used_seq_ids`
+        would be evicted if all slots are occupied."""
+        if len(self.free_slots) == 0:
+            for seq_id in self.slots:
+                if seq_id not in used_seq_ids:
+                    self.free_slots.append(self.slots.pop(seq_id))
+                    break
+            else:
+                raise RuntimeError('No available slot of batch state.')
+        return self.free_slots.pop()
+
+    def get_slots(self, seqs: SeqList) -> torch.LongTensor:
+        """get slots of the sequences, new tokens of the sequences are synced
+        to the slots."""
+        if self.seen_tokens is None:
+            # the last column collects invalid tokens
+            self.seen_tokens = torch.zeros(self.capacity, self.vocab_size + 1, dtype=torch.bool, device=self.device)
+        seq_ids = set(seq.seq_id for seq in seqs)
+        slots = []
+        clear_slots = []
+        new_slots = []
+        new_tokens = []
+        for seq in seqs:
+            seq_id = seq.seq_id
+            slot = self.slots.pop(seq_id, None)
+            num_all_ids = seq.num_all_ids
+            if slot is None or num_all_ids < self.num_synced[slot]:
+                # new sequence or tokens have been dropped
+                if slot is None:
+                    slot = self._alloc_slot(seq_ids)
+                clear_slots.append(slot)
+                self.num_synced[slot] = 0
+            self.slots[seq_id] = slot
+            slots.append(slot)
+
+            tokens = seq.all_ids[self.num_synced[slot]:num_all_ids]
+            tokens = tokens[(tokens >= 0) & (tokens < self.vocab_size)]
+            if len(tokens) > 0:
+                new_slots.append(np.full_like(tokens, slot))
+                new_tokens.append(tokens)
+            self.num_synced[slot] = num_all_ids
+
+        if len(clear_slots) > 0:
+            self.seen_tokens[torch.tensor(clear_slots, device=self.device)] = False
+        if len(new_tokens) > 0:
+            new_slots = torch.from_numpy(np.concatenate(new_slots)).to(self.device)
+            new_tokens = torch.from_numpy(np.concatenate(new_tokens)).to(self.device)
+            self.seen_tokens[new_slots, new_tokens] = True
+        return torch.tensor(slots, device=self.device)
+
+    def append(self, slots: torch.LongTensor, token_ids: torch.LongTensor):
+        """mark the sampled tokens as seen on device.
+
+        Args:
+            slots (torch.LongTensor): Slots of shape [batch_size].
+            token_ids (torch.LongTensor): Tokens of shape [batch_size] or
+                [batch_size, num_tokens], negative tokens are ignored.
+        """
+        if token_ids.dim() == 1:
+            token_ids = token_ids[:, None]
+        slots = slots[:, None].expand_as(token_ids)
+        valid = (token_ids >= 0) & (token_ids < self.vocab_size)
+        token_ids = token_ids.where(valid, self.vocab_size)
+        values = torch.ones_like(valid)
+        self.seen_tokens.index_put_((slots, token_ids), values)
+
+    def get_seen_tokens(self, slots: torch.LongTensor) -> torch.BoolTensor:
+        """seen tokens of the slots, of shape [batch_size, vocab_size]."""
+        return self.seen_tokens[slots, :self.vocab_size]
+
+    def release(self, seq_id: int):
+        """release the slot of a sequence."""
+        slot = self.slots.pop(seq_id, None)
+        if slot is not None:
+            self.free_slots.append(slot)
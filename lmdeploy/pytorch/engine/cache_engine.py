@@ -5,9 +5,11 @@ from typing import Dict, List, Literal, Tuple
 import torch
 
 from lmdeploy.pytorch.backends import get_backend
+from lmdeploy.pytorch.devices import get_device_manager
 from lmdeploy.utils import get_logger
 
 from ..config import CacheConfig, ModelConfig
+from ..disk_cache import LocalDiskBlockStore
 
 KVCache = Tuple[torch.Tensor, torch.Tensor]
 
@@ -39,6 +41,7 @@ class CacheEngine:
 
         self.cache_config = cache_config
         self.model_config = model_config
+        self.device_context = get_device_manager().current_context()
 
         self.block_size = cache_config.block_size
         self.num_layers = model_config.num_layers
@@ -56,10 +59,15 @@ class CacheEngine:
         self.local_cpu_cache = self.allocate_cpu_cache()
 
         # Initialize the stream for caching operations.
-        self.cache_stream = torch.cuda.Stream()
-        assert self.cache_stream != torch.cuda.current_stream()
+        self.cache_stream = self.device_context.new_stream()
+        if not self.device_context.is_cpu:
+            assert self.cache_stream != self.device_context.current_stream()
         # Initialize the events for stream synchronization.
-        self.events = torch.cuda.Event()
+        self.events = self.device_context.new_event()
+
+        self.disk_store = None
+        if cache_config.disk_cache_dir is not None:
+            self.disk_store = LocalDiskBlockStore(cache_config.disk_cache_dir, rank=rank)
 
         logger.debug(f'Initialize cache engine with {cache_config.num_gpu_blocks}'
                      f' gpu blocks and {cache_config.num_cpu_blocks} cpu blocks.')
@@ -196,7 +204,7 @@ class CacheEngine:
 
     def allocate_gpu_cache(self):
         """allocate caches on GPU."""
-        caches = self._allocate_cache(self.num_gpu_blocks, 'cuda')
+        caches = self._allocate_cache(self.num_gpu_blocks, self.device_context.device)
         self.full_gpu_cache = caches
         self.local_gpu_cache = list(zip(*caches))
         return self.local_gpu_cache
@@ -223,7 +231,7 @@ class CacheEngine:
         src_idx, dst_idx = list(zip(*src_to_dst.items()))
         src_idx = torch.tensor(src_idx, device=src[0].device)
         dst_idx = torch.tensor(dst_idx, device=dst[0].device)
-        with torch.cuda.stream(self.cache_stream):
+        with self.device_context.stream(self.cache_stream):
             for scache, dcache in zip(src, dst):
                 for idx in range(0, num_copy, BLOCKS_PER_COPY):
                     sidx = src_idx[idx:idx + BLOCKS_PER_COPY]
@@ -248,6 +256,60 @@ class CacheEngine:
         """
         self._swap(self.full_gpu_cache, self.full_cpu_cache, src_to_dst)
 
+    @torch.inference_mode()
+    def copy_blocks(self, dst_to_src: Dict[int, int]) -> None:
+        """Copy caches between device blocks.
+
+        Args:
+            dst_to_src (Dict[int, int]): Map between dst and src.
+        """
+        dst_idx, src_idx = list(zip(*dst_to_src.items()))
+        device = self.full_gpu_cache[0].device
+        src_idx = torch.tensor(src_idx, device=device)
+        dst_idx = torch.tensor(dst_idx, device=device)
+        with self.device_context.stream(self.cache_stream):
+            for cache in self.full_gpu_cache:
+                cache.index_copy_(1, dst_idx, cache[:, src_idx])
+            self.events.record(stream=self.cache_stream)
+
+    def _get_block_caches(self, phy_block: int):
+        """get caches of a block in the unified physical space."""
+        if phy_block < self.num_gpu_blocks:
+            return [cache[:, phy_block] for cache in self.full_gpu_cache]
+        phy_block -= self.num_gpu_blocks
+        return [cache[:, phy_block] for cache in self.full_cpu_cache]
+
+    @torch.inference_mode()
+    def save_to_disk(self, key_to_block: Dict[str, int]) -> None:
+        """Write caches to disk.
+
+        Args:
+            key_to_block (Dict[str, int]): Map between disk key and physical
+                block, blocks after num_gpu_blocks are on host.
+        """
+        with self.device_context.stream(self.cache_stream):
+            for key, phy_block in key_to_block.items():
+                caches = self._get_block_caches(phy_block)
+                data = torch.cat([cache.flatten().view(torch.uint8) for cache in caches]).cpu()
+                self.disk_store.save(key, data)
+
+    @torch.inference_mode()
+    def load_from_disk(self, key_to_block: Dict[str, int]) -> None:
+        """Read caches from disk.
+
+        Args:
+            key_to_block (Dict[str, int]): Map between disk key and gpu block.
+        """
+        caches = [cache[:, 0] for cache in self.full_gpu_cache]
+        nbytes = [cache.numel() * cache.element_size() for cache in caches]
+        with self.device_context.stream(self.cache_stream):
+            for key, block in key_to_block.items():
+                data = self.disk_store.load(key, sum(nbytes))
+                for cache, sdata in zip(self.full_gpu_cache, data.split(nbytes)):
+                    dcache = cache[:, block]
+                    dcache.copy_(sdata.view(dcache.dtype).view(dcache.shape), non_blocking=True)
+            self.events.record(stream=self.cache_stream)
+
     @classmethod
     def get_cache_block_size(cls,
                              block_size: int,
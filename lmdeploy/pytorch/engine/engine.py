@@ -3,6 +3,7 @@
 import asyncio
 import copy
 import os
+import time
 from dataclasses import dataclass
 from typing import Any, Dict, List
 
@@ -13,15 +14,20 @@ from lmdeploy.messages import PytorchEngineConfig, ResponseType
 from lmdeploy.utils import get_logger, get_max_batch_size, get_model, logging_timer
 
 from ..adapter.adapter import AdapterManager
-from ..config import BackendConfig, CacheConfig, SchedulerConfig
+from ..config import BackendConfig, CacheConfig, SchedulerConfig, SpecDecodeConfig
 from ..devices import DeviceContext, get_device_manager
 from ..messages import MessageStatus, SchedulerSequence
 from ..model_inputs import ModelInputs, VisionModelInputs
 from ..paging import Scheduler
+from ..spec_decode import (BaseProposer, DraftModelProposer, NGramProposer, SpecDecodeStats, greedy_verify,
+                           rejection_sample)
+from .batch_state import BatchState
 from .engine_checker import EngineChecker
-from .logits_process import FusedLogitsProcessor, SamplingInputs
+from .logits_process import FusedLogitsProcessor, GuidedDecoding, SamplingInputs
 from .model_agent import build_model_agent
 from .request import Request, RequestManager, RequestType, Response
+from .stats import EngineMetrics, ScheduleStats, StepStats
+from .stop_matcher import StopSequenceMatcher
 
 logger = get_logger('lmdeploy')
 
@@ -40,6 +46,10 @@ class InferOutput:
     meta: Any = None
     finish: bool = False
     logits: torch.Tensor = None
+    # token ids of all sequences of parallel sampling
+    choices: List[List[int]] = None
+    # engine side timeline of the finished request
+    timeline: Dict[str, Any] = None
 
 
 def _tensorlize_block_offsets(block_offsets):
@@ -69,7 +79,13 @@ def _build_scheduler_config(engine_config: PytorchEngineConfig):
     """build scheduler config."""
     scheduler_config = SchedulerConfig(max_batches=engine_config.max_batch_size,
                                        max_session_len=engine_config.session_len,
-                                       prefill_interval=engine_config.prefill_interval)
+                                       prefill_interval=engine_config.prefill_interval,
+                                       eviction_type=engine_config.eviction_type,
+                                       max_active_adapters=engine_config.max_active_adapters,
+                                       prefill_policy=engine_config.prefill_policy,
+                                       prefill_starvation_time=engine_config.prefill_starvation_time,
+                                       enable_chunked_prefill=engine_config.enable_chunked_prefill,
+                                       enable_pipelined_schedule=engine_config.enable_pipelined_schedule)
     return scheduler_config
 
 
@@ -83,12 +99,31 @@ def _build_cache_config(engine_config: PytorchEngineConfig):
         cache_max_entry_count=engine_config.cache_max_entry_count,
         max_prefill_token_num=engine_config.max_prefill_token_num,
         enable_prefix_caching=engine_config.enable_prefix_caching,
+        enable_host_prefix_caching=engine_config.enable_host_prefix_caching,
+        disk_cache_dir=engine_config.disk_cache_dir,
+        disk_cache_max_blocks=engine_config.disk_cache_max_blocks,
+        disk_cache_prewarm_blocks=engine_config.disk_cache_prewarm_blocks,
         quant_policy=engine_config.quant_policy,
         device_type=engine_config.device_type,
+        max_lora_slots=engine_config.max_lora_slots,
+        max_lora_rank=engine_config.max_lora_rank,
+        lora_target_modules=engine_config.lora_target_modules,
     )
     return cache_config
 
 
+def _build_spec_decode_config(engine_config: PytorchEngineConfig):
+    """build speculative decoding config."""
+    if engine_config.speculative_method is None:
+        return None
+    spec_decode_config = SpecDecodeConfig(method=engine_config.speculative_method,
+                                          num_spec_tokens=engine_config.num_speculative_tokens,
+                                          draft_model=engine_config.speculative_draft_model,
+                                          ngram_min=engine_config.ngram_prompt_lookup_min,
+                                          ngram_max=engine_config.ngram_prompt_lookup_max)
+    return spec_decode_config
+
+
 def _build_backend_config(engine_config: PytorchEngineConfig):
     """build backend config."""
     backend_config = BackendConfig(
@@ -152,13 +187,15 @@ class Engine:
                                                  adapters=adapters,
                                                  tp=self.tp,
                                                  dtype=engine_config.dtype,
-                                                 custom_module_map=engine_config.custom_module_map)
+                                                 custom_module_map=engine_config.custom_module_map,
+                                                 simulated_model=engine_config.simulated_model,
+                                                 simulated_latency_model=engine_config.simulated_latency_model)
 
         self.input_processor = self.model_agent.get_input_processor()
 
         cache_config = self.model_agent.cache_config
-        self.adapter_manager = self._build_adapter_manager(adapters)
-        self.scheduler = Scheduler(scheduler_config, cache_config)
+        self.adapter_manager = self._build_adapter_manager(adapters, cache_config.max_lora_slots)
+        self.scheduler = Scheduler(scheduler_config, cache_config, adapter_manager=self.adapter_manager)
 
         self.scheduler_config = scheduler_config
         self.cache_config = cache_config
@@ -166,11 +203,20 @@ class Engine:
         self.stream = self.model_agent.stream
         self.max_session_len = self._get_max_session_len()
 
+        self.spec_decode_config = _build_spec_decode_config(engine_config)
+        self.proposer = self._build_proposer(self.spec_decode_config, trust_remote_code)
+        self.spec_decode_stats = SpecDecodeStats()
+        self.step_stats = StepStats()
+        self.metrics = EngineMetrics()
+        self.batch_state = BatchState(scheduler_config.max_batches,
+                                      self.model_config.vocab_size,
+                                      device=self.device_context.device)
+
         self.req_manager = self._bind_request_manager()
 
         # create main thread
         self._start_loop()
-        self._output_stream = torch.cuda.Stream()
+        self._output_stream = self.device_context.new_stream()
 
     @classmethod
     def from_pretrained(cls,
@@ -217,8 +263,110 @@ class Engine:
 
         return new_adapters
 
-    def _build_adapter_manager(self, adapters):
-        return AdapterManager(adapters)
+    def _build_adapter_manager(self, adapters: Dict[str, str], num_slots: int = None):
+        return AdapterManager(adapters, num_slots=num_slots)
+
+    def _build_proposer(self, spec_decode_config: SpecDecodeConfig, trust_remote_code: bool) -> BaseProposer:
+        """build proposer of speculative decoding."""
+        if spec_decode_config is None:
+            return None
+        num_spec_tokens = spec_decode_config.num_spec_tokens
+        if spec_decode_config.method == 'ngram':
+            return NGramProposer(num_spec_tokens,
+                                 min_n=spec_decode_config.ngram_min,
+                                 max_n=spec_decode_config.ngram_max)
+
+        draft_model = spec_decode_config.draft_model
+        if not os.path.exists(draft_model):
+            draft_model = get_model(draft_model, self.engine_config.download_dir)
+        # draft caches share block tables with the target caches.
+        draft_cache_config = copy.deepcopy(self.cache_config)
+        draft_cache_config.disk_cache_dir = None
+        # adapters are not applied to the draft model
+        draft_cache_config.max_lora_slots = 0
+        with get_device_manager().context(self.device_context):
+            draft_agent = build_model_agent(draft_model,
+                                            cache_config=draft_cache_config,
+                                            backend_config=self.backend_config,
+                                            trust_remote_code=trust_remote_code,
+                                            dtype=self.engine_config.dtype,
+                                            simulated_model=self.engine_config.simulated_model,
+                                            simulated_latency_model=self.engine_config.simulated_latency_model)
+        if draft_agent.cache_config.block_size != self.cache_config.block_size:
+            raise RuntimeError('Draft model requires block_size='
+                               f'{draft_agent.cache_config.block_size}, '
+                               f'but target model uses {self.cache_config.block_size}.')
+        if draft_agent.model_config.vocab_size != self.model_config.vocab_size:
+            logger.warning('Vocab size of the draft model mismatches the target model.')
+        return DraftModelProposer(draft_agent, num_spec_tokens)
+
+    def get_spec_decode_stats(self) -> SpecDecodeStats:
+        """get acceptance statistics of speculative decoding."""
+        return self.spec_decode_stats
+
+    def get_step_stats(self) -> StepStats:
+        """get host time statistics of the engine steps."""
+        return self.step_stats
+
+    def get_schedule_stats(self) -> ScheduleStats:
+        """get queue depth and free cache blocks of the scheduler."""
+        scheduler = self.scheduler
+        return ScheduleStats(num_waiting=scheduler.num_waiting(),
+                             num_running=scheduler.num_running(),
+                             num_free_gpu_blocks=scheduler.block_manager.get_num_free_gpu_blocks(),
+                             num_gpu_blocks=self.cache_config.num_gpu_blocks)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """get the metrics of the engine.
+
+        Histograms and counters are aggregated by the engine loop, gauges are
+        read from the scheduler when called.
+        """
+        metrics = self.metrics
+        scheduler = self.scheduler
+        block_manager = scheduler.block_manager
+        num_free_gpu_blocks = block_manager.get_num_free_gpu_blocks()
+        num_free_cpu_blocks = block_manager.get_num_free_cpu_blocks()
+        prefix_cache_stats = scheduler.block_trie.stats
+        ret = dict(
+            time_to_first_token_seconds=metrics.time_to_first_token,
+            inter_token_latency_seconds=metrics.inter_token_latency,
+            queue_time_seconds=metrics.queue_time,
+            prefill_batch_size=metrics.prefill_batch_size,
+            decode_batch_size=metrics.decode_batch_size,
+            step_tokens=metrics.step_tokens,
+            schedule_time_seconds=metrics.schedule_time,
+            host_time_seconds=metrics.host_time,
+            generation_tokens_total=metrics.num_generation_tokens,
+            finished_requests_total=metrics.num_finished_requests,
+            steps_total=self.step_stats.num_steps,
+            pipelined_steps_total=self.step_stats.num_pipelined_steps,
+            num_requests_waiting=scheduler.num_waiting(),
+            num_requests_running=scheduler.num_running(),
+            gpu_blocks_free=num_free_gpu_blocks,
+            gpu_blocks_used=block_manager.num_gpu_blocks - num_free_gpu_blocks,
+            cpu_blocks_free=num_free_cpu_blocks,
+            cpu_blocks_used=block_manager.num_cpu_blocks - num_free_cpu_blocks,
+            prefix_cache_query_blocks_total=prefix_cache_stats.num_query_blocks,
+            prefix_cache_hit_blocks_total=prefix_cache_stats.num_all_hit_blocks,
+            prefix_cache_hit_rate=prefix_cache_stats.hit_rate,
+            prefix_cache_evicted_blocks_total=prefix_cache_stats.num_evicted_blocks,
+            evicted_sequences_total=scheduler.eviction_helper.num_evicted_seqs,
+        )
+        if self.proposer is not None:
+            spec_decode_stats = self.spec_decode_stats
+            ret.update(spec_decode_draft_tokens_total=spec_decode_stats.num_draft_tokens,
+                       spec_decode_accepted_tokens_total=spec_decode_stats.num_accepted_tokens,
+                       spec_decode_emitted_tokens_total=spec_decode_stats.num_emitted_tokens)
+        # the graph runner lives in other processes with tensor parallelism
+        graph_runner = getattr(self.model_agent, 'patched_model', None)
+        if graph_runner is not None and hasattr(graph_runner, 'get_graph_stats'):
+            graph_stats = graph_runner.get_graph_stats()
+            if len(graph_stats) > 0:
+                ret.update(cuda_graph_hits_total=graph_stats['num_graph_hits'],
+                           cuda_graph_misses_total=graph_stats['num_graph_misses'],
+                           eager_forwards_total=graph_stats['num_eager_forwards'])
+        return ret
 
     def _bind_request_manager(self):
         """bind request manager."""
@@ -227,6 +375,8 @@ class Engine:
         req_manager.bind_func(RequestType.STOP_SESSION, self._on_stop_session)
         req_manager.bind_func(RequestType.END_SESSION, self._on_end_session)
         req_manager.bind_func(RequestType.ADD_MESSAGE, self._on_add_message)
+        req_manager.bind_func(RequestType.LOAD_ADAPTER, self._on_load_adapter)
+        req_manager.bind_func(RequestType.UNLOAD_ADAPTER, self._on_unload_adapter)
         return req_manager
 
     def _start_loop(self):
@@ -289,6 +439,53 @@ class Engine:
             if resp:
                 self._response(req.resp, resp_type)
 
+    def _load_adapter(self, adapter_name: str, adapter_path: str):
+        """load an adapter to host memory, it is paged into a device slot
+        when scheduled."""
+        if self.adapter_manager.num_slots == 0:
+            raise RuntimeError('No lora slot, set `max_lora_slots` to load adapters at runtime.')
+        adapter_path = self._download_adapters({adapter_name: adapter_path}, self.engine_config)[adapter_name]
+        adapter_id = self.adapter_manager.add_adapter(adapter_name, adapter_path)
+        try:
+            self.model_agent.load_adapter(adapter_id, adapter_path)
+        except Exception:
+            self.adapter_manager.remove_adapter(adapter_name, reserve_name=False)
+            raise
+
+    def _on_load_adapter(self, reqs: Request, **kwargs):
+        """on load adapter callback."""
+        for req in reqs:
+            adapter_name = req.data['adapter_name']
+            try:
+                self._load_adapter(adapter_name, req.data['adapter_path'])
+            except Exception as e:
+                logger.error(f'Failed to load adapter <{adapter_name}>: {e}')
+                self._response(req.resp, ResponseType.INTERNAL_ENGINE_ERROR, err_msg=str(e))
+                continue
+            logger.info(f'Adapter <{adapter_name}> is loaded.')
+            self._response(req.resp, ResponseType.SUCCESS)
+
+    def _on_unload_adapter(self, reqs: Request, **kwargs):
+        """on unload adapter callback."""
+        for req in reqs:
+            adapter_name = req.data['adapter_name']
+            if adapter_name is None or not self.adapter_manager.has_adapter(adapter_name):
+                self._response(req.resp, ResponseType.ADAPTER_NOT_EXIST, err_msg=f'Adapter <{adapter_name}> not found.')
+                continue
+            session_ids = [
+                session_id for session_id, sess in self.scheduler.sessions.items()
+                if any(seq.adapter_name == adapter_name for seq in sess.sequences.values())
+            ]
+            if len(session_ids) > 0:
+                self._response(req.resp,
+                               ResponseType.INTERNAL_ENGINE_ERROR,
+                               err_msg=f'Adapter <{adapter_name}> is used by sessions {session_ids}.')
+                continue
+            adapter_id = self.adapter_manager.remove_adapter(adapter_name)
+            self.model_agent.unload_adapter(adapter_id)
+            logger.info(f'Adapter <{adapter_name}> is unloaded.')
+            self._response(req.resp, ResponseType.SUCCESS)
+
     def _on_add_message(self, reqs: Request, **kwargs):
         """on add message callback."""
         for req in reqs:
@@ -314,6 +511,16 @@ class Engine:
         if len(reqs) > 0:
             self._add_message(reqs)
 
+    def _support_parallel_sampling(self, req_data: Dict[str, Any]):
+        """parallel sampling requires a new session without multimodal
+        inputs, and blocks can not be reused by sliding window."""
+        if self.cache_config.window_size >= 0:
+            return False
+        if req_data.get('input_multimodals') or req_data.get('input_embeddings'):
+            return False
+        session = self.scheduler.sessions[req_data['session_id']]
+        return len(session.sequences) == 0
+
     def _add_message(self, reqs):
 
         def __update_bad_words(msg):
@@ -345,8 +552,17 @@ class Engine:
             # TODO: support 1 session n sequence
             sampling_param = req.data['sampling_param']
             return_logits = sampling_param.out_logits
+            if sampling_param.n > 1 and not self._support_parallel_sampling(req.data):
+                logger.warning(f'session[{session_id}] parallel sampling is not supported, fallback to n=1.')
+                sampling_param.n = 1
             if len(sess.sequences) == 0:
                 assert len(req.data['token_ids']) > 0, ('Empty input is not allowed.')
+                adapter_name = req.data['adapter_name']
+                if not self.adapter_manager.has_adapter(adapter_name):
+                    self._response(req.resp,
+                                   ResponseType.ADAPTER_NOT_EXIST,
+                                   err_msg=f'Adapter <{adapter_name}> not found.')
+                    continue
                 sess.add_sequence(
                     req.data['token_ids'],
                     sampling_param=sampling_param,
@@ -354,6 +570,7 @@ class Engine:
                     return_logits=return_logits,
                     multimodals=req.data.get('input_multimodals'),
                     input_embeddings=req.data.get('input_embeddings'),
+                    priority=req.data.get('priority', 0),
                 )
                 msg = next(iter(sess.sequences.values()))
                 __update_bad_words(msg)
@@ -369,10 +586,17 @@ class Engine:
                 msg.num_new_tokens = 0
                 msg.sampling_param = sampling_param
                 msg.return_logits = return_logits
+                msg.priority = req.data.get('priority', 0)
                 msg.status = MessageStatus.WAITING
                 __update_bad_words(msg)
                 __update_max_new_tokens(msg)
 
+            msg.request_time = time.time()
+            msg.scheduled_time = None
+            msg.first_token_time = None
+            msg.last_token_time = None
+            msg.scheduled_step = None
+            msg.first_token_step = None
             msg.resp = req.resp
 
     @property
@@ -385,16 +609,30 @@ class Engine:
         return self.tp
 
     @logging_timer('CreateModelInputs', logger)
-    def create_model_inputs(self, messages: SeqList, is_prefill: bool):
+    def create_model_inputs(self,
+                            messages: SeqList,
+                            is_prefill: bool,
+                            prefill_chunks: Dict[int, int] = None,
+                            draft_token_ids: List[np.ndarray] = None):
         """create model inputs from messages.
 
         Args:
             messages (SeqList): The input messages.
+            is_prefill (bool): Prefill or mixed batch.
+            prefill_chunks (Dict[int, int]): Number of tokens to compute of
+                the sequences with unfinished chunked prefill.
+            draft_token_ids (List[np.ndarray]): Draft tokens to be verified
+                following the decoding tokens.
         """
+        if prefill_chunks is None:
+            prefill_chunks = dict()
         history_lengths = [msg.history_len for msg in messages]
         history_lengths = torch.tensor(history_lengths)
 
-        token_ids = [msg.token_ids for msg in messages]
+        token_ids = [msg.token_ids[:prefill_chunks.get(msg.seq_id)] for msg in messages]
+        if draft_token_ids is not None:
+            token_ids = [np.concatenate([tokens, draft]) for tokens, draft in zip(token_ids, draft_token_ids)]
+            is_prefill = True
 
         if isinstance(token_ids[0], int):
             token_ids = [token_ids]
@@ -403,8 +641,14 @@ class Engine:
         input_ids = torch.from_numpy(np.concatenate(token_ids))
 
         is_decoding = not is_prefill
+        num_decoding = 0
         if not is_decoding:
             seq_length = [len(tokens) for tokens in token_ids]
+            # decoding sequences are placed first in mixed batch
+            for msg, q_len in zip(messages, seq_length):
+                if msg.num_new_tokens == 0 or q_len != 1:
+                    break
+                num_decoding += 1
             seq_length = torch.tensor(seq_length, dtype=torch.long)
         else:
             seq_length = torch.ones(batch_size, dtype=torch.long)
@@ -414,7 +658,7 @@ class Engine:
         block_offsets = _tensorlize_block_offsets(block_offsets)
 
         local_adapter_ids = None
-        if self.adapter_manager.num_adapters() > 1:
+        if self.adapter_manager.num_slots > 0:
             adapter_names = [msg.adapter_name for msg in messages]
             local_adapter_ids = self.adapter_manager.get_adapter_ids(adapter_names)
             local_adapter_ids = seq_length.new_tensor(local_adapter_ids)
@@ -499,23 +743,135 @@ class Engine:
             cross_length=cross_length,
             history_cross_length=history_cross_length,
             model_metas=model_metas,
+            num_decoding=num_decoding,
         )
 
-    def _batch_stopping_criteria(self, token_ids: torch.Tensor, stop_words: torch.Tensor,
-                                 num_appendable_ids: torch.Tensor):
+    def _batch_stopping_criteria(self,
+                                 token_ids: torch.Tensor,
+                                 stop_words: torch.Tensor,
+                                 num_appendable_ids: torch.Tensor,
+                                 stop_matched: torch.Tensor = None):
         """batched stopping criteria."""
         num_appendable_ids = num_appendable_ids - 1
         # one more step to cache last token(stop word)
         stopped = num_appendable_ids < 0
+        sw_stopped = None
         if stop_words is not None:
             sw_stopped = (token_ids[:, None] == stop_words).any(1)
+        if stop_matched is not None:
+            sw_stopped = stop_matched if sw_stopped is None else sw_stopped | stop_matched
+        if sw_stopped is not None:
             one_ids = torch.clamp_max(num_appendable_ids, 0)
             num_appendable_ids = torch.where(sw_stopped, one_ids, num_appendable_ids)
         return stopped, num_appendable_ids
 
+    def _spec_stopping_criteria(self,
+                                token_ids: torch.Tensor,
+                                stop_words: torch.Tensor,
+                                num_appendable_ids: torch.Tensor,
+                                stop_matcher: StopSequenceMatcher = None,
+                                num_ignore_eos: torch.Tensor = None):
+        """stopping criteria of multiple tokens, tokens after the stopping
+        position are dropped."""
+        stopped = token_ids.new_zeros(token_ids.size(0), dtype=torch.bool)
+        keep = []
+        for idx in range(token_ids.size(1)):
+            step_token_ids = token_ids[:, idx]
+            stop_matched = None
+            if stop_matcher is not None:
+                stop_matched = stop_matcher.step(step_token_ids, mask=step_token_ids >= 0)
+                if num_ignore_eos is not None:
+                    stop_matched = stop_matched & (num_ignore_eos <= idx)
+            step_stopped, num_appendable_ids = self._batch_stopping_criteria(step_token_ids,
+                                                                             stop_words,
+                                                                             num_appendable_ids,
+                                                                             stop_matched=stop_matched)
+            stopped = stopped | step_stopped
+            keep.append(~stopped)
+        keep = torch.stack(keep, 1)
+        token_ids = token_ids.masked_fill(~keep, -1)
+        return token_ids, ~keep[:, 0]
+
+    @logging_timer('VerifyLogits', logger)
+    async def async_verify_logits(self,
+                                  logits: torch.Tensor,
+                                  draft_token_ids: torch.Tensor,
+                                  all_ids: torch.Tensor,
+                                  guided_decoding: GuidedDecoding,
+                                  sampling_inputs: SamplingInputs,
+                                  inputs: ModelInputs,
+                                  num_ignore_eos: torch.Tensor,
+                                  seen_tokens: torch.BoolTensor = None):
+        """verify draft tokens with the logits of all positions.
+
+        Logits are processed by the same logits processor of sampling as if
+        the draft tokens were generated one by one.
+        """
+        batch_size, num_spec_tokens = draft_token_ids.shape
+        num_pos = num_spec_tokens + 1
+        seq_length = inputs.seq_length
+        start_loc = seq_length.cumsum(0) - seq_length
+        pos = torch.arange(num_pos, device=seq_length.device)
+        pos = torch.minimum(pos[None, :], seq_length[:, None] - 1)
+        logits = logits[(start_loc[:, None] + pos).flatten()]
+
+        pad_id = self.model_config.bos_token_id
+        pad_id = 0 if pad_id is None else pad_id
+        padded_drafts = draft_token_ids.masked_fill(draft_token_ids < 0, pad_id)
+
+        def __expand_ids(ids: torch.Tensor):
+            """ids of each position, draft tokens are appended."""
+            if ids is None:
+                return None
+            ids = torch.cat([ids, padded_drafts.to(ids.device)], 1)
+            seq_len = ids.size(1) - num_spec_tokens
+            out = [
+                torch.nn.functional.pad(ids[:, :seq_len + idx], (num_spec_tokens - idx, 0), value=pad_id)
+                for idx in range(num_pos)
+            ]
+            return torch.stack(out, 1).flatten(0, 1)
+
+        def __expand_seen_tokens(seen_tokens: torch.Tensor):
+            """seen tokens of each position, draft tokens are marked."""
+            if seen_tokens is None:
+                return None
+            vocab_size = seen_tokens.size(1)
+            device = seen_tokens.device
+            valid = (draft_token_ids >= 0) & (draft_token_ids < vocab_size)
+            drafts = draft_token_ids.where(valid, 0)
+            out = seen_tokens[:, None].repeat(1, num_pos, 1)
+            rows = torch.arange(batch_size, device=device)[:, None]
+            for idx in range(num_spec_tokens):
+                pos = torch.arange(idx + 1, num_pos, device=device)[None, :]
+                tokens = drafts[:, idx, None]
+                out[rows, pos, tokens] = out[rows, pos, tokens] | valid[:, idx, None]
+            return out.flatten(0, 1)
+
+        all_ids = __expand_ids(all_ids)
+        seen_tokens = __expand_seen_tokens(seen_tokens)
+        if guided_decoding is not None:
+            guided_decoding = guided_decoding.repeat_with_drafts(draft_token_ids)
+        expanded_inputs = sampling_inputs.repeat_interleave(num_pos)
+        ignore_eos = (num_ignore_eos[:, None] - torch.arange(num_pos, device=num_ignore_eos.device)) > 0
+        ignore_eos = ignore_eos.flatten()
+
+        logits_processor = FusedLogitsProcessor(expanded_inputs, ignore_eos)
+        logits = await logits_processor(all_ids, guided_decoding, logits, seen_tokens)
+        if sampling_inputs.max_top_k == 1:
+            target_token_ids = logits.argmax(-1).view(batch_size, num_pos)
+            return greedy_verify(draft_token_ids, target_token_ids)
+        target_probs = logits_processor.get_probs(logits).view(batch_size, num_pos, -1)
+        return rejection_sample(draft_token_ids, target_probs)
+
     @logging_timer('SamplingLogits', logger)
-    async def async_sampling_logits(self, logits: torch.Tensor, all_ids: torch.Tensor, guided_input_ids: torch.Tensor,
-                                    sampling_inputs: SamplingInputs, inputs: ModelInputs, ignore_eos: torch.Tensor):
+    async def async_sampling_logits(self,
+                                    logits: torch.Tensor,
+                                    all_ids: torch.Tensor,
+                                    guided_decoding: GuidedDecoding,
+                                    sampling_inputs: SamplingInputs,
+                                    inputs: ModelInputs,
+                                    ignore_eos: torch.Tensor,
+                                    seen_tokens: torch.BoolTensor = None):
         """sampling logits."""
 
         def __get_last_logits():
@@ -528,36 +884,66 @@ class Engine:
             return logits[last_idx, :]
 
         split_logits = __get_last_logits()
-        logits_processor = FusedLogitsProcessor(sampling_inputs, ignore_eos, self.tokenizer.model.model)
-        logits = await logits_processor(all_ids, guided_input_ids, split_logits)
+        logits_processor = FusedLogitsProcessor(sampling_inputs, ignore_eos)
+        logits = await logits_processor(all_ids, guided_decoding, split_logits, seen_tokens)
         next_token_ids = logits_processor.sampling(logits)
 
         return next_token_ids
 
     @logging_timer('UpdateRunning', logger)
-    def update_running(self, running: SeqList, next_token_ids: torch.Tensor, stopped: torch.Tensor,
-                       model_metas: List[Dict[str, Any]]):
+    def update_running(self,
+                       running: SeqList,
+                       next_token_ids: torch.Tensor,
+                       stopped: torch.Tensor,
+                       model_metas: List[Dict[str, Any]],
+                       prefill_chunks: Dict[int, int] = None):
         """update scheduler."""
         if model_metas is None:
             model_metas = [None] * len(running)
+        if prefill_chunks is None:
+            prefill_chunks = dict()
         next_token_ids = next_token_ids.numpy()
         for token, msg, stop, model_meta in zip(next_token_ids, running, stopped, model_metas):
+            if token.ndim > 0:
+                # speculative decoding, padded with -1
+                token = token[token >= 0]
             if msg.status != MessageStatus.RUNNING:
                 continue
+            if msg.seq_id in prefill_chunks:
+                # unfinished prefill, no token is generated.
+                msg.set_step(msg.num_history_ids + prefill_chunks[msg.seq_id])
+                msg.model_meta = model_meta
+                continue
+            if msg.sampling_param.n > 1 and len(msg.session.sequences) == 1:
+                # fork before the prompt is moved to history
+                for child in self.scheduler.fork_sequence(msg):
+                    child.resp = msg.resp
             update_token = token
             if stop:
                 update_token = _EMPTY_TOKEN
             else:
-                msg.num_new_tokens += 1
+                msg.num_new_tokens += token.size
             msg.update_token_ids(update_token, model_meta=model_meta)
+            if token.size > 1 and not stop:
+                # caches of accepted draft tokens have been filled
+                msg.set_step(msg.num_all_ids - 1)
+                msg.model_meta = model_meta
             if stop:
                 msg.status = MessageStatus.STOPPED
+                self.batch_state.release(msg.seq_id)
 
     @logging_timer('ModelForward', logger)
-    async def _async_model_forward(self, inputs: ModelInputs, swap_in_map: Dict, swap_out_map: Dict,
-                                   return_logits: bool):
+    async def _async_model_forward(self,
+                                   inputs: ModelInputs,
+                                   swap_in_map: Dict,
+                                   swap_out_map: Dict,
+                                   return_logits: bool,
+                                   disk_save_map: Dict = None,
+                                   disk_load_map: Dict = None,
+                                   copy_map: Dict = None):
         """model forward."""
         max_prefill_token_num = self.cache_config.max_prefill_token_num
+        device_context = self.device_context
         swap_done = False
 
         class _OutputGather:
@@ -589,7 +975,7 @@ class Engine:
                 """get tmp_output."""
                 if not return_logits:
                     return self._output[:, -1:]
-                torch.cuda.synchronize()
+                device_context.synchronize()
                 return self._output
 
         async def __forward(inputs):
@@ -599,7 +985,12 @@ class Engine:
                 return await self.model_agent.async_forward(inputs, swap_in_map=dict(), swap_out_map=dict())
             else:
                 swap_done = True
-                return await self.model_agent.async_forward(inputs, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+                return await self.model_agent.async_forward(inputs,
+                                                            swap_in_map=swap_in_map,
+                                                            swap_out_map=swap_out_map,
+                                                            disk_save_map=disk_save_map,
+                                                            disk_load_map=disk_load_map,
+                                                            copy_map=copy_map)
 
         async def __long_context_single_forward(inputs):
             """one large sequence."""
@@ -621,7 +1012,9 @@ class Engine:
             tmp_out['hidden_states'] = output_gather.get_output()
             return tmp_out
 
-        if inputs.input_ids.numel() <= max_prefill_token_num:
+        # batched inputs are never larger than max_prefill_token_num except
+        # mixed batch of chunked prefill, which should not be split.
+        if inputs.input_ids.numel() <= max_prefill_token_num or inputs.seq_length.size(0) > 1:
             ret = await __forward(inputs)
             if not return_logits and not inputs.is_decoding:
                 last_token_loc = inputs.seq_length.cumsum(0) - 1
@@ -632,19 +1025,27 @@ class Engine:
                 last_token_loc = [-1]
                 ret['hidden_states'] = ret['hidden_states'][:, last_token_loc]
             else:
-                ret['hidden_states'] = ret['hidden_states'].to('cuda')
+                ret['hidden_states'] = ret['hidden_states'].to(self.device_context.device)
 
         hidden_states = ret.pop('hidden_states')
         logits = self.model_agent.get_logits(hidden_states)
         ret['logits'] = logits
         return ret
 
-    async def _make_infer_outputs(self, next_token_ids: torch.LongTensor, logits: torch.Tensor, stopped: torch.Tensor,
-                                  model_metas: List[Dict[str, Any]], event: torch.cuda.Event):
+    async def _make_infer_outputs(self,
+                                  next_token_ids: torch.LongTensor,
+                                  logits: torch.Tensor,
+                                  stopped: torch.Tensor,
+                                  model_metas: List[Dict[str, Any]],
+                                  event: Any,
+                                  running: SeqList,
+                                  inputs: ModelInputs,
+                                  prefill_chunks: Dict[int, int],
+                                  num_draft_tokens: List[int] = None,
+                                  num_accepted_tokens: torch.LongTensor = None):
         """make infer output."""
 
         def __get_q_start_loc():
-            inputs = self._inputs
             seq_length = inputs.seq_length
             batch_size = len(seq_length)
             if inputs.is_decoding:
@@ -654,14 +1055,51 @@ class Engine:
 
         while not event.query():
             await asyncio.sleep(0.001)
-        with torch.cuda.stream(self._output_stream):
+        with self.device_context.stream(self._output_stream):
             next_token_ids = next_token_ids.cpu()
             stopped = stopped.cpu()
-
-        running = self._running
-        is_run = [seq.status == MessageStatus.RUNNING for seq in running]
+            if num_accepted_tokens is not None:
+                num_accepted_tokens = num_accepted_tokens.cpu()
+
+        if num_draft_tokens is not None:
+            num_emitted_tokens = (next_token_ids >= 0).sum(1).masked_fill(stopped, 0)
+            self.spec_decode_stats.update(np.array(num_draft_tokens), num_accepted_tokens.numpy(),
+                                          num_emitted_tokens.numpy())
+
+        def __get_new_token_ids(msg: SchedulerSequence):
+            """get generated token ids."""
+            return msg.all_ids[msg.num_all_ids - msg.num_new_tokens:]
+
+        def __get_timeline(msg: SchedulerSequence):
+            """get the timeline of a finished request."""
+            return dict(arrive_time=msg.request_time,
+                        scheduled_time=msg.scheduled_time,
+                        first_token_time=msg.first_token_time,
+                        finish_time=msg.last_token_time,
+                        scheduled_step=msg.scheduled_step,
+                        first_token_step=msg.first_token_step,
+                        finish_step=self.metrics.num_forwards - 1)
+
+        def __make_choices_output(msg: SchedulerSequence):
+            """make output of all sequences in the session."""
+            seqs = sorted(msg.session.sequences.values(), key=lambda seq: seq.seq_id)
+            choices = [__get_new_token_ids(seq) for seq in seqs]
+            finish = all(seq.status == MessageStatus.STOPPED for seq in seqs)
+            return InferOutput(session_id=msg.session_id,
+                               resp=msg.resp,
+                               finish=finish,
+                               token_ids=choices[0],
+                               choices=choices,
+                               timeline=__get_timeline(msg) if finish else None)
+
+        is_run = [seq.status == MessageStatus.RUNNING and seq.seq_id not in prefill_chunks for seq in running]
+        if next_token_ids.dim() == 1:
+            num_step_tokens = [1] * len(running)
+        else:
+            num_step_tokens = (next_token_ids >= 0).sum(1).tolist()
         stopped = stopped.tolist()
-        self.update_running(running, next_token_ids, stopped, model_metas)
+        self.update_running(running, next_token_ids, stopped, model_metas, prefill_chunks)
+        self.metrics.update_outputs(running, is_run, num_step_tokens, stopped)
 
         # generate output
         next_token_ids = next_token_ids.tolist()
@@ -670,6 +1108,10 @@ class Engine:
         for idx, msg in enumerate(running):
             if not is_run[idx]:
                 continue
+            if msg.sampling_param.n > 1:
+                if msg.session_id not in outputs:
+                    outputs[msg.session_id] = __make_choices_output(msg)
+                continue
             token_ids = msg.all_ids[-msg.num_new_tokens:]
             finish = msg.status == MessageStatus.STOPPED
             if not finish and len(token_ids) == 0:
@@ -681,76 +1123,116 @@ class Engine:
                 resp=resp,
                 finish=finish,
                 token_ids=token_ids,
+                timeline=__get_timeline(msg) if finish else None,
             )
             outputs[session_id] = out
 
             if msg.return_logits:
-                inputs = self._inputs
                 start = q_start_loc[idx]
                 seqlen = inputs.seq_length[idx]
                 outputs[session_id].logits = logits[start:start + seqlen]
         return outputs
 
-    async def _async_step_background(self, inputs: ModelInputs, swap_in_map: Dict, swap_out_map: Dict,
-                                     all_ids: torch.Tensor, guided_input_ids: torch.Tensor,
-                                     sampling_inputs: SamplingInputs, num_appendable_ids: torch.LongTensor,
-                                     num_ignore_eos: torch.LongTensor, loop_count: int, return_logits: bool,
-                                     output_que: asyncio.Queue):
-        """asyc forward task."""
+    async def _async_step_background(self,
+                                     running: SeqList,
+                                     prefill_chunks: Dict[int, int],
+                                     inputs: ModelInputs,
+                                     swap_in_map: Dict,
+                                     swap_out_map: Dict,
+                                     all_ids: torch.Tensor,
+                                     seen_slots: torch.LongTensor,
+                                     guided_decoding: GuidedDecoding,
+                                     stop_matcher: StopSequenceMatcher,
+                                     sampling_inputs: SamplingInputs,
+                                     num_appendable_ids: torch.LongTensor,
+                                     num_ignore_eos: torch.LongTensor,
+                                     loop_count: int,
+                                     return_logits: bool,
+                                     output_que: asyncio.Queue,
+                                     disk_save_map: Dict = None,
+                                     disk_load_map: Dict = None,
+                                     copy_map: Dict = None):
+        """asyc forward task, return the device states of the last
+        iteration."""
 
         def __update_inputs(next_token_ids):
             """update inputs."""
-            nonlocal all_ids, guided_input_ids
+            nonlocal all_ids
             inputs.update(next_token_ids)
             if all_ids is not None:
                 all_ids = torch.cat([all_ids, next_token_ids[:, None].to(all_ids.device)], 1)
-            if guided_input_ids is not None:
-                guided_input_ids = torch.cat([guided_input_ids, next_token_ids[:, None].to(guided_input_ids.device)], 1)
+            if seen_slots is not None:
+                self.batch_state.append(seen_slots, next_token_ids)
+            if guided_decoding is not None:
+                guided_decoding.update(next_token_ids)
             if sampling_inputs.random_offsets is not None:
                 sampling_inputs.random_offsets += 1
 
         logger.debug('<ForwardTask>: '
                      f'batch_size={inputs.seq_length.size(0)} '
                      f'num_tokens={inputs.input_ids.size(-1)}')
-        inputs = inputs.to_device('cuda')
+        device = self.device_context.device
+        inputs = inputs.to_device(device)
         is_decoding = inputs.is_decoding
         if all_ids is not None:
-            all_ids = all_ids.cuda()
-        if guided_input_ids is not None:
-            guided_input_ids = guided_input_ids.cuda()
-        sampling_inputs = sampling_inputs.to_device('cuda')
-        num_appendable_ids = num_appendable_ids.cuda()
-        num_ignore_eos = num_ignore_eos.cuda()
+            all_ids = all_ids.to(device)
+        sampling_inputs = sampling_inputs.to_device(device)
+        num_appendable_ids = num_appendable_ids.to(device)
+        num_ignore_eos = num_ignore_eos.to(device)
 
         for idx in range(loop_count):
             # inference
             output = await self._async_model_forward(inputs,
                                                      swap_in_map=swap_in_map,
                                                      swap_out_map=swap_out_map,
-                                                     return_logits=return_logits)
+                                                     return_logits=return_logits,
+                                                     disk_save_map=disk_save_map,
+                                                     disk_load_map=disk_load_map,
+                                                     copy_map=copy_map)
+            if self.proposer is not None:
+                await self.proposer.observe(inputs,
+                                            swap_in_map=swap_in_map,
+                                            swap_out_map=swap_out_map,
+                                            copy_map=copy_map)
             logits = output['logits']
             logits = logits[0]  # [bs, seq, prob] -> [seq, prob]
 
             # sampling
-            next_token_ids = await self.async_sampling_logits(logits, all_ids, guided_input_ids, sampling_inputs,
-                                                              inputs, num_ignore_eos > 0)
-            num_ignore_eos = num_ignore_eos - 1
+            seen_tokens = None
+            if seen_slots is not None:
+                seen_tokens = self.batch_state.get_seen_tokens(seen_slots)
+            next_token_ids = await self.async_sampling_logits(logits,
+                                                              all_ids,
+                                                              guided_decoding,
+                                                              sampling_inputs,
+                                                              inputs,
+                                                              num_ignore_eos > 0,
+                                                              seen_tokens=seen_tokens)
 
             # stopping criteria
-            stopped, num_appendable_ids = self._batch_stopping_criteria(next_token_ids, sampling_inputs.stop_words,
-                                                                        num_appendable_ids)
+            stop_matched = None
+            if stop_matcher is not None:
+                stop_matched = stop_matcher.step(next_token_ids) & (num_ignore_eos <= 0)
+            num_ignore_eos = num_ignore_eos - 1
+            stopped, num_appendable_ids = self._batch_stopping_criteria(next_token_ids,
+                                                                        sampling_inputs.stop_words,
+                                                                        num_appendable_ids,
+                                                                        stop_matched=stop_matched)
 
             # send output
             model_metas = output.get('model_metas')
             finish = (idx == loop_count - 1)
             finish = finish or _check_finish(self.scheduler, idx)
-            event = torch.cuda.Event()
+            event = self.device_context.new_event()
             event.record()
             output = dict(next_token_ids=next_token_ids,
                           logits=logits,
                           stopped=stopped,
                           model_metas=model_metas,
-                          event=event)
+                          event=event,
+                          running=running,
+                          inputs=inputs,
+                          prefill_chunks=prefill_chunks)
             output_que.put_nowait((finish, output))
 
             inputs.model_metas = model_metas
@@ -762,8 +1244,91 @@ class Engine:
             if is_decoding:
                 swap_in_map = dict()
                 swap_out_map = dict()
+                disk_save_map = None
+                disk_load_map = None
+                copy_map = None
                 __update_inputs(next_token_ids)
 
+        return dict(next_token_ids=next_token_ids,
+                    num_appendable_ids=num_appendable_ids,
+                    num_ignore_eos=num_ignore_eos,
+                    model_metas=model_metas)
+
+    async def _async_spec_step_background(self,
+                                          running: SeqList,
+                                          inputs: ModelInputs,
+                                          draft_token_ids: List[np.ndarray],
+                                          swap_in_map: Dict,
+                                          swap_out_map: Dict,
+                                          all_ids: torch.Tensor,
+                                          seen_slots: torch.LongTensor,
+                                          guided_decoding: GuidedDecoding,
+                                          stop_matcher: StopSequenceMatcher,
+                                          sampling_inputs: SamplingInputs,
+                                          num_appendable_ids: torch.LongTensor,
+                                          num_ignore_eos: torch.LongTensor,
+                                          output_que: asyncio.Queue,
+                                          disk_save_map: Dict = None,
+                                          disk_load_map: Dict = None,
+                                          copy_map: Dict = None):
+        """verify draft tokens in one forward."""
+        num_draft_tokens = [len(draft) for draft in draft_token_ids]
+        num_spec_tokens = max(num_draft_tokens)
+        padded_drafts = torch.full((len(draft_token_ids), num_spec_tokens), -1, dtype=torch.int64)
+        for idx, draft in enumerate(draft_token_ids):
+            padded_drafts[idx, :len(draft)] = torch.from_numpy(draft)
+
+        logger.debug('<SpecForwardTask>: '
+                     f'batch_size={inputs.seq_length.size(0)} '
+                     f'num_draft_tokens={sum(num_draft_tokens)}')
+        device = self.device_context.device
+        inputs = inputs.to_device(device)
+        padded_drafts = padded_drafts.to(device)
+        if all_ids is not None:
+            all_ids = all_ids.to(device)
+        sampling_inputs = sampling_inputs.to_device(device)
+        num_appendable_ids = num_appendable_ids.to(device)
+        num_ignore_eos = num_ignore_eos.to(device)
+
+        output = await self._async_model_forward(inputs,
+                                                 swap_in_map=swap_in_map,
+                                                 swap_out_map=swap_out_map,
+                                                 return_logits=True,
+                                                 disk_save_map=disk_save_map,
+                                                 disk_load_map=disk_load_map,
+                                                 copy_map=copy_map)
+        logits = output['logits'][0]
+        seen_tokens = None
+        if seen_slots is not None:
+            seen_tokens = self.batch_state.get_seen_tokens(seen_slots)
+        next_token_ids, num_accepted_tokens = await self.async_verify_logits(logits,
+                                                                             padded_drafts,
+                                                                             all_ids,
+                                                                             guided_decoding,
+                                                                             sampling_inputs,
+                                                                             inputs,
+                                                                             num_ignore_eos,
+                                                                             seen_tokens=seen_tokens)
+        next_token_ids, stopped = self._spec_stopping_criteria(next_token_ids,
+                                                               sampling_inputs.stop_words,
+                                                               num_appendable_ids,
+                                                               stop_matcher=stop_matcher,
+                                                               num_ignore_eos=num_ignore_eos)
+
+        event = self.device_context.new_event()
+        event.record()
+        output = dict(next_token_ids=next_token_ids,
+                      logits=None,
+                      stopped=stopped,
+                      model_metas=output.get('model_metas'),
+                      event=event,
+                      running=running,
+                      inputs=inputs,
+                      prefill_chunks=dict(),
+                      num_draft_tokens=num_draft_tokens,
+                      num_accepted_tokens=num_accepted_tokens)
+        output_que.put_nowait((True, output))
+
     def _set_has_runable_event(self, has_runable_event: asyncio.Event):
         """set has runable event."""
         if self.scheduler.has_unfinished():
@@ -780,13 +1345,16 @@ class Engine:
             await self.req_manager.step()
             self._set_has_runable_event(has_runable_event)
 
-    @torch.inference_mode()
-    async def _async_loop_background(self, in_que: asyncio.Queue, out_que: asyncio.Queue, forward_event: asyncio.Event):
-        """async loop background."""
+    def _prepare_step_inputs(self,
+                             running: SeqList,
+                             is_prefill: bool,
+                             prefill_chunks: Dict[int, int] = None,
+                             draft_token_ids: List[np.ndarray] = None):
+        """prepare the host inputs of one step."""
 
         def __gather_all_ids(seqs: SeqList, sampling_inputs: SamplingInputs):
-            """gather history."""
-            if sampling_inputs.repetition_penalty is None and not any(sampling_inputs.logits_processors):
+            """gather history for custom logits processors."""
+            if not any(sampling_inputs.logits_processors):
                 return None
             batch = len(seqs)
             max_len = max(seq.num_all_ids for seq in seqs)
@@ -801,72 +1369,205 @@ class Engine:
                 output[idx, -h_len:] = h_ids
             return output
 
-        def __gather_guided_input_ids(seqs: SeqList, sampling_inputs: SamplingInputs):
-            """gather input ids for guided decode."""
-            if not any(sampling_inputs.response_formats or ()):
-                return None
-            batch = len(seqs)
-            max_len = max(seq.num_new_tokens for seq in seqs)
-            pad_id = self.model_config.bos_token_id
-            pad_id = 0 if pad_id is None else pad_id
-            output = torch.full((batch, max_len), pad_id, dtype=torch.int64)
-            for idx, seq in enumerate(seqs):
-                h_len = seq.num_new_tokens
-                if h_len == 0:
-                    continue
-                h_ids = torch.from_numpy(seq.all_ids[-seq.num_new_tokens:])
-                output[idx, -h_len:] = h_ids
-            return output
-
-        def __get_num_appendable_ids(seqs: SeqList):
+        def __get_num_appendable_ids(seqs: SeqList, stop_matcher: StopSequenceMatcher):
             """get num appendable ids."""
             ret = [seq.sampling_param.max_new_tokens - seq.num_new_tokens for seq in seqs]
-            return torch.tensor(ret)
+            ret = torch.tensor(ret)
+            # the last step ended with a stop word, only one more step to cache it
+            stopped = [
+                seq.num_new_tokens > max(seq.sampling_param.min_new_tokens, 0)
+                and int(seq.all_ids[seq.num_all_ids - 1]) in seq.sampling_param.stop_words for seq in seqs
+            ]
+            stopped = torch.tensor(stopped, dtype=torch.bool)
+            if stop_matcher is not None:
+                new_tokens = torch.tensor([seq.num_new_tokens for seq in seqs])
+                min_new_tokens = torch.tensor([seq.sampling_param.min_new_tokens for seq in seqs])
+                stopped |= stop_matcher.window_matched & (new_tokens > min_new_tokens.clamp_min(0))
+            return torch.where(stopped, ret.clamp_max(0), ret)
 
         def __get_num_ignore_eos(seqs: SeqList):
             """get num ignore eos."""
             ret = [seq.sampling_param.min_new_tokens - seq.num_new_tokens for seq in seqs]
             return torch.tensor(ret)
 
+        def __get_seen_slots(seqs: SeqList, sampling_inputs: SamplingInputs):
+            """get slots of seen tokens for repetition penalty."""
+            if sampling_inputs.repetition_penalty is None:
+                return None
+            return self.batch_state.get_slots(seqs)
+
+        inputs = self.create_model_inputs(running, is_prefill, prefill_chunks, draft_token_ids=draft_token_ids)
+        sampling_inputs = SamplingInputs.from_sampling_params(running)
+        stop_matcher = StopSequenceMatcher.from_sequences(running, device=self.device_context.device)
+        return dict(inputs=inputs,
+                    all_ids=__gather_all_ids(running, sampling_inputs),
+                    seen_slots=__get_seen_slots(running, sampling_inputs),
+                    guided_decoding=GuidedDecoding.from_sequences(running, self.tokenizer.model.model),
+                    stop_matcher=stop_matcher,
+                    sampling_inputs=sampling_inputs,
+                    num_appendable_ids=__get_num_appendable_ids(running, stop_matcher),
+                    num_ignore_eos=__get_num_ignore_eos(running))
+
+    def _patch_pipelined_inputs(self, step_inputs: Dict[str, Any], running: SeqList, last_decoding: Dict[str, Any]):
+        """patch the inputs prepared before the last decoding step finished.
+
+        The sequences of the last step are one token behind, their tokens,
+        history lengths and sampling states are updated on device with the
+        outputs of the last step without synchronization.
+
+        Args:
+            step_inputs (Dict[str, Any]): Inputs made by `_prepare_step_inputs`.
+            running (SeqList): Sequences of the inputs.
+            last_decoding (Dict[str, Any]): Sequences and the device states of
+                the last iteration of the last decoding step.
+        """
+        last_index = dict((seq.seq_id, idx) for idx, seq in enumerate(last_decoding['running']))
+        patch_index = [last_index.get(seq.seq_id, -1) for seq in running]
+        last_token_ids = last_decoding['next_token_ids']
+        device = last_token_ids.device
+        patch_mask = torch.tensor(patch_index, device=device) >= 0
+        index = torch.tensor(patch_index, device=device).clamp_min(0)
+        next_token_ids = last_token_ids[index]
+
+        inputs = step_inputs['inputs'].to_device(device)
+        inputs.input_ids = torch.where(patch_mask, next_token_ids, inputs.input_ids[0])[None]
+        inputs.history_lengths = inputs.history_lengths + patch_mask.long()
+        last_model_metas = last_decoding['model_metas']
+        if last_model_metas is not None:
+            model_metas = inputs.model_metas or [None] * len(running)
+            inputs.model_metas = [
+                last_model_metas[idx] if idx >= 0 else meta for idx, meta in zip(patch_index, model_metas)
+            ]
+
+        all_ids = step_inputs['all_ids']
+        if all_ids is not None:
+            all_ids = all_ids.to(device)
+            pad_id = self.model_config.bos_token_id
+            pad_id = 0 if pad_id is None else pad_id
+            appended = torch.cat([all_ids, next_token_ids[:, None]], 1)
+            shifted = torch.cat([all_ids.new_full((all_ids.size(0), 1), pad_id), all_ids], 1)
+            all_ids = torch.where(patch_mask[:, None], appended, shifted)
+
+        seen_slots = step_inputs['seen_slots']
+        if seen_slots is not None:
+            self.batch_state.append(seen_slots, next_token_ids.masked_fill(~patch_mask, -1))
+
+        guided_decoding = step_inputs['guided_decoding']
+        if guided_decoding is not None:
+            guided_decoding.update(next_token_ids, mask=patch_mask.tolist())
+
+        stop_matcher = step_inputs['stop_matcher']
+        if stop_matcher is not None:
+            stop_matcher.step(next_token_ids, mask=patch_mask)
+
+        sampling_inputs = step_inputs['sampling_inputs'].to_device(device)
+        if sampling_inputs.random_offsets is not None:
+            sampling_inputs.random_offsets += patch_mask.to(sampling_inputs.random_offsets.dtype)
+
+        def __patch_counter(counter: torch.Tensor, last_counter: torch.Tensor):
+            """counters of the last step have been updated on device."""
+            return torch.where(patch_mask, last_counter[index], counter.to(device))
+
+        num_appendable_ids = __patch_counter(step_inputs['num_appendable_ids'], last_decoding['num_appendable_ids'])
+        num_ignore_eos = __patch_counter(step_inputs['num_ignore_eos'], last_decoding['num_ignore_eos'])
+        return dict(inputs=inputs,
+                    all_ids=all_ids,
+                    seen_slots=seen_slots,
+                    guided_decoding=guided_decoding,
+                    stop_matcher=stop_matcher,
+                    sampling_inputs=sampling_inputs,
+                    num_appendable_ids=num_appendable_ids,
+                    num_ignore_eos=num_ignore_eos)
+
+    @torch.inference_mode()
+    async def _async_loop_background(self, in_que: asyncio.Queue, out_que: asyncio.Queue, forward_event: asyncio.Event):
+        """async loop background."""
+
         def __need_logits(seqs: SeqList):
             """need logits."""
             return any(seq.return_logits for seq in seqs)
 
+        async def __propose(seqs: SeqList, scheduler_output):
+            """propose draft tokens, return None if nothing to verify."""
+            block_offsets = _tensorlize_block_offsets(self.scheduler.get_block_tables(seqs))
+            draft_token_ids = await self.proposer.propose(seqs,
+                                                          block_offsets,
+                                                          swap_in_map=scheduler_output.swap_in_map,
+                                                          swap_out_map=scheduler_output.swap_out_map,
+                                                          copy_map=scheduler_output.copy_map)
+            if all(len(draft) == 0 for draft in draft_token_ids):
+                return None
+            return draft_token_ids
+
+        # sequences and device states of the last decoding step
+        last_decoding = None
         while True:
-            is_prefill, scheduler_output = await in_que.get()
+            is_prefill, scheduler_output, step_inputs, host_time = await in_que.get()
             running = scheduler_output.running
             swap_in_map = scheduler_output.swap_in_map
             swap_out_map = scheduler_output.swap_out_map
+            prefill_chunks = scheduler_output.prefill_chunks
             prefill_interval = self.scheduler_config.prefill_interval
             loop_count = 1 if is_prefill else (prefill_interval - 1)
             assert len(running) > 0
-
-            # create inputs
-            inputs = self.create_model_inputs(running, is_prefill)
-            sampling_inputs = SamplingInputs.from_sampling_params(running)
-            all_ids = __gather_all_ids(running, sampling_inputs)
-            guided_input_ids = __gather_guided_input_ids(running, sampling_inputs)
-            num_appendable_ids = __get_num_appendable_ids(running)
-            num_ignore_eos = __get_num_ignore_eos(running)
             return_logits = __need_logits(running)
 
-            self._running = running
-            self._inputs = inputs
-
+            draft_token_ids = None
             forward_event.clear()
-            await self._async_step_background(
-                inputs=inputs,
+            if self.proposer is not None and not is_prefill:
+                # draft tokens are proposed every step
+                loop_count = 1
+                if not return_logits:
+                    draft_token_ids = await __propose(running, scheduler_output)
+
+            # create inputs
+            pipelined = step_inputs is not None
+            start = time.perf_counter()
+            if pipelined:
+                step_inputs = self._patch_pipelined_inputs(step_inputs, running, last_decoding)
+            else:
+                step_inputs = self._prepare_step_inputs(running,
+                                                        is_prefill,
+                                                        prefill_chunks,
+                                                        draft_token_ids=draft_token_ids)
+            # adapters paged in by the scheduler
+            step_inputs['inputs'].adapter_slot_map = scheduler_output.adapter_slot_map
+            host_time += time.perf_counter() - start
+            self.step_stats.update(host_time, pipelined)
+            self.metrics.host_time.observe(host_time)
+            self.metrics.update_scheduled(running, is_prefill, step_inputs['inputs'].input_ids.numel())
+
+            last_decoding = None
+            if draft_token_ids is not None:
+                await self._async_spec_step_background(
+                    running=running,
+                    draft_token_ids=draft_token_ids,
+                    swap_in_map=swap_in_map,
+                    swap_out_map=swap_out_map,
+                    output_que=out_que,
+                    disk_save_map=scheduler_output.disk_save_map,
+                    disk_load_map=scheduler_output.disk_load_map,
+                    copy_map=scheduler_output.copy_map,
+                    **step_inputs,
+                )
+                forward_event.set()
+                continue
+
+            last_outputs = await self._async_step_background(
+                running=running,
+                prefill_chunks=prefill_chunks,
                 swap_in_map=swap_in_map,
                 swap_out_map=swap_out_map,
-                all_ids=all_ids,
-                guided_input_ids=guided_input_ids,
-                sampling_inputs=sampling_inputs,
-                num_appendable_ids=num_appendable_ids,
-                num_ignore_eos=num_ignore_eos,
                 loop_count=loop_count,
                 return_logits=return_logits,
                 output_que=out_que,
+                disk_save_map=scheduler_output.disk_save_map,
+                disk_load_map=scheduler_output.disk_load_map,
+                copy_map=scheduler_output.copy_map,
+                **step_inputs,
             )
+            if not is_prefill:
+                last_decoding = dict(running=running, **last_outputs)
             forward_event.set()
 
     async def _async_send_responses(self, que: asyncio.Queue, forward_event: asyncio.Event):
@@ -875,7 +1576,12 @@ class Engine:
         def __send_resp(out: InferOutput):
             """send response."""
             resp_type = (ResponseType.FINISH if out.finish else ResponseType.SUCCESS)
-            self._response(out.resp, resp_type, data=dict(token_ids=out.token_ids, logits=out.logits))
+            data = dict(token_ids=out.token_ids, logits=out.logits)
+            if out.choices is not None:
+                data['choices'] = out.choices
+            if out.timeline is not None:
+                data['timeline'] = out.timeline
+            self._response(out.resp, resp_type, data=data)
 
         def __send_resps(step_outputs: Dict[int, InferOutput]):
             """send response callback."""
@@ -917,6 +1623,10 @@ class Engine:
         """
         event_loop = asyncio.get_event_loop()
         prefill_interval = self.scheduler_config.prefill_interval
+        prealloc_size = prefill_interval
+        if self.spec_decode_config is not None:
+            # caches of draft tokens are filled when verifying
+            prealloc_size = max(prealloc_size, self.spec_decode_config.num_spec_tokens + 1)
 
         # forward task
         in_que = asyncio.Queue()
@@ -941,6 +1651,9 @@ class Engine:
         self._add_loop_tasks_done_callback(loop_tasks)
 
         def __do_prefill():
+            if self.scheduler_config.enable_chunked_prefill:
+                # prefill chunks are mixed into decoding batch
+                return self.scheduler.has_waiting() or self.scheduler.has_prefilling()
             # decoding if no waiting
             if not self.scheduler.has_waiting():
                 return False
@@ -956,30 +1669,61 @@ class Engine:
             # decoding
             return False
 
-        async def __step():
-            """step decoding."""
-            prefill = __do_prefill()
-            schedule_output = self.scheduler.schedule(is_prefill=prefill, prealloc_size=prefill_interval)
-            # schedule decoding if no valid prefill reqs.
-            if prefill and len(schedule_output.running) == 0:
+        def __schedule_pipelined():
+            """schedule the next decoding step before the outputs of the
+            current step are synchronized, return True if it is scheduled."""
+            if not self.scheduler_config.enable_pipelined_schedule or self.proposer is not None:
+                return False
+            if __do_prefill() or not self.scheduler.has_running():
+                return False
+            start = time.perf_counter()
+            schedule_output = self.scheduler.schedule(is_prefill=False, prealloc_size=prealloc_size)
+            self.metrics.schedule_time.observe(time.perf_counter() - start)
+            running = schedule_output.running
+            if len(running) == 0:
+                return False
+            step_inputs = self._prepare_step_inputs(running, False, schedule_output.prefill_chunks)
+            in_que.put_nowait((False, schedule_output, step_inputs, time.perf_counter() - start))
+            return True
+
+        async def __step(scheduled: bool):
+            """step decoding, return True if next step has been scheduled."""
+            if scheduled:
+                # a decoding step has been scheduled by the last step
                 prefill = False
-                schedule_output = self.scheduler.schedule(is_prefill=prefill, prealloc_size=prefill_interval)
+            else:
+                start = time.perf_counter()
+                prefill = __do_prefill()
+                schedule_output = self.scheduler.schedule(is_prefill=prefill, prealloc_size=prealloc_size)
+                # schedule decoding if no valid prefill reqs.
+                if prefill and len(schedule_output.running) == 0:
+                    prefill = False
+                    schedule_output = self.scheduler.schedule(is_prefill=prefill, prealloc_size=prealloc_size)
+                schedule_time = time.perf_counter() - start
+                self.metrics.schedule_time.observe(schedule_time)
+                in_que.put_nowait((prefill, schedule_output, None, schedule_time))
 
-            in_que.put_nowait((prefill, schedule_output))
             finish = False
+            next_scheduled = False
             while not finish:
                 finish, out = await out_que.get()
+                if finish and not prefill:
+                    # last forward has been launched, prepare next step on host
+                    next_scheduled = __schedule_pipelined()
                 step_outputs = await self._make_infer_outputs(**out)
                 self._set_has_runable_event(has_runable_event)
                 resp_que.put_nowait(step_outputs)
+            return next_scheduled
 
+        scheduled = False
         while True:
-            await has_runable_event.wait()
-            await __step()
+            if not scheduled:
+                await has_runable_event.wait()
+            scheduled = await __step(scheduled)
 
     async def async_loop(self):
         device_manager = get_device_manager()
-        with device_manager.context(self.device_context), torch.cuda.stream(self.stream):
+        with device_manager.context(self.device_context), self.device_context.stream(self.stream):
             await self._async_loop()
 
     def create_instance(self, cuda_stream_id=0):
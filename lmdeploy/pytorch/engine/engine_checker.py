@@ -25,9 +25,11 @@ class EngineChecker(BaseChecker):
         device_type = engine_config.device_type
 
         # pytorch
-        torch_checker = TorchChecker(logger=logger)
+        torch_checker = TorchChecker(device='cpu' if device_type == 'cpu' else 'cuda', logger=logger)
 
-        if device_type == 'cuda':
+        if device_type == 'cpu':
+            self.register_required_checker(torch_checker)
+        elif device_type == 'cuda':
             # triton
             from ..check_env.triton import TritonChecker
             triton_checker = TritonChecker(logger=logger)
@@ -53,9 +55,9 @@ class EngineChecker(BaseChecker):
         model_checker.register_required_checker(trans_checker)
         self.register_required_checker(model_checker)
 
-        # adapters
+        # adapters, the simulated model loads no adapter weights
         adapters = engine_config.adapters
-        if adapters is not None:
+        if adapters is not None and engine_config.simulated_model is None:
             adapter_paths = list(adapters.values())
             for adapter in adapter_paths:
                 adapter_checker = AdapterChecker(adapter, logger=logger)
@@ -72,6 +74,9 @@ class EngineChecker(BaseChecker):
                 'Read https://github.com/InternLM/lmdeploy/blob/main/docs/en/advance/pytorch_multithread.md for more details.',  # noqa: E501
             )
 
+        if engine_config.device_type == 'cpu' and engine_config.tp > 1:
+            self.log_and_exit(mod_name='Engine', message=f'tp={engine_config.tp} is not supported on cpu.')
+
         if engine_config.max_batch_size <= 0:
             self.log_and_exit(mod_name='Engine',
                               message='max_batch_size should be'
@@ -46,6 +46,30 @@ async def async_cancel(req_sender: RequestSender, session_id: int):
                                f'Error: {resp.type}.'))
 
 
+def _check_adapter_resp(resp: Response, adapter_name: str, op: str):
+    """raise if the adapter op failed."""
+    if resp.type != ResponseType.SUCCESS:
+        raise RuntimeError(f'Failed to {op} adapter <{adapter_name}>: {resp.err_msg or resp.type}')
+
+
+async def async_load_adapter(req_sender: RequestSender, adapter_name: str, adapter_path: str):
+    """Load a lora adapter.
+
+    Args:
+        adapter_name (str): The name used by the requests.
+        adapter_path (str): The local path or model id of the adapter.
+    """
+    resp = await req_sender.async_send(RequestType.LOAD_ADAPTER,
+                                       dict(adapter_name=adapter_name, adapter_path=adapter_path))
+    _check_adapter_resp(resp, adapter_name, 'load')
+
+
+async def async_unload_adapter(req_sender: RequestSender, adapter_name: str):
+    """Unload a lora adapter."""
+    resp = await req_sender.async_send(RequestType.UNLOAD_ADAPTER, dict(adapter_name=adapter_name))
+    _check_adapter_resp(resp, adapter_name, 'unload')
+
+
 def try_add_session(req_sender: RequestSender, session_id: int):
     """Add new session.
 
@@ -69,6 +93,23 @@ def cancel(req_sender: RequestSender, session_id: int):
                                f'Error: {resp.type}.'))
 
 
+def load_adapter(req_sender: RequestSender, adapter_name: str, adapter_path: str):
+    """Load a lora adapter.
+
+    Args:
+        adapter_name (str): The name used by the requests.
+        adapter_path (str): The local path or model id of the adapter.
+    """
+    resp = req_sender.send(RequestType.LOAD_ADAPTER, dict(adapter_name=adapter_name, adapter_path=adapter_path))
+    _check_adapter_resp(resp, adapter_name, 'load')
+
+
+def unload_adapter(req_sender: RequestSender, adapter_name: str):
+    """Unload a lora adapter."""
+    resp = req_sender.send(RequestType.UNLOAD_ADAPTER, dict(adapter_name=adapter_name))
+    _check_adapter_resp(resp, adapter_name, 'unload')
+
+
 class EngineInstance:
     """Instance of TurboMind.
 
@@ -102,12 +143,39 @@ class EngineInstance:
         """
         return try_add_session(self.req_sender, session_id)
 
+    async def async_load_adapter(self, adapter_name: str, adapter_path: str):
+        """Load a lora adapter to host memory, it is paged into a device slot
+        when requested.
+
+        Args:
+            adapter_name (str): The name used by the requests.
+            adapter_path (str): The local path or model id of the adapter.
+        """
+        return await async_load_adapter(self.req_sender, adapter_name, adapter_path)
+
+    async def async_unload_adapter(self, adapter_name: str):
+        """Unload a lora adapter that is not used by any session.
+
+        Args:
+            adapter_name (str): The adapter name.
+        """
+        return await async_unload_adapter(self.req_sender, adapter_name)
+
+    def load_adapter(self, adapter_name: str, adapter_path: str):
+        """Load a lora adapter, see `async_load_adapter`."""
+        return load_adapter(self.req_sender, adapter_name, adapter_path)
+
+    def unload_adapter(self, adapter_name: str):
+        """Unload a lora adapter, see `async_unload_adapter`."""
+        return unload_adapter(self.req_sender, adapter_name)
+
     async def async_stream_infer(self,
                                  session_id: int,
                                  input_ids: List[int],
                                  gen_config: GenerationConfig = None,
                                  multimodal: InputMultiModalType = None,
                                  adapter_name: str = None,
+                                 priority: int = 0,
                                  **kwargs):
         """Send stream inference request.
 
@@ -116,6 +184,8 @@ class EngineInstance:
             input_ids (List[int]): The input token ids.
             gen_config (GenerationConfig): The sampling parameters.
             adapter_name (str): The lora adapter name.
+            priority (int): The request priority, lower value means higher
+                priority.
 
         Yields:
             int: Error flags. 0 if success.
@@ -134,20 +204,33 @@ class EngineInstance:
             sampling_param=sampling_param,
             adapter_name=adapter_name,
             input_multimodals=multimodal,
+            priority=priority,
         )
         resp = self.req_sender.send_async(RequestType.ADD_MESSAGE, msg)
 
         while True:
             resp = await self.req_sender.async_recv(resp)
 
-            if resp.type == ResponseType.SUCCESS:
+            if resp.type in (ResponseType.SUCCESS, ResponseType.FINISH) and 'choices' in resp.data:
+                # parallel sampling, yield all choices.
+                timeline = resp.data.get('timeline')
+                for index, token_ids in enumerate(resp.data['choices']):
+                    token_ids = token_ids.tolist()
+                    yield EngineOutput(resp.type, token_ids, len(token_ids), index=index, timeline=timeline)
+                if resp.type == ResponseType.FINISH:
+                    break
+            elif resp.type == ResponseType.SUCCESS:
                 token_ids = resp.data['token_ids'].tolist()
                 yield EngineOutput(resp.type, token_ids, len(token_ids))
             elif resp.type == ResponseType.FINISH:
                 resp_data = resp.data
                 token_ids = resp_data['token_ids'].tolist()
                 logits = resp_data['logits']
-                yield EngineOutput(resp.type, token_ids, len(token_ids), logits=logits)
+                yield EngineOutput(resp.type,
+                                   token_ids,
+                                   len(token_ids),
+                                   logits=logits,
+                                   timeline=resp_data.get('timeline'))
                 break
             else:
                 yield EngineOutput(resp.type, [], 0)
@@ -9,15 +9,13 @@
 #     http://www.apache.org/licenses/LICENSE-2.0
 
 import copy
-import math
 # Unless required by applicable law or agreed to in writing, software
 # distributed under the License is distributed on an "AS IS" BASIS,
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from collections import defaultdict
 from functools import lru_cache
-from typing import DefaultDict, Dict, List, Union
+from typing import Dict, List, Tuple, Union
 
 import torch
 from outlines.fsm.guide import CFGGuide, Generate, RegexGuide, Write
@@ -25,26 +23,28 @@ from outlines.fsm.json_schema import build_regex_from_schema
 from pydantic import BaseModel
 from transformers import PreTrainedTokenizerBase
 
+from .logits_process import pack_bitmask
 
-class BaseLogitsProcessor:
 
-    def init_state(self):
-        """Initialize the FSM states."""
-        self.fsm_state: DefaultDict[int, int] = defaultdict(int)
+class BaseLogitsProcessor:
+    """Guide generation with a FSM.
 
-    def __call__(self, input_ids: List[int], scores: torch.Tensor) -> torch.Tensor:
-        """Use the FSM to bias the logits before sampling the next token."""
+    States are advanced incrementally by the callers. Allowed tokens of each
+    state are cached as packed bitmasks.
+    """
 
-        seq_id = hash(tuple(input_ids))
+    def __init__(self):
+        self._bitmasks: Dict[Tuple[int, int], torch.Tensor] = dict()
 
-        if len(input_ids) == 0:
-            self.init_state()
-        else:
-            last_token = input_ids[-1]
-            last_seq_id = hash(tuple(input_ids[:-1]))
-            self.fsm_state[seq_id] = self.fsm.get_next_state(state=self.fsm_state[last_seq_id], token_id=last_token)
+    def get_next_state(self, state: int, token_ids: List[int]) -> int:
+        """advance the FSM state by new tokens."""
+        for token_id in token_ids:
+            state = self.fsm.get_next_state(state=state, token_id=token_id)
+        return state
 
-        instruction = self.fsm.get_next_instruction(self.fsm_state[seq_id])
+    def get_allowed_tokens(self, state: int) -> List[int]:
+        """allowed tokens of the FSM state."""
+        instruction = self.fsm.get_next_instruction(state)
 
         if type(instruction) == Generate:
             allowed_tokens = instruction.tokens
@@ -53,12 +53,16 @@ class BaseLogitsProcessor:
             allowed_tokens = [instruction.tokens[0]]
         else:
             raise TypeError(f'Unsupported instruction type {type(instruction)}')
+        return allowed_tokens
 
-        mask = torch.full((scores.shape[-1], ), -math.inf, device=scores.device)
-        mask[allowed_tokens] = 0
-        scores.add_(mask)
-
-        return scores
+    def get_bitmask(self, state: int, vocab_size: int, device: str = 'cuda') -> torch.Tensor:
+        """packed bitmask of allowed tokens."""
+        key = (state, vocab_size)
+        bitmask = self._bitmasks.get(key)
+        if bitmask is None:
+            bitmask = pack_bitmask(self.get_allowed_tokens(state), vocab_size).to(device)
+            self._bitmasks[key] = bitmask
+        return bitmask
 
     def adapt_tokenizer(self, tokenizer):
         """Adapt tokenizer to use to compile the FSM.
@@ -83,6 +87,7 @@ class RegexLogitsProcessor(BaseLogitsProcessor):
             regex_string: A string that represents a regular expression
             tokenizer: The model's tokenizer
         """
+        super().__init__()
         tokenizer = self.adapt_tokenizer(copy.deepcopy(tokenizer))
         fsm = RegexGuide(regex_string, tokenizer)
         self.fsm = fsm
@@ -114,6 +119,7 @@ class CFGLogitsProcessor(BaseLogitsProcessor):
         tokenizer
             The model's tokenizer
         """
+        super().__init__()
         tokenizer = self.adapt_tokenizer(tokenizer)
         fsm = CFGGuide(cfg, tokenizer)
         self.fsm = fsm
@@ -1,14 +1,15 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import asyncio
 import json
-from dataclasses import asdict, dataclass
-from typing import Dict, List, Optional, Tuple
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, List, Tuple
 
+import numpy as np
 import torch
 
 from lmdeploy.messages import LogitsProcessor
-from lmdeploy.tokenizer import Tokenizer
 
+from ..devices import get_device_manager
 from ..messages import SchedulerSequence
 
 
@@ -30,12 +31,19 @@ def _process_bad_words_(scores: torch.Tensor,
     return scores
 
 
-def _process_repetition_penalty_(scores: torch.Tensor, input_ids: torch.LongTensor, penalty: torch.Tensor):
-    """process repetition penalty."""
-    score = torch.gather(scores, 1, input_ids)
-    penalty = penalty.to(score.dtype)
-    score = torch.where(score < 0, score * penalty[:, None], score / penalty[:, None])
-    scores.scatter_(1, input_ids, score)
+def _get_seen_tokens(input_ids: torch.LongTensor, vocab_size: int):
+    """mask of the tokens in input_ids."""
+    seen_tokens = torch.zeros(input_ids.size(0), vocab_size, dtype=torch.bool, device=input_ids.device)
+    return seen_tokens.scatter_(1, input_ids, True)
+
+
+def _process_repetition_penalty_(scores: torch.Tensor, seen_tokens: torch.BoolTensor, penalty: torch.Tensor):
+    """process repetition penalty of the seen tokens."""
+    vocab_size = min(scores.size(1), seen_tokens.size(1))
+    score = scores[:, :vocab_size]
+    penalty = penalty.to(score.dtype)[:, None]
+    penalized = torch.where(score < 0, score * penalty, score / penalty)
+    score.copy_(torch.where(seen_tokens[:, :vocab_size], penalized, score))
     return scores
 
 
@@ -78,35 +86,130 @@ def _multinomial_sampling(scores: torch.Tensor,
     return multinomial_sampling(scores, seeds, offsets, indices)
 
 
-def _guided_sampling(response_formats: Tuple[Dict], scores: torch.Tensor, guided_input_ids: Optional[torch.Tensor],
-                     tokenizer: object):
-    if guided_input_ids is None:
-        return scores
-    for i in range(len(response_formats)):
-        _format = response_formats[i]
-        if isinstance(_format, Dict) and _format.get('type', 'text') != 'text':
-            if _format['type'] == 'json_schema':
-                schema = _format['json_schema']
-                if isinstance(schema, Dict):
-                    for key in ['json_schema', 'schema']:
-                        if key in schema:
-                            schema = json.dumps(schema[key], ensure_ascii=False)
-                elif schema is None:
-                    from .guided_process import JSON_GRAMMAR
-                    schema = JSON_GRAMMAR
-                elif isinstance(schema, str):
-                    raise ValueError(f'Cannot parse schema {schema}. The schema must be '
-                                     'either a dictionary or a string that contains the'
-                                     ' JSON Schema specification')
-            elif _format['type'] == 'regex_schema':
-                schema = _format.get('regex_schema', '')
+def pack_bitmask(token_ids: List[int], vocab_size: int) -> torch.Tensor:
+    """pack allowed tokens into uint8 bitmask of little bit order."""
+    mask = np.zeros((vocab_size + 7) // 8 * 8, dtype=bool)
+    token_ids = np.asarray(token_ids, dtype=np.int64)
+    mask[token_ids[token_ids < vocab_size]] = True
+    return torch.from_numpy(np.packbits(mask, bitorder='little'))
+
+
+def unpack_bitmask(bitmask: torch.Tensor, vocab_size: int) -> torch.BoolTensor:
+    """unpack bitmask of shape [..., num_bytes] to bool mask of shape [...,
+    vocab_size]."""
+    bits = torch.arange(8, dtype=torch.uint8, device=bitmask.device)
+    mask = (bitmask[..., None] >> bits) & 1
+    return mask.flatten(-2)[..., :vocab_size].bool()
+
+
+def _get_guided_processor(response_format: Dict, tokenizer: object):
+    """get guided logits processor of the response format."""
+    if not isinstance(response_format, Dict) or response_format.get('type', 'text') == 'text':
+        return None
+    if response_format['type'] == 'json_schema':
+        schema = response_format['json_schema']
+        if isinstance(schema, Dict):
+            for key in ['json_schema', 'schema']:
+                if key in schema:
+                    schema = json.dumps(schema[key], ensure_ascii=False)
+        elif schema is None:
+            from .guided_process import JSON_GRAMMAR
+            schema = JSON_GRAMMAR
+        elif isinstance(schema, str):
+            raise ValueError(f'Cannot parse schema {schema}. The schema must be '
+                             'either a dictionary or a string that contains the'
+                             ' JSON Schema specification')
+    elif response_format['type'] == 'regex_schema':
+        schema = response_format.get('regex_schema', '')
+    else:
+        raise ValueError(f"unsupported format type: {response_format['type']}")
+    from .guided_process import _get_guided_logits_processor
+    return _get_guided_logits_processor(schema, tokenizer, response_format['type'])
+
+
+class GuidedDecoding:
+    """Guided decoding states of a batch.
+
+    FSM states are stored on the sequences and only advanced by the new
+    tokens, allowed tokens of all sequences are masked in one op.
+
+    Args:
+        processors (List): Guided logits processor of each sequence, None
+            for unguided sequences.
+        states (List[int]): FSM state of each sequence.
+        seqs (List[SchedulerSequence]): Sequences to write the states back.
+    """
+
+    def __init__(self, processors: List[Any], states: List[int], seqs: List[SchedulerSequence] = None):
+        self.processors = processors
+        self.states = states
+        self.seqs = seqs
+
+    @classmethod
+    def from_sequences(cls, seqs: List[SchedulerSequence], tokenizer: object):
+        """create from sequences, return None if no sequence is guided."""
+        processors = [_get_guided_processor(seq.sampling_param.response_format, tokenizer) for seq in seqs]
+        if all(processor is None for processor in processors):
+            return None
+        states = [0] * len(seqs)
+        for idx, (seq, processor) in enumerate(zip(seqs, processors)):
+            if processor is None:
+                continue
+            generated = seq.all_ids[seq.num_all_ids - seq.num_new_tokens:]
+            if seq.num_guided_tokens > len(generated):
+                # sampled tokens have been dropped
+                seq.guided_state = 0
+                seq.num_guided_tokens = 0
+            seq.guided_state = processor.get_next_state(seq.guided_state, generated[seq.num_guided_tokens:].tolist())
+            seq.num_guided_tokens = len(generated)
+            states[idx] = seq.guided_state
+        return cls(processors, states, seqs)
+
+    def update(self, token_ids: torch.LongTensor, mask: List[bool] = None):
+        """advance states by the sampled tokens, sequences with False `mask`
+        are skipped."""
+        token_ids = token_ids.tolist()
+        if mask is None:
+            mask = [True] * len(token_ids)
+        for idx, (processor, token_id) in enumerate(zip(self.processors, token_ids)):
+            if processor is None or not mask[idx]:
+                continue
+            self.states[idx] = processor.get_next_state(self.states[idx], [token_id])
+            if self.seqs is not None:
+                seq = self.seqs[idx]
+                seq.guided_state = self.states[idx]
+                seq.num_guided_tokens += 1
+
+    def repeat_with_drafts(self, draft_token_ids: torch.LongTensor):
+        """states of every draft position, draft tokens of shape [batch_size,
+        k] are consumed one by one."""
+        num_pos = draft_token_ids.size(1) + 1
+        draft_token_ids = draft_token_ids.tolist()
+        processors = []
+        states = []
+        for processor, state, drafts in zip(self.processors, self.states, draft_token_ids):
+            for idx in range(num_pos):
+                processors.append(processor)
+                states.append(state)
+                if processor is not None and idx < num_pos - 1 and drafts[idx] >= 0:
+                    state = processor.get_next_state(state, [drafts[idx]])
+        return GuidedDecoding(processors, states)
+
+    def __call__(self, scores: torch.Tensor) -> torch.Tensor:
+        """mask tokens not allowed."""
+        vocab_size = scores.size(-1)
+        device = scores.device
+        full_bitmask = None
+        bitmasks = []
+        for processor, state in zip(self.processors, self.states):
+            if processor is None:
+                if full_bitmask is None:
+                    full_bitmask = torch.full(((vocab_size + 7) // 8, ), 255, dtype=torch.uint8, device=device)
+                bitmasks.append(full_bitmask)
             else:
-                raise ValueError(f"unsupported format type: {_format['type']}")
-            from .guided_process import _get_guided_logits_processor
-            processor = _get_guided_logits_processor(schema, tokenizer, _format['type'])
-            if processor:
-                scores[i] = processor(guided_input_ids[i].tolist(), scores[i])
-    return scores
+                bitmasks.append(processor.get_bitmask(state, vocab_size, device))
+        mask = unpack_bitmask(torch.stack(bitmasks), vocab_size)
+        return scores.masked_fill_(~mask, -float('inf'))
 
 
 @dataclass
@@ -262,6 +365,20 @@ class SamplingInputs:
 
         return SamplingInputs(**out_dict)
 
+    def repeat_interleave(self, repeats: int):
+        """repeat the inputs of each sequence."""
+        out_dict = dict()
+        for f in fields(self):
+            k = f.name
+            v = getattr(self, k)
+            if isinstance(v, torch.Tensor):
+                v = v.repeat_interleave(repeats, 0)
+            elif k in ('response_formats', 'logits_processors') and v is not None:
+                v = type(v)(elem for elem in v for _ in range(repeats))
+            out_dict[k] = v
+
+        return SamplingInputs(**out_dict)
+
 
 def _apply_custom_logits_processors(batched_logits_processors, all_ids, logits):
     """Apply custom logits processors."""
@@ -275,31 +392,32 @@ def _apply_custom_logits_processors(batched_logits_processors, all_ids, logits):
 class FusedLogitsProcessor:
     """Custom logits processor."""
 
-    def __init__(self,
-                 sampling_inputs: SamplingInputs,
-                 ignore_eos: torch.Tensor,
-                 tokenizer: Optional[Tokenizer] = None):
+    def __init__(self, sampling_inputs: SamplingInputs, ignore_eos: torch.Tensor):
         self.sampling_inputs: SamplingInputs = sampling_inputs
         self.ignore_eos = ignore_eos
-        self.tokenizer = tokenizer
 
     async def _wait_stream_once(self):
         """wait stream once."""
-        stream = torch.cuda.current_stream()
-        if not stream.query():
+        stream = get_device_manager().current_context().current_stream()
+        if stream is not None and not stream.query():
             await asyncio.sleep(0)
 
-    async def __call__(self, all_ids: torch.LongTensor, guided_input_ids: torch.LongTensor,
-                       scores: torch.FloatTensor) -> torch.FloatTensor:
+    async def __call__(self,
+                       all_ids: torch.LongTensor,
+                       guided_decoding: GuidedDecoding,
+                       scores: torch.FloatTensor,
+                       seen_tokens: torch.BoolTensor = None) -> torch.FloatTensor:
         r"""
         Args:
             all_ids (torch.LongTensor): All the token ids.
-            guided_input_ids (torch.LongTensor): Guided prompt ids.
+            guided_decoding (GuidedDecoding): Guided decoding states.
             scores (torch.FloatTensor):
                 Prediction scores of a language modeling head.
                 These can be logits for each vocabulary when not using
                 beam search or log softmax for each vocabulary token
                 when using beam search
+            seen_tokens (torch.BoolTensor): Mask of the tokens to be
+                penalized, gathered from `all_ids` if not given.
 
 
         Return:
@@ -315,7 +433,9 @@ class FusedLogitsProcessor:
 
         repetition_penalty = sampling_inputs.repetition_penalty
         if repetition_penalty is not None:
-            scores = _process_repetition_penalty_(scores, all_ids, repetition_penalty)
+            if seen_tokens is None:
+                seen_tokens = _get_seen_tokens(all_ids, scores.size(1))
+            scores = _process_repetition_penalty_(scores, seen_tokens, repetition_penalty)
 
         temperature = sampling_inputs.temperature
         if temperature is not None:
@@ -332,11 +452,41 @@ class FusedLogitsProcessor:
             stop_mask = torch.where(self.ignore_eos[:, None], stop_mask, False)
             scores = _process_bad_words_(scores, stop_words, stop_mask)
 
-        if guided_input_ids is not None:
-            await self._wait_stream_once()
-            scores = _guided_sampling(sampling_inputs.response_formats, scores, guided_input_ids, self.tokenizer)
+        if guided_decoding is not None:
+            scores = guided_decoding(scores)
+        return scores
+
+    def _filter_sorted_scores(self, scores: torch.Tensor):
+        """filter top-k/top-p/min-p on sorted scores."""
+        sampling_inputs = self.sampling_inputs
+        max_topk = sampling_inputs.max_top_k
+        top_k = sampling_inputs.top_k
+        if max_topk <= 0:
+            max_topk = scores.size(1)
+            if top_k is not None:
+                top_k = torch.where(top_k <= 0, top_k.new_tensor(max_topk), top_k)
+
+        if top_k is not None:
+            scores = _filter_topk_sorted_(scores, top_k)
+
+        top_p = sampling_inputs.top_p
+        if top_p is not None:
+            scores = _filter_topp_sorted_(scores, top_p)
+
+        min_p = sampling_inputs.min_p
+        if min_p is not None:
+            scores = _filter_minp_sorted_(scores, min_p)
         return scores
 
+    def _sort_logits(self, logits: torch.Tensor):
+        """sort logits."""
+        # sort logits is too slow. and we only need topk logits
+        max_topk = self.sampling_inputs.max_top_k
+        if max_topk <= 0:
+            return logits.sort(1, descending=True)
+        else:
+            return logits.topk(max_topk, dim=1)
+
     @torch.inference_mode()
     def sampling(self, logits: torch.Tensor):
         """sampling."""
@@ -344,24 +494,7 @@ class FusedLogitsProcessor:
 
         def __random_sampling(scores: torch.Tensor, indices: torch.LongTensor):
             """random sampling."""
-            max_topk = sampling_inputs.max_top_k
-            top_k = sampling_inputs.top_k
-            if max_topk <= 0:
-                max_topk = scores.size(1)
-                if top_k is not None:
-                    top_k = torch.where(top_k <= 0, top_k.new_tensor(max_topk), top_k)
-
-            if top_k is not None:
-                scores = _filter_topk_sorted_(scores, top_k)
-
-            top_p = sampling_inputs.top_p
-            if top_p is not None:
-                scores = _filter_topp_sorted_(scores, top_p)
-
-            min_p = sampling_inputs.min_p
-            if min_p is not None:
-                scores = _filter_minp_sorted_(scores, min_p)
-
+            scores = self._filter_sorted_scores(scores)
             softmax_scores = scores.softmax(1)
 
             seeds = sampling_inputs.random_seeds
@@ -371,10 +504,15 @@ class FusedLogitsProcessor:
         if sampling_inputs.max_top_k == 1:
             return logits.argmax(-1)
         else:
-            # sort logits is too slow. and we only need topk logits
-            max_topk = sampling_inputs.max_top_k
-            if max_topk <= 0:
-                scores, indices = logits.sort(1, descending=True)
-            else:
-                scores, indices = logits.topk(max_topk, dim=1)
+            scores, indices = self._sort_logits(logits)
             return __random_sampling(scores, indices)
+
+    @torch.inference_mode()
+    def get_probs(self, logits: torch.Tensor):
+        """get the probabilities that `sampling` draws tokens from."""
+        probs = logits.new_zeros(logits.shape, dtype=torch.float32)
+        if self.sampling_inputs.max_top_k == 1:
+            return probs.scatter_(1, logits.argmax(-1, keepdim=True), 1.0)
+        scores, indices = self._sort_logits(logits)
+        scores = self._filter_sorted_scores(scores)
+        return probs.scatter_(1, indices, scores.float().softmax(1))
@@ -13,13 +13,14 @@ from torch import multiprocessing as mp
 
 from lmdeploy.utils import get_logger
 
+from ..adapter.adapter import load_adapter_slots
 from ..backends import get_backend
 from ..config import BackendConfig, CacheConfig, ModelConfig
 from ..devices import DeviceContext, get_device_manager
+from ..disk_cache import get_disk_cache_dir
 from ..distributed import DistContext, get_dist_manager, get_world_rank
 from ..model_inputs import ModelInputs
-from ..models.patch import add_adapters, build_patched_model, update_custom_module_map
-from ..utils import get_gpu_memory
+from ..models.patch import add_adapters, build_patched_model, load_adapter, unload_adapter, update_custom_module_map
 from ..weight_loader.model_weight_loader import load_model_weights
 from .cache_engine import CacheEngine
 
@@ -55,8 +56,12 @@ def _update_cache_config(model_config: ModelConfig,
 
     def __get_free_gpu_mem_size(cache_block_size: int):
         """get free gpu memory size."""
-        torch.cuda.empty_cache()
-        gpu_mem_physical_free, _ = get_gpu_memory(gpu_id)
+        device_context = get_device_manager().current_context()
+        device_context.empty_cache()
+        gpu_mem_physical_free, _ = device_context.mem_get_info(gpu_id)
+        if device_context.is_cpu:
+            # the swap space is allocated from the same host memory
+            gpu_mem_physical_free -= host_mem_size
         logger.debug(f'device<{gpu_id}> free gpu memory:'
                      f' {gpu_mem_physical_free>>20} mb')
         vocal_size = model_config.vocab_size
@@ -104,14 +109,30 @@ def _update_cache_config(model_config: ModelConfig,
     logger.debug('block num: {}'.format(cache_config.num_gpu_blocks))
 
 
-def cache_swapping(cache_engine: CacheEngine, swap_in_map: dict, swap_out_map: dict):
+def cache_swapping(cache_engine: CacheEngine,
+                   swap_in_map: dict,
+                   swap_out_map: dict,
+                   disk_save_map: dict = None,
+                   disk_load_map: dict = None,
+                   copy_map: dict = None):
     """perform cache swapping."""
     issued_cache_op = False
+    # save blocks to disk before they are overwritten by other cache ops.
+    if disk_save_map:
+        cache_engine.save_to_disk(disk_save_map)
+    # swap out first, swap in might reuse the gpu blocks released by swap out.
+    if len(swap_out_map) > 0:
+        cache_engine.swap_out(swap_out_map)
+        issued_cache_op = True
+    # copy before swap in, the source might be released and reused by swap in.
+    if copy_map:
+        cache_engine.copy_blocks(copy_map)
+        issued_cache_op = True
     if len(swap_in_map) > 0:
         cache_engine.swap_in(swap_in_map)
         issued_cache_op = True
-    if len(swap_out_map) > 0:
-        cache_engine.swap_out(swap_out_map)
+    if disk_load_map:
+        cache_engine.load_from_disk(disk_load_map)
         issued_cache_op = True
 
     if issued_cache_op:
@@ -127,8 +148,12 @@ def model_forward(
     stream: torch.cuda.Stream = None,
 ):
     """perform model forward."""
-    stream = stream or torch.cuda.current_stream()
-    with torch.cuda.stream(stream):
+    device_context = get_device_manager().current_context()
+    stream = stream or device_context.current_stream()
+    with device_context.stream(stream):
+        # page in adapters
+        if inputs.adapter_slot_map:
+            load_adapter_slots(model, inputs.adapter_slot_map)
         # forward
         ctx_mgr = model.ctx_mgr
         context = ctx_mgr.build_context(
@@ -153,6 +178,7 @@ def model_forward(
 
 
 SwapMap = Dict[int, int]
+DiskMap = Dict[str, int]
 
 
 class AutoModelAgent:
@@ -162,13 +188,22 @@ class AutoModelAgent:
         self.model_config = model_config
         self.cache_config = cache_config
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap, swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            disk_save_map: DiskMap = None,
+                            disk_load_map: DiskMap = None,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            disk_save_map (DiskMap): Cache maps to save to disk.
+            disk_load_map (DiskMap): Cache maps to load from disk.
+            copy_map (SwapMap): Cache maps to copy on device, dst -> src.
         """
         raise NotImplementedError('Not implemented.')
 
@@ -180,6 +215,19 @@ class AutoModelAgent:
         """get input processor."""
         raise NotImplementedError('Not implemented.')
 
+    def load_adapter(self, adapter_id: int, path: str):
+        """load an adapter to host memory.
+
+        Args:
+            adapter_id (int): The adapter id given by the adapter manager.
+            path (str): The local path of the adapter.
+        """
+        raise NotImplementedError('Not implemented.')
+
+    def unload_adapter(self, adapter_id: int):
+        """free the host memory of an adapter."""
+        raise NotImplementedError('Not implemented.')
+
 
 class BaseModelAgent(AutoModelAgent):
     """Base model agent.
@@ -201,7 +249,8 @@ class BaseModelAgent(AutoModelAgent):
                  adapters: Dict[str, str] = None,
                  trust_remote_code: bool = True):
         super().__init__(model_config=model_config, cache_config=cache_config)
-        device = 'cuda'
+        device_context = get_device_manager().current_context()
+        device = device_context.device
         self.backend_config = backend_config
         self._adapters = adapters
 
@@ -218,7 +267,7 @@ class BaseModelAgent(AutoModelAgent):
 
         self.cache_engine = CacheEngine(cache_config, model_config)
 
-        self.stream = torch.cuda.Stream()
+        self.stream = device_context.new_stream()
 
     def _build_model(self, model_path: str, adapters: Dict[str, str] = None, device: torch.device = 'cuda'):
         """build patched model."""
@@ -230,12 +279,29 @@ class BaseModelAgent(AutoModelAgent):
         logger.info('loading weights.')
         load_model_weights(patched_model, model_path, device=device)
         logger.info('loading adapters.')
-        if adapters is not None:
-            add_adapters(patched_model, adapters, dtype=self.model_config.dtype, device=device)
+        cache_config = self.cache_config
+        add_adapters(patched_model,
+                     adapters,
+                     dtype=self.model_config.dtype,
+                     device=device,
+                     num_slots=cache_config.max_lora_slots,
+                     max_rank=cache_config.max_lora_rank,
+                     target_modules=cache_config.lora_target_modules)
         return patched_model
 
-    def _forward_impl(self, inputs: ModelInputs, swap_in_map: SwapMap, swap_out_map: SwapMap):
-        cache_swapping(self.cache_engine, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+    def _forward_impl(self,
+                      inputs: ModelInputs,
+                      swap_in_map: SwapMap,
+                      swap_out_map: SwapMap,
+                      disk_save_map: DiskMap = None,
+                      disk_load_map: DiskMap = None,
+                      copy_map: SwapMap = None):
+        cache_swapping(self.cache_engine,
+                       swap_in_map=swap_in_map,
+                       swap_out_map=swap_out_map,
+                       disk_save_map=disk_save_map,
+                       disk_load_map=disk_load_map,
+                       copy_map=copy_map)
         output = model_forward(
             self.patched_model,
             inputs,
@@ -245,15 +311,29 @@ class BaseModelAgent(AutoModelAgent):
         )
         return output
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap, swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            disk_save_map: DiskMap = None,
+                            disk_load_map: DiskMap = None,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            disk_save_map (DiskMap): Cache maps to save to disk.
+            disk_load_map (DiskMap): Cache maps to load from disk.
+            copy_map (SwapMap): Cache maps to copy on device, dst -> src.
         """
-        output = self._forward_impl(inputs, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+        output = self._forward_impl(inputs,
+                                    swap_in_map=swap_in_map,
+                                    swap_out_map=swap_out_map,
+                                    disk_save_map=disk_save_map,
+                                    disk_load_map=disk_load_map,
+                                    copy_map=copy_map)
         await asyncio.sleep(0)
         return output
 
@@ -265,6 +345,14 @@ class BaseModelAgent(AutoModelAgent):
         """get input processor.."""
         return self.patched_model.get_input_processor()
 
+    def load_adapter(self, adapter_id: int, path: str):
+        """load an adapter to host memory."""
+        load_adapter(self.patched_model, adapter_id, path)
+
+    def unload_adapter(self, adapter_id: int):
+        """free the host memory of an adapter."""
+        unload_adapter(self.patched_model, adapter_id)
+
 
 @torch.inference_mode()
 def _tp_build_model(
@@ -313,10 +401,15 @@ def _tp_build_model(
             logger.info('loading weights.')
         load_model_weights(patched_model, model_path, device=device_map)
 
-        if adapters is not None:
-            if rank == 0:
-                logger.info('loading adapters.')
-            add_adapters(patched_model, adapters, dtype=model_config.dtype, device=device_map)
+        if rank == 0:
+            logger.info('loading adapters.')
+        add_adapters(patched_model,
+                     adapters,
+                     dtype=model_config.dtype,
+                     device=device_map,
+                     num_slots=cache_config.max_lora_slots,
+                     max_rank=cache_config.max_lora_rank,
+                     target_modules=cache_config.lora_target_modules)
 
         _update_cache_config(model_config, cache_config, gpu_id=rank, world_size=world_size)
 
@@ -336,28 +429,44 @@ def _tp_build_model(
     return patched_model, cache_engine, cache_config
 
 
+# inputs, swap_in_map, swap_out_map, disk_save_map, disk_load_map, copy_map, adapter_op
+_NUM_BROADCAST_INPUTS = 7
+
+
 def _broadcast_inputs(rank: int, inputs: Any, group: dist.group, stream: torch.cuda.Stream):
     """get input tensor parallel."""
     # broadcast meta info
     if rank != 0:
-        inputs = [None, None, None]
+        inputs = [None] * _NUM_BROADCAST_INPUTS
+        device_inputs = None
     else:
+        assert len(inputs) == _NUM_BROADCAST_INPUTS
         device_inputs = inputs[0]
-        meta_inputs = device_inputs.to_device('meta')
-        inputs[0] = meta_inputs
+        if device_inputs is not None:
+            inputs[0] = device_inputs.to_device('meta')
 
     with torch.cuda.stream(stream):
         dist.broadcast_object_list(inputs, group=group)
-        if rank == 0:
-            device_inputs.broadcast()
-        else:
-            device_inputs = inputs[0].broadcast()
+        # adapter ops have no model inputs
+        if inputs[0] is not None:
+            if rank == 0:
+                device_inputs.broadcast()
+            else:
+                device_inputs = inputs[0].broadcast()
 
     inputs[0] = device_inputs
 
     return inputs
 
 
+def _apply_adapter_op(model: torch.nn.Module, adapter_op: Dict[str, Any]):
+    """load or unload an adapter on a tensor parallel rank."""
+    if adapter_op['type'] == 'load':
+        load_adapter(model, adapter_op['adapter_id'], adapter_op['path'])
+    else:
+        unload_adapter(model, adapter_op['adapter_id'])
+
+
 def _tp_model_loop(
     rank: int,
     model_path: str,
@@ -392,9 +501,19 @@ def _tp_model_loop(
 
     while True:
         barrier.wait()
-        inputs, swap_in_map, swap_out_map = _broadcast_inputs(rank, None, cpu_group, stream)
-
-        cache_swapping(cache_engine, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+        inputs, swap_in_map, swap_out_map, disk_save_map, disk_load_map, copy_map, adapter_op = _broadcast_inputs(
+            rank, None, cpu_group, stream)
+
+        if adapter_op is not None:
+            _apply_adapter_op(patched_model, adapter_op)
+            continue
+
+        cache_swapping(cache_engine,
+                       swap_in_map=swap_in_map,
+                       swap_out_map=swap_out_map,
+                       disk_save_map=disk_save_map,
+                       disk_load_map=disk_load_map,
+                       copy_map=copy_map)
         inputs = inputs.to_device('cuda')
 
         model_forward(
@@ -634,14 +753,26 @@ class TPModelAgent(AutoModelAgent):
 
         return model, cache_engine, cache_config
 
-    def _forward_impl(self, inputs: ModelInputs, swap_in_map: SwapMap, swap_out_map: SwapMap):
+    def _forward_impl(self,
+                      inputs: ModelInputs,
+                      swap_in_map: SwapMap,
+                      swap_out_map: SwapMap,
+                      disk_save_map: DiskMap = None,
+                      disk_load_map: DiskMap = None,
+                      copy_map: SwapMap = None):
         """forward impl."""
         with get_dist_manager().context(self._dist_ctx):
             self.mp_bar.wait()
             rank = 0
-            _broadcast_inputs(rank, [inputs, swap_in_map, swap_out_map], self._cpu_group, self.stream)
-
-            cache_swapping(self.cache_engine, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+            _broadcast_inputs(rank, [inputs, swap_in_map, swap_out_map, disk_save_map, disk_load_map, copy_map, None],
+                              self._cpu_group, self.stream)
+
+            cache_swapping(self.cache_engine,
+                           swap_in_map=swap_in_map,
+                           swap_out_map=swap_out_map,
+                           disk_save_map=disk_save_map,
+                           disk_load_map=disk_load_map,
+                           copy_map=copy_map)
             output = model_forward(
                 self.patched_model,
                 inputs,
@@ -651,15 +782,29 @@ class TPModelAgent(AutoModelAgent):
             )
         return output
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap, swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            disk_save_map: DiskMap = None,
+                            disk_load_map: DiskMap = None,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            disk_save_map (DiskMap): Cache maps to save to disk.
+            disk_load_map (DiskMap): Cache maps to load from disk.
+            copy_map (SwapMap): Cache maps to copy on device, dst -> src.
         """
-        output = self._forward_impl(inputs, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+        output = self._forward_impl(inputs,
+                                    swap_in_map=swap_in_map,
+                                    swap_out_map=swap_out_map,
+                                    disk_save_map=disk_save_map,
+                                    disk_load_map=disk_load_map,
+                                    copy_map=copy_map)
         await asyncio.sleep(0)
         return output
 
@@ -671,6 +816,26 @@ class TPModelAgent(AutoModelAgent):
         """get input processor.."""
         return self.patched_model.get_input_processor()
 
+    def _broadcast_adapter_op(self, adapter_op: Dict[str, Any]):
+        """apply the adapter op on the other ranks."""
+        with get_dist_manager().context(self._dist_ctx):
+            self.mp_bar.wait()
+            rank = 0
+            _broadcast_inputs(rank, [None] * (_NUM_BROADCAST_INPUTS - 1) + [adapter_op], self._cpu_group, self.stream)
+
+    def load_adapter(self, adapter_id: int, path: str):
+        """load an adapter to host memory."""
+        # rank 0 checks the adapter before the other ranks load it
+        with get_dist_manager().context(self._dist_ctx):
+            load_adapter(self.patched_model, adapter_id, path)
+        self._broadcast_adapter_op(dict(type='load', adapter_id=adapter_id, path=path))
+
+    def unload_adapter(self, adapter_id: int):
+        """free the host memory of an adapter."""
+        with get_dist_manager().context(self._dist_ctx):
+            unload_adapter(self.patched_model, adapter_id)
+        self._broadcast_adapter_op(dict(type='unload', adapter_id=adapter_id))
+
 
 def _exit_handler(agent: TPModelAgent):
     if hasattr(agent, 'patched_model'):
@@ -684,7 +849,9 @@ def build_model_agent(model_path: str,
                       adapters: Dict[str, str] = None,
                       tp: int = 1,
                       dtype: str = 'auto',
-                      custom_module_map: str = None):
+                      custom_module_map: str = None,
+                      simulated_model: str = None,
+                      simulated_latency_model: str = None):
     """create model agent.
 
     Args:
@@ -696,10 +863,31 @@ def build_model_agent(model_path: str,
         tp (int): the number of devices to be used in tensor parallelism
         dtype (str): the data type of model weights and activations
         custom_module_map (str): customized nn module map
+        simulated_model (str): mode of the simulated model agent, the model
+            is not loaded if it is set
+        simulated_latency_model (str): json file of the latency model of the
+            simulated model agent
     """
     model_config = ModelConfig.from_pretrained(model_path, trust_remote_code=trust_remote_code, dtype=dtype, tp=tp)
     model_config.custom_module_map = custom_module_map
-    if tp == 1:
+    if cache_config.disk_cache_dir is not None:
+        # caches of different models should not be shared
+        cache_config.disk_cache_dir = get_disk_cache_dir(cache_config.disk_cache_dir,
+                                                         model_path,
+                                                         dtype=model_config.dtype,
+                                                         block_size=cache_config.block_size,
+                                                         quant_policy=cache_config.quant_policy,
+                                                         world_size=tp)
+    if simulated_model is not None:
+        from .simulated_agent import LatencyModel, SimulatedModelAgent
+        latency_model = None
+        if simulated_latency_model is not None:
+            latency_model = LatencyModel.from_json(simulated_latency_model)
+        model_agent = SimulatedModelAgent(model_config=model_config,
+                                          cache_config=cache_config,
+                                          latency_model=latency_model,
+                                          mode=simulated_model)
+    elif tp == 1:
         model_agent = BaseModelAgent(model_path,
                                      model_config=model_config,
                                      cache_config=cache_config,
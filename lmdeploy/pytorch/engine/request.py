@@ -19,6 +19,8 @@ class RequestType(enum.Enum):
     END_SESSION = enum.auto()
     STOP_ENGINE = enum.auto()
     RESUME_ENGINE = enum.auto()
+    LOAD_ADAPTER = enum.auto()
+    UNLOAD_ADAPTER = enum.auto()
 
 
 @dataclass
@@ -178,8 +180,8 @@ class RequestManager:
         self.senders: Dict[int, RequestSender] = dict()
         self.callbacks: Dict[RequestType, Callable] = dict()
         self.request_priority: List[RequestType] = [
-            RequestType.STOP_ENGINE, RequestType.STOP_SESSION, RequestType.END_SESSION, RequestType.ADD_SESSION,
-            RequestType.ADD_MESSAGE
+            RequestType.STOP_ENGINE, RequestType.STOP_SESSION, RequestType.END_SESSION, RequestType.UNLOAD_ADAPTER,
+            RequestType.LOAD_ADAPTER, RequestType.ADD_SESSION, RequestType.ADD_MESSAGE
         ]
         self.requests: asyncio.Queue = None
         self._loop_task: asyncio.Future = None
@@ -0,0 +1,290 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import dataclasses
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, Literal
+
+import numpy as np
+import torch
+
+from lmdeploy.utils import get_logger
+
+from ..config import CacheConfig, ModelConfig
+from ..devices import get_device_manager
+from ..model_inputs import ModelInputs
+from .cache_engine import CacheEngine
+from .model_agent import AutoModelAgent, DiskMap, SwapMap
+
+logger = get_logger('lmdeploy')
+
+# primes to hash the context window of a token
+_WINDOW_PRIMES = (1000003, 10007, 101, 7)
+_POSITION_PRIME = 7919
+
+
+@dataclass
+class LatencyModel:
+    """Forward latency of a model on a device in seconds.
+
+    A prefill step costs `prefill_base + prefill_per_token * num_tokens +
+    prefill_attention * sum(q_len * kv_len)`, the quadratic attention term
+    dominates long prompts. A decoding step costs `decode_base +
+    decode_per_token * num_tokens + decode_attention * sum(q_len * kv_len)`,
+    `num_tokens` is the batch size without speculative tokens and the
+    attention term is the number of the cached tokens read. Both stages add
+    `lora_per_adapter` for each distinct lora adapter in the batch, it is not
+    fitted and defaults to 0.
+
+    Args:
+        free_memory (int): Free device memory in bytes after the weights are
+            loaded, sizes the kv cache if `num_gpu_blocks` is not set.
+    """
+    prefill_base: float = 0.005
+    prefill_per_token: float = 5e-5
+    prefill_attention: float = 2e-9
+    decode_base: float = 0.012
+    decode_per_token: float = 5e-5
+    decode_attention: float = 3e-7
+    free_memory: int = 40 << 30
+    lora_per_adapter: float = 0.0
+
+    @staticmethod
+    def get_features(inputs: ModelInputs):
+        """number of tokens and attention pairs of the inputs."""
+        q_seqlens = inputs.seq_length
+        kv_seqlens = q_seqlens + inputs.history_lengths - inputs.num_ignored_history
+        num_tokens = int(q_seqlens.sum())
+        attention = int((q_seqlens * kv_seqlens).sum())
+        return num_tokens, attention
+
+    @staticmethod
+    def get_num_adapters(inputs: ModelInputs):
+        """number of distinct lora adapters of the inputs."""
+        if inputs.local_adapter_ids is None:
+            return 0
+        return len(set(inputs.local_adapter_ids.tolist()) - {0})
+
+    def predict(self, is_decoding: bool, num_tokens: int, attention: int, num_adapters: int = 0) -> float:
+        """latency of a forward with the features."""
+        lora_cost = self.lora_per_adapter * num_adapters
+        if is_decoding:
+            return self.decode_base + self.decode_per_token * num_tokens + self.decode_attention * attention + lora_cost
+        return self.prefill_base + self.prefill_per_token * num_tokens + self.prefill_attention * attention + lora_cost
+
+    def forward_time(self, inputs: ModelInputs) -> float:
+        """latency of the forward of the inputs."""
+        return self.predict(inputs.is_decoding, *self.get_features(inputs), num_adapters=self.get_num_adapters(inputs))
+
+    @classmethod
+    def fit(cls, samples: List[Dict[str, Any]], free_memory: int = None):
+        """fit the coefficients with least squares.
+
+        Args:
+            samples (List[Dict]): Measured forwards, each with keys
+                `is_decoding`, `num_tokens`, `attention` and `latency`.
+            free_memory (int): Free device memory after loading weights.
+        """
+        model = cls()
+        for stage in ['prefill', 'decode']:
+            is_decoding = stage == 'decode'
+            stage_samples = [s for s in samples if s['is_decoding'] == is_decoding]
+            if len(stage_samples) < 3:
+                logger.warning(f'No enough {stage} samples, use the default coefficients.')
+                continue
+            features = np.array([[1.0, s['num_tokens'], s['attention']] for s in stage_samples])
+            latency = np.array([s['latency'] for s in stage_samples])
+            coefs = np.linalg.lstsq(features, latency, rcond=None)[0]
+            coefs = np.maximum(coefs, 0.0)
+            setattr(model, f'{stage}_base', float(coefs[0]))
+            setattr(model, f'{stage}_per_token', float(coefs[1]))
+            setattr(model, f'{stage}_attention', float(coefs[2]))
+        if free_memory is not None:
+            model.free_memory = int(free_memory)
+        return model
+
+    def to_json(self, file_path: str = None):
+        """dump the latency model to json, optionally save to a file."""
+        json_str = json.dumps(dataclasses.asdict(self), indent=4)
+        if file_path:
+            with open(file_path, 'w') as f:
+                f.write(json_str)
+        return json_str
+
+    @classmethod
+    def from_json(cls, file_path: str):
+        """load the latency model from a json file."""
+        with open(file_path, 'r') as f:
+            return cls(**json.load(f))
+
+
+class _SimulatedCache:
+    """token ids in the kv cache blocks, kept on host."""
+
+    def __init__(self, num_gpu_blocks: int, num_cpu_blocks: int, block_size: int):
+        self.block_size = block_size
+        self.gpu_cache = torch.empty(num_gpu_blocks, block_size, dtype=torch.int32)
+        self.cpu_cache = torch.empty(num_cpu_blocks, block_size, dtype=torch.int32)
+        self.disk_cache: Dict[str, torch.Tensor] = dict()
+
+    def _get_block(self, phy_block: int):
+        """get a block in the unified physical space."""
+        num_gpu_blocks = self.gpu_cache.size(0)
+        if phy_block < num_gpu_blocks:
+            return self.gpu_cache[phy_block]
+        return self.cpu_cache[phy_block - num_gpu_blocks]
+
+    def swap(self,
+             swap_in_map: SwapMap,
+             swap_out_map: SwapMap,
+             disk_save_map: DiskMap = None,
+             disk_load_map: DiskMap = None,
+             copy_map: SwapMap = None):
+        """move the blocks in the same order as `cache_swapping`."""
+        for key, phy_block in (disk_save_map or dict()).items():
+            self.disk_cache[key] = self._get_block(phy_block).clone()
+        for src, dst in swap_out_map.items():
+            self.cpu_cache[dst] = self.gpu_cache[src]
+        if copy_map:
+            dst_idx, src_idx = list(zip(*copy_map.items()))
+            self.gpu_cache[list(dst_idx)] = self.gpu_cache[list(src_idx)]
+        for src, dst in swap_in_map.items():
+            self.gpu_cache[dst] = self.cpu_cache[src]
+        for key, block in (disk_load_map or dict()).items():
+            self.gpu_cache[block] = self.disk_cache[key]
+
+
+class SimulatedModelAgent(AutoModelAgent):
+    """Model agent without a model, for benchmarking the scheduler, the block
+    manager and the serving stack without loading weights.
+
+    The input tokens are written to simulated kv cache blocks, the output
+    token of each position is hashed from the cached tokens of its context
+    window, so the outputs are deterministic and bugs of the block tables or
+    cache swapping change them. The forward returns after the latency of the
+    latency model.
+
+    Args:
+        model_config (ModelConfig): The config of the model.
+        cache_config (CacheConfig): The config of the cache info.
+        latency_model (LatencyModel): The latency model of the forwards.
+        mode (str): `deterministic` makes the sampled tokens independent of
+            the sampling params, `sampled` adds noise to the logits.
+        context_window (int): Number of the cached tokens hashed to the next
+            token.
+    """
+
+    def __init__(self,
+                 model_config: ModelConfig,
+                 cache_config: CacheConfig,
+                 latency_model: LatencyModel = None,
+                 mode: Literal['deterministic', 'sampled'] = 'deterministic',
+                 context_window: int = 4):
+        super().__init__(model_config=model_config, cache_config=cache_config)
+        assert mode in ['deterministic', 'sampled'], f'invalid simulated mode: {mode}'
+        assert context_window <= len(_WINDOW_PRIMES), 'context_window is too large'
+        if latency_model is None:
+            latency_model = LatencyModel()
+        self.latency_model = latency_model
+        self.mode = mode
+        self.context_window = context_window
+        self.device = get_device_manager().current_context().device
+        self._update_cache_config()
+        self.cache = _SimulatedCache(cache_config.num_gpu_blocks, cache_config.num_cpu_blocks, cache_config.block_size)
+        self.stream = get_device_manager().current_context().new_stream()
+        self.forward_time = 0.0
+
+    def _update_cache_config(self, host_mem_size: int = 1 * (1 << 30)):
+        """size the caches with the memory of the latency model."""
+        cache_config = self.cache_config
+        cache_block_size = CacheEngine.get_cache_block_size(cache_config.block_size, self.model_config, 1,
+                                                            cache_config.quant_policy)
+        if cache_config.num_cpu_blocks == 0:
+            cache_config.num_cpu_blocks = int(host_mem_size / cache_block_size)
+        if cache_config.num_gpu_blocks == 0:
+            gpu_mem = self.latency_model.free_memory * cache_config.cache_max_entry_count
+            cache_config.num_gpu_blocks = int(gpu_mem / cache_block_size)
+            if cache_config.num_gpu_blocks <= 0:
+                raise RuntimeError('No enough gpu memory for kv cache.')
+        cache_config.window_size = self.model_config.sliding_window
+
+    def _next_tokens(self, inputs: ModelInputs):
+        """fill the input tokens to the cache and hash the next tokens."""
+        block_size = self.cache.block_size
+        input_ids = inputs.input_ids.flatten().cpu()
+        q_seqlens = inputs.seq_length.cpu()
+        history_lengths = inputs.history_lengths.cpu()
+        num_ignored = inputs.num_ignored_history.cpu()
+        block_offsets = inputs.block_offsets.cpu()
+
+        batch_ids = torch.repeat_interleave(torch.arange(q_seqlens.size(0)), q_seqlens)
+        token_ids = torch.arange(input_ids.size(0)) - (q_seqlens.cumsum(0) - q_seqlens)[batch_ids]
+        positions = history_lengths[batch_ids] + token_ids
+        kv_pos = positions - num_ignored[batch_ids]
+        blocks = block_offsets[batch_ids, kv_pos // block_size]
+        self.cache.gpu_cache[blocks, kv_pos % block_size] = input_ids.to(torch.int32)
+
+        window_pos = kv_pos[:, None] - torch.arange(self.context_window)[None]
+        valid = window_pos >= 0
+        window_pos = window_pos.clamp_min(0)
+        window_blocks = block_offsets[batch_ids[:, None], window_pos // block_size]
+        window = self.cache.gpu_cache[window_blocks, window_pos % block_size].long()
+        window = window.masked_fill(~valid, 0)
+        primes = torch.tensor(_WINDOW_PRIMES[:self.context_window])
+        hashes = (window * primes).sum(-1) + positions * _POSITION_PRIME
+        return hashes % (self.model_config.vocab_size - 1) + 1
+
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            disk_save_map: DiskMap = None,
+                            disk_load_map: DiskMap = None,
+                            copy_map: SwapMap = None):
+        """model forward.
+
+        Args:
+            inputs (Dict): The input data comes from _make_inputs.
+            swap_in_map (SwapMap): Cache maps to swap in.
+            swap_out_map (SwapMap): Cache maps to swap out.
+            disk_save_map (DiskMap): Cache maps to save to disk.
+            disk_load_map (DiskMap): Cache maps to load from disk.
+            copy_map (SwapMap): Cache maps to copy on device, dst -> src.
+        """
+        self.cache.swap(swap_in_map,
+                        swap_out_map,
+                        disk_save_map=disk_save_map,
+                        disk_load_map=disk_load_map,
+                        copy_map=copy_map)
+        next_tokens = self._next_tokens(inputs)
+        latency = self.latency_model.forward_time(inputs)
+        self.forward_time += latency
+        await asyncio.sleep(latency)
+        # the hidden states are the next tokens, expanded to logits by get_logits
+        hidden_states = next_tokens.to(self.device)[None, :, None]
+        return dict(hidden_states=hidden_states, model_metas=inputs.model_metas)
+
+    def get_logits(self, hidden_states: torch.Tensor):
+        """get logits of model output."""
+        next_tokens = hidden_states[..., 0]
+        vocab_size = self.model_config.vocab_size
+        if self.mode == 'deterministic':
+            logits = hidden_states.new_zeros(*next_tokens.shape, vocab_size, dtype=torch.float32)
+            peak = 100.0
+        else:
+            logits = torch.randn(*next_tokens.shape, vocab_size, device=hidden_states.device)
+            peak = 4.0
+        logits.scatter_(-1, next_tokens[..., None], peak)
+        return logits
+
+    def get_input_processor(self):
+        """get input processor."""
+        return None
+
+    def load_adapter(self, adapter_id: int, path: str):
+        """adapters have no weights in the simulated model."""
+        pass
+
+    def unload_adapter(self, adapter_id: int):
+        """adapters have no weights in the simulated model."""
+        pass
@@ -0,0 +1,175 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import bisect
+import time
+from dataclasses import dataclass
+from typing import List, Sequence
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1.0, 2.5)
+HOST_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+STEP_TOKENS_BUCKETS = (1, 8, 32, 128, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+@dataclass
+class StepStats:
+    """Host side time of the engine steps.
+
+    The host time of a step covers scheduling and preparing the inputs before
+    the forward is launched. It is hidden behind the forward of the previous
+    step when the step is pipelined.
+    """
+
+    num_steps: int = 0
+    num_pipelined_steps: int = 0
+    host_time: float = 0.0
+    last_host_time: float = 0.0
+    max_host_time: float = 0.0
+
+    def update(self, host_time: float, pipelined: bool = False):
+        """update with the host time of one step.
+
+        Args:
+            host_time (float): Host time of the step in seconds.
+            pipelined (bool): The step is prepared while the previous step
+                is running.
+        """
+        self.num_steps += 1
+        if pipelined:
+            self.num_pipelined_steps += 1
+        self.host_time += host_time
+        self.last_host_time = host_time
+        self.max_host_time = max(self.max_host_time, host_time)
+
+    @property
+    def mean_host_time(self) -> float:
+        """mean host time per step."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.host_time / self.num_steps
+
+    @property
+    def pipelined_ratio(self) -> float:
+        """ratio of the pipelined steps."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.num_pipelined_steps / self.num_steps
+
+    def reset(self):
+        """reset stats."""
+        self.num_steps = 0
+        self.num_pipelined_steps = 0
+        self.host_time = 0.0
+        self.last_host_time = 0.0
+        self.max_host_time = 0.0
+
+
+@dataclass
+class ScheduleStats:
+    """Queue depth and free cache blocks of the engine."""
+
+    num_waiting: int = 0
+    num_running: int = 0
+    num_free_gpu_blocks: int = 0
+    num_gpu_blocks: int = 0
+
+
+class Histogram:
+    """A histogram with fixed buckets.
+
+    It is updated by the engine loop only, so there is no lock. Readers in
+    other threads might see an observation in `count` before it is in
+    `bucket_counts`, which is fine for monitoring.
+
+    Args:
+        buckets (Sequence[float]): upper bounds of the buckets in ascending
+            order, the last bucket `+Inf` is implicit.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """add an observation."""
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        """number of the observations less or equal to each bucket."""
+        counts = []
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class EngineMetrics:
+    """Latency and batch metrics aggregated by the engine loop."""
+
+    def __init__(self):
+        self.time_to_first_token = Histogram(LATENCY_BUCKETS)
+        self.inter_token_latency = Histogram(TOKEN_LATENCY_BUCKETS)
+        self.queue_time = Histogram(LATENCY_BUCKETS)
+        self.prefill_batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.decode_batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.step_tokens = Histogram(STEP_TOKENS_BUCKETS)
+        self.schedule_time = Histogram(HOST_TIME_BUCKETS)
+        self.host_time = Histogram(HOST_TIME_BUCKETS)
+        self.num_generation_tokens = 0
+        self.num_finished_requests = 0
+        # outputs are handled in the order of the forwards
+        self.num_forwards = 0
+
+    def update_scheduled(self, seqs: Sequence, is_prefill: bool, num_tokens: int):
+        """update with a scheduled step.
+
+        Args:
+            seqs (SeqList): the scheduled sequences.
+            is_prefill (bool): the step is a prefill step.
+            num_tokens (int): number of the input tokens of the step.
+        """
+        self.step_tokens.observe(num_tokens)
+        if is_prefill:
+            self.prefill_batch_size.observe(len(seqs))
+        else:
+            self.decode_batch_size.observe(len(seqs))
+        # prefill chunks are scheduled in decoding steps
+        now = time.time()
+        for seq in seqs:
+            if seq.scheduled_time is None:
+                seq.scheduled_time = now
+                self.queue_time.observe(now - seq.request_time)
+
+    def update_outputs(self, seqs: Sequence, is_run: Sequence[bool], num_tokens: Sequence[int],
+                       finished: Sequence[bool]):
+        """update with the outputs of a step.
+
+        Args:
+            seqs (SeqList): the sequences of the step.
+            is_run (List[bool]): the sequences have outputs.
+            num_tokens (List[int]): number of the generated tokens.
+            finished (List[bool]): the sequences are finished.
+        """
+        now = time.time()
+        step = self.num_forwards
+        self.num_forwards += 1
+        for seq, run, num, finish in zip(seqs, is_run, num_tokens, finished):
+            if seq.scheduled_step is None:
+                seq.scheduled_step = step
+            if not run:
+                continue
+            self.num_generation_tokens += num
+            if finish:
+                self.num_finished_requests += 1
+            if seq.last_token_time is None:
+                self.time_to_first_token.observe(now - seq.request_time)
+                seq.first_token_time = now
+                seq.first_token_step = step
+            elif num > 0:
+                self.inter_token_latency.observe((now - seq.last_token_time) / num)
+            seq.last_token_time = now
@@ -0,0 +1,160 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from collections import deque
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from ..messages import SchedulerSequence
+
+SeqList = List[SchedulerSequence]
+
+
+def build_automaton(patterns: Sequence[Sequence[int]]):
+    """build Aho-Corasick automaton of token patterns.
+
+    Tokens out of the patterns are mapped to symbol 0, the transitions are
+    completed with the failure links, so matching is one table lookup per
+    token.
+
+    Args:
+        patterns (Sequence[Sequence[int]]): Token patterns.
+
+    Return:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Sorted tokens of the
+            patterns, transition table of shape [num_states, num_symbols]
+            and pattern outputs of shape [num_states, num_patterns].
+    """
+    alphabet = np.array(sorted(set(token for pattern in patterns for token in pattern)), dtype=np.int64)
+    symbols = dict((token, idx + 1) for idx, token in enumerate(alphabet.tolist()))
+    num_symbols = len(alphabet) + 1
+
+    # trie
+    goto = [dict()]
+    pattern_ends = [[]]
+    for pattern_id, pattern in enumerate(patterns):
+        state = 0
+        for token in pattern:
+            symbol = symbols[token]
+            if symbol not in goto[state]:
+                goto.append(dict())
+                pattern_ends.append([])
+                goto[state][symbol] = len(goto) - 1
+            state = goto[state][symbol]
+        pattern_ends[state].append(pattern_id)
+
+    num_states = len(goto)
+    transitions = np.zeros((num_states, num_symbols), dtype=np.int64)
+    outputs = np.zeros((num_states, len(patterns)), dtype=bool)
+    fail = np.zeros(num_states, dtype=np.int64)
+    for state, ends in enumerate(pattern_ends):
+        outputs[state, ends] = True
+
+    # complete transitions in bfs order
+    que = deque()
+    for symbol, state in goto[0].items():
+        transitions[0, symbol] = state
+        que.append(state)
+    while len(que) > 0:
+        state = que.popleft()
+        outputs[state] |= outputs[fail[state]]
+        for symbol in range(num_symbols):
+            next_state = goto[state].get(symbol)
+            if next_state is None:
+                transitions[state, symbol] = transitions[fail[state], symbol]
+            else:
+                fail[next_state] = transitions[fail[state], symbol]
+                transitions[state, symbol] = next_state
+                que.append(next_state)
+    return alphabet, transitions, outputs
+
+
+class StopSequenceMatcher:
+    """Batched multi-token stop sequence matcher.
+
+    Stop sequences of the batch are compiled into one Aho-Corasick automaton
+    over token ids. The state of each sequence is initialized with a window
+    of its recent generated tokens and advanced on device with the sampled
+    tokens.
+
+    Args:
+        patterns (List[Tuple[int]]): Stop sequences of the batch.
+        seq_patterns (List[List[int]]): Pattern ids of each sequence.
+        windows (List[np.ndarray]): Recent generated tokens of each sequence,
+            no less than the longest stop sequence of it.
+        device (str): Device of the states.
+    """
+
+    def __init__(self,
+                 patterns: List[Tuple[int]],
+                 seq_patterns: List[List[int]],
+                 windows: List[np.ndarray],
+                 device: str = 'cuda'):
+        alphabet, transitions, outputs = build_automaton(patterns)
+        batch_size = len(seq_patterns)
+        seq_mask = np.zeros((batch_size, len(patterns)), dtype=bool)
+        for idx, pattern_ids in enumerate(seq_patterns):
+            seq_mask[idx, pattern_ids] = True
+
+        # the window is short, walk it on host
+        states = np.zeros(batch_size, dtype=np.int64)
+        for idx, window in enumerate(windows):
+            state = 0
+            for symbol in self._to_symbols(alphabet, window):
+                state = transitions[state, symbol]
+            states[idx] = state
+
+        # stop sequences that end with the window, on host
+        self.window_matched = torch.from_numpy((outputs[states] & seq_mask).any(1))
+        self.alphabet = torch.from_numpy(alphabet).to(device)
+        self.transitions = torch.from_numpy(transitions).to(device)
+        self.outputs = torch.from_numpy(outputs).to(device)
+        self.seq_mask = torch.from_numpy(seq_mask).to(device)
+        self.states = torch.from_numpy(states).to(device)
+
+    @staticmethod
+    def _to_symbols(alphabet: np.ndarray, token_ids: np.ndarray):
+        """map tokens to symbols, tokens out of alphabet are 0."""
+        pos = np.searchsorted(alphabet, token_ids).clip(max=len(alphabet) - 1)
+        return np.where(alphabet[pos] == token_ids, pos + 1, 0)
+
+    @classmethod
+    def from_sequences(cls, seqs: SeqList, device: str = 'cuda'):
+        """create from sequences, return None if no sequence has stop
+        sequences."""
+        if not any(seq.sampling_param.stop_sequences for seq in seqs):
+            return None
+        pattern_ids = dict()
+        seq_patterns = []
+        windows = []
+        for seq in seqs:
+            ids = []
+            max_len = 0
+            for pattern in seq.sampling_param.stop_sequences:
+                pattern = tuple(pattern)
+                ids.append(pattern_ids.setdefault(pattern, len(pattern_ids)))
+                max_len = max(max_len, len(pattern))
+            seq_patterns.append(ids)
+            # only generated tokens are matched
+            num_window = min(max_len, seq.num_new_tokens)
+            windows.append(seq.all_ids[seq.num_all_ids - num_window:seq.num_all_ids] if num_window > 0 else [])
+        return cls(list(pattern_ids), seq_patterns, windows, device=device)
+
+    def step(self, token_ids: torch.LongTensor, mask: torch.BoolTensor = None) -> torch.BoolTensor:
+        """advance states by the sampled tokens, sequences with False `mask`
+        are skipped.
+
+        Return:
+            torch.BoolTensor: Whether a stop sequence ends with the token.
+        """
+        alphabet = self.alphabet
+        pos = torch.searchsorted(alphabet, token_ids).clamp_max(alphabet.numel() - 1)
+        symbols = torch.where(alphabet[pos] == token_ids, pos + 1, 0)
+        states = self.transitions[self.states, symbols]
+        if mask is not None:
+            states = torch.where(mask, states, self.states)
+        self.states = states
+        matched = (self.outputs[states] & self.seq_mask).any(1)
+        if mask is not None:
+            matched = matched & mask
+        return matched
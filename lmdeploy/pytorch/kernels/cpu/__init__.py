@@ -0,0 +1,14 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from .fill_kv_cache import fill_kv_cache
+from .flashattention import flash_attention_fwd
+from .flatten_kv_cache import flatten_kv_cache
+from .multinomial_sampling import multinomial_sampling
+from .pagedattention import paged_attention_fwd
+
+__all__ = [
+    'fill_kv_cache',
+    'flash_attention_fwd',
+    'flatten_kv_cache',
+    'multinomial_sampling',
+    'paged_attention_fwd',
+]
@@ -0,0 +1,43 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import Literal
+
+import torch
+from torch import Tensor
+
+
+def _get_token_slots(q_start_loc: Tensor, q_seq_length: Tensor, kv_seq_length: Tensor, block_offsets: Tensor,
+                     block_size: int):
+    """get the cache block and the offset in the block of each new token."""
+    batch_size = q_seq_length.size(0)
+    num_tokens = int(q_seq_length.sum())
+    batch_ids = torch.repeat_interleave(torch.arange(batch_size, device=q_seq_length.device), q_seq_length)
+    # the new tokens are the last tokens of the kv sequence
+    token_ids = torch.arange(num_tokens, device=q_seq_length.device)
+    token_ids = token_ids - (q_seq_length.cumsum(0) - q_seq_length)[batch_ids]
+    positions = (kv_seq_length - q_seq_length)[batch_ids] + token_ids
+    blocks = block_offsets[batch_ids, positions // block_size]
+    token_loc = q_start_loc[batch_ids] + token_ids
+    return token_loc, blocks, positions % block_size
+
+
+def fill_kv_cache(k_states: Tensor,
+                  v_states: Tensor,
+                  k_caches: Tensor,
+                  v_caches: Tensor,
+                  q_start_loc: Tensor,
+                  q_seq_length: Tensor,
+                  kv_seq_length: Tensor,
+                  max_q_seq_length: int,
+                  block_offsets: Tensor,
+                  k_scales_zeros: Tensor = None,
+                  v_scales_zeros: Tensor = None,
+                  quant_policy: Literal[0, 4, 8] = 0):
+    """fill key/value state to cache for paged attention.
+
+    Caches are of shape `[num_blocks, block_size, num_heads, head_dim]`.
+    """
+    assert quant_policy == 0, 'kv cache quantization is not supported on cpu.'
+    block_size = k_caches.size(1)
+    token_loc, blocks, offsets = _get_token_slots(q_start_loc, q_seq_length, kv_seq_length, block_offsets, block_size)
+    k_caches[blocks, offsets] = k_states[token_loc].to(k_caches.dtype)
+    v_caches[blocks, offsets] = v_states[token_loc].to(v_caches.dtype)
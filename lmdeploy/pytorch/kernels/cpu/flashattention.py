@@ -0,0 +1,66 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+from torch import Tensor
+
+
+def masked_attention(q: Tensor, k: Tensor, v: Tensor, mask: Tensor, sm_scale: float, logit_softcapping: float = None):
+    """attention of grouped query heads in float32.
+
+    Args:
+        q (Tensor): query of shape `[..., num_kv_heads, group, q_len, head_dim]`.
+        k (Tensor): key of shape `[..., num_kv_heads, kv_len, head_dim]`.
+        v (Tensor): value of shape `[..., num_kv_heads, kv_len, v_head_dim]`.
+        mask (Tensor): bool mask of the visible keys, broadcastable to
+            `[..., num_kv_heads, group, q_len, kv_len]`.
+    """
+    scores = torch.matmul(q.float(), k.float().unsqueeze(-3).transpose(-1, -2)) * sm_scale
+    if logit_softcapping is not None and logit_softcapping > 0:
+        scores = torch.tanh(scores / logit_softcapping) * logit_softcapping
+    scores = scores.masked_fill(~mask, float('-inf'))
+    probs = torch.softmax(scores, dim=-1).nan_to_num_(0.0)
+    return torch.matmul(probs, v.float().unsqueeze(-3))
+
+
+def flash_attention_fwd(
+    q_states: Tensor,
+    k_states: Tensor,
+    v_states: Tensor,
+    o_states: Tensor,
+    q_start_loc: Tensor,
+    q_seqlens: Tensor,
+    kv_start_loc: Tensor,
+    kv_seqlens: Tensor,
+    max_seqlen: int = None,
+    window_size: int = None,
+    sm_scale: float = None,
+    logit_softcapping: float = None,
+    causal: bool = True,
+):
+    """varlen attention forward, states are of shape `[num_tokens, num_heads,
+    head_dim]`.
+
+    The queries are the last tokens of their kv sequences.
+    """
+    num_heads = q_states.size(1)
+    num_kv_heads = k_states.size(1)
+    group = num_heads // num_kv_heads
+    if sm_scale is None:
+        sm_scale = 1.0 / (q_states.size(-1)**0.5)
+
+    for q_start, q_len, kv_start, kv_len in zip(q_start_loc.tolist(), q_seqlens.tolist(), kv_start_loc.tolist(),
+                                                kv_seqlens.tolist()):
+        if q_len == 0:
+            continue
+        q = q_states[q_start:q_start + q_len].unflatten(1, (num_kv_heads, group)).permute(1, 2, 0, 3)
+        k = k_states[kv_start:kv_start + kv_len].transpose(0, 1)
+        v = v_states[kv_start:kv_start + kv_len].transpose(0, 1)
+        q_pos = torch.arange(kv_len - q_len, kv_len, device=q.device)[:, None]
+        kv_pos = torch.arange(kv_len, device=q.device)[None]
+        mask = torch.ones(q_len, kv_len, dtype=torch.bool, device=q.device)
+        if causal:
+            mask &= kv_pos <= q_pos
+        if window_size is not None and window_size > 0:
+            mask &= kv_pos >= q_pos - window_size
+        out = masked_attention(q, k, v, mask, sm_scale, logit_softcapping)
+        o_states[q_start:q_start + q_len] = out.permute(2, 0, 1, 3).flatten(1, 2).to(o_states.dtype)
+    return o_states
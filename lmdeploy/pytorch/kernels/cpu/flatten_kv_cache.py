@@ -0,0 +1,36 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import Literal
+
+import torch
+from torch import Tensor
+
+from .fill_kv_cache import _get_token_slots
+
+
+def flatten_kv_cache(k_caches: Tensor,
+                     v_caches: Tensor,
+                     seqlens: Tensor,
+                     block_offsets: Tensor,
+                     start_loc: Tensor = None,
+                     out_size: int = None,
+                     out_dtype: torch.dtype = None,
+                     k_scales_zeros: Tensor = None,
+                     v_scales_zeros: Tensor = None,
+                     quant_policy: Literal[0, 4, 8] = 0):
+    """recovery paged kv cache to normal kv cache of shape `[out_size,
+    num_heads, head_dim]`."""
+    assert quant_policy == 0, 'kv cache quantization is not supported on cpu.'
+    if out_dtype is None:
+        out_dtype = k_caches.dtype
+    if start_loc is None:
+        start_loc = seqlens.cumsum(0) - seqlens
+    if out_size is None or out_size <= 0:
+        out_size = int(seqlens.sum())
+
+    block_size = k_caches.size(1)
+    token_loc, blocks, offsets = _get_token_slots(start_loc, seqlens, seqlens, block_offsets, block_size)
+    k_states = k_caches.new_zeros(out_size, *k_caches.shape[2:], dtype=out_dtype)
+    v_states = v_caches.new_zeros(out_size, *v_caches.shape[2:], dtype=out_dtype)
+    k_states[token_loc] = k_caches[blocks, offsets].to(out_dtype)
+    v_states[token_loc] = v_caches[blocks, offsets].to(out_dtype)
+    return k_states, v_states
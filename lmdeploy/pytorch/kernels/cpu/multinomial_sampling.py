@@ -0,0 +1,23 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+from torch import LongTensor, Tensor
+
+
+def multinomial_sampling(scores: Tensor, seeds: LongTensor, offsets: LongTensor, indices: Tensor = None):
+    """multinomial sampling, the random number of each row is decided by its
+    seed and offset, so the outputs are reproducible."""
+    generator = torch.Generator(device=scores.device)
+    randoms = []
+    for seed, offset in zip(seeds.tolist(), offsets.tolist()):
+        generator.manual_seed(hash((seed, offset)) & 0x7fffffffffffffff)
+        randoms.append(torch.rand(1, generator=generator, device=scores.device))
+    randoms = torch.cat(randoms)
+
+    cum_scores = scores.float().cumsum(-1)
+    randoms = randoms * cum_scores[:, -1]
+    sampled_index = torch.searchsorted(cum_scores, randoms[:, None], right=True)
+    sampled_index = sampled_index.clamp_max(scores.size(-1) - 1)
+    if indices is None:
+        return sampled_index.view(-1)
+    outputs = torch.gather(indices, dim=1, index=sampled_index)
+    return outputs.view(-1)
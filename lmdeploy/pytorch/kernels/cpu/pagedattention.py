@@ -0,0 +1,60 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import Literal
+
+import torch
+from torch import Tensor
+
+from .flashattention import masked_attention
+
+
+def paged_attention_fwd(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    o: Tensor,
+    block_offsets: Tensor,
+    kv_seqlens: Tensor,
+    k_scales_zeros: Tensor = None,
+    v_scales_zeros: Tensor = None,
+    quant_policy: Literal[0, 4, 8] = 0,
+    window_size: int = None,
+    sm_scale: float = None,
+    logit_softcapping: float = None,
+):
+    """Paged Attention forward of decoding, all the sequences are computed in
+    one batched attention over the blocks gathered from the block table.
+
+    Args:
+        q (Tensor): Query state of shape `[batch_size, num_heads, head_dim]`.
+        k (Tensor): Key state caches.
+        v (Tensor): Value state caches.
+        o (Tensor): Output state.
+        block_offsets (Tensor): The block offset of key and value.
+        kv_seqlens (Tensor): The key/value length of each sequence.
+    """
+    assert quant_policy == 0, 'kv cache quantization is not supported on cpu.'
+    batch_size, num_heads, head_dim = q.shape
+    block_size = k.size(1)
+    num_kv_heads = k.size(2)
+    group = num_heads // num_kv_heads
+    if sm_scale is None:
+        sm_scale = 1.0 / (head_dim**0.5)
+
+    max_kv_len = int(kv_seqlens.max())
+    num_blocks = (max_kv_len + block_size - 1) // block_size
+    blocks = block_offsets[:, :num_blocks]
+    # [batch_size, num_kv_heads, max_kv_len, head_dim]
+    keys = k[blocks].flatten(1, 2)[:, :max_kv_len].transpose(1, 2)
+    values = v[blocks].flatten(1, 2)[:, :max_kv_len].transpose(1, 2)
+
+    kv_pos = torch.arange(max_kv_len, device=q.device)[None]
+    kv_seqlens = kv_seqlens[:, None]
+    mask = kv_pos < kv_seqlens
+    if window_size is not None and window_size > 0:
+        mask &= kv_pos >= kv_seqlens - 1 - window_size
+    mask = mask[:, None, None, None]
+
+    query = q.view(batch_size, num_kv_heads, group, 1, head_dim)
+    out = masked_attention(query, keys, values, mask, sm_scale, logit_softcapping)
+    o.copy_(out.view(batch_size, num_heads, -1))
+    return o
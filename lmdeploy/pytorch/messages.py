@@ -1,6 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import enum
 import time
+from copy import copy
 from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional
 
@@ -46,12 +47,14 @@ class SamplingParam:
     random_seed: int = None
     stop_words: List[int] = field(default_factory=list)
     bad_words: List[int] = field(default_factory=list)
+    stop_sequences: List[List[int]] = field(default_factory=list)
     max_new_tokens: int = 512
     min_new_tokens: int = 0
     response_format: Optional[str] = None
     logits_processors: Optional[List[LogitsProcessor]] = None
     out_logits: bool = False
     out_last_hidden_states: bool = False
+    n: int = 1
 
     @classmethod
     def from_gen_config(self, gen_config: GenerationConfig):
@@ -60,9 +63,11 @@ class SamplingParam:
 
         stop_words = gen_config.stop_token_ids or []
         bad_words = gen_config.bad_token_ids or []
+        stop_sequences = [list(seq) for seq in gen_config.stop_token_sequences or [] if len(seq) > 0]
         if gen_config.ignore_eos:
             bad_words += stop_words
             stop_words = []
+            stop_sequences = []
 
         top_k = gen_config.top_k
         top_p = gen_config.top_p
@@ -117,11 +122,13 @@ class SamplingParam:
                              random_seed=gen_config.random_seed,
                              stop_words=stop_words,
                              bad_words=bad_words,
+                             stop_sequences=stop_sequences,
                              response_format=response_format,
                              max_new_tokens=max_new_tokens,
                              min_new_tokens=min_new_tokens,
                              logits_processors=gen_config.logits_processors,
-                             out_logits=(output_logits is not None))
+                             out_logits=(output_logits is not None),
+                             n=gen_config.n)
 
 
 class MessageStatus(enum.Enum):
@@ -213,7 +220,8 @@ class SchedulerSession:
                      adapter_name: str = None,
                      return_logits: bool = False,
                      multimodals: MultiModalInputs = None,
-                     input_embeddings: List[InputEmbeddings] = None) -> 'SchedulerSequence':
+                     input_embeddings: List[InputEmbeddings] = None,
+                     priority: int = 0) -> 'SchedulerSequence':
         """Add a new message."""
         if isinstance(token_ids, Tensor):
             token_ids = token_ids.numpy()
@@ -231,7 +239,9 @@ class SchedulerSession:
             num_new_tokens=0,
             sampling_param=sampling_param,
             adapter_name=adapter_name,
+            priority=priority,
             arrive_time=time.time(),
+            request_time=time.time(),
             history_embeddings=HistoryEmbeddings(input_embeddings),
             history_multimodals=HistoryMultiModals(multimodals),
             return_logits=return_logits,
@@ -241,6 +251,39 @@ class SchedulerSession:
             self.seq_manager.add_sequence(seq)
         return seq
 
+    def fork_sequence(self, seq: 'SchedulerSequence', random_seed: int = None) -> 'SchedulerSequence':
+        """Fork a new sequence with the same history.
+
+        Blocks are not shared here, they should be forked by the block
+        manager.
+        """
+        sampling_param = copy(seq.sampling_param)
+        sampling_param.random_seed = random_seed
+        child = SchedulerSequence(
+            seq_id=_new_msg_id(),
+            session=self,
+            history_cache=HistoryTokenIds(seq.all_ids.copy()),
+            num_new_tokens=seq.num_new_tokens,
+            sampling_param=sampling_param,
+            adapter_name=seq.adapter_name,
+            priority=seq.priority,
+            arrive_time=seq.arrive_time,
+            request_time=seq.request_time,
+            scheduled_time=seq.scheduled_time,
+            first_token_time=seq.first_token_time,
+            last_token_time=seq.last_token_time,
+            scheduled_step=seq.scheduled_step,
+            first_token_step=seq.first_token_step,
+            history_embeddings=seq.history_embeddings.clone(),
+            history_multimodals=seq.history_multimodals,
+            random_offsets=seq.random_offsets,
+        )
+        child.set_step(seq.num_history_ids)
+        self.sequences[child.seq_id] = child
+        if self.seq_manager is not None:
+            self.seq_manager.add_sequence(child)
+        return child
+
     def remove_sequence(self, seq: 'SchedulerSequence'):
         """remove sequence."""
         assert seq.seq_id in self.sequences
@@ -363,6 +406,69 @@ class HistoryTokenIds:
         return self.clone()
 
 
+def _mix64(x: np.ndarray):
+    """splitmix64 finalizer."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _pow_series(base: int, num: int):
+    """[1, base, base^2, ...] modulo 2^64."""
+    series = np.full((num, ), base, dtype=np.uint64)
+    series[0] = 1
+    return np.cumprod(series, dtype=np.uint64)
+
+
+class HistoryBlockHashes:
+    """chained hashes of full token blocks.
+
+    The state of block i is `state[i-1] * P + content[i]` modulo 2^64, so
+    identical blocks with different prefixes have different hashes. The
+    recurrence is linear, new states are solved with a cumulative sum instead
+    of a python loop. Hashes are only computed for new blocks.
+    """
+    CHAIN_BASE = 0x100000001b3
+    TOKEN_BASE = 0x9e3779b97f4a7c15
+    SEED = 0xcbf29ce484222325
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._token_powers = _pow_series(self.TOKEN_BASE, block_size)[::-1].copy()
+        self._states = np.empty((0, ), dtype=np.uint64)
+        self._hashes = np.empty((0, ), dtype=np.uint64)
+
+    def _update(self, token_ids: np.ndarray):
+        """hash new full blocks."""
+        block_size = self.block_size
+        num_hashed = len(self._hashes)
+        num_blocks = len(token_ids) // block_size
+        num_new = num_blocks - num_hashed
+        if num_new <= 0:
+            return
+
+        blocks = token_ids[num_hashed * block_size:num_blocks * block_size]
+        blocks = blocks.astype(np.uint64).reshape(num_new, block_size)
+        contents = _mix64(blocks @ self._token_powers)
+
+        # state[k] = P^k * (state[-1] * P + sum_{j<=k} content[j] * P^-j)
+        inv_base = pow(self.CHAIN_BASE, -1, 1 << 64)
+        prev = self._states[-1:] if num_hashed > 0 else np.array([self.SEED], dtype=np.uint64)
+        acc = np.cumsum(contents * _pow_series(inv_base, num_new), dtype=np.uint64)
+        states = _pow_series(self.CHAIN_BASE, num_new) * (prev * np.uint64(self.CHAIN_BASE) + acc)
+
+        self._states = np.concatenate([self._states, states])
+        self._hashes = np.concatenate([self._hashes, _mix64(states)])
+
+    def get(self, token_ids: np.ndarray) -> np.ndarray:
+        """get hashes of full blocks in token ids.
+
+        Token ids should start with the token ids of previous calls.
+        """
+        self._update(token_ids)
+        return self._hashes[:len(token_ids) // self.block_size]
+
+
 class HistoryMultiModals:
 
     def __init__(self, multimodals: MultiModalInputs):
@@ -394,9 +500,9 @@ class HistoryMultiModals:
 
     def empty(self):
         if len(self.multimodals) == 0:
-            return 0
+            return True
 
-        return all(len(vals) == 0 for vals in self.multimodals)
+        return all(len(vals) == 0 for vals in self.multimodals.values())
 
     @staticmethod
     def update_multimodals(input_mms: MultiModalInputs, prev_len: int):
@@ -433,13 +539,26 @@ class SchedulerSequence:
     sampling_param: SamplingParam = field(default_factory=SamplingParam)
     logical_blocks: LogicalTokenBlocks = field(default_factory=LogicalTokenBlocks)
     adapter_name: str = None
+    # lower value means higher priority
+    priority: int = 0
     arrive_time: float = 0.0
+    # time of the request, its first prefill and its first/last token, for metrics
+    request_time: float = None
+    scheduled_time: float = None
+    first_token_time: float = None
+    last_token_time: float = None
+    # index of the engine forward of its first prefill and its first token
+    scheduled_step: int = None
+    first_token_step: int = None
     meta: Any = None
     return_logits: bool = False
     random_offsets: int = 0
     _status: MessageStatus = field(default=MessageStatus.WAITING, init=False)
     num_ignored_history: int = 0
     model_meta: Dict[str, Any] = None
+    # fsm state of guided decoding and number of generated tokens it consumed
+    guided_state: int = 0
+    num_guided_tokens: int = 0
 
     def __post_init__(self):
         """post init."""
@@ -451,6 +570,8 @@ class SchedulerSequence:
         self._num_history_cross: int = 0
         self._num_cross: int = self.history_multimodals.get_encoder_len(0, self._num_token_ids)
 
+        self._block_hashes = HistoryBlockHashes(self.block_size)
+
     @property
     def block_size(self) -> int:
         """block size."""
@@ -500,6 +621,11 @@ class SchedulerSequence:
         """full token ids."""
         return self.history_cache[:self.num_all_ids]
 
+    @property
+    def block_hashes(self) -> np.ndarray:
+        """chained hashes of full blocks in all ids."""
+        return self._block_hashes.get(self.all_ids)
+
     @property
     def num_history_ids(self):
         """num history ids."""
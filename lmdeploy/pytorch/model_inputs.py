@@ -128,11 +128,16 @@ class ModelInputs:
     cross_length: torch.LongTensor = None
     history_cross_length: torch.LongTensor = None
     model_metas: List[Dict[str, Any]] = None
+    # mixed batch: the first `num_decoding` sequences are decoding
+    num_decoding: int = 0
+    # slot -> adapter id, copied to the device slots before the forward
+    adapter_slot_map: Dict[int, int] = None
 
     def update(self, input_ids: torch.LongTensor):
         """update input ids."""
         assert self.is_decoding
         self.history_lengths = self.history_lengths + 1
+        self.adapter_slot_map = None
         if input_ids.dim() == 1:
             input_ids = input_ids[None, :]
         self.input_ids = input_ids
@@ -212,6 +217,7 @@ class ModelInputs:
                 model_metas=self.model_metas,
                 cross_length=cross_length,
                 history_cross_length=history_cross_length,
+                adapter_slot_map=self.adapter_slot_map if start == 0 else None,
             )
             ret.append(inp)
             history_cross_length = cross_length
@@ -281,6 +287,7 @@ class StepContext:
     cross_attn_metadata: Any = None
     kv_quant_policy: Literal[0, 4, 8] = 0
     model_metas: List[Dict[str, Any]] = None
+    num_decoding: int = 0
 
     _outputs: Dict = field(default_factory=dict)
 
@@ -359,6 +366,7 @@ class StepContext:
             model_metas=inputs.model_metas,
             cross_seqlens=cross_seqlens,
             cross_kv_seqlens=cross_kv_seqlens,
+            num_decoding=inputs.num_decoding,
         )
 
         ret = get_backend().update_step_context(ret)
@@ -455,7 +455,7 @@ class InternVLChatModel(nn.Module, DeployModelMixin, CudaGraphMixin):
         else:
             from lmdeploy.pytorch.adapter.adapter import load_lora_weights
 
-            return load_lora_weights(weights, adapter_id)
+            return load_lora_weights(self, weights, adapter_id)
 
     def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]):
         """load weights."""
@@ -224,11 +224,12 @@ class LlamaModel(nn.Module):
         # build rotary embedding in LlamaModel
         rope_dim = config.hidden_size // config.num_attention_heads
         rope_max_pos_emb = config.max_position_embeddings
-        rope_base = config.rope_theta
+        # transformers>=5 moves rope_theta into rope_scaling, aka rope_parameters
+        rope_scaling = config.rope_scaling
+        rope_base = getattr(config, 'rope_theta', None) or rope_scaling['rope_theta']
         scaling_factor = 1.0
         llama3_params = None
-        rope_scaling = config.rope_scaling
-        if rope_scaling is None:
+        if rope_scaling is None or rope_scaling.get('rope_type') == 'default':
             emb_type = RopeType.LinearScaling
         else:
             if 'scaling_factor' in rope_scaling:
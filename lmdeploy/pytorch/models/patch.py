@@ -5,7 +5,7 @@ import inspect
 import os.path as osp
 import re
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 import torch
 from transformers.configuration_utils import PretrainedConfig
@@ -195,20 +195,67 @@ def build_patched_model(config: ModelConfig, device: torch.device = None):
     return build_model_from_hf_config(model_config, dtype=dtype, device=device)
 
 
+def _load_adapter_weights(model: torch.nn.Module, adapter_id: int, path: str, adapter_cfg: Any):
+    """load the weights of an adapter to host memory."""
+    from lmdeploy.pytorch.adapter.adapter import get_lora_modules, get_rank_and_scaling, load_lora_weights
+    lora_modules = get_lora_modules(model)
+    if len(lora_modules) == 0:
+        raise RuntimeError('Model has no lora layers, set `max_lora_slots` to load adapters at runtime.')
+    max_rank = lora_modules[0][1].adapter_info.max_rank
+    if adapter_cfg.r > max_rank:
+        raise ValueError(f'Rank {adapter_cfg.r} of adapter <{path}> exceeds `max_lora_rank`={max_rank}.')
+    target_names = set(name.split('.')[-1] for name in adapter_cfg.target_modules)
+    missing_names = target_names - set(name for name, _ in lora_modules)
+    if len(missing_names) > 0:
+        raise ValueError(f'Target modules {sorted(missing_names)} of adapter <{path}> '
+                         'are not in `lora_target_modules`.')
+
+    for target_name, mod in lora_modules:
+        rank, scaling = get_rank_and_scaling(target_name, adapter_cfg)
+        mod.add_host_adapter(adapter_id, rank, scaling)
+
+    try:
+        checkpoint_path = f'{path}/adapter_model.bin'
+        if not osp.exists(checkpoint_path):
+            checkpoint_path = f'{path}/adapter_model.safetensors'
+        state_dict = load_state_dict(checkpoint_path, map_location='cpu')
+
+        if hasattr(model, 'load_lora_weights'):
+            model.load_lora_weights(state_dict.items(), adapter_id=adapter_id)
+        else:
+            load_lora_weights(model, state_dict.items(), adapter_id=adapter_id)
+    except Exception:
+        for _, mod in lora_modules:
+            mod.remove_host_adapter(adapter_id)
+        raise
+
+
 @torch.inference_mode()
 def add_adapters(model: torch.nn.Module,
                  adapters: Dict[str, str],
                  dtype: torch.dtype = torch.float16,
-                 device: torch.device = None):
-    """add adapters."""
+                 device: torch.device = None,
+                 num_slots: int = None,
+                 max_rank: int = None,
+                 target_modules: List[str] = None):
+    """add lora layers with `num_slots` device slots of adapters.
+
+    The adapters are loaded to host memory with ids of the sorted adapter
+    names starting from 1, the first `num_slots` adapters are paged into the
+    slots of the same ids. `max_rank` and `target_modules` default to the
+    maximum rank and all targets of the adapters.
+    """
+    if adapters is None:
+        adapters = dict()
+    if num_slots is None:
+        num_slots = len(adapters)
+    if num_slots == 0:
+        return
+
     from peft import PeftConfig
-    from peft.tuners.lora import LoraConfig
 
-    from lmdeploy.pytorch.adapter.adapter import find_all_target, get_ranks_and_scalings, load_lora_weights
+    from lmdeploy.pytorch.adapter.adapter import find_all_target, load_adapter_slots
     from lmdeploy.pytorch.nn.linear import LoRA
-    num_adapters = len(adapters)
-    if num_adapters == 0:
-        return
 
     if device is None:
         device = torch.device('cuda')
@@ -222,29 +269,24 @@ def add_adapters(model: torch.nn.Module,
     adapter_names = sorted(adapter_names)
 
     adapter_cfgs = [PeftConfig.from_pretrained(adapters[name]) for name in adapter_names]
-
-    # insert one for no adapter
-    adapter_cfgs = [LoraConfig(r=0, target_modules=[])] + adapter_cfgs
-    adapter_names = [None] + adapter_names
-    adapter_id_map = dict(zip(adapter_names, range(len(adapter_names))))
-
-    # target layer name to add adapter
-    target_names = set()
-    for cfg in adapter_cfgs:
-        target_names = target_names.union(cfg.target_modules)
-    target_names = list(target_names)
+    if not max_rank:
+        max_rank = max((cfg.r for cfg in adapter_cfgs), default=0)
+    if target_modules is None:
+        target_modules = set()
+        for cfg in adapter_cfgs:
+            target_modules = target_modules.union(cfg.target_modules)
+    if max_rank <= 0 or len(target_modules) == 0:
+        raise ValueError('`max_lora_rank` and `lora_target_modules` are required '
+                         'if no adapter is given at start up.')
+
+    # split in case target_name has '.' like 'attention.wo'
+    # which cannot be used as name of a module
+    # and it's not aligned with key in model.packed_modules_mapping
+    target_names = set(name.split('.')[-1] for name in target_modules)
     target_names = sorted(target_names)
 
-    target_infos = dict()
-    for _, target_name in enumerate(target_names):
-        # get ranks and scalings
-        ranks, scalings = get_ranks_and_scalings(target_name, adapter_cfgs, device=device)
-        # split in case target_name has '.' like 'attention.wo'
-        # which cannot be used as name of a module
-        # and it's not aligned with key in model.packed_modules_mapping
-        target_name = target_name.split('.')[-1]
+    for target_name in target_names:
         found_mods, pack_idx = find_all_target(model, target_name)
-        sum_rank = ranks.sum().item()
 
         in_features = 0
         out_features = 0
@@ -262,8 +304,11 @@ def add_adapters(model: torch.nn.Module,
                 out_features = mod.all_out_features[pack_idx]
                 base_slice = slice(prev_feats, prev_feats + out_features)
                 lora_b_spliter = None
-            lora_a = torch.empty((sum_rank, in_features), dtype=dtype, device=device)
-            lora_b = torch.empty((sum_rank, out_features), dtype=dtype, device=device)
+            # slot 0 is no adapter
+            ranks = torch.zeros(num_slots + 1, dtype=torch.long, device=device)
+            scalings = torch.ones(num_slots + 1, dtype=torch.float32, device=device)
+            lora_a = torch.empty((num_slots * max_rank, in_features), dtype=dtype, device=device)
+            lora_b = torch.empty((num_slots * max_rank, out_features), dtype=dtype, device=device)
 
             lora = LoRA(
                 in_features,
@@ -273,6 +318,7 @@ def add_adapters(model: torch.nn.Module,
                 lora_a=lora_a,
                 lora_b=lora_b,
                 base_slice=base_slice,
+                max_rank=max_rank,
                 ctx_mgr=ctx_mgr,
                 colwise=colwise,
                 is_tp=mod.is_tp,
@@ -281,16 +327,28 @@ def add_adapters(model: torch.nn.Module,
             mod.lora_adapters[target_name] = lora
 
     # fill adapter data
-    for name, path in adapters.items():
-        adapter_id = adapter_id_map[name]
-        checkpoint_path = f'{path}/adapter_model.bin'
-        if not osp.exists(checkpoint_path):
-            checkpoint_path = f'{path}/adapter_model.safetensors'
-        state_dict = load_state_dict(checkpoint_path, map_location=device)
+    for adapter_id, (name, cfg) in enumerate(zip(adapter_names, adapter_cfgs), 1):
+        _load_adapter_weights(model, adapter_id, adapters[name], cfg)
+        if adapter_id <= num_slots:
+            load_adapter_slots(model, {adapter_id: adapter_id})
 
-        if hasattr(model, 'load_lora_weights'):
-            model.load_lora_weights(state_dict.items(), adapter_id=adapter_id)
-        else:
-            load_lora_weights(model, state_dict.items(), adapter_id=adapter_id)
 
-    return target_infos
+@torch.inference_mode()
+def load_adapter(model: torch.nn.Module, adapter_id: int, path: str):
+    """load an adapter to host memory, it is paged into a device slot by
+    `load_adapter_slots` before used."""
+    from peft import PeftConfig
+
+    if hasattr(model, 'get_model'):
+        model = model.get_model()
+    _load_adapter_weights(model, adapter_id, path, PeftConfig.from_pretrained(path))
+
+
+def unload_adapter(model: torch.nn.Module, adapter_id: int):
+    """free the host memory of an adapter."""
+    from lmdeploy.pytorch.adapter.adapter import get_lora_modules
+
+    if hasattr(model, 'get_model'):
+        model = model.get_model()
+    for _, mod in get_lora_modules(model):
+        mod.remove_host_adapter(adapter_id)
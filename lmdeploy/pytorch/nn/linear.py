@@ -1,5 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import Any, List, Optional
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
 
 import torch
 import torch.distributed as dist
@@ -64,8 +65,22 @@ class QKVMixin:
         return q, k, v
 
 
+@dataclass
+class HostLoRAWeight:
+    """lora weights of an adapter kept in host memory."""
+    lora_a: torch.Tensor
+    lora_b: torch.Tensor
+    rank: int
+    scaling: float
+
+
 class LoRA(nn.Module):
-    """LoRA layer."""
+    """LoRA layer.
+
+    `lora_a` and `lora_b` are the device slots of the adapters, see
+    `AdapterInfo`. The weight loaders fill the host memory weights of an
+    adapter added by `add_host_adapter`, `load_slot` copies them to a slot.
+    """
 
     def __init__(self,
                  in_features: int,
@@ -75,6 +90,7 @@ class LoRA(nn.Module):
                  lora_a: torch.Tensor,
                  lora_b: torch.Tensor,
                  base_slice: slice,
+                 max_rank: int,
                  ctx_mgr: Any = None,
                  colwise: bool = True,
                  is_tp: bool = True,
@@ -86,6 +102,7 @@ class LoRA(nn.Module):
             ranks=ranks,
             scalings=scalings,
             base_slice=base_slice,
+            max_rank=max_rank,
         )
         impl_builder = get_backend().get_layer_impl_builder(OpType.LoRA)
         self.impl = impl_builder.build()
@@ -100,6 +117,7 @@ class LoRA(nn.Module):
         self.ctx_mgr = ctx_mgr
         self.colwise = colwise
         self.lora_b_spliter = lora_b_spliter
+        self.host_adapters: Dict[int, HostLoRAWeight] = dict()
 
     def forward(self, x, base_output=None):
         """forward of loraA@loraB."""
@@ -112,26 +130,44 @@ class LoRA(nn.Module):
                                  colwise=self.colwise,
                                  is_tp=self.is_tp)
 
+    def add_host_adapter(self, adapter_id: int, rank: int, scaling: float):
+        """allocate host memory for the weights of an adapter."""
+        max_rank = self.adapter_info.max_rank
+        assert rank <= max_rank, f'rank {rank} of adapter exceeds max rank {max_rank}.'
+        pin_memory = self.lora_A.device.type == 'cuda'
+        lora_a = torch.zeros((rank, self.lora_A.size(1)), dtype=self.lora_A.dtype, pin_memory=pin_memory)
+        lora_b = torch.zeros((rank, self.lora_B.size(1)), dtype=self.lora_B.dtype, pin_memory=pin_memory)
+        self.host_adapters[adapter_id] = HostLoRAWeight(lora_a=lora_a, lora_b=lora_b, rank=rank, scaling=scaling)
+
+    def remove_host_adapter(self, adapter_id: int):
+        """free the host memory of an adapter."""
+        self.host_adapters.pop(adapter_id, None)
+
+    def load_slot(self, slot: int, adapter_id: int):
+        """copy the weights of an adapter to a device slot."""
+        assert slot > 0, 'slot 0 is reserved for no adapter.'
+        host_weight = self.host_adapters[adapter_id]
+        rank = host_weight.rank
+        r_start = self.adapter_info.get_rank_offset(slot)
+        if rank > 0:
+            self.lora_A.data[r_start:r_start + rank].copy_(host_weight.lora_a, non_blocking=True)
+            self.lora_B.data[r_start:r_start + rank].copy_(host_weight.lora_b, non_blocking=True)
+        self.adapter_info.ranks[slot] = rank
+        self.adapter_info.scalings[slot] = host_weight.scaling
+
     def weight_loader_A(self, param: nn.Parameter, loaded_weight: torch.Tensor, adapter_id: int):
         """weight loader."""
-        rank = self.adapter_info.ranks[adapter_id].item()
-        r_start = self.adapter_info.rank_offsets[adapter_id].item()
-        r_end = r_start + rank
-        param_r = param.data[r_start:r_end]
+        param_r = self.host_adapters[adapter_id].lora_a
 
         if self.is_tp and not self.colwise:
             world_size, rank = get_world_rank()
-            loaded_weight = loaded_weight.to(param_r.device)
             loaded_weight = loaded_weight.chunk(world_size, dim=1)[rank]
 
         param_r.copy_(loaded_weight)
 
     def weight_loader_B(self, param: nn.Parameter, loaded_weight: torch.Tensor, adapter_id: int):
         """weight loader."""
-        rank = self.adapter_info.ranks[adapter_id].item()
-        r_start = self.adapter_info.rank_offsets[adapter_id].item()
-        r_end = r_start + rank
-        param_r = param.data[r_start:r_end]
+        param_r = self.host_adapters[adapter_id].lora_b
 
         if self.is_tp and self.colwise:
             world_size, rank = get_world_rank()
@@ -232,6 +232,8 @@ class BaseBlockManager:
         self.allocator = LogicalAllocator(num_cpu_blocks, num_gpu_blocks)
 
         self.block_tables: Dict[int, BlockTable] = {}
+        # device blocks to copy before next forward, dst -> src
+        self._copy_map: Dict[int, int] = dict()
 
     @classmethod
     def num_required_blocks(cls, obj: SchedulerSequence, prealloc_size: int = 0):
@@ -259,6 +261,58 @@ class BaseBlockManager:
         """Try swap msg in."""
         raise NotImplementedError('Not implemented.')
 
+    def swap_out_blocks(self, blocks: np.ndarray):
+        """Move logical blocks on device to host memory.
+
+        Args:
+            blocks (np.ndarray): The logical blocks to swap out.
+        Returns:
+            Dict[int, int]: Map between device blocks and host blocks.
+        """
+        allocator = self.allocator
+        cpu_mem_offset = allocator.cpu_mem_offset()
+        phy_blocks = allocator.get_physical_blocks(blocks)
+        gpu_mask = phy_blocks < cpu_mem_offset
+        log_blocks = blocks[gpu_mask]
+        old_blocks = phy_blocks[gpu_mask]
+        if len(old_blocks) == 0:
+            return dict()
+
+        new_blocks = allocator.get_phy_allocator('cpu').allocate(len(old_blocks)).copy()
+        allocator.get_phy_allocator('gpu').free(old_blocks)
+        allocator.update_phy_map(log_blocks, new_blocks)
+        return dict(zip(old_blocks, new_blocks - cpu_mem_offset))
+
+    def swap_in_blocks(self, blocks: np.ndarray):
+        """Move logical blocks on host to device memory.
+
+        Args:
+            blocks (np.ndarray): The logical blocks to swap in.
+        Returns:
+            Dict[int, int]: Map between host blocks and device blocks.
+        """
+        allocator = self.allocator
+        cpu_mem_offset = allocator.cpu_mem_offset()
+        phy_blocks = allocator.get_physical_blocks(blocks)
+        cpu_mask = phy_blocks >= cpu_mem_offset
+        log_blocks = blocks[cpu_mask]
+        old_blocks = phy_blocks[cpu_mask]
+        if len(old_blocks) == 0:
+            return dict()
+
+        new_blocks = allocator.get_phy_allocator('gpu').allocate(len(old_blocks)).copy()
+        allocator.get_phy_allocator('cpu').free(old_blocks)
+        allocator.update_phy_map(log_blocks, new_blocks)
+        return dict(zip(old_blocks - cpu_mem_offset, new_blocks))
+
+    def get_num_cpu_blocks(self, msg: SchedulerSequence) -> int:
+        """Get number of blocks of the msg on host."""
+        return self.allocator.count_cpu_blocks(msg.logical_blocks.get_real_blocks())
+
+    def get_num_gpu_blocks(self, msg: SchedulerSequence) -> int:
+        """Get number of blocks of the msg on device."""
+        return self.allocator.count_gpu_blocks(msg.logical_blocks.get_real_blocks())
+
     def get_block_table(self, msg: SchedulerSequence):
         """Get the block table of given msg.
 
@@ -275,6 +329,72 @@ class BaseBlockManager:
         else:
             raise TypeError(f'Unsupported allocate type: {type(data)}')
 
+    def fork(self, parent: SchedulerSequence, child: SchedulerSequence):
+        """Share blocks of the parent with the child.
+
+        Only blocks holding tokens of the child are shared, blocks would be
+        copied before the shared part is written.
+        """
+        num_blocks = (child.num_all_ids + child.block_size - 1) // child.block_size
+        blocks = parent.logical_blocks[:num_blocks]
+        child.logical_blocks.reset()
+        child.logical_blocks.append(blocks)
+        child.logical_blocks.last_shared_node = parent.logical_blocks.last_shared_node
+        self.allocator.add_ref_count(blocks, 1)
+
+    def _get_write_blocks(self, msg: SchedulerSequence):
+        """allocated blocks that would be written by the message."""
+        block_id = msg.num_history_ids // msg.block_size
+        return msg.logical_blocks[block_id:]
+
+    def _get_swap_out_blocks(self, msg: SchedulerSequence):
+        """device blocks owned by the message only.
+
+        Blocks shared with the prefix cache or other sequences stay on device
+        when the message is swapped out.
+        """
+        blocks = msg.logical_blocks.get_real_blocks()
+        if len(blocks) == 0:
+            return blocks
+        phy_blocks = self.allocator.get_physical_blocks(blocks)
+        ref_count = self.allocator.get_ref_count(blocks)
+        return blocks[(phy_blocks < self.allocator.cpu_mem_offset()) & (ref_count == 1)]
+
+    def get_num_swap_out_blocks(self, msg: SchedulerSequence) -> int:
+        """Get number of blocks to copy when the msg is swapped out."""
+        return len(self._get_swap_out_blocks(msg))
+
+    def get_num_copy_blocks(self, msg: SchedulerSequence) -> int:
+        """Get number of shared blocks to copy before the msg is written."""
+        blocks = self._get_write_blocks(msg)
+        if len(blocks) == 0:
+            return 0
+        return np.count_nonzero(self.allocator.get_ref_count(blocks) > 1)
+
+    def copy_on_write(self, msg: SchedulerSequence):
+        """Give the msg private copies of the shared blocks it would write."""
+        block_id = msg.num_history_ids // msg.block_size
+        blocks = self._get_write_blocks(msg)
+        if len(blocks) == 0:
+            return
+        shared = np.flatnonzero(self.allocator.get_ref_count(blocks) > 1)
+        if len(shared) == 0:
+            return
+        old_blocks = blocks[shared]
+        new_blocks = self.allocator.allocate(len(old_blocks), 'gpu')
+        src = self.allocator.get_physical_blocks(old_blocks)
+        dst = self.allocator.get_physical_blocks(new_blocks)
+        self._copy_map.update(zip(dst.tolist(), src.tolist()))
+        msg.logical_blocks[shared + block_id] = new_blocks
+        self.allocator.free(old_blocks)
+
+    def pop_copy_map(self) -> Dict[int, int]:
+        """Get and clear blocks to copy, a source block might be copied to
+        multiple destinations, so the map is keyed by the destination."""
+        copy_map = self._copy_map
+        self._copy_map = dict()
+        return copy_map
+
     def get_num_free_gpu_blocks(self) -> int:
         """Get number of free gpu blocks."""
         return self.allocator.get_phy_allocator('gpu').get_num_free_blocks()
@@ -44,6 +44,7 @@ class DefaultBlockManager(BaseBlockManager):
         """Allocate physical blocks for given message according to logical
         blocks."""
         logical_blocks = msg.logical_blocks
+        self.copy_on_write(msg)
         num_required_blocks = self.num_required_blocks(msg, prealloc_size)
         if num_required_blocks > 0:
             blocks = self.allocator.allocate(num_required_blocks, 'gpu')
@@ -55,93 +56,29 @@ class DefaultBlockManager(BaseBlockManager):
         msg.logical_blocks.reset()
 
     def try_swap_out(self, msg: SchedulerSequence):
-        """Try swap msg out."""
-        swap_map = dict()
-        logical_blocks = msg.logical_blocks
-        cpu_mem_offset = self.allocator.cpu_mem_offset()
-        phy_blocks = self.allocator.get_physical_blocks(logical_blocks)
-        cpu_allocator = self.allocator.get_phy_allocator('cpu')
-        gpu_allocator = self.allocator.get_phy_allocator('gpu')
-
-        def _can_swap():
-            """check swap."""
-            if len(logical_blocks) == 0:
-                return False
-
-            # we only support all blocks of a sequence on same device
-            if phy_blocks[0] >= cpu_mem_offset:
-                return False
-
-            # no free blocks
-            num_free = self.get_num_free_cpu_blocks()
-            if num_free < len(phy_blocks):
-                return False
-
-            # don't swap sequence with multiple reference
-            ref_count = self.allocator.get_ref_count(logical_blocks)
-            if np.count_nonzero(ref_count != 1) > 0:
-                return False
+        """Try swap msg out.
 
-            return True
+        Only the blocks owned by the msg are swapped, blocks shared with the
+        prefix cache or other sequences are kept on device.
+        """
+        blocks = self._get_swap_out_blocks(msg)
+        if len(blocks) == 0:
+            return False, dict()
 
-        def _do_swap():
-            """perform swap."""
-            new_blocks = cpu_allocator.allocate(len(logical_blocks))
+        # no free blocks
+        if self.get_num_free_cpu_blocks() < len(blocks):
+            return False, dict()
 
-            old_blocks = phy_blocks
-            swap_map = dict(zip(old_blocks, new_blocks - self.num_gpu_blocks))
-
-            gpu_allocator.free(old_blocks)
-            self.allocator.update_phy_map(logical_blocks.get_real_blocks(), new_blocks)
-            return True, swap_map
-
-        if not _can_swap():
-            return False, swap_map
-        else:
-            return _do_swap()
+        return True, self.swap_out_blocks(blocks)
 
     def try_swap_in(self, msg: SchedulerSequence):
         """Try swap msg in."""
-        swap_map = dict()
-        logical_blocks = msg.logical_blocks
-        cpu_mem_offset = self.allocator.cpu_mem_offset()
-        phy_blocks = self.allocator.get_physical_blocks(logical_blocks)
-        cpu_allocator = self.allocator.get_phy_allocator('cpu')
-        gpu_allocator = self.allocator.get_phy_allocator('gpu')
-
-        def _can_swap():
-            """check swap."""
-            if len(logical_blocks) == 0:
-                return False
-
-            # we only support all blocks of a sequence on same device
-            if phy_blocks[0] < cpu_mem_offset:
-                return False
-
-            # no free blocks
-            num_free = self.get_num_free_gpu_blocks()
-            if num_free < len(phy_blocks):
-                return False
-
-            # don't swap sequence with multiple reference
-            ref_count = self.allocator.get_ref_count(logical_blocks)
-            if np.count_nonzero(ref_count != 1) > 0:
-                return False
-
-            return True
-
-        def _do_swap():
-            """perform swap."""
-            new_blocks = gpu_allocator.allocate(len(logical_blocks))
-
-            old_blocks = phy_blocks
-            swap_map = dict(zip(old_blocks - self.num_gpu_blocks, new_blocks))
-
-            cpu_allocator.free(old_blocks)
-            self.allocator.update_phy_map(logical_blocks.get_real_blocks(), new_blocks)
-            return True, swap_map
-
-        if not _can_swap():
-            return False, swap_map
-        else:
-            return _do_swap()
+        num_cpu_blocks = self.get_num_cpu_blocks(msg)
+        if num_cpu_blocks == 0:
+            return False, dict()
+
+        # no free blocks
+        if self.get_num_free_gpu_blocks() < num_cpu_blocks:
+            return False, dict()
+
+        return True, self.swap_in_blocks(msg.logical_blocks.get_real_blocks())
@@ -1,12 +1,14 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import heapq
+from dataclasses import dataclass
 from typing import Dict, Set
 
 import numpy as np
 
-from lmdeploy.pytorch.messages import SchedulerSequence
+from lmdeploy.pytorch.messages import HistoryBlockHashes, SchedulerSequence
 
 from ..config import CacheConfig
+from ..disk_cache import DiskCacheIndex, block_digest, root_digest
 from .block_manager import BaseBlockManager
 
 
@@ -20,6 +22,8 @@ class Node:
         self.num_matched = num_matched
         self.children: Dict[int, 'Node'] = dict()
         self._parent: 'Node' = None
+        # stable chained digest, used as the key of disk cache
+        self.digest: str = None
 
     @property
     def parent(self):
@@ -41,8 +45,45 @@ class Node:
         return True
 
 
+@dataclass
+class PrefixCacheStats:
+    """statistics of prefix caching, counted in blocks."""
+    num_query_blocks: int = 0
+    num_hit_blocks: int = 0
+    num_host_hit_blocks: int = 0
+    num_disk_hit_blocks: int = 0
+    num_spilled_blocks: int = 0
+    num_evicted_blocks: int = 0
+
+    @property
+    def num_miss_blocks(self):
+        """num blocks not found in cache."""
+        return self.num_query_blocks - self.num_all_hit_blocks
+
+    @property
+    def num_all_hit_blocks(self):
+        """num blocks found in any cache tier."""
+        return self.num_hit_blocks + self.num_host_hit_blocks + self.num_disk_hit_blocks
+
+    @property
+    def hit_rate(self):
+        """hit rate of all cache tiers."""
+        if self.num_query_blocks == 0:
+            return 0.0
+        return self.num_all_hit_blocks / self.num_query_blocks
+
+
 class BlockTrie:
-    """block trie for prefix caching."""
+    """block trie for prefix caching.
+
+    If host prefix caching is enabled, blocks evicted from device are moved to
+    host memory and keep their place in the trie. Matching these blocks would
+    swap them in instead of recomputing.
+
+    If disk cache is enabled, dropped blocks are written to disk, keyed by
+    the chained digest of the block. Missed blocks found on disk are loaded
+    on matching.
+    """
 
     def __init__(self, cache_config: CacheConfig, block_manager: BaseBlockManager):
         self.block_manager = block_manager
@@ -50,17 +91,119 @@ class BlockTrie:
         self.allocator = self.block_manager.allocator
         self.block_size = cache_config.block_size
         self.enable = self.cache_config.enable_prefix_caching
+        self.enable_host_cache = self.enable and self.cache_config.enable_host_prefix_caching
 
         # caches with different adapter should not be shared.
         self._roots: Dict[str, Node] = dict()
+        # nodes on device without children on device, might contain stale nodes
         self.leaves: Set[Node] = set()
+        # nodes on host without children, might contain stale nodes
+        self.host_leaves: Set[Node] = set()
+        self.stats = PrefixCacheStats()
+
+        # disk cache ops to be performed by the cache engine
+        self.disk_index: DiskCacheIndex = None
+        self.disk_save_map: Dict[str, int] = dict()
+        self.disk_load_map: Dict[str, int] = dict()
+        if self.enable and cache_config.disk_cache_dir is not None:
+            self.disk_index = DiskCacheIndex(cache_config.disk_cache_dir, max_blocks=cache_config.disk_cache_max_blocks)
+            self._prewarm(cache_config.disk_cache_prewarm_blocks)
+
+    def _on_host(self, node: Node):
+        """node block is on host."""
+        phy_block = self.allocator.get_physical_blocks(node.block)
+        return phy_block >= self.allocator.cpu_mem_offset()
+
+    def _has_device_child(self, node: Node):
+        """node has children on device."""
+        if not self.enable_host_cache:
+            return len(node.children) > 0
+        return any(not self._on_host(child) for child in node.children.values())
 
     def get_root(self, adapter_name: str):
         """get root by adapter name."""
         if adapter_name not in self._roots:
-            self._roots[adapter_name] = Node(-1, -1, None)
+            root = Node(-1, -1, None)
+            root.digest = root_digest(adapter_name)
+            self._roots[adapter_name] = root
         return self._roots[adapter_name]
 
+    def _get_adapter_name(self, node: Node):
+        """get adapter name of the node."""
+        while node.parent is not None:
+            node = node.parent
+        for adapter_name, root in self._roots.items():
+            if root is node:
+                return adapter_name
+        return None
+
+    def _load_from_disk(self, parent: Node, hash_key: int, digest: str, tokens: np.ndarray):
+        """create node with a device block that would be loaded from disk."""
+        block = self.allocator.allocate(1, 'gpu')[0]
+        node = Node(hash_key=hash_key, block=block, tokens=tokens, num_matched=parent.num_matched + self.block_size)
+        node.digest = digest
+        node.parent = parent
+        self.leaves.discard(parent)
+        self.leaves.add(node)
+        self.disk_load_map[digest] = int(self.allocator.get_physical_blocks(block))
+        return node
+
+    def _save_to_disk(self, node: Node):
+        """write block of the node to disk before releasing it."""
+        if self.disk_index is None or node.digest in self.disk_index:
+            return
+        self.disk_save_map[node.digest] = int(self.allocator.get_physical_blocks(node.block))
+        self.disk_index.add(node.digest, node.parent.digest, self._get_adapter_name(node), node.tokens)
+
+    def _prewarm(self, num_blocks: int):
+        """load the hottest blocks on disk."""
+        num_loaded = 0
+        for key in self.disk_index.hottest(num_blocks):
+            chain = self.disk_index.get_chain(key)
+            if len(chain) == 0:
+                continue
+            parent = self.get_root(chain[0]['adapter'])
+            all_tokens = np.array([entry['tokens'] for entry in chain], dtype=np.int64)
+            hash_keys = HistoryBlockHashes(self.block_size).get(all_tokens.flatten()).tolist()
+            for entry, tokens, hash_key in zip(chain, all_tokens, hash_keys):
+                if num_loaded >= num_blocks or self.block_manager.get_num_free_gpu_blocks() == 0:
+                    return
+                if hash_key in parent.children:
+                    parent = parent.children[hash_key]
+                    continue
+                parent = self._load_from_disk(parent, hash_key, entry['key'], tokens)
+                num_loaded += 1
+
+    def pop_disk_ops(self):
+        """get and reset disk cache ops of current step."""
+        disk_save_map = self.disk_save_map
+        disk_load_map = self.disk_load_map
+        self.disk_save_map = dict()
+        self.disk_load_map = dict()
+        return disk_save_map, disk_load_map
+
+    def peek(self, seq: SchedulerSequence):
+        """get the deepest cached node of the sequence without allocation."""
+        logical_blocks = seq.logical_blocks
+        curr: Node = getattr(logical_blocks, 'last_shared_node', None)
+        if curr is None:
+            curr = self.get_root(seq.adapter_name)
+        if not self.enable or curr.num_matched != len(logical_blocks) * self.block_size:
+            return curr
+
+        block_size = self.block_size
+        num_matched = curr.num_matched
+        num_blocks = (seq.num_all_ids - 1) // block_size
+        for key in seq.block_hashes[len(logical_blocks):num_blocks].tolist():
+            child = curr.children.get(key)
+            if child is None:
+                break
+            if not np.array_equal(seq.history_cache[num_matched:num_matched + block_size], child.tokens):
+                break
+            curr = child
+            num_matched += block_size
+        return curr
+
     def match(self, seq: SchedulerSequence):
         """match sequence and cache."""
         if not self.enable:
@@ -75,24 +218,53 @@ class BlockTrie:
             curr = self.get_root(seq.adapter_name)
         num_matched = curr.num_matched
 
+        # blocks of the sequence not covered by the trie
+        if num_matched != len(logical_blocks) * block_size:
+            return
+
+        host_nodes = []
+
         def __match_success(node: Node):
             nonlocal curr, num_matched
             matched_blocks.append(node.block)
+            if self.enable_host_cache and self._on_host(node):
+                host_nodes.append(node)
             curr = node
             num_matched += block_size
 
-        while num_matched + block_size < seq.num_all_ids:
-            curr_tokens = seq.history_cache[num_matched:num_matched + block_size]
-
-            key = hash(tuple(curr_tokens))
+        # the last token is always computed, block including it can not be matched.
+        num_blocks = (seq.num_all_ids - 1) // block_size
+        hash_keys = seq.block_hashes[len(logical_blocks):num_blocks].tolist()
+        self.stats.num_query_blocks += len(hash_keys)
+        key_id = 0
+        while key_id < len(hash_keys):
+            key = hash_keys[key_id]
             if key not in curr.children:
                 break
 
             child = curr.children[key]
+            curr_tokens = seq.history_cache[num_matched:num_matched + block_size]
             if not np.array_equal(curr_tokens, child.tokens):
                 break
 
             __match_success(child)
+            key_id += 1
+
+        num_disk_blocks = 0
+        while self.disk_index is not None and key_id < len(hash_keys):
+            if self.block_manager.get_num_free_gpu_blocks() == 0:
+                break
+            key = hash_keys[key_id]
+            if key in curr.children:
+                break
+            curr_tokens = seq.history_cache[num_matched:num_matched + block_size]
+            digest = block_digest(curr.digest, curr_tokens)
+            if digest not in self.disk_index:
+                break
+            self.disk_index.touch(digest)
+            __match_success(self._load_from_disk(curr, key, digest, curr_tokens.copy()))
+            num_disk_blocks += 1
+            key_id += 1
 
         if len(matched_blocks) > 0:
             matched_blocks = np.array(matched_blocks)
@@ -101,6 +273,13 @@ class BlockTrie:
             seq.logical_blocks.append(matched_blocks)
             seq.set_step(num_matched)
 
+        # host blocks would be swapped in by the scheduler.
+        for node in host_nodes:
+            self.leaves.add(node)
+        self.stats.num_host_hit_blocks += len(host_nodes)
+        self.stats.num_disk_hit_blocks += num_disk_blocks
+        self.stats.num_hit_blocks += len(matched_blocks) - len(host_nodes) - num_disk_blocks
+
         seq.logical_blocks.last_shared_node = curr
 
     def allocate(self, seq: SchedulerSequence):
@@ -121,35 +300,40 @@ class BlockTrie:
         if num_matched + block_size > num_all_ids:
             return
 
-        if len(node.children) == 0 and node.parent is not None:
-            self.leaves.remove(node)
-
         block_id = num_matched // block_size
+        hash_keys = seq.block_hashes[block_id:].tolist()
         blocks = []
         free_blocks = []
-        while num_matched + block_size <= num_all_ids:
+        for hash_key in hash_keys:
             curr_tokens = seq.history_cache[num_matched:num_matched + block_size]
 
             block = logical_blocks[block_id]
 
-            hash_key = hash(tuple(curr_tokens))
             parent = node
             if hash_key in parent.children:
                 child = parent.children[hash_key]
                 if not np.array_equal(curr_tokens, child.tokens):
                     break
                 node = child
-                free_blocks.append(block)
-                logical_blocks[block_id] = node.block
+                if self.enable_host_cache and self._on_host(node):
+                    # take the device block of the sequence, release the host one.
+                    free_blocks.append(node.block)
+                    node.block = block
+                else:
+                    free_blocks.append(block)
+                    logical_blocks[block_id] = node.block
             else:
                 node = Node(hash_key=hash_key, block=block, tokens=curr_tokens, num_matched=num_matched + block_size)
+                if self.disk_index is not None:
+                    node.digest = block_digest(parent.digest, curr_tokens)
                 node.parent = parent
+            self.leaves.discard(parent)
             blocks.append(node.block)
             num_matched += block_size
             block_id += 1
 
         logical_blocks.last_shared_node = node
-        if node.parent is not None and len(node.children) == 0:
+        if node.parent is not None and not self._has_device_child(node):
             # ignore root
             self.leaves.add(node)
         if len(blocks) > 0:
@@ -157,27 +341,109 @@ class BlockTrie:
         if len(free_blocks) > 0:
             self.allocator.free(np.array(free_blocks))
 
-    def evict(self, max_num_blocks: int):
-        """evict."""
-        if not self.enable:
+    def _spill(self, node: Node, swap_out_map: Dict[int, int]):
+        """move block of the node to host memory."""
+        block_manager = self.block_manager
+        if block_manager.get_num_free_cpu_blocks() == 0:
+            self.evict_host(1)
+        if block_manager.get_num_free_cpu_blocks() == 0:
+            return False
+
+        swap_map = block_manager.swap_out_blocks(np.array([node.block]))
+        swap_out_map.update(swap_map)
+        if len(node.children) == 0:
+            self.host_leaves.add(node)
+        self.stats.num_spilled_blocks += 1
+        return True
+
+    def evict_host(self, max_num_blocks: int):
+        """evict blocks on host."""
+        if not self.enable_host_cache:
             return 0
 
-        def __remove_leaf(leaves, evicted_blocks):
+        def __is_host_leaf(node: Node):
+            return node.parent is not None and len(node.children) == 0 and self._on_host(node)
+
+        def __push_leaf(leaves, node: Node):
+            if self.allocator.get_ref_count(node.block) == 1:
+                access_time = self.allocator.get_access_time(node.block)
+                heapq.heappush(leaves, (access_time, node))
+
+        leaves = []
+        for leaf in list(self.host_leaves):
+            if not __is_host_leaf(leaf):
+                self.host_leaves.discard(leaf)
+                continue
+            __push_leaf(leaves, leaf)
+
+        evicted_blocks = []
+        while len(leaves) > 0 and len(evicted_blocks) < max_num_blocks:
             _, leaf = heapq.heappop(leaves)
+            self._save_to_disk(leaf)
             evicted_blocks.append(leaf.block)
             parent = leaf.parent
             leaf.parent = None
+            self.host_leaves.discard(leaf)
+            if parent.parent is None:
+                # ignore root
+                continue
+            if __is_host_leaf(parent):
+                self.host_leaves.add(parent)
+                __push_leaf(leaves, parent)
+
+        if len(evicted_blocks) > 0:
+            self.allocator.free(np.array(evicted_blocks))
+        self.stats.num_evicted_blocks += len(evicted_blocks)
+        return len(evicted_blocks)
+
+    def evict(self, max_num_blocks: int, swap_in_map: Dict[int, int] = None, swap_out_map: Dict[int, int] = None):
+        """evict blocks on device.
+
+        Args:
+            max_num_blocks (int): max number of device blocks to release.
+            swap_in_map (Dict[int, int]): swap in map of current step.
+            swap_out_map (Dict[int, int]): swap out map of current step,
+                blocks would be spilled to host memory if provided.
+        """
+        if not self.enable:
+            return 0
+
+        # host blocks released by swap in might be reused by spilling.
+        spill = self.enable_host_cache and swap_out_map is not None and not swap_in_map
+
+        def __remove_leaf(leaves, evicted_blocks):
+            _, leaf = heapq.heappop(leaves)
+            parent = leaf.parent
             self.leaves.remove(leaf)
-            return parent
+            if spill and self._spill(leaf, swap_out_map):
+                return parent, True
+            if len(leaf.children) > 0:
+                # host children can not be dropped
+                return parent, False
+            self._save_to_disk(leaf)
+            evicted_blocks.append(leaf.block)
+            leaf.parent = None
+            return parent, True
 
         def __add_leaf(leaves, parent):
+            if self.enable_host_cache and self._on_host(parent):
+                return
             self.leaves.add(parent)
             if self.allocator.get_ref_count(parent.block) == 1:
                 access_time = self.allocator.get_access_time(parent.block)
                 heapq.heappush(leaves, (access_time, parent))
 
-        evicted_blocks = []
-        leaves = list(self.leaves)
+        # filter stale leaves
+        leaves = []
+        for leaf in list(self.leaves):
+            if leaf.parent is None or self._has_device_child(leaf):
+                self.leaves.discard(leaf)
+                continue
+            if self.enable_host_cache and self._on_host(leaf):
+                continue
+            leaves.append(leaf)
+        if len(leaves) == 0:
+            return 0
 
         # filter ref-cnt == 1 (trie own one block ref)
         leave_blocks = np.array(list(leaf.block for leaf in leaves))
@@ -193,14 +459,25 @@ class BlockTrie:
         leaves = list(zip(access_times, leaves))
         heapq.heapify(leaves)
 
-        while len(leaves) > 0 and len(evicted_blocks) < max_num_blocks:
-            parent = __remove_leaf(leaves, evicted_blocks)
+        evicted_blocks = []
+        kept_leaves = []
+        num_evicted = 0
+        while len(leaves) > 0 and num_evicted < max_num_blocks:
+            leaf = leaves[0][1]
+            parent, success = __remove_leaf(leaves, evicted_blocks)
+            if not success:
+                kept_leaves.append(leaf)
+                continue
+            num_evicted += 1
             if parent.parent is None:
                 # ignore root
                 continue
-            if len(parent.children) == 0:
+            if not self._has_device_child(parent):
                 __add_leaf(leaves, parent)
 
-        self.allocator.free(np.array(evicted_blocks))
+        self.leaves.update(kept_leaves)
+        if len(evicted_blocks) > 0:
+            self.allocator.free(np.array(evicted_blocks))
+        self.stats.num_evicted_blocks += len(evicted_blocks)
 
-        return len(evicted_blocks)
+        return num_evicted
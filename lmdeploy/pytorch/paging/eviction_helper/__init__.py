@@ -1,4 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from .recompute_eviction_helper import RecomputeEvictionHelper
+from .swap_eviction_helper import SwapEvictionHelper
 
-__all__ = ['RecomputeEvictionHelper']
+__all__ = ['RecomputeEvictionHelper', 'SwapEvictionHelper']
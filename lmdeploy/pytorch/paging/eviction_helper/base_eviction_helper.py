@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List
+from typing import Dict, List
 
 from ...messages import SchedulerSequence
 from ..scheduler import Scheduler
@@ -14,11 +14,22 @@ class BaseEvictionHelper:
         self.scheduler = scheduler
         self.block_manager = scheduler.block_manager
         self.block_trie = scheduler.block_trie
+        # number of the evicted sequences, for metrics
+        self.num_evicted_seqs = 0
 
     def need_swap_in(self, seq: SchedulerSequence):
         """sequence need swap in."""
         raise NotImplementedError('Not implemented.')
 
-    def evict_for_seq(self, seq: SchedulerSequence, evictable_seqs: List[SchedulerSequence], prealloc_size: int):
+    def swap_in(self, seq: SchedulerSequence, swap_in_map: Dict[int, int]):
+        """swap in sequence."""
+        raise NotImplementedError('Not implemented.')
+
+    def evict_for_seq(self,
+                      seq: SchedulerSequence,
+                      evictable_seqs: List[SchedulerSequence],
+                      prealloc_size: int,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None):
         """evict seqs."""
         raise NotImplementedError('Not implemented.')
@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List
+from typing import Dict, List
 
 from ...messages import SchedulerSequence
 from .base_eviction_helper import BaseEvictionHelper
@@ -8,26 +8,77 @@ from .base_eviction_helper import BaseEvictionHelper
 class RecomputeEvictionHelper(BaseEvictionHelper):
     """recompute eviction."""
 
-    def evict_for_seq(self, seq: SchedulerSequence, evictable_seqs: List[SchedulerSequence], prealloc_size: int):
+    def need_swap_in(self, seq: SchedulerSequence):
+        """sequence need swap in."""
+        return self.block_manager.get_num_cpu_blocks(seq) > 0
+
+    def swap_in(self, seq: SchedulerSequence, swap_in_map: Dict[int, int]):
+        """swap in blocks of the sequence kept in host memory."""
+        block_manager = self.block_manager
+        num_cpu_blocks = block_manager.get_num_cpu_blocks(seq)
+        if num_cpu_blocks == 0:
+            return True
+        if block_manager.get_num_free_gpu_blocks() < num_cpu_blocks:
+            return False
+        swap_map = block_manager.swap_in_blocks(seq.logical_blocks.get_real_blocks())
+        swap_in_map.update(swap_map)
+        return True
+
+    def evict_seq(self,
+                  seq: SchedulerSequence,
+                  swap_in_map: Dict[int, int] = None,
+                  swap_out_map: Dict[int, int] = None):
+        """evict one sequence, the history would be recomputed."""
+        self.block_manager.free(seq)
+        seq.set_step(0)
+        self.num_evicted_seqs += 1
+
+    def num_required_blocks(self, seq: SchedulerSequence, prealloc_size: int):
+        """num gpu blocks required to schedule the sequence."""
+        num_required_blocks = self.block_manager.num_required_blocks(seq, prealloc_size)
+        num_required_blocks += self.block_manager.get_num_cpu_blocks(seq)
+        num_required_blocks += self.block_manager.get_num_copy_blocks(seq)
+        return num_required_blocks
+
+    def evict_for_seq(self,
+                      seq: SchedulerSequence,
+                      evictable_seqs: List[SchedulerSequence],
+                      prealloc_size: int,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None):
         """evict seqs."""
         block_manager = self.block_manager
         block_trie = self.block_trie
-        num_required_blocks = block_manager.num_required_blocks(seq, prealloc_size)
+        num_required_blocks = self.num_required_blocks(seq, prealloc_size)
 
         if block_manager.get_num_free_gpu_blocks() >= num_required_blocks:
             return True
 
         success = False
+        # swapped sequences only keep the shared blocks on device and would
+        # lose the blocks on host, they are evicted after the prefix cache.
+        evictable_seqs = sorted(evictable_seqs, key=self.need_swap_in)
         while len(evictable_seqs) > 0:
             evict_seq = evictable_seqs.pop(0)
 
-            block_manager.free(evict_seq)
+            # skip sequence without gpu blocks
+            if block_manager.get_num_gpu_blocks(evict_seq) == 0:
+                continue
+
+            if self.need_swap_in(evict_seq):
+                num_req = (num_required_blocks - block_manager.get_num_free_gpu_blocks())
+                block_trie.evict(num_req, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+                if block_manager.get_num_free_gpu_blocks() >= num_required_blocks:
+                    success = True
+                    break
+
+            self.evict_seq(evict_seq, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
             num_req = (num_required_blocks - block_manager.get_num_free_gpu_blocks())
             if num_req <= 0:
                 success = True
                 break
 
-            block_trie.evict(num_req)
+            block_trie.evict(num_req, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
             num_req = (num_required_blocks - block_manager.get_num_free_gpu_blocks())
             if num_req <= 0:
                 success = True
@@ -36,7 +87,7 @@ class RecomputeEvictionHelper(BaseEvictionHelper):
         # for empty evictable_seqs case
         num_req = num_required_blocks - block_manager.get_num_free_gpu_blocks()
         if num_req > 0:
-            block_trie.evict(num_req)
+            block_trie.evict(num_req, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
             if num_required_blocks <= block_manager.get_num_free_gpu_blocks():
                 success = True
 
@@ -0,0 +1,44 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import Dict
+
+from ...messages import SchedulerSequence
+from ..scheduler import Scheduler
+from .recompute_eviction_helper import RecomputeEvictionHelper
+
+
+class SwapEvictionHelper(RecomputeEvictionHelper):
+    """swap eviction.
+
+    Blocks of the evicted sequence are moved to host memory and swapped back
+    when the sequence is scheduled again. Blocks shared with the prefix cache
+    or other sequences are kept on device. Sequence would fallback to
+    recompute if copying the blocks is more expensive than recomputing the
+    history, or the blocks can not be swapped.
+    """
+
+    def __init__(self, scheduler: Scheduler):
+        super().__init__(scheduler)
+        self.swap_block_cost = scheduler.scheduler_config.swap_block_cost
+
+    def _prefer_swap(self, seq: SchedulerSequence):
+        """swap if copy blocks out and in is cheaper than recompute."""
+        num_blocks = self.block_manager.get_num_swap_out_blocks(seq)
+        if num_blocks == 0:
+            return False
+        copy_cost = 2 * num_blocks * self.swap_block_cost
+        return copy_cost < seq.num_history_ids
+
+    def evict_seq(self,
+                  seq: SchedulerSequence,
+                  swap_in_map: Dict[int, int] = None,
+                  swap_out_map: Dict[int, int] = None):
+        """evict one sequence."""
+        # cpu blocks released by swap in are reused by swap out. Since swap
+        # out is performed before swap in, we can not swap out in this step.
+        can_swap = swap_out_map is not None and not swap_in_map
+        if can_swap and self._prefer_swap(seq):
+            success, swap_map = self.block_manager.try_swap_out(seq)
+            if success:
+                swap_out_map.update(swap_map)
+                return
+        super().evict_seq(seq, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
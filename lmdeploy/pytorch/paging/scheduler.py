@@ -1,12 +1,16 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # modify from: https://github.com/vllm-project/vllm
 
+import random
+import time
 from collections import OrderedDict
-from dataclasses import dataclass
-from typing import Dict, List
+from dataclasses import dataclass, field
+from itertools import chain, groupby
+from typing import Dict, List, Set
 
 from lmdeploy.utils import get_logger, logging_timer
 
+from ..adapter.adapter import AdapterManager
 from ..config import CacheConfig, SchedulerConfig
 from ..messages import MessageStatus, SchedulerSequence, SchedulerSession, SequenceManager
 from .block_manager import build_block_manager
@@ -24,7 +28,23 @@ class SchedulerOutput:
     running: SeqList
     swap_in_map: Dict[int, int]
     swap_out_map: Dict[int, int]
+    # dst -> src
     copy_map: Dict[int, int]
+    disk_save_map: Dict[str, int] = field(default_factory=dict)
+    disk_load_map: Dict[str, int] = field(default_factory=dict)
+    # seq_id -> number of tokens to prefill, for unfinished chunked prefill
+    prefill_chunks: Dict[int, int] = field(default_factory=dict)
+    # slot -> adapter id, adapters to page in before the forward
+    adapter_slot_map: Dict[int, int] = field(default_factory=dict)
+
+
+@dataclass
+class PriorityClassStats:
+    """Queue depth of a priority class."""
+
+    num_waiting: int = 0
+    num_running: int = 0
+    num_preempted: int = 0
 
 
 class Scheduler:
@@ -33,11 +53,17 @@ class Scheduler:
     Args:
         scheduler_config (SchedulerConfig): The config of scheduler.
         cache_config (CacheConfig): The config of cache info.
+        adapter_manager (AdapterManager): Device slots of lora adapters,
+            sequences are deferred until their adapters are paged in.
     """
 
-    def __init__(self, scheduler_config: SchedulerConfig, cache_config: CacheConfig) -> None:
+    def __init__(self,
+                 scheduler_config: SchedulerConfig,
+                 cache_config: CacheConfig,
+                 adapter_manager: AdapterManager = None) -> None:
         self.scheduler_config = scheduler_config
         self.cache_config = cache_config
+        self.adapter_manager = adapter_manager
 
         self.sessions: Dict[int, SchedulerSession] = OrderedDict()
 
@@ -45,6 +71,10 @@ class Scheduler:
         self.block_trie = BlockTrie(self.cache_config, self.block_manager)
 
         self.eviction_helper = self.build_eviction_helper(self.scheduler_config.eviction_type)
+        # cache ops of the step that has nothing to run
+        self._pending_maps = None
+        # priority -> number of preempted sequences
+        self._num_preempted: Dict[int, int] = dict()
 
         self.seq_manager = SequenceManager()
 
@@ -74,6 +104,9 @@ class Scheduler:
         if eviction_type == 'recompute':
             from .eviction_helper import RecomputeEvictionHelper
             return RecomputeEvictionHelper(self)
+        elif eviction_type == 'swap':
+            from .eviction_helper import SwapEvictionHelper
+            return SwapEvictionHelper(self)
         else:
             raise TypeError(f'Unknown eviction type: {eviction_type}')
 
@@ -108,6 +141,161 @@ class Scheduler:
         # push message to waiting queue
         self._set_message_status(seq, MessageStatus.WAITING)
 
+    def _get_evictable(self, waiting: SeqList = None):
+        """sequences that can be evicted, lowest priority first."""
+        if waiting is None:
+            waiting = self.waiting
+        evictable = list(chain(reversed(self.hanging), reversed(waiting)))
+        # sort is stable, sequences in the same class keep the order above.
+        return sorted(evictable, key=lambda seq: -seq.priority)
+
+    def _preempt_for_seq(self, seq: SchedulerSequence, prealloc_size: int, swap_in_map: Dict[int, int],
+                         swap_out_map: Dict[int, int]):
+        """preempt running sequences with lower priority than `seq`.
+
+        Victims are taken from the lowest class, latest arrival first.
+
+        Returns:
+            bool: True if blocks of `seq` can be allocated.
+        """
+        victims = [other for other in self.running if other.priority > seq.priority]
+        if len(victims) == 0:
+            return False
+        victims = sorted(victims, key=lambda other: (other.priority, other.arrive_time), reverse=True)
+        success = self.eviction_helper.evict_for_seq(seq,
+                                                     list(victims),
+                                                     prealloc_size,
+                                                     swap_in_map=swap_in_map,
+                                                     swap_out_map=swap_out_map)
+        for victim in victims:
+            # swapped victims keep the blocks shared with the prefix cache on device
+            if self.block_manager.get_num_gpu_blocks(victim) > 0 and not self.eviction_helper.need_swap_in(victim):
+                continue
+            logger.debug(f'session[{victim.session_id}] sequence[{victim.seq_id}] '
+                         f'is preempted by sequence[{seq.seq_id}].')
+            self._set_message_status(victim, MessageStatus.WAITING)
+            self._num_preempted[victim.priority] = self._num_preempted.get(victim.priority, 0) + 1
+        return success
+
+    def _get_cache_maps(self):
+        """get swap in, swap out and copy maps of the step."""
+        if self._pending_maps is None:
+            return dict(), dict(), dict()
+        maps = self._pending_maps
+        self._pending_maps = None
+        return maps
+
+    def _cache_aware_reorder(self, waiting: SeqList):
+        """reorder waiting sequences to reuse prefix caches.
+
+        Sequences waiting longer than `prefill_starvation_time` come first in
+        arrival order. The rest are grouped by the deepest cached node, groups
+        with longer cached prefix come first.
+
+        Returns:
+            SeqList: reordered waiting sequences.
+            Dict[int, int]: number of uncached tokens of each sequence.
+        """
+        now = time.time()
+        starvation_time = self.scheduler_config.prefill_starvation_time
+        num_uncached: Dict[int, int] = dict()
+        starved: SeqList = []
+        groups: Dict[int, SeqList] = OrderedDict()
+        group_nodes = dict()
+        for seq in waiting:
+            node = self.block_trie.peek(seq)
+            num_cached = max(seq.num_history_ids, node.num_matched)
+            num_uncached[seq.seq_id] = seq.num_all_ids - num_cached
+            if now - seq.arrive_time > starvation_time:
+                starved.append(seq)
+                continue
+            group_nodes[id(node)] = node
+            groups.setdefault(id(node), []).append(seq)
+
+        # sort is stable, groups with the same cached length keep arrival order.
+        group_keys = sorted(groups, key=lambda key: -group_nodes[key].num_matched)
+        reordered = list(starved)
+        for key in group_keys:
+            reordered += groups[key]
+        return reordered, num_uncached
+
+    def _adapter_aware_reorder(self, waiting: SeqList):
+        """reorder waiting sequences to share lora adapters in a step.
+
+        Sequences waiting longer than `prefill_starvation_time` come first in
+        arrival order. The rest are grouped by the adapter, groups of the
+        adapters used by the running sequences come first and the others take
+        turns by the arrival of their oldest sequence.
+
+        Returns:
+            SeqList: reordered waiting sequences.
+        """
+        now = time.time()
+        starvation_time = self.scheduler_config.prefill_starvation_time
+        running_adapters = set(seq.adapter_name for seq in self.running)
+        starved: SeqList = []
+        groups: Dict[str, SeqList] = OrderedDict()
+        for seq in waiting:
+            if now - seq.arrive_time > starvation_time:
+                starved.append(seq)
+                continue
+            groups.setdefault(seq.adapter_name, []).append(seq)
+
+        # sort is stable, the other groups keep the order of the oldest sequence.
+        group_keys = sorted(groups, key=lambda name: name not in running_adapters)
+        reordered = list(starved)
+        for key in group_keys:
+            reordered += groups[key]
+        return reordered
+
+    def _acquire_adapter(self, seq: SchedulerSequence, pinned: Set[str]):
+        """page in the adapter of the sequence, adapters in `pinned` are used
+        by the running sequences and can not be evicted. A step has at most
+        `max_active_adapters` distinct adapters.
+
+        Returns:
+            bool: False if the sequence should be deferred.
+        """
+        if self.adapter_manager is None or seq.adapter_name is None:
+            return True
+        if seq.adapter_name not in pinned:
+            num_active = sum(1 for name in pinned if name is not None)
+            if num_active >= self.scheduler_config.max_active_adapters:
+                return False
+        if not self.adapter_manager.acquire(seq.adapter_name, pinned):
+            return False
+        pinned.add(seq.adapter_name)
+        return True
+
+    def _is_starved(self, seq: SchedulerSequence):
+        """sequence waits longer than `prefill_starvation_time`."""
+        return time.time() - seq.arrive_time > self.scheduler_config.prefill_starvation_time
+
+    def _reorder_waiting(self):
+        """reorder waiting.
+
+        Returns:
+            SeqList: reordered waiting sequences.
+            Dict[int, int]: number of tokens to compute of each sequence.
+        """
+        waiting = sorted(self.waiting, key=lambda seq: (seq.priority, seq.arrive_time))
+        num_uncached = dict((seq.seq_id, seq.num_token_ids) for seq in waiting)
+        prefill_policy = self.scheduler_config.prefill_policy
+        if prefill_policy == 'fcfs':
+            return waiting, num_uncached
+
+        # reorder inside each priority class
+        reordered: SeqList = []
+        for _, group in groupby(waiting, key=lambda seq: seq.priority):
+            group = list(group)
+            if prefill_policy == 'cache_aware':
+                group, group_uncached = self._cache_aware_reorder(group)
+                num_uncached.update(group_uncached)
+            else:
+                group = self._adapter_aware_reorder(group)
+            reordered += group
+        return reordered, num_uncached
+
     @logging_timer('SchedulePrefilling', logger)
     def _schedule_prefill(self):
         """Schedule for prefilling."""
@@ -115,9 +303,7 @@ class Scheduler:
         current_running = self.running
         max_batches = self.scheduler_config.max_batches - len(current_running)
         eviction_helper = self.eviction_helper
-        swap_out_map: Dict[int, int] = dict()
-        swap_in_map: Dict[int, int] = dict()
-        copy_map: Dict[int, int] = dict()
+        swap_in_map, swap_out_map, copy_map = self._get_cache_maps()
         running: SeqList = []
         token_count = 0
 
@@ -130,38 +316,74 @@ class Scheduler:
 
         def __evict_for_seq(seq: SchedulerSequence, waiting):
             """evict until can append."""
-            from itertools import chain
-            hanging = reversed(self.hanging)
-            waiting = reversed(waiting)
-            evictable = list(chain(hanging, waiting))
-            return eviction_helper.evict_for_seq(seq, evictable, 0)
-
-        def _reorder_waiting():
-            """reorder waiting."""
-            return sorted(self.waiting, key=lambda seq: seq.arrive_time)
+            evictable = self._get_evictable(waiting)
+            if eviction_helper.evict_for_seq(seq, evictable, 0, swap_in_map=swap_in_map, swap_out_map=swap_out_map):
+                return True
+            return self._preempt_for_seq(seq, 0, swap_in_map, swap_out_map)
 
         num_waiting = self.seq_manager.num_sequences(MessageStatus.WAITING)
         if (len(running) >= max_batches or num_waiting == 0):
             return running, swap_in_map, swap_out_map, copy_map
 
-        waiting = _reorder_waiting()
+        pinned_adapters = set(seq.adapter_name for seq in current_running)
+        waiting, num_uncached = self._reorder_waiting()
         while len(waiting) > 0 and len(running) < max_batches:
             seq = waiting.pop(0)
 
-            if (len(running) > 0 and token_count + seq.num_token_ids > self.cache_config.max_prefill_token_num):
+            if (len(running) > 0 and token_count + num_uncached[seq.seq_id] > self.cache_config.max_prefill_token_num):
                 break
 
+            if not self._acquire_adapter(seq, pinned_adapters):
+                # all adapter slots are used by running sequences, a starved
+                # sequence stops the others to release the slots.
+                if self._is_starved(seq):
+                    break
+                continue
+
             self.block_trie.match(seq)
 
             if not __evict_for_seq(seq, waiting):
                 break
 
+            # swap in blocks kept in host memory
+            if not eviction_helper.swap_in(seq, swap_in_map):
+                break
+
             # allocate session memory
             self.block_manager.allocate(seq)
             _to_running(seq)
 
         return running, swap_in_map, swap_out_map, copy_map
 
+    def _schedule_running_seq(self, seq: SchedulerSequence, prealloc_size: int, swap_in_map: Dict[int, int],
+                              swap_out_map: Dict[int, int]):
+        """allocate blocks for the next token of a running sequence.
+
+        Returns:
+            bool: False if the sequence can not run this step.
+        """
+        if len(seq.logical_blocks) > self.block_manager.num_gpu_blocks:
+            # Reach max gpu cache size.
+            logger.warning(f'session[{seq.session_id}] '
+                           f'sequence[{seq.seq_id}] '
+                           'reach max gpu size.')
+            self._set_message_status(seq, MessageStatus.ABORTED)
+            self.block_manager.free(seq)
+            seq.set_step(0)
+            return False
+
+        # evict until can append
+        evictable = self._get_evictable()
+        if not self.eviction_helper.evict_for_seq(
+                seq, evictable, prealloc_size, swap_in_map=swap_in_map,
+                swap_out_map=swap_out_map) and not self._preempt_for_seq(seq, prealloc_size, swap_in_map, swap_out_map):
+            self._set_message_status(seq, MessageStatus.WAITING)
+            return False
+
+        self.block_manager.allocate(seq, prealloc_size)
+        self.block_trie.allocate(seq)
+        return True
+
     @logging_timer('ScheduleDecoding', logger)
     def _schedule_decoding(self, prealloc_size: int = 0):
         """schedule decoding."""
@@ -169,51 +391,168 @@ class Scheduler:
         running = self.running
         assert len(running) != 0
 
-        eviction_helper = self.eviction_helper
-        swap_out_map: Dict[int, int] = dict()
-        swap_in_map: Dict[int, int] = dict()
-        copy_map: Dict[int, int] = dict()
-
-        def __evict_for_seq(seq: SchedulerSequence):
-            """evict until can append."""
-            from itertools import chain
-            hanging = reversed(self.hanging)
-            waiting = reversed(self.waiting)
-            evictable = list(chain(hanging, waiting))
-            return eviction_helper.evict_for_seq(seq, evictable, prealloc_size)
+        swap_in_map, swap_out_map, copy_map = self._get_cache_maps()
 
-        # 1. running
+        # 1. running, higher priority first
+        running = sorted(running, key=lambda seq: (seq.priority, seq.arrive_time))
         for seq in running:
+            # skip preempted sequences
+            if seq.status != MessageStatus.RUNNING:
+                continue
             # token + n
+            self._schedule_running_seq(seq, prealloc_size, swap_in_map, swap_out_map)
+
+        return self.running, swap_in_map, swap_out_map, copy_map
+
+    @staticmethod
+    def _can_chunk(seq: SchedulerSequence):
+        """prefill of the sequence can be split into chunks."""
+        return len(seq.history_embeddings) == 0 and seq.history_multimodals.empty()
 
-            if len(seq.logical_blocks) > self.block_manager.num_gpu_blocks:
-                # Reach max gpu cache size.
-                logger.warning(f'session[{seq.session_id}] '
-                               f'sequence[{seq.seq_id}] '
-                               'reach max gpu size.')
-                self._set_message_status(seq, MessageStatus.ABORTED)
-                self.block_manager.free(seq)
-                seq.set_step(0)
+    @logging_timer('ScheduleChunkedPrefill', logger)
+    def _schedule_chunked_prefill(self):
+        """schedule running sequences and prefill chunks in one batch.
+
+        Each decoding sequence takes one token of `max_prefill_token_num`. The
+        rest of the budget is spent on prefill chunks, unfinished prefills
+        come first. Sequences with multimodal inputs are never chunked.
+        """
+        max_batches = self.scheduler_config.max_batches
+        eviction_helper = self.eviction_helper
+        swap_in_map, swap_out_map, copy_map = self._get_cache_maps()
+        running: SeqList = []
+        prefill_chunks: Dict[int, int] = dict()
+        budget = self.cache_config.max_prefill_token_num
+
+        def __add_chunk(seq: SchedulerSequence):
+            """add prefill chunk."""
+            nonlocal budget
+            num_tokens = seq.num_token_ids
+            if self._can_chunk(seq):
+                num_tokens = min(num_tokens, budget)
+            if num_tokens < seq.num_token_ids:
+                prefill_chunks[seq.seq_id] = num_tokens
+            budget -= num_tokens
+            running.append(seq)
+
+        # 1. decoding, higher priority first
+        prefilling: SeqList = []
+        for seq in sorted(self.running, key=lambda seq: (seq.priority, seq.arrive_time)):
+            if seq.status != MessageStatus.RUNNING:
                 continue
+            if seq.num_token_ids > 1:
+                prefilling.append(seq)
+                continue
+            if self._schedule_running_seq(seq, 0, swap_in_map, swap_out_map):
+                running.append(seq)
+                budget -= 1
 
-            if not __evict_for_seq(seq):
-                self._set_message_status(seq, MessageStatus.WAITING)
+        # 2. unfinished prefill
+        for seq in prefilling:
+            if budget <= 0:
+                break
+            __add_chunk(seq)
+
+        # 3. new prefill
+        if budget <= 0 or len(self.running) >= max_batches:
+            return running, swap_in_map, swap_out_map, copy_map, prefill_chunks
+
+        num_running = len(self.running)
+        pinned_adapters = set(seq.adapter_name for seq in self.running)
+        waiting, num_uncached = self._reorder_waiting()
+        while len(waiting) > 0 and budget > 0 and num_running < max_batches:
+            seq = waiting.pop(0)
+
+            if not self._can_chunk(seq) and num_uncached[seq.seq_id] > budget:
+                break
+
+            if not self._acquire_adapter(seq, pinned_adapters):
+                if self._is_starved(seq):
+                    break
                 continue
 
-            self.block_manager.allocate(seq, prealloc_size)
-            self.block_trie.allocate(seq)
+            self.block_trie.match(seq)
+
+            evictable = self._get_evictable(waiting)
+            if not eviction_helper.evict_for_seq(seq, evictable, 0, swap_in_map=swap_in_map, swap_out_map=swap_out_map):
+                success = self._preempt_for_seq(seq, 0, swap_in_map, swap_out_map)
+                # preempted sequences leave the batch
+                running = [other for other in running if other.status == MessageStatus.RUNNING]
+                running_ids = set(other.seq_id for other in running)
+                prefill_chunks = dict((k, v) for k, v in prefill_chunks.items() if k in running_ids)
+                num_running = len(self.running)
+                if not success:
+                    break
+
+            # swap in blocks kept in host memory
+            if not eviction_helper.swap_in(seq, swap_in_map):
+                break
 
-        return self.running, swap_in_map, swap_out_map, copy_map
+            # allocate session memory
+            self.block_manager.allocate(seq)
+            seq.status = MessageStatus.RUNNING
+            num_running += 1
+            __add_chunk(seq)
+
+        return running, swap_in_map, swap_out_map, copy_map, prefill_chunks
+
+    def has_prefilling(self):
+        """has running sequences with unfinished prefill."""
+        return any(seq.num_token_ids > 1 for seq in self.running)
 
     def schedule(self, is_prefill: bool, prealloc_size: int = 0):
         """Schedule inputs for next steps."""
-        if is_prefill:
-            output = self._schedule_prefill()
-        else:
+        prefill_chunks: Dict[int, int] = dict()
+        if not is_prefill:
             output = self._schedule_decoding(prealloc_size)
+        elif self.scheduler_config.enable_chunked_prefill:
+            *output, prefill_chunks = self._schedule_chunked_prefill()
+        else:
+            output = self._schedule_prefill()
         running, swap_in_map, swap_out_map, copy_map = output
-
-        return SchedulerOutput(running=running, swap_in_map=swap_in_map, swap_out_map=swap_out_map, copy_map=copy_map)
+        copy_map.update(self.block_manager.pop_copy_map())
+
+        if len(running) == 0:
+            # empty outputs are not forwarded, keep cache ops for next step.
+            self._pending_maps = (swap_in_map, swap_out_map, copy_map)
+            return SchedulerOutput(running=running, swap_in_map=dict(), swap_out_map=dict(), copy_map=dict())
+
+        disk_save_map, disk_load_map = self.block_trie.pop_disk_ops()
+        adapter_slot_map = dict()
+        if self.adapter_manager is not None:
+            adapter_slot_map = self.adapter_manager.pop_slot_loads()
+        return SchedulerOutput(running=running,
+                               swap_in_map=swap_in_map,
+                               swap_out_map=swap_out_map,
+                               copy_map=copy_map,
+                               disk_save_map=disk_save_map,
+                               disk_load_map=disk_load_map,
+                               prefill_chunks=prefill_chunks,
+                               adapter_slot_map=adapter_slot_map)
+
+    def fork_sequence(self, seq: SchedulerSequence):
+        """Fork `n - 1` children of a prefilled sequence for parallel sampling.
+
+        Children share the blocks of the parent. The last token of the parent
+        is recomputed by each child, so every child samples its own first
+        token in the next decoding step.
+
+        Returns:
+            SeqList: the forked children.
+        """
+        num_children = seq.sampling_param.n - 1
+        random_seed = seq.sampling_param.random_seed
+        step = seq.num_all_ids - 1
+        children: SeqList = []
+        for idx in range(num_children):
+            # children sample with different seeds
+            child_seed = random.getrandbits(64) if random_seed is None else random_seed + idx + 1
+            child = seq.session.fork_sequence(seq, random_seed=child_seed)
+            child.set_step(step)
+            self.block_manager.fork(seq, child)
+            self._set_message_status(child, MessageStatus.RUNNING)
+            children.append(child)
+        return children
 
     def _set_session_status(self, session_id: int, status: MessageStatus):
         """Setup the status of session.
@@ -279,3 +618,20 @@ class Scheduler:
     def num_waiting(self):
         """num waiting."""
         return self.seq_manager.num_sequences(MessageStatus.WAITING)
+
+    def get_priority_stats(self) -> Dict[int, PriorityClassStats]:
+        """get queue depth of each priority class."""
+        stats: Dict[int, PriorityClassStats] = dict()
+
+        def __get_stats(priority: int):
+            if priority not in stats:
+                stats[priority] = PriorityClassStats()
+            return stats[priority]
+
+        for seq in self.waiting:
+            __get_stats(seq.priority).num_waiting += 1
+        for seq in self.running:
+            __get_stats(seq.priority).num_running += 1
+        for priority, num_preempted in self._num_preempted.items():
+            __get_stats(priority).num_preempted = num_preempted
+        return dict(sorted(stats.items()))
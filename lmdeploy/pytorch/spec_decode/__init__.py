@@ -0,0 +1,8 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from .proposer import BaseProposer, DraftModelProposer, NGramProposer
+from .rejection_sampler import greedy_verify, rejection_sample
+from .stats import SpecDecodeStats
+
+__all__ = [
+    'BaseProposer', 'DraftModelProposer', 'NGramProposer', 'greedy_verify', 'rejection_sample', 'SpecDecodeStats'
+]
@@ -0,0 +1,197 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from dataclasses import replace
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from lmdeploy.utils import get_logger
+
+from ..devices import get_device_manager
+from ..messages import SchedulerSequence
+from ..model_inputs import ModelInputs
+
+logger = get_logger('lmdeploy')
+
+SeqList = List[SchedulerSequence]
+
+_EMPTY_TOKEN = np.empty((0, ), dtype=np.int64)
+
+
+class BaseProposer:
+    """Propose draft tokens to be verified by the target model.
+
+    Args:
+        num_spec_tokens (int): Max number of draft tokens of each sequence.
+    """
+
+    def __init__(self, num_spec_tokens: int):
+        self.num_spec_tokens = num_spec_tokens
+
+    async def propose(self,
+                      seqs: SeqList,
+                      block_offsets: torch.LongTensor,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None,
+                      copy_map: Dict[int, int] = None) -> List[np.ndarray]:
+        """propose draft tokens of the decoding sequences.
+
+        Args:
+            seqs (SeqList): Decoding sequences.
+            block_offsets (torch.LongTensor): Block tables of the sequences.
+            swap_in_map (Dict[int, int]): Cache maps to swap in.
+            swap_out_map (Dict[int, int]): Cache maps to swap out.
+            copy_map (Dict[int, int]): Cache maps to copy on device.
+
+        Return:
+            List[np.ndarray]: Draft tokens of each sequence, might be shorter
+                than `num_spec_tokens`.
+        """
+        raise NotImplementedError('Not implemented.')
+
+    async def observe(self,
+                      inputs: ModelInputs,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None,
+                      copy_map: Dict[int, int] = None):
+        """observe the inputs forwarded by the target model without
+        speculation."""
+        pass
+
+
+class NGramProposer(BaseProposer):
+    """Model free proposer that looks up the suffix ngram in the prompt and
+    generated tokens, and proposes the tokens following the latest match.
+
+    Args:
+        num_spec_tokens (int): Max number of draft tokens of each sequence.
+        min_n (int): Min ngram size to match.
+        max_n (int): Max ngram size to match, larger ngrams are tried first.
+    """
+
+    def __init__(self, num_spec_tokens: int, min_n: int = 1, max_n: int = 4):
+        super().__init__(num_spec_tokens)
+        assert 0 < min_n <= max_n
+        self.min_n = min_n
+        self.max_n = max_n
+
+    def propose_tokens(self, token_ids: np.ndarray) -> np.ndarray:
+        """propose draft tokens of a token sequence."""
+        num_tokens = len(token_ids)
+        for n in range(min(self.max_n, num_tokens - 1), self.min_n - 1, -1):
+            suffix = token_ids[-n:]
+            # windows exclude the suffix itself
+            windows = np.lib.stride_tricks.sliding_window_view(token_ids[:-1], n)
+            matched = np.flatnonzero((windows == suffix).all(1))
+            if len(matched) == 0:
+                continue
+            start = matched[-1] + n
+            return token_ids[start:start + self.num_spec_tokens]
+        return _EMPTY_TOKEN
+
+    async def propose(self,
+                      seqs: SeqList,
+                      block_offsets: torch.LongTensor = None,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None,
+                      copy_map: Dict[int, int] = None) -> List[np.ndarray]:
+        """propose draft tokens of the decoding sequences."""
+        return [self.propose_tokens(seq.all_ids) for seq in seqs]
+
+
+class DraftModelProposer(BaseProposer):
+    """Propose draft tokens greedily with a small draft model.
+
+    The draft model keeps its own caches with the same block tables of the
+    target model, so it is fed with the same inputs of the target model. The
+    last two tokens are recomputed when proposing, the caches of the draft
+    tokens rejected in previous step would be overwritten.
+
+    Args:
+        model_agent (AutoModelAgent): Model agent of the draft model.
+        num_spec_tokens (int): Max number of draft tokens of each sequence.
+    """
+
+    def __init__(self, model_agent, num_spec_tokens: int):
+        super().__init__(num_spec_tokens)
+        self.model_agent = model_agent
+        self.max_prefill_token_num = model_agent.cache_config.max_prefill_token_num
+
+    async def _forward(self,
+                       inputs: ModelInputs,
+                       swap_in_map: Dict[int, int] = None,
+                       swap_out_map: Dict[int, int] = None,
+                       copy_map: Dict[int, int] = None):
+        """forward draft model."""
+        stream = get_device_manager().current_context().current_stream()
+        draft_stream = self.model_agent.stream
+        if stream is not None:
+            draft_stream.wait_stream(stream)
+        output = await self.model_agent.async_forward(inputs,
+                                                      swap_in_map=swap_in_map or dict(),
+                                                      swap_out_map=swap_out_map or dict(),
+                                                      copy_map=copy_map)
+        if stream is not None:
+            stream.wait_stream(draft_stream)
+        return output
+
+    async def observe(self,
+                      inputs: ModelInputs,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None,
+                      copy_map: Dict[int, int] = None):
+        """fill caches of the draft model."""
+        inputs = replace(inputs, vision_inputs=None, model_metas=None)
+        if len(inputs.seq_length) == 1 and inputs.input_ids.numel() > self.max_prefill_token_num:
+            inputs = inputs.split(self.max_prefill_token_num)
+        else:
+            inputs = [inputs]
+        for inp in inputs:
+            await self._forward(inp, swap_in_map=swap_in_map, swap_out_map=swap_out_map, copy_map=copy_map)
+            swap_in_map = swap_out_map = copy_map = None
+
+    async def propose(self,
+                      seqs: SeqList,
+                      block_offsets: torch.LongTensor,
+                      swap_in_map: Dict[int, int] = None,
+                      swap_out_map: Dict[int, int] = None,
+                      copy_map: Dict[int, int] = None) -> List[np.ndarray]:
+        """propose draft tokens of the decoding sequences."""
+        history_lengths = [max(0, seq.num_all_ids - 2) for seq in seqs]
+        token_ids = [seq.all_ids[start:] for seq, start in zip(seqs, history_lengths)]
+        seq_length = torch.tensor([len(tokens) for tokens in token_ids])
+        history_lengths = torch.tensor(history_lengths)
+        num_ignored_history = torch.tensor([seq.num_ignored_history for seq in seqs])
+        inputs = ModelInputs(input_ids=torch.from_numpy(np.concatenate(token_ids))[None],
+                             seq_length=seq_length,
+                             history_lengths=history_lengths,
+                             block_offsets=block_offsets,
+                             is_decoding=False,
+                             num_ignored_history=num_ignored_history)
+        inputs = inputs.to_device(get_device_manager().current_context().device)
+
+        output = await self._forward(inputs, swap_in_map=swap_in_map, swap_out_map=swap_out_map, copy_map=copy_map)
+        last_token_loc = inputs.seq_length.cumsum(0) - 1
+        hidden_states = output['hidden_states'][:, last_token_loc]
+
+        draft_token_ids = []
+        for idx in range(self.num_spec_tokens):
+            logits = self.model_agent.get_logits(hidden_states)[0]
+            next_token_ids = logits.argmax(-1)
+            draft_token_ids.append(next_token_ids)
+            if idx == self.num_spec_tokens - 1:
+                break
+            if idx == 0:
+                inputs = ModelInputs(input_ids=next_token_ids[None],
+                                     seq_length=torch.ones_like(inputs.seq_length),
+                                     history_lengths=inputs.history_lengths + inputs.seq_length,
+                                     block_offsets=inputs.block_offsets,
+                                     is_decoding=True,
+                                     num_ignored_history=inputs.num_ignored_history)
+            else:
+                inputs.update(next_token_ids)
+            output = await self._forward(inputs)
+            hidden_states = output['hidden_states']
+
+        draft_token_ids = torch.stack(draft_token_ids, 1).cpu().numpy()
+        return list(draft_token_ids)
@@ -0,0 +1,99 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+
+
+def _make_output(draft_token_ids: torch.LongTensor, num_accepted: torch.LongTensor, last_token_ids: torch.LongTensor):
+    """accepted draft tokens followed by the token sampled from the target
+    model, padded with -1."""
+    batch_size, num_spec_tokens = draft_token_ids.shape
+    output = draft_token_ids.new_full((batch_size, num_spec_tokens + 1), -1)
+    output[:, :num_spec_tokens] = draft_token_ids
+    output.scatter_(1, num_accepted[:, None], last_token_ids[:, None])
+    pos = torch.arange(num_spec_tokens + 1, device=output.device)
+    output.masked_fill_(pos[None, :] > num_accepted[:, None], -1)
+    return output
+
+
+def greedy_verify(draft_token_ids: torch.LongTensor, target_token_ids: torch.LongTensor):
+    """verify draft tokens against greedy sampled target tokens.
+
+    Args:
+        draft_token_ids (torch.LongTensor): Draft tokens of shape
+            [batch_size, k], padded with -1.
+        target_token_ids (torch.LongTensor): Target tokens of shape
+            [batch_size, k + 1].
+
+    Return:
+        Tuple[torch.LongTensor, torch.LongTensor]: Output tokens of shape
+            [batch_size, k + 1] padded with -1 and the number of accepted
+            draft tokens of each sequence.
+    """
+    accepted = draft_token_ids == target_token_ids[:, :-1]
+    num_accepted = accepted.long().cumprod(1).sum(1)
+    last_token_ids = target_token_ids.gather(1, num_accepted[:, None])[:, 0]
+    output = _make_output(draft_token_ids, num_accepted, last_token_ids)
+    return output, num_accepted
+
+
+def rejection_sample(draft_token_ids: torch.LongTensor,
+                     target_probs: torch.Tensor,
+                     draft_probs: torch.Tensor = None,
+                     generator: torch.Generator = None):
+    """speculative rejection sampling.
+
+    A draft token `x` is accepted with probability `min(1, p(x) / q(x))`.
+    On the first rejection, a token is sampled from `norm(max(0, p - q))`.
+    If all draft tokens are accepted, a bonus token is sampled from the last
+    target distribution. The output tokens follow the target distribution.
+
+    Args:
+        draft_token_ids (torch.LongTensor): Draft tokens of shape
+            [batch_size, k], padded with -1.
+        target_probs (torch.Tensor): Target probs of shape
+            [batch_size, k + 1, vocab_size].
+        draft_probs (torch.Tensor): Draft probs of shape
+            [batch_size, k, vocab_size]. None means the draft tokens are
+            proposed deterministically.
+        generator (torch.Generator): Random generator.
+
+    Return:
+        Tuple[torch.LongTensor, torch.LongTensor]: Output tokens of shape
+            [batch_size, k + 1] padded with -1 and the number of accepted
+            draft tokens of each sequence.
+    """
+    batch_size, num_spec_tokens = draft_token_ids.shape
+    vocab_size = target_probs.size(-1)
+    device = target_probs.device
+    valid = draft_token_ids >= 0
+    token_ids = draft_token_ids.clamp_min(0)
+
+    target_token_probs = target_probs[:, :num_spec_tokens].gather(2, token_ids[..., None])[..., 0]
+    if draft_probs is None:
+        draft_token_probs = valid.to(target_token_probs.dtype)
+    else:
+        draft_token_probs = draft_probs.gather(2, token_ids[..., None])[..., 0]
+
+    uniform = torch.rand(batch_size, num_spec_tokens, device=device, generator=generator)
+    accepted = valid & (uniform * draft_token_probs < target_token_probs)
+    num_accepted = accepted.long().cumprod(1).sum(1)
+
+    # distribution at the first rejected (or the bonus) position
+    index = num_accepted[:, None, None].expand(-1, 1, vocab_size)
+    probs = target_probs.gather(1, index)[:, 0]
+    padded_ids = torch.cat([draft_token_ids, draft_token_ids.new_full((batch_size, 1), -1)], 1)
+    rejected_ids = padded_ids.gather(1, num_accepted[:, None])
+    rejected_valid = rejected_ids >= 0
+    if draft_probs is None:
+        residual = probs.scatter(1, rejected_ids.clamp_min(0), 0.0)
+        residual = torch.where(rejected_valid, residual, probs)
+    else:
+        padded_probs = torch.cat([draft_probs, draft_probs.new_zeros(batch_size, 1, vocab_size)], 1)
+        rejected_probs = padded_probs.gather(1, index)[:, 0]
+        rejected_probs = rejected_probs.masked_fill(~rejected_valid, 0)
+        residual = (probs - rejected_probs).clamp_min(0)
+    residual_sum = residual.sum(-1, keepdim=True)
+    residual = torch.where(residual_sum > 0, residual / residual_sum.clamp_min(1e-12), probs)
+
+    last_token_ids = torch.multinomial(residual.float(), 1, generator=generator)[:, 0]
+    output = _make_output(draft_token_ids, num_accepted, last_token_ids)
+    return output, num_accepted
@@ -0,0 +1,50 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class SpecDecodeStats:
+    """Acceptance statistics of speculative decoding."""
+
+    num_steps: int = 0
+    num_draft_tokens: int = 0
+    num_accepted_tokens: int = 0
+    num_emitted_tokens: int = 0
+
+    def update(self, num_draft_tokens: np.ndarray, num_accepted_tokens: np.ndarray, num_emitted_tokens: np.ndarray):
+        """update with the results of one verification step.
+
+        Args:
+            num_draft_tokens (np.ndarray): Proposed tokens of each sequence.
+            num_accepted_tokens (np.ndarray): Accepted draft tokens of each
+                sequence.
+            num_emitted_tokens (np.ndarray): Generated tokens of each
+                sequence, including the token sampled from the target model.
+        """
+        self.num_steps += len(num_draft_tokens)
+        self.num_draft_tokens += int(np.sum(num_draft_tokens))
+        self.num_accepted_tokens += int(np.sum(num_accepted_tokens))
+        self.num_emitted_tokens += int(np.sum(num_emitted_tokens))
+
+    @property
+    def acceptance_rate(self) -> float:
+        """ratio of accepted draft tokens."""
+        if self.num_draft_tokens == 0:
+            return 0.0
+        return self.num_accepted_tokens / self.num_draft_tokens
+
+    @property
+    def mean_emitted_tokens(self) -> float:
+        """mean tokens generated per sequence per forward."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.num_emitted_tokens / self.num_steps
+
+    def reset(self):
+        """reset stats."""
+        self.num_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_emitted_tokens = 0
@@ -8,6 +8,7 @@ import json
 import os
 import random
 import re
+import time
 from contextlib import asynccontextmanager, closing
 from copy import deepcopy
 from functools import partial
@@ -20,8 +21,10 @@ import tqdm
 
 from lmdeploy import Tokenizer
 from lmdeploy.logger import RequestLogger
-from lmdeploy.messages import GenerationConfig, PytorchEngineConfig, Response, ResponseType, TurbomindEngineConfig
+from lmdeploy.messages import (GenerationConfig, PytorchEngineConfig, RequestTimeline, Response, ResponseType,
+                               TurbomindEngineConfig)
 from lmdeploy.model import MODELS, ChatTemplateConfig, best_match_model
+from lmdeploy.serve.tokenization import TokenizationService
 from lmdeploy.serve.utils import LogitsMixin
 from lmdeploy.tokenizer import DetokenizeState
 from lmdeploy.utils import _get_and_verify_max_len, _stop_words, get_logger
@@ -58,6 +61,19 @@ class GenOut:
     logprobs: List[Dict[int, float]] = None
     logits: Any = None
     last_hidden_state: Any = None
+    index: int = 0
+    timeline: RequestTimeline = None
+
+
+@dataclasses.dataclass
+class _ChoiceState:
+    """Decoding state of a choice."""
+    token_ids: List[int]
+    state: DetokenizeState
+    prev_len: int = 0
+    hit_stop_token: int = 0
+    gen_len: int = 0
+    response: str = ''
 
 
 def _gen_out_to_response(out: GenOut, index) -> Response:
@@ -246,6 +262,8 @@ class AsyncEngine(LogitsMixin):
             Default to None.
         max_log_len (int): Max number of prompt characters or prompt tokens
             being printed in log. Default: Unlimited
+        num_tokenizer_workers (int): Number of the threads that render chat
+            templates and tokenize prompts off the event loop. Default: 4
     """
 
     def __init__(self,
@@ -255,6 +273,7 @@ class AsyncEngine(LogitsMixin):
                  backend_config: Optional[Union[TurbomindEngineConfig, PytorchEngineConfig]] = None,
                  chat_template_config: Optional[ChatTemplateConfig] = None,
                  max_log_len: int = None,
+                 num_tokenizer_workers: int = 4,
                  **kwargs) -> None:
         logger.info(f'input backend={backend}, backend_config={backend_config}')
         logger.info(f'input chat_template_config={chat_template_config}')
@@ -269,6 +288,7 @@ class AsyncEngine(LogitsMixin):
         logger.info(f'updated chat_template_onfig={chat_template_config}')
 
         self.tokenizer = Tokenizer(model_path)
+        self.tokenization = TokenizationService(self.tokenizer, max_workers=num_tokenizer_workers)
         # build backend engine
         if backend == 'turbomind':
             self._build_turbomind(model_path=model_path, backend_config=backend_config, **kwargs)
@@ -289,6 +309,8 @@ class AsyncEngine(LogitsMixin):
         self.id2step = {}
         self.id2inst = {}
         self.free_insts: asyncio.Queue = None
+        # number of the requests waiting for a free instance
+        self.num_waiting_insts = 0
         self.instances = [self.engine.create_instance() for _ in range(self.instance_num)]
         self._session_id = count(0)
         self.request_logger = RequestLogger(max_log_len)
@@ -297,6 +319,34 @@ class AsyncEngine(LogitsMixin):
 
     def close(self):
         self.internal_thread.close()
+        self.tokenization.close()
+
+    def get_schedule_stats(self) -> Dict[str, Optional[int]]:
+        """get the queue depth of the server and free cache blocks of the
+        engine, None if the engine does not report it."""
+        stats = dict(num_waiting=self.num_waiting_insts,
+                     num_running=len(self.id2inst),
+                     num_free_gpu_blocks=None,
+                     num_gpu_blocks=None)
+        get_schedule_stats = getattr(self.engine, 'get_schedule_stats', None)
+        if get_schedule_stats is not None:
+            engine_stats = get_schedule_stats()
+            # requests of the instances are waiting or running in the engine
+            stats.update(num_waiting=stats['num_waiting'] + engine_stats.num_waiting,
+                         num_running=engine_stats.num_running,
+                         num_free_gpu_blocks=engine_stats.num_free_gpu_blocks,
+                         num_gpu_blocks=engine_stats.num_gpu_blocks)
+        return stats
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """get the metrics of the server and the engine, the engine metrics
+        are only reported by the pytorch engine."""
+        stats = self.get_schedule_stats()
+        metrics = dict(num_requests_waiting_instance=self.num_waiting_insts, num_requests_running=stats['num_running'])
+        get_metrics = getattr(self.engine, 'get_metrics', None)
+        if get_metrics is not None:
+            metrics.update(get_metrics())
+        return metrics
 
     def _get_free_insts(self):
         if self.free_insts is None:
@@ -384,6 +434,52 @@ class AsyncEngine(LogitsMixin):
         finally:
             self._get_free_insts().put_nowait(inst)
 
+    async def async_load_adapter(self, adapter_name: str, adapter_path: str):
+        """Load a lora adapter at runtime, only supported by the pytorch
+        backend with `max_lora_slots` set.
+
+        Args:
+            adapter_name (str): The name used by the requests.
+            adapter_path (str): The local path or model id of the adapter.
+        """
+        if not isinstance(self.backend_config, PytorchEngineConfig):
+            raise RuntimeError('Loading adapters at runtime is only supported by the pytorch backend.')
+        if adapter_name == self.model_name:
+            raise RuntimeError(f'Adapter name <{adapter_name}> conflicts with the model name.')
+        inst = await self._get_free_insts().get()
+        try:
+            await inst.async_load_adapter(adapter_name, adapter_path)
+        finally:
+            self._get_free_insts().put_nowait(inst)
+        adapters = dict(self.backend_config.adapters or dict())
+        adapters[adapter_name] = adapter_path
+        self.backend_config.adapters = adapters
+
+    async def async_unload_adapter(self, adapter_name: str):
+        """Unload a lora adapter that is not used by any session.
+
+        Args:
+            adapter_name (str): The adapter name.
+        """
+        if not isinstance(self.backend_config, PytorchEngineConfig):
+            raise RuntimeError('Unloading adapters at runtime is only supported by the pytorch backend.')
+        inst = await self._get_free_insts().get()
+        try:
+            await inst.async_unload_adapter(adapter_name)
+        finally:
+            self._get_free_insts().put_nowait(inst)
+        adapters = dict(self.backend_config.adapters or dict())
+        adapters.pop(adapter_name, None)
+        self.backend_config.adapters = adapters
+
+    def load_adapter(self, adapter_name: str, adapter_path: str):
+        """Load a lora adapter at runtime, see `async_load_adapter`."""
+        return self._run(coro=self.async_load_adapter(adapter_name, adapter_path)).result()
+
+    def unload_adapter(self, adapter_name: str):
+        """Unload a lora adapter at runtime, see `async_unload_adapter`."""
+        return self._run(coro=self.async_unload_adapter(adapter_name)).result()
+
     def _get_limiter(self):
         if not self.limiter:
             self.limiter = asyncio.Semaphore(self.instance_num)
@@ -455,6 +551,10 @@ class AsyncEngine(LogitsMixin):
 
         def requests():
             for prompt, gen_cfg in zip(prompts, gen_config):
+                if gen_cfg.n > 1:
+                    # responses of choices are not separated by the pipeline
+                    logger.warning(f'n({gen_cfg.n}) > 1 is only supported by api server. Fallback to 1')
+                    gen_cfg = dataclasses.replace(gen_cfg, n=1)
                 r = dict(messages=prompt,
                          gen_config=gen_cfg,
                          do_preprocess=do_preprocess,
@@ -547,12 +647,12 @@ class AsyncEngine(LogitsMixin):
             chat_template = self.chat_template
             if adapter_name in MODELS.module_dict:
                 chat_template = MODELS.module_dict[adapter_name]()
-            prompt = chat_template.messages2prompt(prompt, sequence_start, tools=tools)
+            prompt = await self.tokenization.run(chat_template.messages2prompt, prompt, sequence_start, tools=tools)
         if prompt is None:
             raise ValueError(
                 f'You are using base template to handle chat task. Please specify a `--chat-template` name chosen from `lmdeploy list` if you want to use OpenAI messages input.'  # noqa
             )
-        input_ids = self.tokenizer.encode(prompt, add_bos=sequence_start)
+        input_ids = await self.tokenization.encode(prompt, add_bos=sequence_start)
         return {'prompt': prompt, 'input_ids': input_ids}
 
     @asynccontextmanager
@@ -560,7 +660,11 @@ class AsyncEngine(LogitsMixin):
         """A context manager to make sure server's safe running."""
         assert session_id not in self.id2inst
         free_insts = self._get_free_insts()
-        inst = await free_insts.get()
+        self.num_waiting_insts += 1
+        try:
+            inst = await free_insts.get()
+        finally:
+            self.num_waiting_insts -= 1
         inst._active = asyncio.Event()
         self.id2inst[session_id] = inst
         try:
@@ -597,6 +701,7 @@ class AsyncEngine(LogitsMixin):
             skip_stop_tokens: bool = True,
             rewind_stop_tokens: bool = False,
             input_ids: Optional[List] = None,
+            priority: int = 0,
             **kwargs):
         """Generate responses.
 
@@ -611,9 +716,12 @@ class AsyncEngine(LogitsMixin):
             step (int): the offset of the k/v cache
             do_preprocess (bool): whether pre-process the messages. Default to
                 True, which means chat_template will be applied.
+            priority (int): the request priority for pytorch backend, lower
+                value means higher priority. Default to 0.
         """
         if (messages is not None) ^ (input_ids is None):
             raise ValueError('You must specify exactly one of messages or input_ids')
+        timeline = RequestTimeline(request_time=time.time())
         if session_id not in self.id2step:
             self.id2step[session_id] = 0
         if step != 0:
@@ -639,9 +747,9 @@ class AsyncEngine(LogitsMixin):
         # set random if it is not set and sequence_start is True
         elif gen_config.random_seed is None and sequence_start:
             gen_config.random_seed = random.getrandbits(64)
-        if gen_config.n > 1:
-            logger.ERROR(f"n({gen_config.n}) > 1 hasn't been supported yet. "
-                         f'Fallback to 1')
+        if gen_config.n > 1 and (self.backend != 'pytorch' or not (sequence_start and sequence_end)):
+            logger.warning(f'n({gen_config.n}) > 1 is only supported by pytorch backend '
+                           'without interactive mode. Fallback to 1')
             gen_config.n = 1
         if messages:
             prompt = messages
@@ -668,6 +776,7 @@ class AsyncEngine(LogitsMixin):
             # TODO(lvhan) VLM doesn't support input_ids as an argument.
             # Figure out a graceful way to handle the invalid input
             prompt_input = dict(input_ids=input_ids)
+        timeline.tokenized_time = time.time()
         if gen_config.max_new_tokens is None:
             # for interactive endpoint, will try maximum possible token num
             gen_config.max_new_tokens = max(128, self.session_len - self.id2step[session_id] - len(input_ids))
@@ -692,87 +801,106 @@ class AsyncEngine(LogitsMixin):
                 stop_ids.append(self.tokenizer.eos_token_id)
 
         async with self.model_inst(session_id) as inst:
-            token_ids = input_ids.copy()
+            timeline.instance_time = time.time()
             history_len = self.id2step[session_id]
             input_len = len(input_ids)
-            output_len, gen_len = 0, 0
-            state = DetokenizeState(len(input_ids))
-            start_ids_offset = state.ids_offset
-            response = ''
+            output_len = 0
+            choices = [_ChoiceState(input_ids.copy(), DetokenizeState(input_len)) for _ in range(gen_config.n)]
+            start_ids_offset = choices[0].state.ids_offset
             finish_reason = None
             async with self.safe_run(inst,
                                      session_id=session_id,
                                      **prompt_input,
                                      gen_config=gen_config,
                                      adapter_name=adapter_name,
+                                     priority=priority,
                                      stream_output=stream_response,
                                      sequence_start=sequence_start,
                                      sequence_end=sequence_end,
                                      step=history_len) as gen:
-                prev_len = 0
-                hit_stop_token = 0
                 async for outputs in gen:
                     # decode res
                     if is_error(outputs.status):
                         break
+                    if outputs.timeline is not None:
+                        timeline.update(**outputs.timeline)
 
+                    choice = choices[outputs.index]
                     output_len = outputs.num_token
 
-                    if hit_stop_token or prev_len == output_len:
+                    if choice.hit_stop_token or choice.prev_len == output_len:
                         continue
 
                     # This assumes the engine will stop when stop token is hit
                     if output_len and outputs.token_ids[-1] in stop_ids:
-                        hit_stop_token = 1
+                        choice.hit_stop_token = 1
                         # one token and it's been skipped
-                        if output_len == prev_len + 1:
+                        if output_len == choice.prev_len + 1:
                             continue
 
-                    mask = slice(prev_len - output_len, output_len - hit_stop_token)
+                    mask = slice(choice.prev_len - output_len, output_len - choice.hit_stop_token)
 
-                    token_ids += outputs.token_ids[mask]
-                    gen_len = len(token_ids) - input_len
+                    choice.token_ids += outputs.token_ids[mask]
+                    choice.gen_len = len(choice.token_ids) - input_len
 
-                    prev_len = output_len
+                    choice.prev_len = output_len
 
-                    ids_offset = state.ids_offset
-                    response, state = self.tokenizer.detokenize_incrementally(
-                        token_ids,
-                        state,
+                    ids_offset = choice.state.ids_offset
+                    start = time.perf_counter()
+                    choice.response, choice.state = self.tokenizer.detokenize_incrementally(
+                        choice.token_ids,
+                        choice.state,
                         skip_special_tokens=gen_config.skip_special_tokens,
                         spaces_between_special_tokens=gen_config.spaces_between_special_tokens)
-                    res = token_ids[ids_offset:]
+                    timeline.detokenize_time += time.perf_counter() - start
+                    res = choice.token_ids[ids_offset:]
 
-                    out = GenOut(response, history_len, input_len, gen_len, finish_reason, res)
+                    out = GenOut(choice.response,
+                                 history_len,
+                                 input_len,
+                                 choice.gen_len,
+                                 finish_reason,
+                                 res,
+                                 index=outputs.index)
 
                     if outputs.logprobs is not None:
                         log_offset = ids_offset - start_ids_offset
                         out.logprobs = outputs.logprobs[log_offset:]
                     if outputs.last_hidden_state is not None:
                         out.last_hidden_state = outputs.last_hidden_state
-                        if hit_stop_token:
+                        if choice.hit_stop_token:
                             out.last_hidden_state = \
-                                out.last_hidden_state[:-hit_stop_token]
+                                out.last_hidden_state[:-choice.hit_stop_token]
                     if outputs.logits is not None:
                         out.logits = outputs.logits
-                        if hit_stop_token:
-                            out.logits = out.logits[:-hit_stop_token]
+                        if choice.hit_stop_token:
+                            out.logits = out.logits[:-choice.hit_stop_token]
 
                     yield out
                 # end of generator loop
+                timeline.end_time = time.time()
+                self.request_logger.log_timeline(session_id, timeline)
 
                 if not is_error(outputs.status):
-                    finish_reason = 'length' \
-                        if gen_len >= gen_config.max_new_tokens else 'stop'
-                    # utf-8 char at the end means it's a potential unfinished
-                    # byte sequence
-                    if not response.endswith('�'):
-                        # avoid returning the last response twice
-                        response = ''
-                    logger.info(f'session {session_id} finished, reason '
-                                f'"{finish_reason}", input_tokens '
-                                f'{len(input_ids)}, outupt_tokens {gen_len}')
-                    yield GenOut(response, self.id2step[session_id], len(input_ids), gen_len, finish_reason)
+                    for index, choice in enumerate(choices):
+                        finish_reason = 'length' \
+                            if choice.gen_len >= gen_config.max_new_tokens else 'stop'
+                        # utf-8 char at the end means it's a potential unfinished
+                        # byte sequence
+                        response = choice.response
+                        if not response.endswith('�'):
+                            # avoid returning the last response twice
+                            response = ''
+                        logger.info(f'session {session_id} finished, reason '
+                                    f'"{finish_reason}", input_tokens '
+                                    f'{len(input_ids)}, outupt_tokens {choice.gen_len}')
+                        yield GenOut(response,
+                                     self.id2step[session_id],
+                                     len(input_ids),
+                                     choice.gen_len,
+                                     finish_reason,
+                                     index=index,
+                                     timeline=timeline)
                 else:
                     logger.error(f'session {session_id} finished, '
                                  'reason "error"')
@@ -781,7 +909,8 @@ class AsyncEngine(LogitsMixin):
                                  input_token_len=len(input_ids),
                                  generate_token_len=0,
                                  finish_reason='error',
-                                 token_ids=[])
+                                 token_ids=[],
+                                 timeline=timeline)
             # update step
             if sequence_end:
                 self.id2step[session_id] = 0
@@ -791,7 +920,7 @@ class AsyncEngine(LogitsMixin):
             else:
                 if rewind_stop_tokens:
                     # rewind the step to the token before the stop token
-                    output_len = gen_len
+                    output_len = choices[0].gen_len
                 self.id2step[session_id] += input_len + output_len
 
     def parse_tool_response(self, text, tools, **kwargs):
@@ -0,0 +1,90 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import math
+from typing import Any, Dict, List
+
+METRIC_PREFIX = 'lmdeploy_'
+
+# metric name -> (type, help)
+METRIC_INFOS = {
+    'time_to_first_token_seconds': ('histogram', 'Time from the request to its first token.'),
+    'inter_token_latency_seconds': ('histogram', 'Time between the generated tokens of a request.'),
+    'queue_time_seconds': ('histogram', 'Time from the request to its first prefill.'),
+    'prefill_batch_size': ('histogram', 'Number of the sequences of a prefill step.'),
+    'decode_batch_size': ('histogram', 'Number of the sequences of a decoding step.'),
+    'step_tokens': ('histogram', 'Number of the input tokens of a step.'),
+    'schedule_time_seconds': ('histogram', 'Time of scheduling a step.'),
+    'host_time_seconds': ('histogram', 'Host time of scheduling and preparing the inputs of a step.'),
+    'generation_tokens_total': ('counter', 'Number of the generated tokens.'),
+    'finished_requests_total': ('counter', 'Number of the finished requests.'),
+    'steps_total': ('counter', 'Number of the engine steps.'),
+    'pipelined_steps_total': ('counter', 'Number of the steps prepared during the previous forward.'),
+    'num_requests_waiting': ('gauge', 'Number of the requests waiting to be scheduled.'),
+    'num_requests_running': ('gauge', 'Number of the requests being decoded.'),
+    'num_requests_waiting_instance': ('gauge', 'Number of the requests of the server waiting for an instance.'),
+    'gpu_blocks_free': ('gauge', 'Number of the free kv cache blocks on device.'),
+    'gpu_blocks_used': ('gauge', 'Number of the used kv cache blocks on device.'),
+    'cpu_blocks_free': ('gauge', 'Number of the free kv cache blocks on host.'),
+    'cpu_blocks_used': ('gauge', 'Number of the used kv cache blocks on host.'),
+    'prefix_cache_query_blocks_total': ('counter', 'Number of the blocks looked up in the prefix cache.'),
+    'prefix_cache_hit_blocks_total': ('counter', 'Number of the blocks found in the prefix cache.'),
+    'prefix_cache_hit_rate': ('gauge', 'Ratio of the blocks found in the prefix cache.'),
+    'prefix_cache_evicted_blocks_total': ('counter', 'Number of the blocks evicted from the prefix cache.'),
+    'evicted_sequences_total': ('counter', 'Number of the sequences evicted to be recomputed.'),
+    'spec_decode_draft_tokens_total': ('counter', 'Number of the proposed draft tokens.'),
+    'spec_decode_accepted_tokens_total': ('counter', 'Number of the accepted draft tokens.'),
+    'spec_decode_emitted_tokens_total': ('counter', 'Number of the tokens generated by speculative decoding.'),
+    'cuda_graph_hits_total': ('counter', 'Number of the forwards replaying a captured cuda graph.'),
+    'cuda_graph_misses_total': ('counter', 'Number of the forwards capturing a new cuda graph.'),
+    'eager_forwards_total': ('counter', 'Number of the forwards without cuda graph.'),
+}
+
+
+def _format_value(value: float) -> str:
+    """format a sample value."""
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _is_histogram(value: Any) -> bool:
+    """whether the value is a `Histogram` of the engine, which is not
+    imported to keep the pytorch engine optional."""
+    return hasattr(value, 'buckets') and hasattr(value, 'cumulative_counts')
+
+
+def _format_histogram(name: str, hist: Any, labels: str) -> List[str]:
+    """format the samples of a histogram."""
+    lines = []
+    bounds = list(hist.buckets) + [float('inf')]
+    sep = ',' if labels else ''
+    for bound, count in zip(bounds, hist.cumulative_counts()):
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{_format_value(float(bound))}"}} {count}')
+    labels = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{labels} {_format_value(float(hist.sum))}')
+    lines.append(f'{name}_count{labels} {hist.count}')
+    return lines
+
+
+def render_metrics(metrics: Dict[str, Any], labels: Dict[str, str] = None) -> str:
+    """render the metrics in the text format of Prometheus.
+
+    Args:
+        metrics (Dict[str, Any]): metric name -> a number or a `Histogram`.
+        labels (Dict[str, str]): labels of all the samples, such as the
+            model name.
+    """
+    labels = ','.join(f'{key}="{value}"' for key, value in (labels or dict()).items())
+    lines = []
+    for key, value in metrics.items():
+        if value is None:
+            continue
+        metric_type, help = METRIC_INFOS.get(key, ('gauge', key))
+        name = METRIC_PREFIX + key
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if _is_histogram(value):
+            lines.extend(_format_histogram(name, value, labels))
+        else:
+            sample_labels = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}{sample_labels} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
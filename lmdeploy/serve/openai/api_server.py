@@ -1,7 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # yapf: disable
 import asyncio
-import copy
 import os
 import time
 from functools import partial
@@ -19,15 +18,17 @@ from lmdeploy.archs import get_task
 from lmdeploy.messages import GenerationConfig, LogitsProcessor, PytorchEngineConfig, TurbomindEngineConfig
 from lmdeploy.model import ChatTemplateConfig
 from lmdeploy.serve.async_engine import AsyncEngine
+from lmdeploy.serve.metrics import render_metrics
 from lmdeploy.serve.openai.protocol import ChatCompletionResponse  # noqa: E501
 from lmdeploy.serve.openai.protocol import (ChatCompletionRequest, ChatCompletionResponseChoice,
                                             ChatCompletionResponseStreamChoice, ChatCompletionStreamResponse,
                                             ChatCompletionTokenLogprob, ChatMessage, ChoiceLogprobs, CompletionRequest,
                                             CompletionResponse, CompletionResponseChoice,
                                             CompletionResponseStreamChoice, CompletionStreamResponse, DeltaMessage,
-                                            EmbeddingsRequest, EncodeRequest, EncodeResponse, ErrorResponse,
-                                            FunctionResponse, GenerateRequest, GenerateResponse, LogProbs, ModelCard,
-                                            ModelList, ModelPermission, ToolCall, TopLogprob, UsageInfo)
+                                            EmbeddingsRequest, EncodeRequest, EncodeResponse, EngineStatsResponse,
+                                            ErrorResponse, FunctionResponse, GenerateRequest, GenerateResponse,
+                                            LoadAdapterRequest, LogProbs, ModelCard, ModelList, ModelPermission,
+                                            ToolCall, TopLogprob, UnloadAdapterRequest, UsageInfo)
 from lmdeploy.tokenizer import DetokenizeState, Tokenizer
 from lmdeploy.utils import get_logger
 
@@ -164,14 +165,19 @@ def _create_completion_logprobs(tokenizer: Tokenizer,
 
         res = {}
         out_state = None
-        for top_id, prob in tops.items():
-            response, _state = tokenizer.detokenize_incrementally(
-                all_token_ids + [top_id],
-                copy.deepcopy(state),
-                skip_special_tokens=skip_special_tokens,
-                spaces_between_special_tokens=spaces_between_special_tokens)
-            res[response] = prob
+        # the candidates are decoded in a batch from the window of the state,
+        # the state is relative to the new token
+        ids_offset, prev_tokens, prefix_offset, read_offset = state.as_tuple()
+        top_ids = list(tops.keys())
+        responses, states = tokenizer.batch_detokenize_incrementally(
+            [[top_id] for top_id in top_ids],
+            [DetokenizeState(0, prev_tokens, prefix_offset, read_offset) for _ in top_ids],
+            skip_special_tokens=skip_special_tokens,
+            spaces_between_special_tokens=spaces_between_special_tokens)
+        for top_id, response, _state in zip(top_ids, responses, states):
+            res[response] = tops[top_id]
             if top_id == token_id:
+                _state.ids_offset = ids_offset + 1
                 out_state = _state
                 offset += len(response)
                 out_logprobs.tokens.append(response)
@@ -225,6 +231,29 @@ async def health() -> Response:
     return Response(status_code=200)
 
 
+@router.get('/engine/stats')
+async def engine_stats() -> EngineStatsResponse:
+    """Queue depth and free cache blocks of the engine, polled by the proxy
+    server.
+
+    - num_waiting (int): requests waiting to be scheduled.
+    - num_running (int): requests being decoded.
+    - num_free_gpu_blocks (int | None): free kv cache blocks, only reported
+        by the pytorch engine.
+    - num_gpu_blocks (int | None): all the kv cache blocks.
+    """
+    return EngineStatsResponse(**VariableInterface.async_engine.get_schedule_stats())
+
+
+@router.get('/metrics')
+async def metrics() -> Response:
+    """Metrics of the server and the engine in the text format of
+    Prometheus."""
+    async_engine = VariableInterface.async_engine
+    content = render_metrics(async_engine.get_metrics(), labels=dict(model_name=async_engine.model_name))
+    return Response(content=content, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # modified from https://github.com/vllm-project/vllm/blob/v0.5.4/vllm/entrypoints/openai/logits_processors.py#L51  # noqa
 def logit_bias_logits_processor(logit_bias: Union[Dict[int, float], Dict[str, float]], tokenizer) -> LogitsProcessor:
     try:
@@ -272,7 +301,7 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
         probable tokens with probabilities that add up to top_p or higher
         are kept for generation.
     - n (int): How many chat completion choices to generate for each input
-        message. **Only support one here**.
+        message. Only pytorch backend supports `n > 1`.
     - stream: whether to stream the results or not. Default to false.
     - stream_options: Options for streaming response. Only set this when you
         set stream: true.
@@ -357,6 +386,7 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
 
     gen_config = GenerationConfig(max_new_tokens=request.max_tokens,
                                   do_sample=True,
+                                  n=request.n,
                                   logprobs=gen_logprobs,
                                   top_k=request.top_k,
                                   top_p=request.top_p,
@@ -396,6 +426,7 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
         sequence_end=True,
         do_preprocess=not isinstance(request.messages, str),  # text completion for string input
         adapter_name=adapter_name,
+        priority=request.priority,
     )
 
     def create_stream_response_json(index: int,
@@ -431,7 +462,10 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
                     completion_tokens=res.generate_token_len,
                     total_tokens=total_tokens,
                 )
-            response_json = create_stream_response_json(index=0,
+            if request.return_timeline and res.timeline is not None:
+                usage = usage or UsageInfo()
+                usage.timeline = res.timeline.to_dict()
+            response_json = create_stream_response_json(index=res.index,
                                                         text=res.response,
                                                         finish_reason=res.finish_reason,
                                                         logprobs=logprobs,
@@ -444,58 +478,67 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
         return StreamingResponse(completion_stream_generator(), media_type='text/event-stream')
 
     # Non-streaming response
-    final_logprobs = []
-    final_token_ids = []
-    final_res = None
-    text = ''
+    num_choices = gen_config.n
+    final_logprobs = [[] for _ in range(num_choices)]
+    final_token_ids = [[] for _ in range(num_choices)]
+    final_res = [None] * num_choices
+    texts = [''] * num_choices
     async for res in result_generator:
         if await raw_request.is_disconnected():
             # Abort the request if the client disconnects.
             await VariableInterface.async_engine.stop_session(request.session_id)
             return create_error_response(HTTPStatus.BAD_REQUEST, 'Client disconnected')
-        final_res = res
-        text += res.response
+        index = res.index
+        final_res[index] = res
+        texts[index] += res.response
         if res.token_ids:
-            final_token_ids.extend(res.token_ids)
+            final_token_ids[index].extend(res.token_ids)
         if res.logprobs:
-            final_logprobs.extend(res.logprobs)
-
-    tool_calls = None
-    if request.tool_choice != 'none' and ('<|plugin|>' in text or '<function=' in text or '<tool_call>' in text):
-        if final_res.finish_reason == 'stop':
-            final_res.finish_reason = 'tool_calls'
-        try:  # TODO add json_schema guidance to turbomind
-            text, call_info_list = VariableInterface.async_engine.parse_tool_response(  # noqa
-                text, request.tools)
-            tool_calls = [
-                ToolCall(id=str(call_info[0]), function=FunctionResponse(name=call_info[1], arguments=call_info[2]))
-                for call_info in call_info_list
-            ]
-        except Exception as e:
-            logger.error(f'Failed to parse {text}. Exception: {e}.')
-            return create_error_response(HTTPStatus.BAD_REQUEST, 'Failed to parse fc related info to json format!')
+            final_logprobs[index].extend(res.logprobs)
 
-    logprobs = None
-    if gen_logprobs and len(final_logprobs):
-        logprobs = _create_chat_completion_logprobs(VariableInterface.async_engine.tokenizer, final_token_ids,
-                                                    final_logprobs)
-
-    assert final_res is not None
+    assert final_res[0] is not None
+    # only the first choice is returned on error
+    num_choices = sum(res is not None for res in final_res)
     choices = []
-    choice_data = ChatCompletionResponseChoice(
-        index=0,
-        message=ChatMessage(role='assistant', content=text, tool_calls=tool_calls),
-        logprobs=logprobs,
-        finish_reason=final_res.finish_reason,
-    )
-    choices.append(choice_data)
+    for index in range(num_choices):
+        text = texts[index]
+        tool_calls = None
+        if request.tool_choice != 'none' and ('<|plugin|>' in text or '<function=' in text or '<tool_call>' in text):
+            if final_res[index].finish_reason == 'stop':
+                final_res[index].finish_reason = 'tool_calls'
+            try:  # TODO add json_schema guidance to turbomind
+                text, call_info_list = VariableInterface.async_engine.parse_tool_response(  # noqa
+                    text, request.tools)
+                tool_calls = [
+                    ToolCall(id=str(call_info[0]), function=FunctionResponse(name=call_info[1], arguments=call_info[2]))
+                    for call_info in call_info_list
+                ]
+            except Exception as e:
+                logger.error(f'Failed to parse {text}. Exception: {e}.')
+                return create_error_response(HTTPStatus.BAD_REQUEST, 'Failed to parse fc related info to json format!')
+
+        logprobs = None
+        if gen_logprobs and len(final_logprobs[index]):
+            logprobs = _create_chat_completion_logprobs(VariableInterface.async_engine.tokenizer,
+                                                        final_token_ids[index], final_logprobs[index])
+
+        choice_data = ChatCompletionResponseChoice(
+            index=index,
+            message=ChatMessage(role='assistant', content=text, tool_calls=tool_calls),
+            logprobs=logprobs,
+            finish_reason=final_res[index].finish_reason,
+        )
+        choices.append(choice_data)
 
-    total_tokens = sum([final_res.history_token_len, final_res.input_token_len, final_res.generate_token_len])
+    prompt_tokens = final_res[0].input_token_len
+    completion_tokens = sum(res.generate_token_len for res in final_res[:num_choices])
     usage = UsageInfo(
-        prompt_tokens=final_res.input_token_len,
-        completion_tokens=final_res.generate_token_len,
-        total_tokens=total_tokens,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=final_res[0].history_token_len + prompt_tokens + completion_tokens,
     )
+    if request.return_timeline and final_res[0].timeline is not None:
+        usage.timeline = final_res[0].timeline.to_dict()
     response = ChatCompletionResponse(
         id=request_id,
         created=created_time,
@@ -524,7 +567,7 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
         probable tokens with probabilities that add up to top_p or higher
         are kept for generation.
     - n (int): How many chat completion choices to generate for each input
-        message. **Only support one here**.
+        message. Only pytorch backend supports `n > 1`.
     - stream: whether to stream the results or not. Default to false.
     - stream_options: Options for streaming response. Only set this when you
         set stream: true.
@@ -572,6 +615,7 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
 
     gen_config = GenerationConfig(max_new_tokens=request.max_tokens if request.max_tokens else 512,
                                   do_sample=True,
+                                  n=request.n,
                                   logprobs=request.logprobs,
                                   top_k=request.top_k,
                                   top_p=request.top_p,
@@ -592,7 +636,8 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
             sequence_start=True,
             sequence_end=True,
             do_preprocess=False,
-            adapter_name=adapter_name)
+            adapter_name=adapter_name,
+            priority=request.priority)
         generators.append(result_generator)
 
     def create_stream_response_json(index: int,
@@ -617,18 +662,20 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
 
     async def completion_stream_generator() -> AsyncGenerator[str, None]:
         # First chunk with role
-        for generator in generators:
-            offset = 0
-            all_token_ids = []
-            state = DetokenizeState()
+        for i, generator in enumerate(generators):
+            offsets = [0] * gen_config.n
+            all_token_ids = [[] for _ in range(gen_config.n)]
+            states = [DetokenizeState() for _ in range(gen_config.n)]
             async for res in generator:
                 logprobs = None
                 usage = None
+                index = res.index
                 if request.logprobs and res.logprobs:
-                    logprobs, offset, all_token_ids, state = _create_completion_logprobs(  # noqa E501
-                        VariableInterface.async_engine.tokenizer, res.token_ids, res.logprobs,
-                        gen_config.skip_special_tokens, offset, all_token_ids, state,
-                        gen_config.spaces_between_special_tokens)
+                    logprobs, offsets[index], all_token_ids[index], states[
+                        index] = _create_completion_logprobs(  # noqa E501
+                            VariableInterface.async_engine.tokenizer, res.token_ids, res.logprobs,
+                            gen_config.skip_special_tokens, offsets[index], all_token_ids[index], states[index],
+                            gen_config.spaces_between_special_tokens)
                 if request.stream_options and request.stream_options.include_usage:  # noqa E501
                     final_res = res
                     total_tokens = sum(
@@ -638,7 +685,10 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
                         completion_tokens=final_res.generate_token_len,
                         total_tokens=total_tokens,
                     )
-                response_json = create_stream_response_json(index=0,
+                if request.return_timeline and res.timeline is not None:
+                    usage = usage or UsageInfo()
+                    usage.timeline = res.timeline.to_dict()
+                response_json = create_stream_response_json(index=i * gen_config.n + index,
                                                             text=res.response,
                                                             finish_reason=res.finish_reason,
                                                             logprobs=logprobs,
@@ -652,49 +702,58 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
 
     # Non-streaming response
     usage = UsageInfo()
-    choices = [None] * len(generators)
+    num_choices = gen_config.n
+    choices = [None] * (len(generators) * num_choices)
 
     async def _inner_call(i, generator):
-        final_logprobs = []
-        final_token_ids = []
-        final_res = None
-        text = ''
+        final_logprobs = [[] for _ in range(num_choices)]
+        final_token_ids = [[] for _ in range(num_choices)]
+        final_res = [None] * num_choices
+        texts = [''] * num_choices
         async for res in generator:
             if await raw_request.is_disconnected():
                 # Abort the request if the client disconnects.
                 await VariableInterface.async_engine.stop_session(request.session_id)
                 return create_error_response(HTTPStatus.BAD_REQUEST, 'Client disconnected')
-            final_res = res
-            text += res.response
+            index = res.index
+            final_res[index] = res
+            texts[index] += res.response
             if res.token_ids:
-                final_token_ids.extend(res.token_ids)
+                final_token_ids[index].extend(res.token_ids)
             if res.logprobs:
-                final_logprobs.extend(res.logprobs)
-
-        logprobs = None
-        if request.logprobs and len(final_logprobs):
-            logprobs, _, _, _ = _create_completion_logprobs(
-                VariableInterface.async_engine.tokenizer,
-                final_token_ids,
-                final_logprobs,
-                gen_config.skip_special_tokens,
-                spaces_between_special_tokens=gen_config.spaces_between_special_tokens)
-
-        assert final_res is not None
-        choice_data = CompletionResponseChoice(
-            index=i,
-            text=text,
-            finish_reason=final_res.finish_reason,
-            logprobs=logprobs,
-        )
-        choices[i] = choice_data
+                final_logprobs[index].extend(res.logprobs)
+
+        assert final_res[0] is not None
+        if request.return_timeline and final_res[0].timeline is not None and len(generators) == 1:
+            usage.timeline = final_res[0].timeline.to_dict()
+        usage.prompt_tokens += final_res[0].input_token_len
+        usage.total_tokens += final_res[0].history_token_len + final_res[0].input_token_len
+        for index in range(num_choices):
+            if final_res[index] is None:
+                # only the first choice is returned on error
+                break
+            logprobs = None
+            if request.logprobs and len(final_logprobs[index]):
+                logprobs, _, _, _ = _create_completion_logprobs(
+                    VariableInterface.async_engine.tokenizer,
+                    final_token_ids[index],
+                    final_logprobs[index],
+                    gen_config.skip_special_tokens,
+                    spaces_between_special_tokens=gen_config.spaces_between_special_tokens)
+
+            choice_data = CompletionResponseChoice(
+                index=i * num_choices + index,
+                text=texts[index],
+                finish_reason=final_res[index].finish_reason,
+                logprobs=logprobs,
+            )
+            choices[i * num_choices + index] = choice_data
 
-        total_tokens = sum([final_res.history_token_len, final_res.input_token_len, final_res.generate_token_len])
-        usage.prompt_tokens += final_res.input_token_len
-        usage.completion_tokens += final_res.generate_token_len
-        usage.total_tokens += total_tokens
+            usage.completion_tokens += final_res[index].generate_token_len
+            usage.total_tokens += final_res[index].generate_token_len
 
     await asyncio.gather(*[_inner_call(i, generators[i]) for i in range(len(generators))])
+    choices = [choice for choice in choices if choice is not None]
 
     response = CompletionResponse(
         id=request_id,
@@ -713,6 +772,36 @@ async def create_embeddings(request: EmbeddingsRequest, raw_request: Request = N
     return create_error_response(HTTPStatus.BAD_REQUEST, 'Unsupported by turbomind.')
 
 
+@router.post('/adapters/load', dependencies=[Depends(check_api_key)])
+async def load_adapter(request: LoadAdapterRequest):
+    """Load a lora adapter at runtime, it is served as a model named
+    `adapter_name`. Requires the pytorch backend with `--max-lora-slots`.
+
+    - adapter_name (str): the name used by the requests.
+    - adapter_path (str): the local path or model id of the adapter.
+    """
+    try:
+        await VariableInterface.async_engine.async_load_adapter(request.adapter_name, request.adapter_path)
+    except Exception as e:
+        return create_error_response(HTTPStatus.BAD_REQUEST, str(e))
+    return Response(status_code=200)
+
+
+@router.post('/adapters/unload', dependencies=[Depends(check_api_key)])
+async def unload_adapter(request: UnloadAdapterRequest):
+    """Unload a lora adapter that is not used by any session.
+
+    - adapter_name (str): the adapter name.
+    """
+    if request.adapter_name not in get_model_list()[1:]:
+        return create_error_response(HTTPStatus.NOT_FOUND, f'The adapter `{request.adapter_name}` does not exist.')
+    try:
+        await VariableInterface.async_engine.async_unload_adapter(request.adapter_name)
+    except Exception as e:
+        return create_error_response(HTTPStatus.BAD_REQUEST, str(e))
+    return Response(status_code=200)
+
+
 @router.post('/v1/encode', dependencies=[Depends(check_api_key)])
 async def encode(request: EncodeRequest, raw_request: Request = None):
     """Encode prompts.
@@ -724,21 +813,21 @@ async def encode(request: EncodeRequest, raw_request: Request = None):
         is not. Default to True.
     """
 
-    def encode(prompt: str, do_preprocess: bool, add_bos: bool):
+    async_engine = VariableInterface.async_engine
+
+    async def encode(prompts: List[str], do_preprocess: bool, add_bos: bool):
         if do_preprocess:
-            prompt = VariableInterface.async_engine.chat_template.get_prompt(prompt, sequence_start=add_bos)
-        input_ids = VariableInterface.async_engine.tokenizer.encode(prompt, add_bos=add_bos)
-        return input_ids
+            chat_template = async_engine.chat_template
+            prompts = await async_engine.tokenization.run(
+                lambda: [chat_template.get_prompt(prompt, sequence_start=add_bos) for prompt in prompts])
+        return await async_engine.tokenization.batch_encode(prompts, add_bos=add_bos)
 
     if isinstance(request.input, str):
-        encoded = encode(request.input, request.do_preprocess, request.add_bos)
+        encoded = (await encode([request.input], request.do_preprocess, request.add_bos))[0]
         return EncodeResponse(input_ids=encoded, length=len(encoded))
     else:
-        encoded, length = [], []
-        for prompt in request.input:
-            ids = encode(prompt, request.do_preprocess, request.add_bos)
-            encoded.append(ids)
-            length.append(len(ids))
+        encoded = await encode(request.input, request.do_preprocess, request.add_bos)
+        length = [len(ids) for ids in encoded]
         return EncodeResponse(input_ids=encoded, length=length)
 
 
@@ -838,7 +927,8 @@ async def chat_interactive_v1(request: GenerateRequest, raw_request: Request = N
         stream_response=True,  # always use stream to enable batching
         sequence_start=sequence_start,
         sequence_end=sequence_end,
-        adapter_name=request.adapter_name)
+        adapter_name=request.adapter_name,
+        priority=request.priority)
 
     # Streaming case
     async def stream_results() -> AsyncGenerator[bytes, None]:
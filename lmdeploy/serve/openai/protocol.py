@@ -55,6 +55,8 @@ class UsageInfo(BaseModel):
     prompt_tokens: int = 0
     total_tokens: int = 0
     completion_tokens: Optional[int] = 0
+    # timeline of the request, returned if `return_timeline` is set
+    timeline: Optional[Dict[str, Any]] = None
 
 
 class Function(BaseModel):
@@ -136,6 +138,8 @@ class ChatCompletionRequest(BaseModel):
     seed: Optional[int] = None
     min_new_tokens: Optional[int] = Field(default=None, examples=[None])
     min_p: float = 0.0
+    priority: int = 0
+    return_timeline: Optional[bool] = False
 
 
 class FunctionResponse(BaseModel):
@@ -249,6 +253,8 @@ class CompletionRequest(BaseModel):
     spaces_between_special_tokens: Optional[bool] = True
     top_k: Optional[int] = 40  # for opencompass
     seed: Optional[int] = None
+    priority: int = 0
+    return_timeline: Optional[bool] = False
 
 
 class CompletionResponseChoice(BaseModel):
@@ -309,6 +315,25 @@ class EncodeRequest(BaseModel):
     add_bos: Optional[bool] = True
 
 
+class LoadAdapterRequest(BaseModel):
+    """Load lora adapter request."""
+    adapter_name: str
+    adapter_path: str
+
+
+class UnloadAdapterRequest(BaseModel):
+    """Unload lora adapter request."""
+    adapter_name: str
+
+
+class EngineStatsResponse(BaseModel):
+    """Queue depth and free cache blocks of the engine."""
+    num_waiting: int
+    num_running: int
+    num_free_gpu_blocks: Optional[int] = None
+    num_gpu_blocks: Optional[int] = None
+
+
 class EncodeResponse(BaseModel):
     """Encode response."""
     input_ids: Union[List[int], List[List[int]]]
@@ -335,6 +360,7 @@ class GenerateRequest(BaseModel):
     seed: Optional[int] = None
     min_new_tokens: Optional[int] = Field(default=None, examples=[None])
     min_p: float = 0.0
+    priority: int = 0
 
 
 class GenerateResponse(BaseModel):
@@ -0,0 +1,159 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import bisect
+import json
+import math
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+def get_prompt_text(request: Dict) -> str:
+    """get the text of the prompt of a chat or completion request, rounds of a
+    chat are concatenated in order."""
+    if 'messages' in request:
+        messages = request['messages']
+        if isinstance(messages, str):
+            return messages
+        texts = []
+        for message in messages:
+            content = message.get('content')
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+            texts.append(f'<{message.get("role")}>{content}')
+        return ''.join(texts)
+    prompt = request.get('prompt', '')
+    if isinstance(prompt, str):
+        return prompt
+    return json.dumps(prompt, ensure_ascii=False)
+
+
+class PrefixAffinity:
+    """Route the requests sharing a prompt prefix to the same node.
+
+    The prompt text is split into blocks, and each block is hashed together
+    with the blocks before it, like the `BlockTrie` of the engine. The proxy
+    remembers the node of the first and the last block of the routed
+    requests, so a new round of a chat, which extends the prompt of the last
+    round, goes to the node holding its history, and the requests sharing a
+    system prompt go to the same node.
+
+    Requests without a remembered prefix are routed by consistent hashing of
+    the session id or the first block. A node is saturated if its unfinished
+    requests exceed `load_factor` times its share of all the unfinished
+    requests, and the requests of saturated nodes fall back to the least
+    loaded node.
+
+    Args:
+        block_size (int): number of the characters of a block.
+        max_blocks (int): max number of the hashed blocks of a prompt.
+        num_virtual_nodes (int): number of the points of a node on the
+            hash ring.
+        load_factor (float): the bound of the load of a node relative to
+            the average load.
+        cache_size (int): max number of the remembered prefixes.
+    """
+
+    def __init__(self,
+                 block_size: int = 64,
+                 max_blocks: int = 256,
+                 num_virtual_nodes: int = 64,
+                 load_factor: float = 1.25,
+                 cache_size: int = 65536):
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.num_virtual_nodes = num_virtual_nodes
+        self.load_factor = load_factor
+        self.cache_size = cache_size
+        # prefix hash -> node url, in LRU order
+        self.prefixes: Dict[int, str] = OrderedDict()
+        self._ring_urls: Tuple[str, ...] = ()
+        self._ring: List[Tuple[int, str]] = []
+        self._ring_keys: List[int] = []
+
+    def get_keys(self, request: Dict) -> Tuple[List[int], int]:
+        """hashes of the prefixes of a request.
+
+        Return:
+            List[int]: the key of the session id if there is one, then the
+                keys of the full blocks from the longest prefix to the
+                shortest one.
+            int: the key to look up the hash ring, which is the key of the
+                session id or the first block.
+        """
+        text = get_prompt_text(request)
+        keys = []
+        key = None
+        # the incomplete last block will change in the next round of a chat
+        num_blocks = min(max(1, len(text) // self.block_size), self.max_blocks)
+        for idx in range(num_blocks):
+            block = text[idx * self.block_size:(idx + 1) * self.block_size]
+            key = hash((key, block))
+            keys.append(key)
+        keys.reverse()
+        ring_key = keys[-1]
+        session_id = request.get('session_id', -1)
+        if session_id is not None and session_id != -1:
+            ring_key = hash(('session', session_id))
+            keys.insert(0, ring_key)
+        return keys, ring_key
+
+    def _update_ring(self, urls: List[str]):
+        """rebuild the hash ring if the nodes changed."""
+        urls = tuple(sorted(urls))
+        if urls == self._ring_urls:
+            return
+        self._ring_urls = urls
+        self._ring = sorted((hash((url, idx)), url) for url in urls for idx in range(self.num_virtual_nodes))
+        self._ring_keys = [point for point, _ in self._ring]
+
+    def _ring_lookup(self, key: int) -> str:
+        """the first node after the key on the hash ring."""
+        idx = bisect.bisect(self._ring_keys, key) % len(self._ring)
+        return self._ring[idx][1]
+
+    def route(self, keys: List[int], ring_key: int, urls: List[str], unfinished: List[int],
+              speeds: List[float]) -> Tuple[Optional[str], bool]:
+        """choose a node for a request.
+
+        Args:
+            keys (List[int]): the prefix keys of the request.
+            ring_key (int): the key to look up the hash ring.
+            urls (List[str]): the candidate nodes.
+            unfinished (List[int]): the unfinished requests of the nodes.
+            speeds (List[float]): the speeds of the nodes.
+        Return:
+            str: the url of the node, None if there is no candidate.
+            bool: whether the node has served a prefix of the request.
+        """
+        if len(urls) == 0:
+            return None, False
+        self._update_ring(urls)
+        total_unfinished = sum(unfinished) + 1
+        speed_sum = sum(speeds)
+        loads = dict()
+        saturated = set()
+        for url, num, speed in zip(urls, unfinished, speeds):
+            loads[url] = num / speed
+            capacity = math.ceil(self.load_factor * total_unfinished * speed / speed_sum)
+            if num >= capacity:
+                saturated.add(url)
+
+        url = None
+        for key in keys:
+            url = self.prefixes.get(key)
+            if url in loads:
+                break
+            url = None
+        hit = url is not None
+        if url is None:
+            url = self._ring_lookup(ring_key)
+        if url in saturated:
+            url = min(urls, key=lambda url: loads[url])
+            hit = False
+        # the session, the longest and the shortest prefix
+        longest = keys[1] if keys[0] == ring_key and len(keys) > 1 else keys[0]
+        for key in set([ring_key, longest, keys[-1]]):
+            self.prefixes.pop(key, None)
+            self.prefixes[key] = url
+        while len(self.prefixes) > self.cache_size:
+            self.prefixes.popitem(last=False)
+        return url, hit
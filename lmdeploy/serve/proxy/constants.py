@@ -3,7 +3,14 @@
 import enum
 
 LATENCY_DEQUE_LEN = 15
+API_CONNECT_TIMEOUT = 5
 API_READ_TIMEOUT = 100
+MAX_CONNECTIONS_PER_NODE = 512
+CONNECTIONS_PER_CLIENT = 8
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_TIMEOUT = 2
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_RECOVERY_TIME = 30
 
 
 class Strategy(enum.Enum):
@@ -11,6 +18,7 @@ class Strategy(enum.Enum):
     RANDOM = enum.auto()
     MIN_EXPECTED_LATENCY = enum.auto()
     MIN_OBSERVED_LATENCY = enum.auto()
+    PREFIX_AFFINITY = enum.auto()
 
     @classmethod
     def from_str(cls, name):
@@ -21,9 +29,11 @@ class Strategy(enum.Enum):
             return cls.MIN_EXPECTED_LATENCY
         elif name == 'min_observed_latency':
             return cls.MIN_OBSERVED_LATENCY
+        elif name == 'prefix_affinity':
+            return cls.PREFIX_AFFINITY
         else:
             raise ValueError(f'Invalid strategy: {name}. Supported: random, '
-                             f'min_expected_latency, min_observed_latency.')
+                             f'min_expected_latency, min_observed_latency, prefix_affinity.')
 
 
 class ErrorCodes(enum.Enum):
@@ -31,10 +41,12 @@ class ErrorCodes(enum.Enum):
     MODEL_NOT_FOUND = 10400
     SERVICE_UNAVAILABLE = 10401
     API_TIMEOUT = 10402
+    SERVICE_OVERLOADED = 10403
 
 
 err_msg = {
     ErrorCodes.MODEL_NOT_FOUND: 'The request model name does not exist in the model list.',
     ErrorCodes.SERVICE_UNAVAILABLE: 'The service is unavailable now. May retry later.',
-    ErrorCodes.API_TIMEOUT: 'Failed to get response after a period of time'
+    ErrorCodes.API_TIMEOUT: 'Failed to get response after a period of time',
+    ErrorCodes.SERVICE_OVERLOADED: 'All the nodes are overloaded now. Please retry later.'
 }
@@ -0,0 +1,55 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import time
+
+
+class CircuitBreaker:
+    """Stop dispatching requests to a failing node.
+
+    The circuit is `closed` while the node works. It is `open` after
+    `failure_threshold` consecutive failures of the health probes or the
+    requests, and no request is dispatched to the node. After
+    `recovery_time` seconds the circuit is `half_open` and the node is tried
+    again, the next success closes the circuit and the next failure opens it
+    again.
+
+    Args:
+        failure_threshold (int): number of the consecutive failures to open
+            the circuit.
+        recovery_time (float): seconds before an open circuit is tried again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, recovery_time: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.num_failures = 0
+        self.opened_at = None
+        self.last_success = time.time()
+
+    @property
+    def state(self) -> str:
+        """state of the circuit."""
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at < self.recovery_time:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self) -> bool:
+        """whether requests can be dispatched to the node."""
+        return self.state != self.OPEN
+
+    def record_success(self):
+        """the node responded."""
+        self.num_failures = 0
+        self.opened_at = None
+        self.last_success = time.time()
+
+    def record_failure(self):
+        """the node failed to respond."""
+        self.num_failures += 1
+        if self.state == self.HALF_OPEN or self.num_failures >= self.failure_threshold:
+            self.opened_at = time.time()
@@ -3,15 +3,16 @@
 import asyncio
 import copy
 import json
+import math
 import os
 import os.path as osp
 import random
-import threading
 import time
 from collections import deque
 from http import HTTPStatus
-from typing import Deque, Dict, List, Literal, Optional, Union
+from typing import Deque, Dict, List, Literal, Optional, Tuple, Union
 
+import httpx
 import numpy as np
 import requests
 import uvicorn
@@ -19,13 +20,18 @@ import yaml
 from fastapi import BackgroundTasks, Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, computed_field
 from requests.exceptions import RequestException
 
 from lmdeploy.serve.openai.api_server import check_api_key, create_error_response
 from lmdeploy.serve.openai.protocol import ModelCard  # noqa: E501
 from lmdeploy.serve.openai.protocol import ChatCompletionRequest, CompletionRequest, ModelList, ModelPermission
-from lmdeploy.serve.proxy.constants import API_READ_TIMEOUT, LATENCY_DEQUE_LEN, ErrorCodes, Strategy, err_msg
+from lmdeploy.serve.proxy.affinity import PrefixAffinity
+from lmdeploy.serve.proxy.constants import (API_CONNECT_TIMEOUT, API_READ_TIMEOUT, CIRCUIT_FAILURE_THRESHOLD,
+                                            CIRCUIT_RECOVERY_TIME, CONNECTIONS_PER_CLIENT, HEALTH_CHECK_INTERVAL,
+                                            HEALTH_CHECK_TIMEOUT, LATENCY_DEQUE_LEN, MAX_CONNECTIONS_PER_NODE,
+                                            ErrorCodes, Strategy, err_msg)
+from lmdeploy.serve.proxy.health import CircuitBreaker
 from lmdeploy.utils import get_logger
 
 logger = get_logger('lmdeploy')
@@ -37,6 +43,19 @@ class Status(BaseModel):
     unfinished: int = 0
     latency: Deque = Field(default=deque(maxlen=LATENCY_DEQUE_LEN), examples=[[]])
     speed: Optional[int] = Field(default=None, examples=[None])
+    prefix_requests: int = 0
+    prefix_hits: int = 0
+    num_waiting: Optional[int] = None
+    num_running: Optional[int] = None
+    num_free_gpu_blocks: Optional[int] = None
+    circuit: str = CircuitBreaker.CLOSED
+
+    @computed_field
+    @property
+    def prefix_hit_rate(self) -> float:
+        """ratio of the requests routed to a node which has served their
+        prefixes, only counted by the prefix_affinity strategy."""
+        return self.prefix_hits / max(self.prefix_requests, 1)
 
 
 class Node(BaseModel):
@@ -45,14 +64,23 @@ class Node(BaseModel):
     status: Optional[Status] = None
 
 
-CONTROLLER_HEART_BEAT_EXPIRATION = int(os.getenv('LMDEPLOY_CONTROLLER_HEART_BEAT_EXPIRATION', 90))
+def _close_clients(clients: Optional[List[httpx.AsyncClient]], loop: Optional[asyncio.AbstractEventLoop]):
+    """Close the clients in their event loop, can be called from any
+    thread."""
+    if clients is None or loop.is_closed():
+        return
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    for client in clients:
+        if running_loop is loop:
+            loop.create_task(client.aclose())
+        else:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
 
 
-def heart_beat_controller(proxy_controller):
-    while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
-        logger.info('Start heart beat check')
-        proxy_controller.remove_stale_nodes_by_expiration()
+CONTROLLER_HEART_BEAT_EXPIRATION = int(os.getenv('LMDEPLOY_CONTROLLER_HEART_BEAT_EXPIRATION', 90))
 
 
 class NodeManager:
@@ -68,11 +96,35 @@ class NodeManager:
             - min_observed_latency: Based on previous finished requests. The
                 sooner they get processed, the more requests will be dispatched
                 to.
+            - prefix_affinity: requests sharing a prompt prefix or a session
+                id are dispatched to the same node to reuse its prefix cache,
+                unless the node is much busier than the others.
+        max_connections_per_node (int): the max number of the connections to
+            a node. Requests exceeding the limit wait for a free connection.
+        max_queue_depth (int): requests are rejected with 429 when the
+            waiting requests of every node exceed it. None means no limit.
+        health_check_interval (float): seconds between the health probes of
+            the nodes.
     """
 
-    def __init__(self, config_path: Optional[str] = None, strategy: str = 'min_expected_latency') -> None:
+    def __init__(self,
+                 config_path: Optional[str] = None,
+                 strategy: str = 'min_expected_latency',
+                 max_connections_per_node: int = MAX_CONNECTIONS_PER_NODE,
+                 max_queue_depth: Optional[int] = None,
+                 health_check_interval: float = HEALTH_CHECK_INTERVAL) -> None:
         self.nodes = dict()
+        self.max_connections_per_node = max_connections_per_node
+        self.max_queue_depth = max_queue_depth
+        self.health_check_interval = health_check_interval
+        self.breakers: Dict[str, CircuitBreaker] = dict()
+        # node url -> (clients, event loop of the clients)
+        self.clients: Dict[str, Tuple[List[httpx.AsyncClient], asyncio.AbstractEventLoop]] = dict()
+        self.client_index: Dict[str, int] = dict()
+        # node url -> (client of the health probes, event loop of the client)
+        self.probe_clients: Dict[str, Tuple[httpx.AsyncClient, asyncio.AbstractEventLoop]] = dict()
         self.strategy = Strategy.from_str(strategy)
+        self.affinity = PrefixAffinity()
         self.latencies = dict()
         self.config_path = osp.join(osp.dirname(osp.realpath(__file__)), 'proxy_config.yml')
         if config_path is not None:
@@ -84,9 +136,8 @@ class NodeManager:
                     latency = deque(status.get('latency', []), maxlen=LATENCY_DEQUE_LEN)
                     status['latency'] = latency
                     status = Status(**status)
+                    status.circuit = CircuitBreaker.CLOSED
                     self.nodes[url] = status
-        self.heart_beat_thread = threading.Thread(target=heart_beat_controller, args=(self, ), daemon=True)
-        self.heart_beat_thread.start()
 
     def update_config_file(self):
         """Update the config file."""
@@ -128,23 +179,152 @@ class NodeManager:
         if node_url in self.nodes.keys():
             self.nodes.pop(node_url)
             self.update_config_file()
+        self.breakers.pop(node_url, None)
+        self.close_client(node_url)
+
+    def get_client(self, node_url: str) -> httpx.AsyncClient:
+        """Get a client of a node, the connections of the node are kept alive
+        and shared by the requests.
+
+        The connections of a node are sharded over several clients, since
+        the connection pool of a client scans all its connections each time
+        a request is assigned.
+        """
+        loop = asyncio.get_running_loop()
+        clients, client_loop = self.clients.get(node_url, (None, None))
+        if clients is None or client_loop is not loop or clients[0].is_closed:
+            num_clients = -(-self.max_connections_per_node // CONNECTIONS_PER_CLIENT)
+            max_connections = -(-self.max_connections_per_node // num_clients)
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            timeout = httpx.Timeout(API_READ_TIMEOUT, connect=API_CONNECT_TIMEOUT)
+            clients = [httpx.AsyncClient(base_url=node_url, limits=limits, timeout=timeout) for _ in range(num_clients)]
+            self.clients[node_url] = (clients, loop)
+            self.client_index[node_url] = 0
+        index = self.client_index[node_url]
+        self.client_index[node_url] = (index + 1) % len(clients)
+        return clients[index]
+
+    def get_probe_client(self, node_url: str) -> httpx.AsyncClient:
+        """Get the client of the health probes of a node.
+
+        The probes have their own connection, so that they do not wait for the
+        connections taken by the requests of a busy node.
+        """
+        loop = asyncio.get_running_loop()
+        client, client_loop = self.probe_clients.get(node_url, (None, None))
+        if client is None or client_loop is not loop or client.is_closed:
+            limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+            client = httpx.AsyncClient(base_url=node_url, limits=limits, timeout=HEALTH_CHECK_TIMEOUT)
+            self.probe_clients[node_url] = (client, loop)
+        return client
+
+    def close_client(self, node_url: str):
+        """Close the clients of a node, can be called from any thread."""
+        clients, loop = self.clients.pop(node_url, (None, None))
+        self.client_index.pop(node_url, None)
+        _close_clients(clients, loop)
+        probe_client, loop = self.probe_clients.pop(node_url, (None, None))
+        if probe_client is not None:
+            _close_clients([probe_client], loop)
+
+    def get_breaker(self, node_url: str) -> CircuitBreaker:
+        """Get the circuit breaker of a node."""
+        breaker = self.breakers.get(node_url)
+        if breaker is None:
+            breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIME)
+            self.breakers[node_url] = breaker
+        return breaker
+
+    def is_available(self, node_url: str) -> bool:
+        """Whether requests can be dispatched to a node."""
+        return self.get_breaker(node_url).allow_request()
+
+    def record_failure(self, node_url: str):
+        """Record a failed probe or request of a node."""
+        breaker = self.get_breaker(node_url)
+        breaker.record_failure()
+        if node_url in self.nodes:
+            self.nodes[node_url].circuit = breaker.state
+
+    async def probe_node(self, node_url: str):
+        """Poll the queue depth of a node, nodes not reporting it are checked
+        by `/health`."""
+        breaker = self.get_breaker(node_url)
+        try:
+            client = self.get_probe_client(node_url)
+            response = await client.get('/engine/stats')
+            if response.status_code == HTTPStatus.NOT_FOUND:
+                response = await client.get('/health')
+                stats = dict()
+            else:
+                stats = response.json()
+            response.raise_for_status()
+        except httpx.PoolTimeout as e:
+            # the probe is not sent, which says nothing about the node
+            logger.warning(f'health check of {node_url} skipped: {e}')
+            return
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f'health check of {node_url} failed: {e}')
+            self.record_failure(node_url)
+            return
+        breaker.record_success()
+        status = self.nodes.get(node_url)
+        if status is None:
+            return
+        status.num_waiting = stats.get('num_waiting')
+        status.num_running = stats.get('num_running')
+        status.num_free_gpu_blocks = stats.get('num_free_gpu_blocks')
+        status.circuit = breaker.state
 
     def remove_stale_nodes_by_expiration(self):
-        """remove stale nodes."""
-        to_be_deleted = []
-        for node_url in self.nodes.keys():
-            url = f'{node_url}/health'
-            headers = {'accept': 'application/json'}
-            try:
-                response = requests.get(url, headers=headers)
-                if response.status_code != 200:
-                    to_be_deleted.append(node_url)
-            except:  # noqa
-                to_be_deleted.append(node_url)
-        for node_url in to_be_deleted:
-            self.remove(node_url)
-            logger.info(f'Removed node_url: {node_url} '
-                        'due to heart beat expiration')
+        """remove the nodes failing the health checks for longer than the
+        expiration."""
+        now = time.time()
+        for node_url in list(self.nodes.keys()):
+            if now - self.get_breaker(node_url).last_success > CONTROLLER_HEART_BEAT_EXPIRATION:
+                self.remove(node_url)
+                logger.info(f'Removed node_url: {node_url} '
+                            'due to heart beat expiration')
+
+    async def health_check_loop(self):
+        """Probe the nodes periodically."""
+        while True:
+            node_urls = list(self.nodes.keys())
+            await asyncio.gather(*[self.probe_node(node_url) for node_url in node_urls])
+            self.remove_stale_nodes_by_expiration()
+            await asyncio.sleep(self.health_check_interval)
+
+    def get_load(self, node_url: str) -> int:
+        """The number of the unfinished requests of a node.
+
+        The queue depth reported by the node includes the requests from other
+        clients, while the requests dispatched after the last probe are only
+        counted by the proxy.
+        """
+        status = self.nodes[node_url]
+        if status.num_waiting is None or status.num_running is None:
+            return status.unfinished
+        return max(status.unfinished, status.num_waiting + status.num_running)
+
+    def get_queue_depth(self, node_url: str) -> int:
+        """The number of the waiting requests of a node."""
+        status = self.nodes[node_url]
+        if status.num_waiting is None:
+            return status.unfinished
+        return status.num_waiting
+
+    def is_overloaded(self, model_name: str) -> bool:
+        """Whether the waiting requests of all the available nodes of the
+        model exceed the max queue depth."""
+        if self.max_queue_depth is None:
+            return False
+        node_urls = [
+            node_url for node_url, status in self.nodes.items()
+            if model_name in status.models and self.is_available(node_url)
+        ]
+        if len(node_urls) == 0:
+            return False
+        return all(self.get_queue_depth(node_url) >= self.max_queue_depth for node_url in node_urls)
 
     @property
     def model_list(self):
@@ -159,12 +339,14 @@ class NodeManager:
         """Return the status."""
         return self.nodes
 
-    def get_node_url(self, model_name: str):
+    def get_node_url(self, model_name: str, request: Optional[Dict] = None):
         """Add a node to the manager.
 
         Args:
             model_name (str): A http url. Can be the url generated by
                 `lmdeploy serve api_server`.
+            request (Dict): the request, used by the prefix_affinity
+                strategy.
         Return:
             A node url or None.
         """
@@ -172,7 +354,7 @@ class NodeManager:
         def get_matched_urls():
             urls_with_speeds, speeds, urls_without_speeds = [], [], []
             for node_url, node_status in self.nodes.items():
-                if model_name in node_status.models:
+                if model_name in node_status.models and self.is_available(node_url):
                     if node_status.speed is not None:
                         urls_with_speeds.append(node_url)
                         speeds.append(node_status.speed)
@@ -180,7 +362,7 @@ class NodeManager:
                         urls_without_speeds.append(node_url)
             all_matched_urls = urls_with_speeds + urls_without_speeds
             if len(all_matched_urls) == 0:
-                return None
+                return [], []
             # some nodes does not contain speed
             # we can set them the average speed value
             average_speed = sum(speeds) / len(speeds) if len(speeds) else 1
@@ -206,7 +388,7 @@ class NodeManager:
             all_indexes = [i for i in range(len(all_the_speeds))]
             random.shuffle(all_indexes)
             for index in all_indexes:
-                latency = self.nodes[all_matched_urls[index]].unfinished / all_the_speeds[index]
+                latency = self.get_load(all_matched_urls[index]) / all_the_speeds[index]
                 if min_latency > latency:
                     min_latency = latency
                     min_index = index
@@ -215,7 +397,7 @@ class NodeManager:
         elif self.strategy == Strategy.MIN_OBSERVED_LATENCY:
             all_matched_urls, latencies = [], []
             for node_url, node_status in self.nodes.items():
-                if model_name in node_status.models:
+                if model_name in node_status.models and self.is_available(node_url):
                     if len(node_status.latency):
                         latencies.append(np.mean(np.array(node_status.latency)))
                     else:
@@ -225,6 +407,18 @@ class NodeManager:
                 return None
             index = np.argmin(np.array(latencies))
             return all_matched_urls[index]
+        elif self.strategy == Strategy.PREFIX_AFFINITY:
+            all_matched_urls, all_the_speeds = get_matched_urls()
+            if len(all_matched_urls) == 0:
+                return None
+            if request is None:
+                request = dict()
+            keys, ring_key = self.affinity.get_keys(request)
+            unfinished = [self.get_load(url) for url in all_matched_urls]
+            url, hit = self.affinity.route(keys, ring_key, all_matched_urls, unfinished, all_the_speeds)
+            self.nodes[url].prefix_requests += 1
+            self.nodes[url].prefix_hits += int(hit)
+            return url
         else:
             raise ValueError(f'Invalid strategy: {self.strategy}')
 
@@ -241,13 +435,30 @@ class NodeManager:
         Args:
             model_name (str): the model in the request.
         """
-        logger.warning(f'no model name: {model_name}')
+        if model_name in self.model_list:
+            # the circuits of all the nodes of the model are open
+            logger.warning(f'no available node of model: {model_name}')
+            error_code = ErrorCodes.SERVICE_UNAVAILABLE
+        else:
+            logger.warning(f'no model name: {model_name}')
+            error_code = ErrorCodes.MODEL_NOT_FOUND
         ret = {
-            'error_code': ErrorCodes.MODEL_NOT_FOUND,
-            'text': err_msg[ErrorCodes.MODEL_NOT_FOUND],
+            'error_code': error_code.value,
+            'text': err_msg[error_code],
         }
         return json.dumps(ret).encode() + b'\n'
 
+    def handle_overloaded(self, model_name: str):
+        """Reject a request when all the nodes of the model are overloaded.
+
+        Args:
+            model_name (str): the model in the request.
+        """
+        logger.warning(f'all nodes of {model_name} are overloaded')
+        ret = create_error_response(HTTPStatus.TOO_MANY_REQUESTS, err_msg[ErrorCodes.SERVICE_OVERLOADED])
+        ret.headers['Retry-After'] = str(math.ceil(self.health_check_interval))
+        return ret
+
     def handle_api_timeout(self, node_url):
         """Handle the api time out."""
         logger.warning(f'api timeout: {node_url}')
@@ -257,26 +468,27 @@ class NodeManager:
         }
         return json.dumps(ret).encode() + b'\n'
 
-    def stream_generate(self, request: Dict, node_url: str, endpoint: str):
+    async def stream_generate(self, request: Dict, node_url: str, endpoint: str):
         """Return a generator to handle the input request.
 
+        The chunks are read from the node only when the previous chunk has
+        been sent to the client, the connection to the node is closed if the
+        client disconnects.
+
         Args:
             request (Dict): the input request.
             node_url (str): the node url.
             endpoint (str): the endpoint. Such as `/v1/chat/completions`.
         """
         try:
-            response = requests.post(
-                node_url + endpoint,
-                json=request,
-                stream=True,
-                timeout=(5, API_READ_TIMEOUT),
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b'\n'):
-                if chunk:
-                    yield chunk + b'\n\n'
-        except (Exception, GeneratorExit, RequestException) as e:  # noqa
+            client = self.get_client(node_url)
+            async with client.stream('POST', endpoint, json=request) as response:
+                # the events of the node are passed through as they are
+                async for chunk in response.aiter_raw():
+                    yield chunk
+        except Exception as e:  # noqa
             logger.error(f'catched an exception: {e}')
+            self.record_failure(node_url)
             # exception happened, reduce unfinished num
             yield self.handle_api_timeout(node_url)
 
@@ -289,12 +501,13 @@ class NodeManager:
             endpoint (str): the endpoint. Such as `/v1/chat/completions`.
         """
         try:
-            import httpx
-            async with httpx.AsyncClient() as client:
-                response = await client.post(node_url + endpoint, json=request, timeout=API_READ_TIMEOUT)
-                return response.text
+            client = self.get_client(node_url)
+            response = await client.post(endpoint, json=request)
+            return response.text
         except (Exception, GeneratorExit, RequestException, asyncio.CancelledError) as e:  # noqa
             logger.error(f'catched an exception: {e}')
+            if isinstance(e, Exception):
+                self.record_failure(node_url)
             return self.handle_api_timeout(node_url)
 
     def pre_call(self, node_url):
@@ -339,6 +552,12 @@ app.add_middleware(
 node_manager = NodeManager()
 
 
+@app.on_event('startup')
+async def startup_event():
+    """Start probing the nodes."""
+    app.state.health_check_task = asyncio.create_task(node_manager.health_check_loop())
+
+
 @app.get('/v1/models', dependencies=[Depends(check_api_key)])
 def available_models():
     """Show available models."""
@@ -449,12 +668,14 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
     check_response = await node_manager.check_request_model(request.model)
     if check_response is not None:
         return check_response
-    node_url = node_manager.get_node_url(request.model)
+    if node_manager.is_overloaded(request.model):
+        return node_manager.handle_overloaded(request.model)
+    request_dict = request.model_dump()
+    node_url = node_manager.get_node_url(request.model, request_dict)
     if not node_url:
         return node_manager.handle_unavailable_model(request.model)
 
     logger.info(f'A request is dispatched to {node_url}')
-    request_dict = request.model_dump()
     start = node_manager.pre_call(node_url)
     if request.stream is True:
         response = node_manager.stream_generate(request_dict, node_url, '/v1/chat/completions')
@@ -506,12 +727,14 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
     check_response = await node_manager.check_request_model(request.model)
     if check_response is not None:
         return check_response
-    node_url = node_manager.get_node_url(request.model)
+    if node_manager.is_overloaded(request.model):
+        return node_manager.handle_overloaded(request.model)
+    request_dict = request.model_dump()
+    node_url = node_manager.get_node_url(request.model, request_dict)
     if not node_url:
         return node_manager.handle_unavailable_model(request.model)
 
     logger.info(f'A request is dispatched to {node_url}')
-    request_dict = request.model_dump()
     start = node_manager.pre_call(node_url)
     if request.stream is True:
         response = node_manager.stream_generate(request_dict, node_url, '/v1/completions')
@@ -525,24 +748,35 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
 
 def proxy(server_name: str = '0.0.0.0',
           server_port: int = 8000,
-          strategy: Literal['random', 'min_expected_latency', 'min_observed_latency'] = 'min_expected_latency',
+          strategy: Literal['random', 'min_expected_latency', 'min_observed_latency',
+                            'prefix_affinity'] = 'min_expected_latency',
           api_keys: Optional[Union[List[str], str]] = None,
           ssl: bool = False,
           log_level: str = 'INFO',
+          max_connections_per_node: int = MAX_CONNECTIONS_PER_NODE,
+          max_queue_depth: Optional[int] = None,
+          health_check_interval: float = HEALTH_CHECK_INTERVAL,
           **kwargs):
     """To launch the proxy server.
 
     Args:
         server_name (str): the server name of the proxy. Default to '0.0.0.0'.
         server_port (str): the server port. Default to 8000.
-        strategy ('random' | 'min_expected_latency' | 'min_observed_latency'):
+        strategy ('random' | 'min_expected_latency' | 'min_observed_latency' | 'prefix_affinity'):
             the strategy to dispatch requests to nodes. Default to
             'min_expected_latency'
         api_keys (List[str] | str | None): Optional list of API keys. Accepts string type as
             a single api_key. Default to None, which means no api key applied.
         ssl (bool): Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.
+        max_connections_per_node (int): The max number of the connections to a node. Default to 512.
+        max_queue_depth (int): Requests are rejected with 429 when the waiting requests of every node
+            exceed it. Default to None, which means no limit.
+        health_check_interval (float): Seconds between the health probes of the nodes. Default to 5.
     """  # noqa
     node_manager.strategy = Strategy.from_str(strategy)
+    node_manager.max_connections_per_node = max_connections_per_node
+    node_manager.max_queue_depth = max_queue_depth
+    node_manager.health_check_interval = health_check_interval
     if api_keys is not None:
         if isinstance(api_keys, str):
             api_keys = api_keys.split(',')
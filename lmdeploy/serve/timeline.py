@@ -0,0 +1,106 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Analyze the request timelines logged by the server.
+
+Usage:
+    python -m lmdeploy.serve.timeline server.log --steps
+"""
+import argparse
+import json
+import re
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+TIMELINE_PATTERN = re.compile(r'session=(\d+), timeline=(\{.*\})')
+STAGES = ('tokenize', 'instance_queue', 'scheduler_queue', 'prefill', 'decode', 'detokenize', 'total')
+
+
+def parse_timelines(lines: Iterable[str]) -> List[Dict[str, Any]]:
+    """parse the timelines logged by `RequestLogger.log_timeline`."""
+    timelines = []
+    for line in lines:
+        match = TIMELINE_PATTERN.search(line)
+        if match is None:
+            continue
+        timeline = json.loads(match.group(2))
+        timeline['session_id'] = int(match.group(1))
+        timelines.append(timeline)
+    return timelines
+
+
+def reconstruct_steps(timelines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """reconstruct the requests of each engine forward.
+
+    A request is prefilled from its `scheduled_step` to its `first_token_step`
+    and decoded until its `finish_step`. The steps are counted by each engine,
+    so the logs of different engines should be analyzed separately. The
+    forwards skipped by a request evicted to be recomputed are not known.
+    """
+    steps = dict()
+    for timeline in timelines:
+        start = timeline.get('scheduled_step')
+        first = timeline.get('first_token_step')
+        finish = timeline.get('finish_step')
+        if start is None or first is None or finish is None:
+            continue
+        for step in range(start, finish + 1):
+            stage = 'prefill' if step <= first else 'decode'
+            if step not in steps:
+                steps[step] = dict(step=step, prefill=[], decode=[])
+            steps[step][stage].append(timeline['session_id'])
+    return [steps[step] for step in sorted(steps)]
+
+
+def summarize(timelines: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """statistics of the seconds spent in each stage."""
+    summary = dict()
+    for stage in STAGES:
+        values = [t['durations'][stage] for t in timelines if stage in t.get('durations', {})]
+        if len(values) == 0:
+            continue
+        values = np.array(values)
+        summary[stage] = dict(count=len(values),
+                              mean=float(values.mean()),
+                              p50=float(np.percentile(values, 50)),
+                              p90=float(np.percentile(values, 90)),
+                              p99=float(np.percentile(values, 99)),
+                              max=float(values.max()))
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Analyze the request timelines in the server logs.')
+    parser.add_argument('log_file', type=str, help='the log file of the server')
+    parser.add_argument('--steps', action='store_true', help='print the requests of each engine forward')
+    parser.add_argument('--output', type=str, default=None, help='save the timelines, summary and steps in json')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.log_file, 'r') as f:
+        timelines = parse_timelines(f)
+    summary = summarize(timelines)
+    steps = reconstruct_steps(timelines)
+
+    print(f'number of requests: {len(timelines)}')
+    print(f'{"stage":<16}{"count":>8}{"mean":>10}{"p50":>10}{"p90":>10}{"p99":>10}{"max":>10}')
+    for stage, stats in summary.items():
+        print(f'{stage:<16}{stats["count"]:>8}' + ''.join(f'{stats[key]:>10.4f}'
+                                                          for key in ['mean', 'p50', 'p90', 'p99', 'max']))
+    if len(steps) > 0:
+        prefill_sizes = [len(step['prefill']) for step in steps]
+        decode_sizes = [len(step['decode']) for step in steps]
+        print(f'number of steps: {len(steps)}, '
+              f'mean prefill batch: {np.mean(prefill_sizes):.2f}, '
+              f'mean decode batch: {np.mean(decode_sizes):.2f}')
+    if args.steps:
+        for step in steps:
+            print(f'step {step["step"]}: prefill={step["prefill"]}, decode={step["decode"]}')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(timelines=timelines, summary=summary, steps=steps), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
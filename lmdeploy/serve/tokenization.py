@@ -0,0 +1,217 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
+
+from lmdeploy.tokenizer import Tokenizer
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+
+class TokenizationService:
+    """Tokenize prompts in a thread pool instead of the event loop.
+
+    Huggingface fast tokenizers release the GIL, so encoding long prompts in
+    the worker threads does not stall the streaming of other requests. The
+    prompts submitted in the same iteration of the event loop are encoded in
+    one batch.
+
+    Token ids of the rendered prompts are cached by the text before their
+    last special token. Text after a special token is tokenized
+    independently of the text before it, so a prompt of a multi-round chat
+    only encodes the rounds after the cached prefix. A cached prefix is only
+    reused if the prompt continues with the same special token, otherwise
+    the tokens may merge across the end of the prefix.
+
+    Args:
+        tokenizer (Tokenizer): the tokenizer.
+        max_workers (int): number of the worker threads.
+        max_batch_size (int): max number of prompts encoded in one batch.
+        cache_size (int): max number of the cached prompt prefixes, 0 to
+            disable the cache.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, max_workers: int = 4, max_batch_size: int = 32, cache_size: int = 256):
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lmdeploy_tokenize')
+        # (add_bos, prefix text, special token after the prefix) -> prefix
+        # token ids, in LRU order
+        self._prefix_cache: Dict[Tuple[bool, str, str], List[int]] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._added_tokens: Dict[int, str] = None
+        # event loop -> add_bos -> prompts and futures to be encoded
+        self._pending: Dict[asyncio.AbstractEventLoop, Dict[bool, List[Tuple[str, asyncio.Future]]]] = dict()
+        # running batches, the event loop only keeps weak references of tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def added_tokens(self) -> Dict[int, str]:
+        """added tokens of the tokenizer, which split the prompts."""
+        if self._added_tokens is None:
+            hf_tokenizer = getattr(self.tokenizer.model, 'model', None)
+            added_tokens_decoder = getattr(hf_tokenizer, 'added_tokens_decoder', None) or dict()
+            self._added_tokens = dict(
+                (idx, getattr(token, 'content', str(token))) for idx, token in added_tokens_decoder.items())
+        return self._added_tokens
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """run a function in the worker threads, such as rendering the chat
+        template."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    async def encode(self, prompt: str, add_bos: bool = True) -> List[int]:
+        """tokenize a prompt."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get(loop)
+        if pending is None:
+            pending = self._pending[loop] = dict()
+            loop.call_soon(self._flush, loop)
+        pending.setdefault(add_bos, []).append((prompt, future))
+        return await future
+
+    async def batch_encode(self, prompts: List[str], add_bos: bool = True) -> List[List[int]]:
+        """tokenize prompts."""
+        return await asyncio.gather(*[self.encode(prompt, add_bos) for prompt in prompts])
+
+    def _match_prefix(self, prompt: str, add_bos: bool):
+        """find the longest cached prefix of the prompt, which is followed by
+        the special token it was split on."""
+        with self._cache_lock:
+            best = None
+            for key in self._prefix_cache:
+                cached_bos, prefix, boundary = key
+                if cached_bos != add_bos or not prompt.startswith(prefix):
+                    continue
+                if not prompt.startswith(boundary, len(prefix)):
+                    continue
+                if best is None or len(prefix) > len(best[1]):
+                    best = key
+            if best is None:
+                return '', []
+            self._prefix_cache.move_to_end(best)
+            return best[1], self._prefix_cache[best]
+
+    def _update_cache(self, prefix: str, boundary: str, add_bos: bool, prefix_ids: List[int]):
+        """cache the token ids of a prefix split before the special token
+        `boundary`."""
+        key = (add_bos, prefix, boundary)
+        with self._cache_lock:
+            self._prefix_cache.pop(key, None)
+            self._prefix_cache[key] = prefix_ids
+            while len(self._prefix_cache) > self.cache_size:
+                self._prefix_cache.popitem(last=False)
+
+    def _find_prefix(self, prompt: str, input_ids: List[int]):
+        """split the prompt before its last special token.
+
+        Return:
+            int: length of the prefix text, -1 if the prompt can not be split.
+            int: number of the prefix tokens.
+            str: the special token after the prefix.
+        """
+        added_tokens = self.added_tokens
+        for num_tokens in range(len(input_ids) - 1, 0, -1):
+            token = added_tokens.get(input_ids[num_tokens])
+            if token is None:
+                continue
+            pos = prompt.rfind(token)
+            if pos < 0:
+                # not in the text, such as the byte fallback tokens
+                continue
+            # the suffix must be tokenized into the same ids
+            if pos > 0 and self.tokenizer.encode(prompt[pos:], add_bos=False) == input_ids[num_tokens:]:
+                return pos, num_tokens, token
+            break
+        return -1, 0, None
+
+    def _encode_batch(self, prompts: List[str], add_bos: bool):
+        """encode the prompts in the worker thread."""
+        if len(prompts) == 1:
+            return [self.tokenizer.encode(prompts[0], add_bos=add_bos)]
+        return self.tokenizer.batch_encode(prompts, add_bos=add_bos)
+
+    def _find_prefixes(self, prompts: List[str], outputs: List[List[int]]):
+        """split the prompts for the prefix cache in the worker thread."""
+        return [self._find_prefix(prompt, input_ids) for prompt, input_ids in zip(prompts, outputs)]
+
+    def _flush(self, loop: asyncio.AbstractEventLoop):
+        """encode the pending prompts of the event loop."""
+        pending = self._pending.pop(loop)
+        for add_bos, requests in pending.items():
+            for start in range(0, len(requests), self.max_batch_size):
+                batch = requests[start:start + self.max_batch_size]
+                task = loop.create_task(self._encode_requests(batch, add_bos))
+                self._tasks.add(task)
+                task.add_done_callback(functools.partial(self._on_batch_done, batch))
+
+    def _on_batch_done(self, requests: List[Tuple[str, asyncio.Future]], task: asyncio.Task):
+        """release the task of a batch and fail the requests it left
+        unfinished."""
+        self._tasks.discard(task)
+        if task.cancelled():
+            for _, future in requests:
+                future.cancel()
+            return
+        exc = task.exception()
+        if exc is None:
+            return
+        logger.error(f'Failed to encode a batch of {len(requests)} prompts: {exc!r}')
+        for _, future in requests:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def _encode_requests(self, requests: List[Tuple[str, asyncio.Future]], add_bos: bool):
+        """encode the prompts of the requests and set the results."""
+        loop = asyncio.get_running_loop()
+        prefixes = []
+        suffixes = []
+        for prompt, _ in requests:
+            if self.cache_size > 0:
+                prefix, prefix_ids = self._match_prefix(prompt, add_bos)
+            else:
+                prefix, prefix_ids = '', []
+            prefixes.append(prefix_ids)
+            suffixes.append(prompt[len(prefix):])
+        # prompts with a cached prefix are not in the beginning of the sequence
+        suffix_bos = [add_bos and len(prefix_ids) == 0 for prefix_ids in prefixes]
+        try:
+            outputs = [None] * len(requests)
+            for bos in set(suffix_bos):
+                indices = [idx for idx, flag in enumerate(suffix_bos) if flag == bos]
+                encoded = await loop.run_in_executor(self.executor, self._encode_batch,
+                                                     [suffixes[idx] for idx in indices], bos)
+                for idx, input_ids in zip(indices, encoded):
+                    outputs[idx] = prefixes[idx] + list(input_ids)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), input_ids in zip(requests, outputs):
+            if not future.done():
+                future.set_result(input_ids)
+
+        if self.cache_size > 0:
+            prompts = [prompt for prompt, _ in requests]
+            try:
+                splits = await loop.run_in_executor(self.executor, self._find_prefixes, prompts, outputs)
+            except Exception as e:
+                logger.debug(f'Failed to cache prompt prefixes: {e}')
+                return
+            for prompt, input_ids, (pos, num_tokens, boundary) in zip(prompts, outputs, splits):
+                if pos < 0:
+                    continue
+                self._update_cache(prompt[:pos], boundary, add_bos, input_ids[:num_tokens])
+
+    def close(self):
+        """shutdown the worker threads."""
+        self.executor.shutdown(wait=False)
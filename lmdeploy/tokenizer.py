@@ -1,7 +1,9 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
 import json
+import os
 import os.path as osp
-from collections import deque
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import List, Optional, Sequence, Tuple, Union
 
@@ -10,6 +12,10 @@ from lmdeploy.utils import get_logger
 # this file will be copied to triton server, make sure all
 # importing are starting from the package root lmdeploy
 
+# number of the prompt tokens used as the context of the first round of
+# incremental detokenization
+INITIAL_DETOKENIZE_OFFSET = 5
+
 
 @dataclass
 class DetokenizeState:
@@ -19,7 +25,8 @@ class DetokenizeState:
         ids_offset (int): offset to all input ids. In LMDeploy, the output
             ids length is not one by one. It could be random by random.
         prev_tokens (List[str] | None): for incrementally decoding.
-            Default to None, which means the first round.
+            Default to None, which means the first round. Only the window
+            of tokens from `prefix_offset` is kept.
         prefix_offset (int): the start index of tokens to be converted to
             string (prev + new tokens). Default to 0 for the first round.
         read_offset (int): the end index of tokens to be converted to
@@ -47,6 +54,7 @@ class HuggingFaceTokenizer:
         from transformers import AutoTokenizer
         self.logger = get_logger('lmdeploy')
         self.model = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True)
+        self.model_dir = model_dir
         self._prefix_space_tokens = None
 
         if self.model.eos_token_id is None:
@@ -61,11 +69,16 @@ class HuggingFaceTokenizer:
         # for stop words
         self._vocab_size_with_added: int = None
         self._maybe_decode_bytes: bool = None
-        # TODO maybe lack a constant.py
-        self._indexes_tokens_deque = deque(maxlen=10)
+        # LRU of stop words sent by clients
+        self._indexes_tokens_cache = OrderedDict()
+        self._indexes_tokens_cache_size = 256
         self.max_indexes_num = 5
         self.token2id = {}
 
+        # for incremental detokenization
+        self._id_to_token: List[str] = None
+        self._special_ids: set = None
+
     def _check_transformers_version(self, model_dir: str):
         import transformers
         from packaging import version
@@ -144,27 +157,58 @@ class HuggingFaceTokenizer:
                     break
         return self._maybe_decode_bytes
 
+    def _vocab_index_path(self):
+        """path of the vocab index persisted on disk, keyed by the vocab."""
+        cache_dir = os.getenv('LMDEPLOY_CACHE_DIR', osp.join(osp.expanduser('~'), '.cache', 'lmdeploy'))
+        vocab = sorted(self.model.get_vocab().items(), key=lambda item: item[1])
+        key = hashlib.sha1(f'{type(self.model).__name__}:{self.vocab_size}:{vocab}'.encode()).hexdigest()
+        return osp.join(cache_dir, 'vocab_index', f'{key}.json')
+
+    def _build_token2id(self):
+        """map decoded tokens to ids, the index is built once per tokenizer
+        and persisted to disk."""
+        index_path = self._vocab_index_path()
+        if osp.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                self.logger.warning(f'Failed to load vocab index {index_path}, rebuild it.')
+
+        # traversing vocab is time consuming, can not be accelerated with
+        # multi threads (computation) or multi process (can't pickle tokenizer)
+        token2id = {}
+        # decode is slower than convert_ids_to_tokens
+        if self.maybe_decode_bytes:
+            for i in range(self.vocab_size):
+                try:
+                    token2id[self.model.decode(i)] = i
+                except:  # noqa: E722
+                    # some tokens just can't be decoded by `decode`
+                    pass
+        else:
+            token2id = {self.model.convert_ids_to_tokens(i): i for i in range(self.vocab_size)}
+
+        try:
+            os.makedirs(osp.dirname(index_path), exist_ok=True)
+            tmp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(token2id, f, ensure_ascii=False)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            self.logger.debug(f'Failed to save vocab index {index_path}: {e}')
+        return token2id
+
     def indexes_containing_token(self, token: str):
         """Return all the possible indexes, whose decoding output may contain
         the input token."""
-        # traversing vocab is time consuming, can not be accelerated with
-        # multi threads (computation) or multi process (can't pickle tokenizer)
-        # so, we maintain latest 10 stop words and return directly if matched
-        for _token, _indexes in self._indexes_tokens_deque:
-            if token == _token:
-                return _indexes
+        if token in self._indexes_tokens_cache:
+            self._indexes_tokens_cache.move_to_end(token)
+            return self._indexes_tokens_cache[token]
 
+        query = token
         if self.token2id == {}:
-            # decode is slower than convert_ids_to_tokens
-            if self.maybe_decode_bytes:
-                for i in range(self.vocab_size):
-                    try:
-                        self.token2id[self.model.decode(i)] = i
-                    except:  # noqa: E722
-                        # some tokens just can't be decoded by `decode`
-                        pass
-            else:
-                self.token2id = {self.model.convert_ids_to_tokens(i): i for i in range(self.vocab_size)}
+            self.token2id = self._build_token2id()
         if token == ' ':  # ' ' is special
             token = '▁'
         indexes = [i for _token, i in self.token2id.items() if token in _token]
@@ -179,9 +223,11 @@ class HuggingFaceTokenizer:
             indexes = self.encode(token, False)
             if len(indexes) != 1:
                 self.logger.warning(f'The token {token}, its length of indexes {indexes} is '
-                                    'not 1. Currently, it can not be used as stop words')
+                                    'not 1. It can only be used as a stop sequence')
                 indexes = []
-        self._indexes_tokens_deque.append((token, indexes))
+        self._indexes_tokens_cache[query] = indexes
+        if len(self._indexes_tokens_cache) > self._indexes_tokens_cache_size:
+            self._indexes_tokens_cache.popitem(last=False)
         return indexes
 
     def encode(self, s: str, add_bos: bool = True, add_special_tokens: bool = True, **kwargs):
@@ -203,6 +249,29 @@ class HuggingFaceTokenizer:
                 encoded = encoded[1:]
         return encoded
 
+    def batch_encode(self, s: Sequence[str], add_bos: bool = True, add_special_tokens: bool = True, **kwargs):
+        """Tokenize a batch of prompts.
+
+        Args:
+            s (List[str]): prompts
+            add_bos (bool): Whether to add `bos` token id when encoding
+                the prompts
+            add_special_tokens (bool): Whether or not to add special tokens
+                when encoding the prompts
+        Returns:
+            list[list[int]]: token ids of the prompts
+        """
+        if not getattr(self.model, 'is_fast', False):
+            return [self.encode(prompt, add_bos, add_special_tokens, **kwargs) for prompt in s]
+        # fast tokenizers encode the batch in parallel without the GIL
+        batch_encoded = self.model(list(s), add_special_tokens=add_special_tokens, **kwargs)['input_ids']
+        if not add_bos:
+            batch_encoded = [
+                encoded[1:] if len(encoded) and encoded[0] == self.bos_token_id else encoded
+                for encoded in batch_encoded
+            ]
+        return batch_encoded
+
     def decode(self, t: Sequence[int], offset: Optional[int] = None, skip_special_tokens: bool = True):
         """De-tokenize.
 
@@ -224,6 +293,31 @@ class HuggingFaceTokenizer:
             out_string = self._maybe_add_prefix_space(t, out_string)
         return out_string
 
+    @property
+    def id_to_token(self) -> List[str]:
+        """token strings of all the ids, built once."""
+        if self._id_to_token is None:
+            tokenizer = self.model
+            self._id_to_token = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+            self._special_ids = set(tokenizer.all_special_ids)
+        return self._id_to_token
+
+    def _convert_ids_to_tokens(self, ids: Sequence[int], skip_special_tokens: bool):
+        """convert ids to tokens with the cached token strings."""
+        id_to_token = self.id_to_token
+        num_tokens = len(id_to_token)
+        special_ids = self._special_ids
+        tokens = []
+        for i in ids:
+            i = int(i)
+            if skip_special_tokens and i in special_ids:
+                continue
+            if 0 <= i < num_tokens:
+                tokens.append(id_to_token[i])
+            else:
+                tokens.append(self.model.convert_ids_to_tokens(i))
+        return tokens
+
     @staticmethod
     def _convert_tokens_to_string_with_added_encoders(
         tokenizer,
@@ -282,21 +376,19 @@ class HuggingFaceTokenizer:
         """
         tokenizer = self.model
         ids_offset, prev_tokens, prefix_offset, read_offset = state.as_tuple()
+        new_tokens = self._convert_ids_to_tokens(all_input_ids[ids_offset:], skip_special_tokens=skip_special_tokens)
         # This is the first iteration for this sequence
-        new_tokens = tokenizer.convert_ids_to_tokens(all_input_ids[ids_offset:],
-                                                     skip_special_tokens=skip_special_tokens)
         if prev_tokens is None:
             # Please notice that in VLLM, indexes are detokenized one by one
             # while in LMDeploy, every turn, the detokenized indexes length
             # can be different.
-            prev_tokens = tokenizer.convert_ids_to_tokens(all_input_ids[:ids_offset],
-                                                          skip_special_tokens=skip_special_tokens)
+            # Only the tail of the prompt is required as the context.
+            start = max(ids_offset - INITIAL_DETOKENIZE_OFFSET, 0)
+            prev_tokens = self._convert_ids_to_tokens(all_input_ids[start:ids_offset],
+                                                      skip_special_tokens=skip_special_tokens)
             read_offset = len(prev_tokens)
-            if skip_special_tokens and new_tokens and new_tokens[0] in tokenizer.all_special_ids:
-                read_offset = read_offset + 1  # skip special token
 
         output_tokens = prev_tokens + new_tokens
-        prev_tokens += new_tokens
         prefix_text = self._convert_tokens_to_string_with_added_encoders(
             tokenizer,
             output_tokens[prefix_offset:read_offset],
@@ -322,7 +414,40 @@ class HuggingFaceTokenizer:
         else:
             new_text = ''
 
-        return new_text, DetokenizeState(len(all_input_ids), prev_tokens, prefix_offset, read_offset)
+        # tokens before prefix offset would never be read again
+        output_tokens = output_tokens[prefix_offset:]
+        read_offset -= prefix_offset
+        return new_text, DetokenizeState(len(all_input_ids), output_tokens, 0, read_offset)
+
+    def batch_detokenize_incrementally(self,
+                                       all_input_ids: Sequence[Sequence[int]],
+                                       states: Sequence[DetokenizeState],
+                                       skip_special_tokens: bool = True,
+                                       spaces_between_special_tokens: bool = True):
+        """Incrementally detokenize the input indexes of multiple sequences.
+
+        Args:
+            all_input_ids (List[List[int]]): token ids of the sequences.
+            states (List[DetokenizeState]): decoding states of the sequences.
+            skip_special_tokens (bool): Whether or not to remove special tokens
+                in the decoding. Default to be True.
+            spaces_between_special_tokens (bool): Whether or not to add spaces
+                between special tokens. Default to be True.
+        Returns:
+            List[str]: decoding output strings of the current round.
+            List[DetokenizeState]: new decoding states of the sequences.
+        """
+        assert len(all_input_ids) == len(states)
+        texts = []
+        new_states = []
+        for input_ids, state in zip(all_input_ids, states):
+            text, state = self.detokenize_incrementally(input_ids,
+                                                        state,
+                                                        skip_special_tokens=skip_special_tokens,
+                                                        spaces_between_special_tokens=spaces_between_special_tokens)
+            texts.append(text)
+            new_states.append(state)
+        return texts, new_states
 
     def __call__(self, s: Union[str, Sequence[str]]):
         """Tokenize prompts.
@@ -357,6 +482,10 @@ class ChatGLM4Tokenizer(HuggingFaceTokenizer):
         # a prompt. Refer to https://huggingface.co/THUDM/glm-4-9b-chat/blob/main/tokenization_chatglm.py#L227 # noqa E501
         return super(ChatGLM4Tokenizer, self).encode(s, add_bos, add_special_tokens=False, **kwargs)
 
+    def batch_encode(self, s: Sequence[str], add_bos: bool = True, add_special_tokens: bool = True, **kwargs):
+        """tokenize a batch of prompts."""
+        return super(ChatGLM4Tokenizer, self).batch_encode(s, add_bos, add_special_tokens=False, **kwargs)
+
 
 class ChatGLMTokenizer(HuggingFaceTokenizer):
     """tokenizer of GLM2."""
@@ -428,6 +557,29 @@ class Tokenizer:
             encoded = encoded[1:]
         return encoded
 
+    def batch_encode(self, s: Sequence[str], add_bos: bool = True, add_special_tokens: bool = True, **kwargs):
+        """Tokenize a batch of prompts.
+
+        Args:
+            s (List[str]): prompts
+            add_bos (bool): Whether to add `bos` token id when encoding
+                the prompts
+            add_special_tokens (bool): Whether or not to add special tokens
+                when encoding the prompts
+        Returns:
+            list[list[int]]: token ids of the prompts
+        """
+        batch_encoded = self.model.batch_encode(s, add_bos, add_special_tokens, **kwargs)
+        outputs = []
+        for encoded in batch_encoded:
+            if encoded[:2] == [self.bos_token_id] * 2:
+                self.logger.warning(f'Detected duplicate bos token {self.bos_token_id} in prompt, '
+                                    'this will likely reduce response quality, one of them will be'
+                                    'removed')
+                encoded = encoded[1:]
+            outputs.append(encoded)
+        return outputs
+
     def decode(
         self,
         t: Sequence[int],
@@ -473,6 +625,29 @@ class Tokenizer:
                                                    skip_special_tokens=skip_special_tokens,
                                                    spaces_between_special_tokens=spaces_between_special_tokens)
 
+    def batch_detokenize_incrementally(self,
+                                       all_input_ids: Sequence[Sequence[int]],
+                                       states: Sequence[DetokenizeState],
+                                       skip_special_tokens: bool = True,
+                                       spaces_between_special_tokens: bool = True):
+        """Incrementally detokenize the input indexes of multiple sequences.
+
+        Args:
+            all_input_ids (List[List[int]]): token ids of the sequences.
+            states (List[DetokenizeState]): decoding states of the sequences.
+            skip_special_tokens (bool): Whether or not to remove special tokens
+                in the decoding. Default to be True.
+            spaces_between_special_tokens (bool): Whether or not to add spaces
+                between special tokens. Default to be True.
+        Returns:
+            List[str]: decoding output strings of the current round.
+            List[DetokenizeState]: new decoding states of the sequences.
+        """
+        return self.model.batch_detokenize_incrementally(all_input_ids,
+                                                         states,
+                                                         skip_special_tokens=skip_special_tokens,
+                                                         spaces_between_special_tokens=spaces_between_special_tokens)
+
     def __call__(self, s: Union[str, Sequence[str]]):
         """Tokenize prompts.
 
@@ -489,6 +664,6 @@ class Tokenizer:
         encoded = self.encode(token, add_bos=False)
         if len(encoded) > 1:
             self.logger.warning(f'The token {token}, its length of indexes {encoded} is over '
-                                'than 1. Currently, it can not be used as stop words')
+                                'than 1. It can only be used as a stop sequence')
             return []
         return self.model.indexes_containing_token(token)
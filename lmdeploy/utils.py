@@ -322,7 +322,7 @@ def get_max_batch_size(device_type: str):
     Args:
         device_type (str): the type of device
     """
-    assert device_type in ['cuda', 'ascend', 'maca', 'camb']
+    assert device_type in ['cuda', 'ascend', 'maca', 'camb', 'cpu']
     if device_type == 'cuda':
         max_batch_size_map = {'a100': 256, 'a800': 256, 'h100': 512, 'h800': 512}
         import torch
@@ -339,6 +339,8 @@ def get_max_batch_size(device_type: str):
         return 256
     elif device_type == 'camb':
         return 128
+    elif device_type == 'cpu':
+        return 16
 
 
 def is_bf16_supported(device_type: str = 'cuda'):
@@ -376,5 +378,7 @@ def is_bf16_supported(device_type: str = 'cuda'):
         return True
     elif device_type == 'camb':
         return True
+    elif device_type == 'cpu':
+        return True
     else:
         return False
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+
+def _make_seq(seq_id, token_ids):
+    token_ids = np.array(token_ids)
+    return SimpleNamespace(seq_id=seq_id, all_ids=token_ids, num_all_ids=len(token_ids))
+
+
+def _to_mask(token_ids, vocab_size):
+    mask = torch.zeros(vocab_size, dtype=torch.bool)
+    mask[token_ids] = True
+    return mask
+
+
+class TestBatchState:
+
+    def test_get_slots(self):
+        from lmdeploy.pytorch.engine.batch_state import BatchState
+        vocab_size = 10
+        state = BatchState(2, vocab_size, device='cpu')
+        seq0 = _make_seq(0, [1, 2, 3])
+        seq1 = _make_seq(1, [4, 4, 12])
+        slots = state.get_slots([seq0, seq1])
+        seen_tokens = state.get_seen_tokens(slots)
+        torch.testing.assert_close(seen_tokens[0], _to_mask([1, 2, 3], vocab_size))
+        torch.testing.assert_close(seen_tokens[1], _to_mask([4], vocab_size))
+
+        # sampled tokens are marked on device
+        state.append(slots, torch.tensor([5, -1]))
+        seen_tokens = state.get_seen_tokens(slots)
+        torch.testing.assert_close(seen_tokens[0], _to_mask([1, 2, 3, 5], vocab_size))
+        torch.testing.assert_close(seen_tokens[1], _to_mask([4], vocab_size))
+
+        # new host tokens are synced incrementally
+        seq1.all_ids = np.array([4, 4, 12, 6, 7])
+        seq1.num_all_ids = 5
+        slots = state.get_slots([seq1])
+        torch.testing.assert_close(state.get_seen_tokens(slots)[0], _to_mask([4, 6, 7], vocab_size))
+
+    def test_evict(self):
+        from lmdeploy.pytorch.engine.batch_state import BatchState
+        vocab_size = 10
+        state = BatchState(2, vocab_size, device='cpu')
+        seq0 = _make_seq(0, [1])
+        seq1 = _make_seq(1, [2])
+        seq2 = _make_seq(2, [3])
+        state.get_slots([seq0, seq1])
+        state.get_slots([seq1])
+
+        # seq0 is the least recently used
+        slots = state.get_slots([seq1, seq2])
+        assert 0 not in state.slots
+        torch.testing.assert_close(state.get_seen_tokens(slots)[1], _to_mask([3], vocab_size))
+
+        # released slot is reused and cleared
+        state.release(1)
+        slots = state.get_slots([seq0, seq2])
+        seen_tokens = state.get_seen_tokens(slots)
+        torch.testing.assert_close(seen_tokens[0], _to_mask([1], vocab_size))
+        torch.testing.assert_close(seen_tokens[1], _to_mask([3], vocab_size))
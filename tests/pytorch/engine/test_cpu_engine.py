@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    from tokenizers import Tokenizer, models
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+    model_path = str(tmp_path_factory.mktemp('tiny_llama'))
+    vocab = dict((f'<t{idx}>', idx) for idx in range(128))
+    vocab.update({'<unk>': 0, '<s>': 1, '</s>': 2})
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel(vocab, unk_token='<unk>')),
+                                        unk_token='<unk>',
+                                        bos_token='<s>',
+                                        eos_token='</s>')
+    tokenizer.save_pretrained(model_path)
+    config = LlamaConfig(vocab_size=128,
+                         hidden_size=64,
+                         intermediate_size=128,
+                         num_hidden_layers=2,
+                         num_attention_heads=4,
+                         num_key_value_heads=2,
+                         max_position_embeddings=256,
+                         bos_token_id=1,
+                         eos_token_id=2)
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(config).eval()
+    model.save_pretrained(model_path)
+    yield model_path
+
+
+def test_greedy(model_path):
+    from transformers import LlamaForCausalLM
+
+    from lmdeploy.messages import GenerationConfig, PytorchEngineConfig
+    from lmdeploy.pytorch.engine import Engine
+    from lmdeploy.tokenizer import Tokenizer
+    prompts = [[1, 5, 9, 17, 33, 65], [1, 100, 7, 3]]
+    max_new_tokens = 8
+
+    model = LlamaForCausalLM.from_pretrained(model_path).eval()
+    expected = []
+    for prompt in prompts:
+        output = model.generate(torch.tensor([prompt]),
+                                max_new_tokens=max_new_tokens,
+                                min_new_tokens=max_new_tokens,
+                                do_sample=False)
+        expected.append(output[0, len(prompt):].tolist())
+
+    engine_config = PytorchEngineConfig(device_type='cpu',
+                                        dtype='float32',
+                                        session_len=256,
+                                        max_batch_size=4,
+                                        block_size=16,
+                                        num_gpu_blocks=32,
+                                        num_cpu_blocks=8)
+    engine = Engine.from_pretrained(model_path, tokenizer=Tokenizer(model_path), engine_config=engine_config)
+    instance = engine.create_instance()
+    gen_config = GenerationConfig(max_new_tokens=max_new_tokens, ignore_eos=True, top_k=1)
+    outputs = []
+    for session_id, prompt in enumerate(prompts):
+        output = instance.infer(session_id, prompt, gen_config=gen_config)
+        outputs.append(output.token_ids)
+        instance.end(session_id)
+    assert outputs == expected
@@ -50,7 +50,7 @@ def test_process_bad_words():
 
 
 def test_processrepetition_penalty():
-    from lmdeploy.pytorch.engine.logits_process import _process_repetition_penalty_
+    from lmdeploy.pytorch.engine.logits_process import _get_seen_tokens, _process_repetition_penalty_
     batch_size = 4
     num_tokens = 16
     scores = torch.rand(batch_size, num_tokens)
@@ -68,7 +68,8 @@ def test_processrepetition_penalty():
         gt.append(warper(ids[None], score[None].clone()))
     gt = torch.cat(gt)
 
-    out = _process_repetition_penalty_(scores, input_ids, penalties)
+    seen_tokens = _get_seen_tokens(input_ids, num_tokens)
+    out = _process_repetition_penalty_(scores, seen_tokens, penalties)
     torch.testing.assert_close(out, gt)
 
 
@@ -124,3 +125,75 @@ def test_filter_minp_sorted():
 
     out = _filter_minp_sorted_(scores, min_p)
     torch.testing.assert_close(out, gt)
+
+
+def test_bitmask():
+    from lmdeploy.pytorch.engine.logits_process import pack_bitmask, unpack_bitmask
+
+    vocab_size = 21
+    token_ids = [0, 3, 8, 20, 30]
+    bitmask = pack_bitmask(token_ids, vocab_size)
+    assert bitmask.numel() == 3
+    mask = unpack_bitmask(bitmask[None], vocab_size)[0]
+    assert mask.size(0) == vocab_size
+    assert mask.nonzero()[:, 0].tolist() == [0, 3, 8, 20]
+
+
+class _ToyGuide:
+    """allow token `state + 1` only."""
+
+    def __init__(self):
+        self.num_steps = 0
+
+    def get_next_state(self, state, token_ids):
+        self.num_steps += len(token_ids)
+        return state + len(token_ids)
+
+    def get_bitmask(self, state, vocab_size, device='cpu'):
+        from lmdeploy.pytorch.engine.logits_process import pack_bitmask
+        return pack_bitmask([state + 1], vocab_size).to(device)
+
+
+def test_guided_decoding(monkeypatch):
+    import numpy as np
+
+    from lmdeploy.pytorch.engine import logits_process
+    from lmdeploy.pytorch.engine.logits_process import GuidedDecoding
+    from lmdeploy.pytorch.messages import SamplingParam, SchedulerSession
+
+    guide = _ToyGuide()
+    monkeypatch.setattr(logits_process, '_get_guided_processor', lambda response_format, tokenizer: guide
+                        if response_format else None)
+
+    session = SchedulerSession(0, block_size=16)
+    guided_param = SamplingParam(response_format=dict(type='regex_schema'))
+    seq0 = session.add_sequence(np.array([1, 2, 3]), sampling_param=guided_param)
+    seq1 = session.add_sequence(np.array([1, 2, 3]))
+    seqs = [seq0, seq1]
+    vocab_size = 8
+
+    guided_decoding = GuidedDecoding.from_sequences(seqs, None)
+    scores = guided_decoding(torch.zeros(2, vocab_size))
+    assert scores[0].isfinite().nonzero()[:, 0].tolist() == [1]
+    assert scores[1].isfinite().all()
+
+    # advanced in decoding loop
+    guided_decoding.update(torch.tensor([1, 5]))
+    scores = guided_decoding(torch.zeros(2, vocab_size))
+    assert scores[0].isfinite().nonzero()[:, 0].tolist() == [2]
+    assert seq0.guided_state == 1 and seq0.num_guided_tokens == 1
+
+    # tokens are committed, states are not replayed
+    for token in [1, 2]:
+        seq0.update_token_ids(np.array([token]))
+        seq0.num_new_tokens += 1
+    num_steps = guide.num_steps
+    guided_decoding = GuidedDecoding.from_sequences(seqs, None)
+    assert guide.num_steps == num_steps + 1
+    assert guided_decoding.states == [2, 0]
+
+    # draft positions
+    repeated = guided_decoding.repeat_with_drafts(torch.tensor([[3, -1], [0, 0]]))
+    assert repeated.states == [2, 3, 3, 0, 0, 0]
+
+    assert GuidedDecoding.from_sequences([seq1], None) is None
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+
+class TestAdapterManager:
+
+    @pytest.fixture
+    def manager(self):
+        from lmdeploy.pytorch.adapter.adapter import AdapterManager
+        yield AdapterManager(dict(b='/path/b', a='/path/a', c='/path/c'), num_slots=2)
+
+    def test_startup(self, manager):
+        # sorted names take ids from 1, the first adapters are resident
+        assert manager.adapter_id_map == {None: 0, 'a': 1, 'b': 2, 'c': 3}
+        assert manager.is_resident('a') and manager.is_resident('b')
+        assert not manager.is_resident('c')
+        assert manager.get_adapter_ids([None, 'b', 'a']) == [0, 2, 1]
+        assert manager.pop_slot_loads() == dict()
+
+    def test_lru(self, manager):
+        assert manager.acquire('a')
+        # b is the least recently used
+        assert manager.acquire('c')
+        assert not manager.is_resident('b')
+        assert manager.get_adapter_ids(['c']) == [2]
+        assert manager.pop_slot_loads() == {2: 3}
+
+        # adapters of the running sequences are not evicted
+        assert not manager.acquire('b', pinned={'a', 'c'})
+        assert manager.acquire('b', pinned={'c'})
+        assert manager.get_adapter_ids(['b', 'c']) == [1, 2]
+        assert manager.pop_slot_loads() == {1: 2}
+
+    def test_add_remove(self, manager):
+        adapter_id = manager.add_adapter('d', '/path/d')
+        assert adapter_id == 4
+        with pytest.raises(ValueError):
+            manager.add_adapter('d', '/path/d')
+
+        assert manager.acquire('d')
+        assert manager.pop_slot_loads() == {1: 4}
+        assert manager.remove_adapter('d') == 4
+        assert not manager.has_adapter('d')
+        # the slot is free
+        assert manager.acquire('c', pinned={'b'})
+        assert manager.is_resident('b')
+        assert manager.pop_slot_loads() == {1: 3}
+
+        # a removed name can only be reused by the same weights
+        with pytest.raises(ValueError):
+            manager.add_adapter('d', '/path/e')
+        assert manager.add_adapter('d', '/path/d') == 5
+
+        # names released without reservation can take other weights
+        assert manager.add_adapter('e', '/path/e') == 6
+        manager.remove_adapter('e', reserve_name=False)
+        assert manager.add_adapter('e', '/path/f') == 7
+
+
+class TestLoRA:
+
+    @pytest.fixture
+    def lora(self):
+        from lmdeploy.pytorch.devices import DeviceContext, get_device_manager
+        from lmdeploy.pytorch.nn.linear import LoRA
+        num_slots, max_rank, in_features, out_features = 2, 4, 8, 6
+        self.context = SimpleNamespace(local_adapter_ids=None, q_seqlens=None)
+        ctx_mgr = SimpleNamespace(current_context=lambda: self.context)
+        with get_device_manager().context(DeviceContext(device_type='cpu')):
+            yield LoRA(in_features,
+                       out_features,
+                       ranks=torch.zeros(num_slots + 1, dtype=torch.long),
+                       scalings=torch.ones(num_slots + 1),
+                       lora_a=torch.empty(num_slots * max_rank, in_features),
+                       lora_b=torch.empty(num_slots * max_rank, out_features),
+                       base_slice=slice(0, out_features),
+                       max_rank=max_rank,
+                       ctx_mgr=ctx_mgr,
+                       is_tp=False)
+
+    @staticmethod
+    def _add_adapter(lora, adapter_id, rank, scaling):
+        lora.add_host_adapter(adapter_id, rank, scaling)
+        lora_a = torch.rand(rank, lora.lora_A.size(1))
+        lora_b = torch.rand(lora.lora_B.size(1), rank)
+        lora.weight_loader_A(lora.lora_A, lora_a, adapter_id=adapter_id)
+        lora.weight_loader_B(lora.lora_B, lora_b, adapter_id=adapter_id)
+        return lora_a, lora_b
+
+    def test_paging(self, lora):
+        adapters = {1: (2, 0.5), 2: (4, 2.0), 3: (3, 1.0)}
+        weights = dict((adapter_id, self._add_adapter(lora, adapter_id, *cfg)) for adapter_id, cfg in adapters.items())
+
+        def _check(slots):
+            self.context.local_adapter_ids = torch.tensor([slot for slot, _ in slots])
+            self.context.q_seqlens = torch.tensor([2, 1, 3])
+            x = torch.rand(1, 6, 8)
+            base_output = torch.rand(1, 6, 6)
+            gt = base_output.clone()
+            batch_ids = torch.tensor([0, 0, 1, 2, 2, 2])
+            for idx, (_, adapter_id) in enumerate(slots):
+                if adapter_id == 0:
+                    continue
+                lora_a, lora_b = weights[adapter_id]
+                mask = batch_ids == idx
+                gt[0, mask] += x[0, mask] @ lora_a.t() @ lora_b.t() * adapters[adapter_id][1]
+            torch.testing.assert_close(lora(x, base_output), gt)
+
+        lora.load_slot(1, 2)
+        lora.load_slot(2, 1)
+        _check([(1, 2), (0, 0), (2, 1)])
+
+        # page adapter 3 into slot 1, adapter 1 is kept
+        lora.load_slot(1, 3)
+        _check([(2, 1), (1, 3), (1, 3)])
+
+        lora.remove_host_adapter(3)
+        assert 3 not in lora.host_adapters
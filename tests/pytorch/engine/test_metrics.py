@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import torch
+
+from lmdeploy.pytorch.config import CacheConfig, SchedulerConfig
+from lmdeploy.pytorch.engine.stats import EngineMetrics, Histogram, StepStats
+from lmdeploy.pytorch.paging.scheduler import Scheduler
+from lmdeploy.serve.metrics import render_metrics
+
+
+def test_histogram():
+    hist = Histogram([1, 2, 4])
+    for value in [0.5, 1, 3, 5, 5]:
+        hist.observe(value)
+    assert hist.cumulative_counts() == [2, 2, 3, 5]
+    assert hist.count == 5
+    assert hist.sum == 14.5
+
+
+def test_engine_metrics():
+    cache_config = CacheConfig(max_batches=4, block_size=16, num_cpu_blocks=4, num_gpu_blocks=8)
+    scheduler_config = SchedulerConfig(max_batches=4,
+                                       max_session_len=128,
+                                       max_request_output_len=64,
+                                       eviction_type='recompute')
+    scheduler = Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+    seqs = []
+    for session_id in range(2):
+        session = scheduler.add_session(session_id)
+        seq = session.add_sequence(torch.tensor([0] * 20))
+        scheduler.add_sequence(seq)
+        seqs.append(seq)
+
+    metrics = EngineMetrics()
+    running = scheduler.schedule(is_prefill=True).running
+    metrics.update_scheduled(running, True, 40)
+    assert metrics.queue_time.count == 2
+    assert all(seq.scheduled_time is not None for seq in seqs)
+    metrics.update_outputs(running, [True, True], [1, 1], [False, False])
+    assert metrics.time_to_first_token.count == 2
+    assert metrics.inter_token_latency.count == 0
+    assert all(seq.scheduled_step == 0 and seq.first_token_step == 0 for seq in seqs)
+    metrics.update_scheduled(running, False, 2)
+    metrics.update_outputs(running, [True, False], [2, 1], [True, False])
+    assert metrics.queue_time.count == 2
+    assert metrics.decode_batch_size.count == 1
+    assert metrics.inter_token_latency.count == 1
+    assert metrics.num_generation_tokens == 4
+    assert metrics.num_finished_requests == 1
+    assert metrics.num_forwards == 2
+
+    # gauges are read from the scheduler
+    from lmdeploy.pytorch.engine.engine import Engine
+    engine = SimpleNamespace(metrics=metrics,
+                             scheduler=scheduler,
+                             step_stats=StepStats(),
+                             proposer=None,
+                             model_agent=None)
+    engine_metrics = Engine.get_metrics(engine)
+    assert engine_metrics['gpu_blocks_used'] == 4
+    assert engine_metrics['gpu_blocks_free'] == 4
+    assert engine_metrics['num_requests_running'] == 2
+
+    text = render_metrics(engine_metrics, labels=dict(model_name='test'))
+    assert '# TYPE lmdeploy_time_to_first_token_seconds histogram' in text
+    assert 'lmdeploy_time_to_first_token_seconds_bucket{model_name="test",le="+Inf"} 2' in text
+    assert 'lmdeploy_generation_tokens_total{model_name="test"} 4' in text
+    assert 'lmdeploy_gpu_blocks_used{model_name="test"} 4' in text
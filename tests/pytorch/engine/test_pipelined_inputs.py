@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import torch
+
+
+def _make_inputs(history_lengths, input_ids):
+    from lmdeploy.pytorch.model_inputs import ModelInputs
+    batch_size = len(history_lengths)
+    return ModelInputs(input_ids=torch.tensor([input_ids]),
+                       seq_length=torch.ones(batch_size, dtype=torch.long),
+                       history_lengths=torch.tensor(history_lengths),
+                       block_offsets=torch.zeros(batch_size, 1, dtype=torch.long),
+                       is_decoding=True,
+                       num_ignored_history=torch.zeros(batch_size, dtype=torch.long))
+
+
+def test_patch_pipelined_inputs():
+    from lmdeploy.pytorch.engine.engine import Engine
+    from lmdeploy.pytorch.engine.logits_process import SamplingInputs
+
+    engine = SimpleNamespace(model_config=SimpleNamespace(bos_token_id=0))
+    seqs = [SimpleNamespace(seq_id=seq_id) for seq_id in range(4)]
+    # seq 3 is stopped, seq 1 is new in the next step
+    last_decoding = dict(running=[seqs[3], seqs[0], seqs[2]],
+                         next_token_ids=torch.tensor([30, 10, 20]),
+                         num_appendable_ids=torch.tensor([0, 5, 7]),
+                         num_ignore_eos=torch.tensor([-1, -2, 3]),
+                         model_metas=None)
+    running = [seqs[0], seqs[1], seqs[2]]
+    step_inputs = dict(inputs=_make_inputs([4, 6, 2], [1, 2, 3]),
+                       all_ids=torch.tensor([[0, 8, 1], [5, 6, 2], [0, 0, 3]]),
+                       seen_slots=None,
+                       guided_decoding=None,
+                       stop_matcher=None,
+                       sampling_inputs=SamplingInputs(random_offsets=torch.tensor([4, 6, 2])),
+                       num_appendable_ids=torch.tensor([6, 9, 8]),
+                       num_ignore_eos=torch.tensor([-1, 4, 4]))
+
+    out = Engine._patch_pipelined_inputs(engine, step_inputs, running, last_decoding)
+    inputs = out['inputs']
+    torch.testing.assert_close(inputs.input_ids, torch.tensor([[10, 2, 20]]))
+    torch.testing.assert_close(inputs.history_lengths, torch.tensor([5, 6, 3]))
+    torch.testing.assert_close(out['all_ids'], torch.tensor([[0, 8, 1, 10], [0, 5, 6, 2], [0, 0, 3, 20]]))
+    torch.testing.assert_close(out['sampling_inputs'].random_offsets, torch.tensor([5, 6, 3]))
+    torch.testing.assert_close(out['num_appendable_ids'], torch.tensor([5, 9, 7]))
+    torch.testing.assert_close(out['num_ignore_eos'], torch.tensor([-2, 4, 3]))
+
+
+def test_step_stats():
+    from lmdeploy.pytorch.engine.stats import StepStats
+
+    stats = StepStats()
+    assert stats.mean_host_time == 0
+    stats.update(0.004)
+    stats.update(0.002, pipelined=True)
+    assert stats.num_steps == 2
+    assert stats.num_pipelined_steps == 1
+    assert abs(stats.mean_host_time - 0.003) < 1e-9
+    assert stats.max_host_time == 0.004
+    assert stats.last_host_time == 0.002
+    assert stats.pipelined_ratio == 0.5
+    stats.reset()
+    assert stats.num_steps == 0
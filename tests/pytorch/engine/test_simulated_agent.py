@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+import torch
+
+
+def _make_inputs(token_ids, history_lengths, block_offsets, is_decoding=False):
+    from lmdeploy.pytorch.model_inputs import ModelInputs
+    seq_length = torch.tensor([len(ids) for ids in token_ids])
+    return ModelInputs(input_ids=torch.tensor(sum(token_ids, []))[None],
+                       seq_length=seq_length,
+                       history_lengths=torch.tensor(history_lengths),
+                       block_offsets=torch.tensor(block_offsets),
+                       is_decoding=is_decoding,
+                       num_ignored_history=torch.zeros_like(seq_length))
+
+
+class TestLatencyModel:
+
+    def test_fit(self, tmp_path):
+        from lmdeploy.pytorch.engine.simulated_agent import LatencyModel
+        gt = LatencyModel(prefill_base=0.01,
+                          prefill_per_token=1e-4,
+                          prefill_attention=1e-8,
+                          decode_base=0.02,
+                          decode_per_token=2e-4,
+                          decode_attention=1e-6)
+        samples = []
+        for num_tokens, attention in [(128, 128 * 128), (512, 512 * 512), (1024, 1024 * 1024), (64, 64 * 64 * 4)]:
+            samples.append(dict(is_decoding=False, num_tokens=num_tokens, attention=attention))
+        for num_tokens, attention in [(1, 128), (8, 1024), (32, 4096), (32, 65536)]:
+            samples.append(dict(is_decoding=True, num_tokens=num_tokens, attention=attention))
+        for sample in samples:
+            sample['latency'] = gt.predict(sample['is_decoding'], sample['num_tokens'], sample['attention'])
+
+        model = LatencyModel.fit(samples, free_memory=1 << 30)
+        for sample in samples:
+            assert model.predict(sample['is_decoding'], sample['num_tokens'],
+                                 sample['attention']) == pytest.approx(sample['latency'])
+        assert model.free_memory == 1 << 30
+
+        file_path = str(tmp_path / 'latency.json')
+        model.to_json(file_path)
+        assert LatencyModel.from_json(file_path) == model
+
+    def test_lora_cost(self):
+        from lmdeploy.pytorch.engine.simulated_agent import LatencyModel
+        model = LatencyModel(0, 0, 0, 0, 0, 0, lora_per_adapter=0.01)
+        inputs = _make_inputs([[3], [4], [5]], [4, 4, 4], [[0], [1], [2]], is_decoding=True)
+        assert model.forward_time(inputs) == 0
+        inputs.local_adapter_ids = torch.tensor([1, 0, 1])
+        assert model.forward_time(inputs) == pytest.approx(0.01)
+        inputs.local_adapter_ids = torch.tensor([1, 2, 3])
+        assert model.forward_time(inputs) == pytest.approx(0.03)
+
+
+class TestSimulatedModelAgent:
+
+    @pytest.fixture
+    def agent(self):
+        from lmdeploy.pytorch.config import CacheConfig, ModelConfig
+        from lmdeploy.pytorch.devices import DeviceContext, get_device_manager
+        from lmdeploy.pytorch.engine.simulated_agent import LatencyModel, SimulatedModelAgent
+        model_config = ModelConfig(hidden_size=64,
+                                   num_layers=2,
+                                   num_attention_heads=4,
+                                   num_key_value_heads=4,
+                                   bos_token_id=1,
+                                   eos_token_id=[2],
+                                   head_dim=16,
+                                   vocab_size=100)
+        cache_config = CacheConfig(max_batches=4, block_size=4, num_cpu_blocks=8, num_gpu_blocks=8)
+        latency_model = LatencyModel(0, 0, 0, 0, 0, 0)
+        with get_device_manager().context(DeviceContext(device_type='cpu')):
+            yield SimulatedModelAgent(model_config, cache_config, latency_model=latency_model)
+
+    @staticmethod
+    def _forward(agent, inputs, **kwargs):
+        kwargs.setdefault('swap_in_map', dict())
+        kwargs.setdefault('swap_out_map', dict())
+        output = asyncio.run(agent.async_forward(inputs, **kwargs))
+        logits = agent.get_logits(output['hidden_states'])
+        return logits.argmax(-1)[0]
+
+    def test_forward(self, agent):
+        prompt = list(range(3, 12))
+        out = self._forward(agent, _make_inputs([prompt], [0], [[0, 1, 2]]))
+        assert out.shape == (9, )
+
+        # chunked prefill in other blocks
+        out0 = self._forward(agent, _make_inputs([prompt[:5]], [0], [[5, 3, 4]]))
+        out1 = self._forward(agent, _make_inputs([prompt[5:]], [5], [[5, 3, 4]]))
+        torch.testing.assert_close(torch.cat([out0, out1]), out)
+
+        # decode after the blocks are swapped out and in
+        next_token = out[-1:].tolist()
+        self._forward(agent, _make_inputs([prompt], [0], [[0, 1, 2]]))
+        gt = self._forward(agent, _make_inputs([next_token], [9], [[0, 1, 2]], is_decoding=True))
+        out = self._forward(agent,
+                            _make_inputs([next_token], [9], [[6, 7, 0]], is_decoding=True),
+                            swap_out_map={
+                                0: 0,
+                                1: 1,
+                                2: 2
+                            },
+                            swap_in_map={
+                                0: 6,
+                                1: 7,
+                                2: 0
+                            })
+        torch.testing.assert_close(out, gt)
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+
+def _make_seq(stop_sequences, all_ids, num_new_tokens):
+    return SimpleNamespace(sampling_param=SimpleNamespace(stop_sequences=stop_sequences),
+                           all_ids=np.array(all_ids, dtype=np.int64),
+                           num_all_ids=len(all_ids),
+                           num_new_tokens=num_new_tokens)
+
+
+class TestStopSequenceMatcher:
+
+    def _step_all(self, matcher, token_ids, mask=None):
+        token_ids = torch.tensor(token_ids)
+        if mask is not None:
+            mask = torch.tensor(mask)
+        return matcher.step(token_ids, mask=mask).tolist()
+
+    def test_no_stop_sequences(self):
+        from lmdeploy.pytorch.engine.stop_matcher import StopSequenceMatcher
+        seqs = [_make_seq([], [1, 2], 1)]
+        assert StopSequenceMatcher.from_sequences(seqs, device='cpu') is None
+
+    @pytest.mark.parametrize('tokens,matched_at', [
+        ([5, 6, 7], [2]),
+        ([5, 5, 6, 7], [3]),
+        ([6, 7, 8], [2]),
+        ([5, 6, 9, 7], []),
+    ])
+    def test_overlapping(self, tokens, matched_at):
+        from lmdeploy.pytorch.engine.stop_matcher import StopSequenceMatcher
+        # [6, 7, 8] shares prefix with the suffix of [5, 6, 7]
+        seqs = [_make_seq([[5, 6, 7], [6, 7, 8]], [1], 0)]
+        matcher = StopSequenceMatcher.from_sequences(seqs, device='cpu')
+        matched = [idx for idx, token in enumerate(tokens) if self._step_all(matcher, [token])[0]]
+        assert matched == matched_at
+
+    def test_window(self):
+        from lmdeploy.pytorch.engine.stop_matcher import StopSequenceMatcher
+        # partial match in generated tokens, prompt tokens are not matched
+        seqs = [_make_seq([[5, 6, 7]], [1, 5, 6], 2), _make_seq([[5, 6, 7]], [5, 6], 1)]
+        matcher = StopSequenceMatcher.from_sequences(seqs, device='cpu')
+        assert matcher.window_matched.tolist() == [False, False]
+        assert self._step_all(matcher, [7, 7]) == [True, False]
+
+        # stop sequence ended in the last step
+        seqs = [_make_seq([[5, 6, 7]], [1, 5, 6, 7], 3), _make_seq([[5, 6, 7]], [5, 6, 7], 1)]
+        matcher = StopSequenceMatcher.from_sequences(seqs, device='cpu')
+        assert matcher.window_matched.tolist() == [True, False]
+
+    def test_seq_patterns(self):
+        from lmdeploy.pytorch.engine.stop_matcher import StopSequenceMatcher
+        seqs = [_make_seq([[3, 4]], [1], 0), _make_seq([[4]], [1], 0), _make_seq([], [1], 0)]
+        matcher = StopSequenceMatcher.from_sequences(seqs, device='cpu')
+        assert self._step_all(matcher, [3, 3, 3]) == [False, False, False]
+        assert self._step_all(matcher, [4, 4, 4]) == [True, True, False]
+
+    def test_mask(self):
+        from lmdeploy.pytorch.engine.stop_matcher import StopSequenceMatcher
+        seqs = [_make_seq([[3, 4]], [1], 0), _make_seq([[3, 4]], [1], 0)]
+        matcher = StopSequenceMatcher.from_sequences(seqs, device='cpu')
+        assert self._step_all(matcher, [3, 3], mask=[True, False]) == [False, False]
+        assert self._step_all(matcher, [4, 4]) == [True, False]
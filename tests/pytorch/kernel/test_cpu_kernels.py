@@ -0,0 +1,121 @@
+import pytest
+import torch
+
+from lmdeploy.pytorch.kernels.cpu import (fill_kv_cache, flash_attention_fwd, flatten_kv_cache, multinomial_sampling,
+                                          paged_attention_fwd)
+
+
+def _naive_attention(q, k, v, q_lens, kv_lens, window_size=None):
+    """attention of each sequence, q/k/v are of shape `[S, H, D]`."""
+    group = q.size(1) // k.size(1)
+    outs = []
+    q_start = kv_start = 0
+    for q_len, kv_len in zip(q_lens, kv_lens):
+        q_seq = q[q_start:q_start + q_len].transpose(0, 1)
+        k_seq = k[kv_start:kv_start + kv_len].repeat_interleave(group, 1).transpose(0, 1)
+        v_seq = v[kv_start:kv_start + kv_len].repeat_interleave(group, 1).transpose(0, 1)
+        scores = q_seq @ k_seq.transpose(-1, -2) / q.size(-1)**0.5
+        q_pos = torch.arange(kv_len - q_len, kv_len)[:, None]
+        kv_pos = torch.arange(kv_len)[None]
+        mask = kv_pos <= q_pos
+        if window_size is not None:
+            mask &= kv_pos >= q_pos - window_size
+        scores = scores.masked_fill(~mask, float('-inf'))
+        outs.append((scores.softmax(-1) @ v_seq).transpose(0, 1))
+        q_start += q_len
+        kv_start += kv_len
+    return torch.cat(outs)
+
+
+class TestCpuAttention:
+
+    @pytest.fixture
+    def num_heads(self):
+        yield 4
+
+    @pytest.fixture
+    def num_kv_heads(self):
+        yield 2
+
+    @pytest.fixture
+    def head_dim(self):
+        yield 16
+
+    @pytest.fixture
+    def block_size(self):
+        yield 4
+
+    @pytest.fixture
+    def kv_lens(self):
+        yield [5, 12, 1]
+
+    @pytest.fixture
+    def block_offsets(self, kv_lens, block_size):
+        # shuffled blocks
+        num_blocks = (max(kv_lens) + block_size - 1) // block_size
+        yield torch.randperm(len(kv_lens) * num_blocks).view(len(kv_lens), num_blocks)
+
+    @pytest.fixture
+    def caches(self, block_offsets, block_size, num_kv_heads, head_dim):
+        shape = (block_offsets.numel(), block_size, num_kv_heads, head_dim)
+        yield torch.zeros(shape), torch.zeros(shape)
+
+    @pytest.fixture
+    def kv_states(self, kv_lens, num_kv_heads, head_dim):
+        yield torch.rand(sum(kv_lens), num_kv_heads, head_dim), torch.rand(sum(kv_lens), num_kv_heads, head_dim)
+
+    @pytest.fixture
+    def filled_caches(self, kv_states, caches, kv_lens, block_offsets):
+        k_caches, v_caches = caches
+        kv_seqlens = torch.tensor(kv_lens)
+        fill_kv_cache(*kv_states,
+                      k_caches,
+                      v_caches,
+                      q_start_loc=kv_seqlens.cumsum(0) - kv_seqlens,
+                      q_seq_length=kv_seqlens,
+                      kv_seq_length=kv_seqlens,
+                      max_q_seq_length=max(kv_lens),
+                      block_offsets=block_offsets)
+        yield k_caches, v_caches
+
+    def test_fill_flatten(self, kv_states, filled_caches, kv_lens, block_offsets):
+        k_states, v_states = flatten_kv_cache(*filled_caches, torch.tensor(kv_lens), block_offsets)
+        torch.testing.assert_close(k_states, kv_states[0])
+        torch.testing.assert_close(v_states, kv_states[1])
+
+    @pytest.mark.parametrize('window_size', [None, 3])
+    def test_paged_attention(self, kv_states, filled_caches, kv_lens, block_offsets, num_heads, head_dim, window_size):
+        q = torch.rand(len(kv_lens), num_heads, head_dim)
+        o = torch.empty_like(q)
+        paged_attention_fwd(q, *filled_caches, o, block_offsets, torch.tensor(kv_lens), window_size=window_size)
+        gt = _naive_attention(q, *kv_states, [1] * len(kv_lens), kv_lens, window_size=window_size)
+        torch.testing.assert_close(o, gt)
+
+    @pytest.mark.parametrize('window_size', [None, 3])
+    def test_flash_attention(self, kv_states, kv_lens, num_heads, head_dim, window_size):
+        q_lens = [min(3, kv_len) for kv_len in kv_lens]
+        q = torch.rand(sum(q_lens), num_heads, head_dim)
+        o = torch.empty_like(q)
+        q_seqlens = torch.tensor(q_lens)
+        kv_seqlens = torch.tensor(kv_lens)
+        flash_attention_fwd(q,
+                            *kv_states,
+                            o,
+                            q_start_loc=q_seqlens.cumsum(0) - q_seqlens,
+                            q_seqlens=q_seqlens,
+                            kv_start_loc=kv_seqlens.cumsum(0) - kv_seqlens,
+                            kv_seqlens=kv_seqlens,
+                            window_size=window_size)
+        gt = _naive_attention(q, *kv_states, q_lens, kv_lens, window_size=window_size)
+        torch.testing.assert_close(o, gt)
+
+
+def test_multinomial_sampling():
+    scores = torch.tensor([[0.0, 1.0, 0.0], [0.5, 0.0, 0.5], [0.2, 0.3, 0.5]])
+    seeds = torch.tensor([1, 2, 3])
+    offsets = torch.tensor([0, 0, 7])
+    indices = torch.tensor([[5, 6, 7]]).expand(3, 3)
+    out = multinomial_sampling(scores, seeds, offsets, indices)
+    assert out[0] == 6 and out[1] in (5, 7)
+    # the same seeds and offsets sample the same tokens
+    torch.testing.assert_close(multinomial_sampling(scores, seeds, offsets, indices), out)
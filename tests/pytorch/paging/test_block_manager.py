@@ -196,6 +196,37 @@ class TestDefaultBlockManager:
         success, swap_map = block_mgr.try_swap_out(msg)
         assert not success
 
+    def test_fork(self, block_mgr, block_size, num_gpu_blocks):
+        sess = SchedulerSession(0, block_size)
+
+        token_ids = torch.tensor([1] * (block_size + 1))
+        msg = sess.add_sequence(token_ids)
+        block_mgr.allocate(msg)
+        child = sess.fork_sequence(msg)
+        child.set_step(msg.num_all_ids - 1)
+        block_mgr.fork(msg, child)
+        assert (block_mgr.get_block_table(child) == block_mgr.get_block_table(msg)).all()
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        # copy the shared block on write
+        msg.update_token_ids(torch.tensor([2]))
+        assert block_mgr.get_num_copy_blocks(msg) == 1
+        block_mgr.allocate(msg)
+        parent_table = block_mgr.get_block_table(msg)
+        child_table = block_mgr.get_block_table(child)
+        assert parent_table[0] == child_table[0]
+        assert block_mgr.pop_copy_map() == {int(parent_table[1]): int(child_table[1])}
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks - 3
+
+        # the last owner writes in place
+        assert block_mgr.get_num_copy_blocks(child) == 0
+        block_mgr.allocate(child)
+        assert len(block_mgr.pop_copy_map()) == 0
+
+        block_mgr.free(msg)
+        block_mgr.free(child)
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks
+
 
 class TestWindowBlockManager:
 
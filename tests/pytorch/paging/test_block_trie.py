@@ -1,7 +1,11 @@
+import os
+
 import numpy as np
 import pytest
+import torch
 
 from lmdeploy.pytorch.config import CacheConfig
+from lmdeploy.pytorch.disk_cache import get_disk_cache_dir
 from lmdeploy.pytorch.messages import SchedulerSession
 from lmdeploy.pytorch.paging.block_manager import build_block_manager
 from lmdeploy.pytorch.paging.block_trie import BlockTrie
@@ -112,6 +116,27 @@ class TestBlockTire:
         ref_cnt = allocator.get_ref_count(logical_blocks.get_real_blocks())
         assert np.array_equal(ref_cnt, [4, 3])
 
+    def test_block_hashes(self, block_trie, block_mgr, block_size):
+        sess = SchedulerSession(0, block_size)
+        token_ids = ([1] * block_size + [2] * block_size + [2] * block_size)
+        seq = sess.add_sequence(token_ids)
+        block_hashes = seq.block_hashes
+        assert len(block_hashes) == 3
+        # same tokens with different prefix
+        assert block_hashes[1] != block_hashes[2]
+
+        # incremental update
+        seq.update_token_ids([3] * (block_size + 1))
+        assert len(seq.block_hashes) == 4
+        assert np.array_equal(seq.block_hashes[:3], block_hashes)
+        other = sess.add_sequence(seq.all_ids.copy())
+        assert np.array_equal(other.block_hashes, seq.block_hashes)
+
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        node = seq.logical_blocks.last_shared_node
+        assert node.hash_key == int(seq.block_hashes[-1])
+
     def test_evict(self, block_trie, block_size, num_gpu_blocks):
         block_mgr = block_trie.block_manager
         sess = SchedulerSession(0, block_size)
@@ -133,3 +158,182 @@ class TestBlockTire:
         new_leaf = next(iter(block_trie.leaves))
         assert leaf != new_leaf
         assert block_mgr.get_num_free_gpu_blocks() == 5
+
+
+class TestHostBlockTrie:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks,
+                          enable_prefix_caching=True,
+                          enable_host_prefix_caching=True)
+
+    @pytest.fixture
+    def block_mgr(self, cache_config):
+        yield build_block_manager(cache_config)
+
+    @pytest.fixture
+    def block_trie(self, cache_config, block_mgr):
+        yield BlockTrie(cache_config, block_mgr)
+
+    def test_spill(self, block_trie, block_mgr, block_size, num_gpu_blocks, num_cpu_blocks):
+        sess = SchedulerSession(0, block_size)
+        token_ids = ([1] * block_size + [2] * block_size)
+        token_ids += [3] * (block_size // 2)
+        seq = sess.add_sequence(token_ids)
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        block_mgr.free(seq)
+        seq.set_step(0)
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        # spill to host
+        swap_out_map = dict()
+        num_evicted = block_trie.evict(2, swap_in_map=dict(), swap_out_map=swap_out_map)
+        assert num_evicted == 2
+        assert len(swap_out_map) == 2
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks
+        assert block_mgr.get_num_free_cpu_blocks() == num_cpu_blocks - 2
+        assert block_trie.stats.num_spilled_blocks == 2
+        assert len(block_trie.host_leaves) == 1
+
+        # match host blocks
+        seq = sess.add_sequence(token_ids)
+        block_trie.match(seq)
+        assert len(seq.logical_blocks) == 2
+        assert seq.num_history_ids == block_size * 2
+        assert block_mgr.get_num_cpu_blocks(seq) == 2
+        assert block_trie.stats.num_host_hit_blocks == 2
+
+        # swap in
+        swap_in_map = block_mgr.swap_in_blocks(seq.logical_blocks.get_real_blocks())
+        assert len(swap_in_map) == 2
+        assert block_mgr.get_num_cpu_blocks(seq) == 0
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+        assert block_mgr.get_num_free_cpu_blocks() == num_cpu_blocks
+
+        # host blocks can not be spilled again without swap out map
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        block_mgr.free(seq)
+        seq.set_step(0)
+        num_evicted = block_trie.evict(2)
+        assert num_evicted == 2
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks
+        assert block_mgr.get_num_free_cpu_blocks() == num_cpu_blocks
+
+
+class TestDiskBlockTrie:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks, tmp_path):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks,
+                          enable_prefix_caching=True,
+                          disk_cache_dir=str(tmp_path))
+
+    @pytest.fixture
+    def block_mgr(self, cache_config):
+        yield build_block_manager(cache_config)
+
+    @pytest.fixture
+    def block_trie(self, cache_config, block_mgr):
+        yield BlockTrie(cache_config, block_mgr)
+
+    def test_save_load(self, cache_config, block_trie, block_mgr, block_size, num_gpu_blocks):
+        sess = SchedulerSession(0, block_size)
+        token_ids = ([1] * block_size + [2] * block_size)
+        token_ids += [3] * (block_size // 2)
+        seq = sess.add_sequence(token_ids)
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        block_mgr.free(seq)
+        seq.set_step(0)
+
+        # dropped blocks are saved
+        num_evicted = block_trie.evict(2)
+        assert num_evicted == 2
+        disk_save_map, disk_load_map = block_trie.pop_disk_ops()
+        assert len(disk_save_map) == 2
+        assert len(disk_load_map) == 0
+        assert len(block_trie.disk_index) == 2
+        block_trie.disk_index.flush()
+
+        # pretend the engine has written the blocks
+        for key in disk_save_map:
+            path = os.path.join(cache_config.disk_cache_dir, key[:2], f'{key}.rank0.bin')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+
+        # blocks are loaded by a new trie
+        block_mgr = build_block_manager(cache_config)
+        block_trie = BlockTrie(cache_config, block_mgr)
+        assert len(block_trie.disk_index) == 2
+        seq = sess.add_sequence(token_ids)
+        block_trie.match(seq)
+        assert len(seq.logical_blocks) == 2
+        assert seq.num_history_ids == block_size * 2
+        assert block_trie.stats.num_disk_hit_blocks == 2
+        assert block_mgr.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+        disk_save_map, disk_load_map = block_trie.pop_disk_ops()
+        assert len(disk_save_map) == 0
+        assert set(disk_load_map.keys()) == set(block_trie.disk_index.entries.keys())
+
+        # prewarm
+        cache_config.disk_cache_prewarm_blocks = 2
+        block_mgr = build_block_manager(cache_config)
+        block_trie = BlockTrie(cache_config, block_mgr)
+        assert len(block_trie.disk_load_map) == 2
+        assert len(block_trie.leaves) == 1
+
+    def test_cache_dir(self, tmp_path):
+        model_paths = [tmp_path / 'run1' / 'checkpoint', tmp_path / 'run2' / 'checkpoint']
+        for model_path in model_paths:
+            model_path.mkdir(parents=True)
+            (model_path / 'config.json').write_text('{}')
+
+        def _get_dir(model_path):
+            return get_disk_cache_dir(str(tmp_path / 'cache'),
+                                      str(model_path),
+                                      dtype=torch.float16,
+                                      block_size=16,
+                                      quant_policy=0,
+                                      world_size=1)
+
+        # models sharing a directory name do not share caches
+        assert _get_dir(model_paths[0]) != _get_dir(model_paths[1])
+        assert _get_dir(model_paths[0]) == _get_dir(str(model_paths[0]) + '/')
+
+        # nor do the updated weights
+        cache_dir = _get_dir(model_paths[0])
+        (model_paths[0] / 'config.json').write_text('{"torch_dtype": "float16"}')
+        assert _get_dir(model_paths[0]) != cache_dir
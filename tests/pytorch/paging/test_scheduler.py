@@ -2,7 +2,7 @@ import pytest
 import torch
 
 from lmdeploy.pytorch.config import CacheConfig, SchedulerConfig
-from lmdeploy.pytorch.messages import MessageStatus
+from lmdeploy.pytorch.messages import MessageStatus, SamplingParam
 from lmdeploy.pytorch.paging.scheduler import Scheduler
 
 
@@ -175,3 +175,511 @@ class TestScheduler:
         assert seq1.status == MessageStatus.WAITING
         assert seq2.status == MessageStatus.RUNNING
         assert block_manager.get_num_free_gpu_blocks() == 0
+
+    def test_fork(self, scheduler, block_size, num_gpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+        seq = session.add_sequence(torch.tensor([1] * (block_size + 1)), sampling_param=SamplingParam(n=3))
+        scheduler.add_sequence(seq)
+        scheduler.schedule(is_prefill=True)
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        # children recompute the last prompt token
+        children = scheduler.fork_sequence(seq)
+        assert len(children) == 2
+        assert len(session.sequences) == 3
+        seq.update_token_ids(torch.tensor([2]))
+        for child in children:
+            assert child.status == MessageStatus.RUNNING
+            assert child.num_token_ids == 1
+            assert (child.all_ids == seq.all_ids[:-1]).all()
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        # the shared partial block is copied on write
+        output = scheduler.schedule(is_prefill=False)
+        assert len(output.running) == 3
+        assert len(output.copy_map) == 2
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 4
+
+        scheduler.end_session(0)
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks
+
+
+class TestSwapScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4,
+                              max_session_len=128,
+                              max_request_output_len=64,
+                              eviction_type='swap',
+                              swap_block_cost=1)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+
+    def test_swap(self, scheduler, block_size, num_gpu_blocks, num_cpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+
+        token_ids1 = torch.tensor([0] * block_size)
+        seq1 = session.add_sequence(token_ids1)
+        scheduler.add_sequence(seq1)
+        output = scheduler.schedule(is_prefill=True)
+        assert seq1.status == MessageStatus.RUNNING
+        assert len(output.swap_out_map) == 0
+
+        # seq1: 1 hanging gpu
+        seq1.update_token_ids(torch.tensor([1]))
+        seq1.status = MessageStatus.STOPPED
+        history_len = seq1.history_len
+
+        token_ids2 = torch.tensor([0] * block_size * num_gpu_blocks)
+        seq2 = session.add_sequence(token_ids2)
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+        # seq1: 1 hanging cpu
+        # seq2: 4 running gpu
+        assert seq2.status == MessageStatus.RUNNING
+        assert len(output.swap_out_map) == 1
+        assert len(output.swap_in_map) == 0
+        assert seq1.history_len == history_len
+        assert block_manager.on_device(seq1, 'cpu')
+        assert block_manager.get_num_free_gpu_blocks() == 0
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks - 1
+
+        seq2.status = MessageStatus.ENDED
+        scheduler._remove_sequence(seq2)
+        seq1.status = MessageStatus.WAITING
+        output = scheduler.schedule(is_prefill=True)
+        # seq1: 2 running gpu
+        assert seq1.status == MessageStatus.RUNNING
+        assert len(output.swap_in_map) == 1
+        assert seq1.history_len == history_len
+        assert block_manager.on_device(seq1, 'gpu')
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks
+
+
+class TestSwapPrefixCachingScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks,
+                          enable_prefix_caching=True)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4,
+                              max_session_len=128,
+                              max_request_output_len=64,
+                              eviction_type='swap',
+                              swap_block_cost=1)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+
+    def test_swap(self, scheduler, block_size, num_gpu_blocks, num_cpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+
+        token_ids1 = torch.tensor([1] * (block_size * 2 + 1))
+        seq1 = session.add_sequence(token_ids1)
+        scheduler.add_sequence(seq1)
+        scheduler.schedule(is_prefill=True)
+        seq1.update_token_ids(torch.tensor([1]))
+        scheduler.schedule(is_prefill=False)
+
+        # seq1: 2 blocks shared with the prefix cache, 1 block owned
+        seq1.update_token_ids(torch.tensor([1]))
+        seq1.status = MessageStatus.STOPPED
+        history_len = seq1.history_len
+        block_table = block_manager.get_block_table(seq1)
+        assert block_manager.get_num_swap_out_blocks(seq1) == 1
+
+        token_ids2 = torch.tensor([2] * block_size * 2)
+        seq2 = session.add_sequence(token_ids2)
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+        # seq1: 2 hanging gpu, 1 hanging cpu
+        # seq2: 2 running gpu
+        assert seq2.status == MessageStatus.RUNNING
+        assert len(output.swap_out_map) == 1
+        assert seq1.history_len == history_len
+        assert block_manager.get_num_gpu_blocks(seq1) == 2
+        assert block_manager.get_num_cpu_blocks(seq1) == 1
+        assert (block_manager.get_block_table(seq1)[:2] == block_table[:2]).all()
+        assert block_manager.get_num_free_gpu_blocks() == 0
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks - 1
+
+        seq2.status = MessageStatus.ENDED
+        scheduler._remove_sequence(seq2)
+        seq1.status = MessageStatus.WAITING
+        output = scheduler.schedule(is_prefill=True)
+        # seq1: 3 running gpu
+        assert seq1.status == MessageStatus.RUNNING
+        assert len(output.swap_in_map) == 1
+        assert seq1.history_len == history_len
+        assert block_manager.on_device(seq1, 'gpu')
+        assert block_manager.get_num_cpu_blocks(seq1) == 0
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks
+
+
+class TestCacheAwareScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks,
+                          max_prefill_token_num=block_size * 3,
+                          enable_prefix_caching=True)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4,
+                              max_session_len=128,
+                              max_request_output_len=64,
+                              prefill_policy='cache_aware',
+                              prefill_starvation_time=5.0)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+
+    @pytest.fixture
+    def prefix(self, scheduler, block_size):
+        prefix = [1] * block_size * 2
+        session = scheduler.add_session(0)
+        seq = session.add_sequence(torch.tensor(prefix + [9] * (block_size // 2)))
+        scheduler.add_sequence(seq)
+        scheduler.schedule(is_prefill=True)
+        seq.update_token_ids(torch.tensor([5]))
+        scheduler.schedule(is_prefill=False)
+        scheduler.end_session(0)
+        yield prefix
+
+    def test_prefer_cached(self, scheduler, block_size, prefix):
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([2] * (block_size * 2 + block_size // 2)))
+        scheduler.add_sequence(seq1)
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor(prefix + [3] * (block_size // 2)))
+        scheduler.add_sequence(seq2)
+
+        # seq2 only charges uncached tokens, both can be prefilled.
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2, seq1]
+        assert seq2.num_token_ids == block_size // 2
+
+    def test_starvation(self, scheduler, block_size, prefix):
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([2] * block_size * 3))
+        seq1.arrive_time -= 10
+        scheduler.add_sequence(seq1)
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor(prefix + [3] * (block_size // 2)))
+        scheduler.add_sequence(seq2)
+
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert seq2.status == MessageStatus.WAITING
+
+
+class TestChunkedPrefillScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks,
+                          max_prefill_token_num=block_size * 2)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4,
+                              max_session_len=128,
+                              max_request_output_len=64,
+                              enable_chunked_prefill=True)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+
+    def test_mixed_batch(self, scheduler, block_size):
+        block_manager = scheduler.block_manager
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([1] * block_size))
+        scheduler.add_sequence(seq1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert len(output.prefill_chunks) == 0
+        seq1.update_token_ids(torch.tensor([1]))
+
+        # long prompt is split into chunks and batched with decoding
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor([2] * block_size * 4))
+        scheduler.add_sequence(seq2)
+        budget = block_size * 2 - 1
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1, seq2]
+        assert output.prefill_chunks == {seq2.seq_id: budget}
+        assert len(block_manager.get_block_table(seq2)) == 4
+        assert scheduler.has_prefilling()
+        seq1.update_token_ids(torch.tensor([1]))
+        seq2.set_step(seq2.num_history_ids + budget)
+
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1, seq2]
+        assert output.prefill_chunks == {seq2.seq_id: budget}
+        seq1.update_token_ids(torch.tensor([1]))
+        seq2.set_step(seq2.num_history_ids + budget)
+
+        # last chunk
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1, seq2]
+        assert len(output.prefill_chunks) == 0
+        assert seq2.num_token_ids == block_size * 4 - budget * 2
+        seq1.update_token_ids(torch.tensor([1]))
+        seq2.update_token_ids(torch.tensor([2]))
+        assert not scheduler.has_prefilling()
+
+
+class TestPriorityScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def num_cpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 4
+
+    @pytest.fixture
+    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=num_cpu_blocks,
+                          num_gpu_blocks=num_gpu_blocks)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4, max_session_len=128, max_request_output_len=64)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config)
+
+    def test_order(self, scheduler, block_size):
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([1] * block_size), priority=1)
+        scheduler.add_sequence(seq1)
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor([2] * block_size), priority=0)
+        scheduler.add_sequence(seq2)
+
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2, seq1]
+
+    def test_preempt(self, scheduler, block_size, num_gpu_blocks):
+        block_manager = scheduler.block_manager
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([1] * block_size * 3), priority=1)
+        scheduler.add_sequence(seq1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 3
+
+        # high priority request is blocked on blocks, preempt seq1
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor([2] * block_size * 2), priority=0)
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2]
+        assert seq1.status == MessageStatus.WAITING
+        assert block_manager.get_num_gpu_blocks(seq1) == 0
+
+        stats = scheduler.get_priority_stats()
+        assert stats[0].num_running == 1
+        assert stats[1].num_waiting == 1
+        assert stats[1].num_preempted == 1
+
+        # low priority request never preempts
+        session3 = scheduler.add_session(3)
+        seq3 = session3.add_sequence(torch.tensor([3] * block_size * 3), priority=2)
+        scheduler.add_sequence(seq3)
+        output = scheduler.schedule(is_prefill=True)
+        assert len(output.running) == 0
+        assert seq2.status == MessageStatus.RUNNING
+
+
+class TestAdapterScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size):
+        yield CacheConfig(max_batches=256, block_size=block_size, num_cpu_blocks=4, num_gpu_blocks=8)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=4, max_session_len=128, max_request_output_len=64)
+
+    @pytest.fixture
+    def adapter_manager(self):
+        from lmdeploy.pytorch.adapter.adapter import AdapterManager
+        yield AdapterManager(dict(a='/path/a', b='/path/b'), num_slots=1)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config, adapter_manager):
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config, adapter_manager=adapter_manager)
+
+    def test_defer(self, scheduler, adapter_manager, block_size):
+        session1 = scheduler.add_session(1)
+        seq1 = session1.add_sequence(torch.tensor([1] * block_size), adapter_name='a')
+        scheduler.add_sequence(seq1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert output.adapter_slot_map == dict()
+
+        # the only slot is used by seq1, seq2 waits without blocking seq3
+        session2 = scheduler.add_session(2)
+        seq2 = session2.add_sequence(torch.tensor([2] * block_size), adapter_name='b')
+        scheduler.add_sequence(seq2)
+        session3 = scheduler.add_session(3)
+        seq3 = session3.add_sequence(torch.tensor([3] * block_size))
+        scheduler.add_sequence(seq3)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq3]
+        assert seq2.status == MessageStatus.WAITING
+
+        scheduler.end_session(1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2]
+        assert output.adapter_slot_map == {1: adapter_manager.adapter_id_map['b']}
+
+
+class TestAdapterAwareScheduler:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size):
+        yield CacheConfig(max_batches=256, block_size=block_size, num_cpu_blocks=4, num_gpu_blocks=8)
+
+    @pytest.fixture
+    def scheduler_config(self):
+        yield SchedulerConfig(max_batches=8,
+                              max_session_len=128,
+                              max_request_output_len=64,
+                              max_active_adapters=1,
+                              prefill_policy='adapter_aware',
+                              prefill_starvation_time=5.0)
+
+    @pytest.fixture
+    def scheduler(self, cache_config, scheduler_config):
+        from lmdeploy.pytorch.adapter.adapter import AdapterManager
+        adapter_manager = AdapterManager(dict(a='/path/a', b='/path/b'))
+        yield Scheduler(scheduler_config=scheduler_config, cache_config=cache_config, adapter_manager=adapter_manager)
+
+    @staticmethod
+    def _add_sequence(scheduler, session_id, block_size, adapter_name=None):
+        session = scheduler.add_session(session_id)
+        seq = session.add_sequence(torch.tensor([session_id] * block_size), adapter_name=adapter_name)
+        scheduler.add_sequence(seq)
+        return seq
+
+    def test_share(self, scheduler, block_size):
+        seq_a0 = self._add_sequence(scheduler, 0, block_size, 'a')
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq_a0]
+
+        # adapter a is running, b exceeds max_active_adapters
+        seq_b = self._add_sequence(scheduler, 1, block_size, 'b')
+        seq_a1 = self._add_sequence(scheduler, 2, block_size, 'a')
+        seq_base = self._add_sequence(scheduler, 3, block_size)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq_a1, seq_base]
+        assert seq_b.status == MessageStatus.WAITING
+
+        # starved seq_b stops other adapters until adapter a is released
+        seq_b.arrive_time -= 10
+        seq_a2 = self._add_sequence(scheduler, 4, block_size, 'a')
+        output = scheduler.schedule(is_prefill=True)
+        assert len(output.running) == 0
+
+        scheduler.end_session(0)
+        scheduler.end_session(2)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq_b]
+        assert seq_a2.status == MessageStatus.WAITING
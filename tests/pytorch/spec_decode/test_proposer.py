@@ -0,0 +1,50 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from lmdeploy.pytorch.messages import SchedulerSession
+from lmdeploy.pytorch.spec_decode import NGramProposer
+
+
+class TestNGramProposer:
+
+    @pytest.fixture
+    def proposer(self):
+        yield NGramProposer(num_spec_tokens=3, min_n=1, max_n=3)
+
+    def test_propose_tokens(self, proposer):
+        # suffix [1, 2, 3] matches the start
+        token_ids = np.array([1, 2, 3, 4, 5, 6, 7, 1, 2, 3])
+        np.testing.assert_equal(proposer.propose_tokens(token_ids), [4, 5, 6])
+
+        # larger ngram first, [8, 2] matches [8, 2, 9]
+        token_ids = np.array([2, 5, 8, 2, 9, 0, 8, 2])
+        np.testing.assert_equal(proposer.propose_tokens(token_ids), [9, 0, 8])
+
+        # the latest match is used
+        token_ids = np.array([4, 1, 4, 2, 4])
+        np.testing.assert_equal(proposer.propose_tokens(token_ids), [2, 4])
+
+        # no match
+        token_ids = np.array([1, 2, 3, 4])
+        assert len(proposer.propose_tokens(token_ids)) == 0
+
+        # too short
+        assert len(proposer.propose_tokens(np.array([1]))) == 0
+
+    def test_min_n(self):
+        proposer = NGramProposer(num_spec_tokens=2, min_n=2, max_n=2)
+        token_ids = np.array([3, 1, 2, 3])
+        assert len(proposer.propose_tokens(token_ids)) == 0
+        token_ids = np.array([2, 3, 1, 2, 3])
+        np.testing.assert_equal(proposer.propose_tokens(token_ids), [1, 2])
+
+    def test_propose(self, proposer):
+        session = SchedulerSession(0, block_size=16)
+        seq0 = session.add_sequence(np.array([1, 2, 3, 4, 1, 2]))
+        seq1 = session.add_sequence(np.array([5, 6, 7]))
+        seq1.update_token_ids(np.array([8, 5, 6]))
+        drafts = asyncio.run(proposer.propose([seq0, seq1], None))
+        np.testing.assert_equal(drafts[0], [3, 4, 1])
+        np.testing.assert_equal(drafts[1], [7, 8, 5])
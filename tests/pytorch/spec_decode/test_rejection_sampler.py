@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+
+from lmdeploy.pytorch.spec_decode import SpecDecodeStats, greedy_verify, rejection_sample
+
+
+def test_greedy_verify():
+    draft_token_ids = torch.tensor([
+        [1, 2, 3],
+        [1, 2, 3],
+        [4, 5, -1],
+        [-1, -1, -1],
+    ])
+    target_token_ids = torch.tensor([
+        [1, 2, 3, 9],
+        [1, 7, 3, 9],
+        [4, 5, 6, 9],
+        [8, 7, 6, 5],
+    ])
+    output, num_accepted = greedy_verify(draft_token_ids, target_token_ids)
+    torch.testing.assert_close(num_accepted, torch.tensor([3, 1, 2, 0]))
+    torch.testing.assert_close(output, torch.tensor([
+        [1, 2, 3, 9],
+        [1, 7, -1, -1],
+        [4, 5, 6, -1],
+        [8, -1, -1, -1],
+    ]))
+
+
+def test_rejection_sample_onehot():
+    """one-hot target behaves like greedy verification."""
+    draft_token_ids = torch.tensor([[1, 2, 3], [1, 2, -1]])
+    target_token_ids = torch.tensor([[1, 2, 0, 3], [1, 2, 3, 0]])
+    target_probs = torch.nn.functional.one_hot(target_token_ids, 4).float()
+    output, num_accepted = rejection_sample(draft_token_ids, target_probs)
+    torch.testing.assert_close(num_accepted, torch.tensor([2, 2]))
+    torch.testing.assert_close(output, torch.tensor([[1, 2, 0, -1], [1, 2, 3, -1]]))
+
+
+def _toy_model(vocab_size: int, temperature: float, seed: int):
+    """toy bigram language model."""
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(vocab_size, vocab_size, generator=generator)
+    return (logits / temperature).softmax(-1)
+
+
+def test_rejection_sample_distribution():
+    """tokens sampled with a draft model follow the target distribution."""
+    vocab_size = 8
+    num_spec_tokens = 2
+    batch_size = 50000
+    target_model = _toy_model(vocab_size, 1.0, 0)
+    draft_model = _toy_model(vocab_size, 2.0, 1)
+    generator = torch.Generator().manual_seed(2)
+    prompt = 3
+
+    # propose with the draft model
+    draft_token_ids = []
+    draft_probs = []
+    last_ids = torch.full((batch_size, ), prompt)
+    for _ in range(num_spec_tokens):
+        probs = draft_model[last_ids]
+        last_ids = torch.multinomial(probs, 1, generator=generator)[:, 0]
+        draft_probs.append(probs)
+        draft_token_ids.append(last_ids)
+    draft_token_ids = torch.stack(draft_token_ids, 1)
+    draft_probs = torch.stack(draft_probs, 1)
+
+    # verify with the target model
+    context = torch.cat([torch.full((batch_size, 1), prompt), draft_token_ids], 1)
+    target_probs = target_model[context]
+    output, num_accepted = rejection_sample(draft_token_ids, target_probs, draft_probs, generator=generator)
+
+    assert ((output >= 0).sum(1) == num_accepted + 1).all()
+    first_token = output[:, 0]
+    freq = torch.bincount(first_token, minlength=vocab_size).float() / batch_size
+    torch.testing.assert_close(freq, target_model[prompt], atol=0.01, rtol=0)
+
+    # second token conditioned on the first one
+    mask = output[:, 1] >= 0
+    for token in range(vocab_size):
+        token_mask = mask & (first_token == token)
+        if token_mask.sum() < 5000:
+            continue
+        freq = torch.bincount(output[token_mask, 1], minlength=vocab_size).float() / token_mask.sum()
+        torch.testing.assert_close(freq, target_model[token], atol=0.02, rtol=0)
+
+
+def test_rejection_sample_same_model():
+    """all draft tokens are accepted if draft model equals target model."""
+    vocab_size = 8
+    target_model = _toy_model(vocab_size, 1.0, 0)
+    draft_token_ids = torch.tensor([[1, 2], [3, 4]])
+    context = torch.tensor([[0, 1, 2], [5, 3, 4]])
+    target_probs = target_model[context]
+    draft_probs = target_probs[:, :2]
+    output, num_accepted = rejection_sample(draft_token_ids, target_probs, draft_probs)
+    torch.testing.assert_close(num_accepted, torch.tensor([2, 2]))
+    torch.testing.assert_close(output[:, :2], draft_token_ids)
+
+
+def test_stats():
+    stats = SpecDecodeStats()
+    stats.update(np.array([3, 3]), np.array([3, 1]), np.array([4, 2]))
+    stats.update(np.array([2]), np.array([0]), np.array([1]))
+    assert stats.num_steps == 3
+    assert stats.acceptance_rate == 0.5
+    assert stats.mean_emitted_tokens == 7 / 3
+    stats.reset()
+    assert stats.acceptance_rate == 0.0
@@ -0,0 +1,46 @@
+import pytest
+
+from lmdeploy.profiler import SLO, Profiler, Session
+
+
+def _make_session(profiler: Profiler, ts, ns, req_output_len, status=Session.SUCCESS):
+    sess = profiler.new_session(8, req_output_len)
+    sess.ts = list(ts)
+    sess.ns = list(ns)
+    sess.finish(status)
+    return sess
+
+
+def test_slo_meet():
+    profiler = Profiler(True, [50, 99])
+    sess = _make_session(profiler, [0.0, 0.5, 1.5], [0, 1, 11], 11)
+    assert sess.ttft == pytest.approx(0.5)
+    assert sess.tpot == pytest.approx(0.1)
+    assert sess.e2e == pytest.approx(1.5)
+    assert SLO().meet(sess)
+    assert SLO(ttft=0.6, tpot=0.11, e2e=2.0).meet(sess)
+    assert not SLO(ttft=0.4).meet(sess)
+    assert not SLO(tpot=0.05).meet(sess)
+
+    # incomplete and failed requests never meet the slo
+    assert not SLO().meet(_make_session(profiler, [0.0, 0.5, 1.5], [0, 1, 5], 11))
+    assert not SLO().meet(_make_session(profiler, [0.0, 0.5, 1.5], [0, 1, 11], 11, Session.FAIL))
+
+
+def test_goodput():
+    profiler = Profiler(True, [50, 99])
+    _make_session(profiler, [0.0, 0.5, 1.5], [0, 1, 11], 11)
+    _make_session(profiler, [0.0, 2.0, 3.0], [0, 1, 11], 11)
+    _make_session(profiler, [0.0, 0.5, 1.5], [0, 1, 11], 11, Session.FAIL)
+    profiler.elapsed_time = 2.0
+    profiler.compute_metrics()
+    profiler.compute_goodput(SLO(ttft=1.0))
+    assert profiler.success == 2
+    assert profiler.goodput == pytest.approx(0.5)
+    assert profiler.goodput_tokens == pytest.approx(5.5)
+    assert profiler.slo_attainment == pytest.approx(1 / 3)
+
+    metrics = profiler.to_dict()
+    assert metrics['goodput'] == pytest.approx(0.5)
+    assert metrics['ttft_p50'] == pytest.approx(1.25)
+    assert {'e2e_p99', 'tpot_mean', 'itl_p99'} <= set(metrics)
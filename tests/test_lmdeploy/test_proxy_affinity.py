@@ -0,0 +1,45 @@
+from lmdeploy.serve.proxy.affinity import PrefixAffinity
+
+URLS = [f'http://127.0.0.1:{23333 + idx}' for idx in range(4)]
+
+
+def _chat(system: str, num_rounds: int, session_id: int = -1):
+    messages = [dict(role='system', content=system)]
+    for idx in range(num_rounds):
+        messages.append(dict(role='user', content=f'question {idx} ' * 8))
+        messages.append(dict(role='assistant', content=f'answer {idx} ' * 8))
+    messages.append(dict(role='user', content=f'question {num_rounds} ' * 8))
+    return dict(messages=messages, session_id=session_id)
+
+
+def _route(affinity: PrefixAffinity, request, unfinished=None):
+    keys, ring_key = affinity.get_keys(request)
+    unfinished = unfinished or [0] * len(URLS)
+    return affinity.route(keys, ring_key, URLS, unfinished, [1.0] * len(URLS))
+
+
+def test_chat_rounds_stick_to_node():
+    affinity = PrefixAffinity(block_size=16)
+    for session in range(8):
+        system = f'{session}: you are a helpful assistant.'
+        url, hit = _route(affinity, _chat(system, 0))
+        assert not hit
+        for num_rounds in range(1, 4):
+            next_url, hit = _route(affinity, _chat(system, num_rounds))
+            assert hit and next_url == url
+
+
+def test_session_id_sticks_to_node():
+    affinity = PrefixAffinity(block_size=16)
+    url, _ = _route(affinity, dict(prompt='hello', session_id=1))
+    next_url, hit = _route(affinity, dict(prompt='a different prompt', session_id=1))
+    assert hit and next_url == url
+
+
+def test_saturated_node_falls_back():
+    affinity = PrefixAffinity(block_size=16)
+    request = _chat('You are a helpful assistant.', 1)
+    url, _ = _route(affinity, request)
+    unfinished = [8 if node_url == url else 0 for node_url in URLS]
+    next_url, hit = _route(affinity, request, unfinished)
+    assert not hit and next_url != url
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from lmdeploy.serve.proxy.health import CircuitBreaker
+from lmdeploy.serve.proxy.proxy import NodeManager, Status
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_time=0.1)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow_request()
+    time.sleep(0.1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN and breaker.allow_request()
+    # a failure in half open state opens the circuit again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.1)
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_node_manager_load_shedding(tmp_path):
+    manager = NodeManager(config_path=str(tmp_path / 'proxy_config.yml'), max_queue_depth=4)
+    for idx in range(2):
+        manager.add(f'http://node{idx}', Status(models=['model']))
+    manager.nodes['http://node0'].num_waiting = 8
+    manager.nodes['http://node0'].num_running = 16
+    assert manager.get_load('http://node0') == 24
+    assert not manager.is_overloaded('model')
+    assert manager.get_node_url('model') == 'http://node1'
+
+    # requests are not dispatched to the nodes with an open circuit
+    for _ in range(3):
+        manager.record_failure('http://node1')
+    assert manager.nodes['http://node1'].circuit == CircuitBreaker.OPEN
+    assert manager.get_node_url('model') == 'http://node0'
+    assert manager.is_overloaded('model')
+
+
+async def _serve_node(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """a node answering the stats at once and holding the other requests."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            if not request_line.split()[1].startswith(b'/engine/stats'):
+                await asyncio.sleep(3600)
+            body = json.dumps(dict(num_waiting=4, num_running=8, num_free_gpu_blocks=16)).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+def test_probe_saturated_node(tmp_path):
+
+    async def _test():
+        server = await asyncio.start_server(_serve_node, '127.0.0.1', 0)
+        node_url = 'http://127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+        manager = NodeManager(config_path=str(tmp_path / 'proxy_config.yml'), max_connections_per_node=2)
+        manager.add(node_url, Status(models=['model']))
+
+        # take all the connections of the requests
+        requests = [asyncio.create_task(manager.get_client(node_url).get('/slow')) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        with pytest.raises(httpx.PoolTimeout):
+            await manager.get_client(node_url).get('/slow', timeout=0.1)
+
+        for _ in range(3):
+            await manager.probe_node(node_url)
+        assert manager.get_breaker(node_url).state == CircuitBreaker.CLOSED
+        assert manager.nodes[node_url].num_waiting == 4
+        assert manager.nodes[node_url].num_running == 8
+
+        for task in requests:
+            task.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        manager.close_client(node_url)
+        server.close()
+
+    asyncio.run(_test())
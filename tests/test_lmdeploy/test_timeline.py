@@ -0,0 +1,46 @@
+import json
+
+from lmdeploy.messages import RequestTimeline
+from lmdeploy.serve.timeline import parse_timelines, reconstruct_steps, summarize
+
+
+def _log_line(session_id, timeline):
+    return f'2024-01-01 00:00:00,000 - lmdeploy - INFO - logger.py:56 - session={session_id}, ' \
+           f'timeline={json.dumps(timeline.to_dict())}\n'
+
+
+def test_request_timeline():
+    timeline = RequestTimeline(request_time=1.0, tokenized_time=1.5, instance_time=2.0)
+    timeline.update(arrive_time=2.0, scheduled_time=3.0, first_token_time=3.5, finish_time=5.0, unknown=0)
+    timeline.end_time = 5.5
+    durations = timeline.durations()
+    assert durations == dict(tokenize=0.5,
+                             instance_queue=0.5,
+                             scheduler_queue=1.0,
+                             prefill=0.5,
+                             decode=1.5,
+                             total=4.5,
+                             detokenize=0.0)
+    # the engine side stages are skipped without the engine timeline
+    durations = RequestTimeline(request_time=1.0, tokenized_time=1.5, end_time=2.0).durations()
+    assert 'prefill' not in durations and durations['total'] == 1.0
+
+
+def test_analyze_timelines():
+    timelines = [
+        RequestTimeline(request_time=0.0, end_time=1.0, scheduled_step=0, first_token_step=0, finish_step=3),
+        RequestTimeline(request_time=0.0, end_time=2.0, scheduled_step=2, first_token_step=3, finish_step=4),
+    ]
+    lines = ['2024-01-01 00:00:00,000 - lmdeploy - INFO - session=1, prompt=\'hi\'\n']
+    lines += [_log_line(idx + 1, timeline) for idx, timeline in enumerate(timelines)]
+    timelines = parse_timelines(lines)
+    assert [t['session_id'] for t in timelines] == [1, 2]
+
+    steps = reconstruct_steps(timelines)
+    assert [step['prefill'] for step in steps] == [[1], [], [2], [2], []]
+    assert [step['decode'] for step in steps] == [[], [1], [1], [1], [2]]
+
+    summary = summarize(timelines)
+    assert summary['total']['count'] == 2
+    assert summary['total']['mean'] == 1.5
+    assert 'prefill' not in summary
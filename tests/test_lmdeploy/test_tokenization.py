@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from lmdeploy.model import MODELS
+from lmdeploy.serve.tokenization import TokenizationService
+from lmdeploy.tokenizer import Tokenizer
+
+
+@pytest.mark.parametrize('model_path,chat_template', [('internlm/internlm2_5-7b-chat', 'internlm2'),
+                                                      ('Qwen/Qwen2-7B-Instruct', 'qwen')])
+def test_tokenization_service(model_path, chat_template):
+    tokenizer = Tokenizer(model_path)
+    chat_template = MODELS.get(chat_template)()
+    messages = [dict(role='system', content='You are a helpful assistant.')]
+    for idx in range(4):
+        messages.append(dict(role='user', content=f'hi, this is the round {idx} 😆😆! 為什麼'))
+        messages.append(dict(role='assistant', content=f'reply of the round {idx}  '))
+    prompts = [chat_template.messages2prompt(messages[:end]) for end in range(2, len(messages) + 1, 2)]
+
+    async def _encode_all(service: TokenizationService):
+        outputs = []
+        for prompt in prompts:
+            outputs.append(await service.encode(prompt))
+        # concurrent prompts are encoded in a batch
+        outputs += await service.batch_encode(prompts, add_bos=False)
+        return outputs
+
+    service = TokenizationService(tokenizer, max_workers=2)
+    outputs = asyncio.run(_encode_all(service))
+    service.close()
+    expected = [tokenizer.encode(prompt) for prompt in prompts]
+    expected += [tokenizer.encode(prompt, add_bos=False) for prompt in prompts]
+    assert outputs == expected
+    assert len(service._prefix_cache) > 0
+
+
+@pytest.fixture
+def bpe_tokenizer(tmp_path):
+    from tokenizers import Tokenizer as BPETokenizer
+    from tokenizers import models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, PreTrainedTokenizerFast
+    special_tokens = ['<s>', '</s>', '<|im_end|>']
+    bpe = BPETokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.Whitespace()
+    trainer = trainers.BpeTrainer(special_tokens=special_tokens, vocab_size=300)
+    bpe.train_from_iterator(['xx foo foobar foobar'] * 16, trainer=trainer)
+    hf_tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe,
+                                           bos_token='<s>',
+                                           eos_token='</s>',
+                                           additional_special_tokens=['<|im_end|>'])
+    hf_tokenizer.save_pretrained(str(tmp_path))
+    LlamaConfig(vocab_size=len(hf_tokenizer), architectures=['LlamaForCausalLM']).save_pretrained(str(tmp_path))
+    yield Tokenizer(str(tmp_path))
+
+
+def test_prefix_continued_mid_word(bpe_tokenizer):
+    tokenizer = bpe_tokenizer
+    prompts = ['xx foo<|im_end|>', 'xx foobar<|im_end|>', 'xx foo<|im_end|>bar']
+
+    async def _encode_all(service: TokenizationService):
+        outputs = [await service.encode(prompts[0])]
+        # wait for the prefix to be cached
+        while len(service._prefix_cache) == 0:
+            await asyncio.sleep(0.01)
+        for prompt in prompts[1:]:
+            outputs.append(await service.encode(prompt))
+        return outputs
+
+    service = TokenizationService(tokenizer, max_workers=1)
+    outputs = asyncio.run(_encode_all(service))
+    service.close()
+    # 'foobar' is one token, the cached ids of 'xx foo' can not be reused
+    assert tokenizer.encode('xx foobar') != tokenizer.encode('xx foo') + tokenizer.encode('bar', add_bos=False)
+    assert outputs == [tokenizer.encode(prompt) for prompt in prompts]
+    assert list(service._prefix_cache)[0][1:] == ('xx foo', '<|im_end|>')
+
+
+def test_batch_error(bpe_tokenizer):
+
+    def _match_prefix(prompt, add_bos):
+        raise RuntimeError('broken cache')
+
+    async def _encode(service: TokenizationService):
+        return await asyncio.wait_for(service.encode('xx foo'), timeout=5)
+
+    service = TokenizationService(bpe_tokenizer, max_workers=1)
+    service._match_prefix = _match_prefix
+    # errors raised before the results are set reach the requests
+    with pytest.raises(RuntimeError, match='broken cache'):
+        asyncio.run(_encode(service))
+    service.close()
+    assert len(service._tasks) == 0
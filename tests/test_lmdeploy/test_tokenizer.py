@@ -32,6 +32,28 @@ def test_tokenizer(model_path, input, interval, add_special_tokens, skip_special
     assert input == output, 'input string should equal to output after enc-dec'
 
 
+@pytest.mark.parametrize('model_path', ['internlm/internlm-chat-7b', 'Qwen/Qwen-7B-Chat', 'codellama/CodeLlama-7b-hf'])
+@pytest.mark.parametrize('skip_special_tokens', [True, False])
+def test_batch_detokenize_incrementally(model_path, skip_special_tokens):
+    tokenizer = Tokenizer(model_path)
+    prompt = tokenizer.encode('a prompt of the test')
+    inputs = [' hi, this is a test 😆😆!', ' 為什麼我還在用繁體字 😆😆       ', 'hello world']
+    encoded = [prompt + tokenizer.encode(text, add_bos=False) for text in inputs]
+    outputs = [''] * len(inputs)
+    states = [DetokenizeState(len(prompt)) for _ in inputs]
+    for i in range(len(prompt), max(len(ids) for ids in encoded)):
+        texts, states = tokenizer.batch_detokenize_incrementally([ids[:i + 1] for ids in encoded],
+                                                                 states,
+                                                                 skip_special_tokens=skip_special_tokens)
+        for idx, text in enumerate(texts):
+            outputs[idx] += text
+    for idx, ids in enumerate(encoded):
+        text, _ = tokenizer.detokenize_incrementally(ids, DetokenizeState(len(prompt)), skip_special_tokens)
+        assert outputs[idx] == text
+    # only a window of tokens is kept
+    assert all(len(state.prev_tokens) < 16 for state in states)
+
+
 @pytest.mark.parametrize('model_path', [
     'internlm/internlm-chat-7b', 'Qwen/Qwen-7B-Chat', 'baichuan-inc/Baichuan2-7B-Chat', 'codellama/CodeLlama-7b-hf',
     'upstage/SOLAR-0-70b-16bit'